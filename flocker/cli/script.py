@@ -4,6 +4,8 @@
 The command-line ``flocker-deploy`` tool.
 """
 
+import sys
+from json import loads
 from subprocess import CalledProcessError
 
 from twisted.internet.defer import DeferredList
@@ -22,7 +24,7 @@ from ..common.script import (flocker_standard_options, ICommandLineScript,
                              FlockerScriptRunner)
 from ..node import (FlockerConfiguration, ConfigurationError,
                     FigConfiguration, applications_to_flocker_yaml,
-                    model_from_configuration)
+                    model_from_configuration, profile_report)
 
 from ..common import ProcessNode, gather_deferreds
 from ._sshconfig import DEFAULT_SSH_DIRECTORY, OpenSSHConfiguration
@@ -46,6 +48,12 @@ class DeployOptions(Options):
 
     """
 
+    optFlags = [
+        ["profile", None,
+         "Once done, report how long each node took and which state changes "
+         "held up the deployment."],
+    ]
+
     synopsis = ("Usage: flocker-deploy [OPTIONS] "
                 "DEPLOYMENT_CONFIGURATION_PATH APPLICATION_CONFIGURATION_PATH"
                 "\n"
@@ -116,6 +124,8 @@ class DeployScript(object):
     """
     A script to start configured deployments on a Flocker cluster.
     """
+    _stdout = sys.stdout
+
     def __init__(self, ssh_configuration=None, ssh_port=22):
         if ssh_configuration is None:
             ssh_configuration = OpenSSHConfiguration.defaults()
@@ -167,8 +177,13 @@ class DeployScript(object):
                 deployment,
                 options["deployment_config"],
                 options["application_config"],
-                current_config)
+                current_config,
+                options["profile"])
         configuring.addCallback(configured)
+        if options["profile"]:
+            configuring.addCallback(
+                lambda profiles: self._stdout.write(
+                    profile_report(profiles).encode("utf-8")))
         configuring.addCallback(lambda _: None)
         return configuring
 
@@ -221,7 +236,8 @@ class DeployScript(object):
         return d
 
     def _changestate_on_nodes(self, deployment, deployment_config,
-                              application_config, cluster_config):
+                              application_config, cluster_config,
+                              profile=False):
         """
         Connect to all nodes and run ``flocker-changestate``.
 
@@ -232,22 +248,37 @@ class DeployScript(object):
             configuration.
         :param bytes current_config: YAML-encoded current cluster
             configuration.
+        :param bool profile: Whether to ask each node for how long its state
+            changes took.
 
         :return: ``Deferred`` that fires when all remote calls are finished.
+            If ``profile`` is true it fires with a ``dict`` mapping the
+            hostname of each node which succeeded to its marshalled
+            ``ChangeProfile``, suitable for passing to ``profile_report``.
         """
-        command = [b"flocker-changestate",
-                   deployment_config,
-                   application_config,
-                   cluster_config]
+        command = [b"flocker-changestate"]
+        if profile:
+            command.append(b"--profile")
+        command.extend([deployment_config,
+                        application_config,
+                        cluster_config])
         results = []
         for target in self._get_destinations(deployment):
             # XXX if number of nodes is bigger than number of available
             # threads we won't get the required parallelism...
             # https://github.com/ClusterHQ/flocker/issues/347
-            results.append(
-                deferToThread(
-                    target.node.get_output, command + [target.hostname]))
-        return DeferredList(results)
+            d = deferToThread(
+                target.node.get_output, command + [target.hostname])
+            if profile:
+                d.addCallback(
+                    lambda output, hostname=target.hostname: (
+                        hostname, loads(output)))
+            results.append(d)
+        d = DeferredList(results)
+        if profile:
+            d.addCallback(lambda node_results: dict(
+                value for (succeeded, value) in node_results if succeeded))
+        return d
 
 
 def flocker_deploy_main():
@@ -4,6 +4,8 @@
 Unit tests for the implementation ``flocker-deploy``.
 """
 
+from json import dumps
+from StringIO import StringIO
 from yaml import safe_dump, safe_load
 from threading import current_thread
 
@@ -17,7 +19,8 @@ from ...testtools import (
     FlockerScriptTestsMixin, StandardOptionsTestsMixin, make_with_init_tests)
 from ..script import DeployScript, DeployOptions, NodeTarget
 from .._sshconfig import DEFAULT_SSH_DIRECTORY
-from ...node import Application, Deployment, DockerImage, Node
+from ...node import (
+    Application, Deployment, DockerImage, Node, profile_report)
 from ...common import ProcessNode, FakeNode
 
 
@@ -173,6 +176,22 @@ class DeployOptionsTests(StandardOptionsTestsMixin, SynchronousTestCase):
         self.assertRaises(
             UsageError, options.parseOptions, [deploy.path, app.path])
 
+    def test_profile(self):
+        """
+        ``--profile`` asks for a report of how long the deployment took,
+        which isn't given by default.
+        """
+        deploy = FilePath(self.mktemp())
+        app = FilePath(self.mktemp())
+        deploy.setContent(b"nodes:\n  node1.test: [postgres]\nversion: 1\n")
+        app.setContent(b"{'postgres': {'image': 'sample/postgres'}}")
+        default = self.options()
+        default.parseOptions([deploy.path, app.path])
+        profiling = self.options()
+        profiling.parseOptions([b"--profile", deploy.path, app.path])
+        self.assertEqual((False, True),
+                         (default["profile"], profiling["profile"]))
+
     def test_deployment_object(self):
         """
         A ``Deployment`` object is assigned to the ``Options`` instance.
@@ -335,13 +354,15 @@ class FlockerDeployMainTests(TestCase):
             {node(node1.hostname), node(node2.hostname)},
             set(destinations))
 
-    def run_script(self, alternate_destinations):
+    def run_script(self, alternate_destinations, arguments=()):
         """
         Run ``DeployScript.main`` with overridden destinations for
         ``flocker-changestate`` and ``flocker-reportstate``.
 
         :param list alternate_destinations: ``INode`` providers to connect
              to instead of the default SSH-based ``ProcessNode``.
+        :param arguments: Extra command line arguments.  The script's
+             standard output is recorded in ``self.output``.
 
         :return: ``Deferred`` that fires with result of ``DeployScript.main``.
         """
@@ -377,11 +398,13 @@ class FlockerDeployMainTests(TestCase):
         deployment_config_path.setContent(self.deployment_config)
 
         options = DeployOptions()
-        options.parseOptions([
+        options.parseOptions(list(arguments) + [
             deployment_config_path.path, application_config_path.path])
 
         # Change destination of commands:
         script = DeployScript()
+        self.output = StringIO()
+        self.patch(script, "_stdout", self.output)
         script._get_destinations = lambda nodes: alternate_destinations
 
         # Disable SSH configuration:
@@ -537,3 +560,34 @@ class FlockerDeployMainTests(TestCase):
                 set([current_thread().ident]))
         running.addCallback(ran)
         return running
+
+    def test_profile(self):
+        """
+        With ``--profile``, ``DeployScript.main`` calls
+        ``flocker-changestate --profile`` and writes a report of the profiles
+        it returns.
+        """
+        profiles = {
+            b'node101.example.com': [
+                {u"identifier": 0, u"parent": None, u"after": None,
+                 u"change": u"StopApplication()", u"started": 10,
+                 u"finished": 12, u"succeeded": True, u"bytes": None}],
+            b'node102.example.com': [
+                {u"identifier": 0, u"parent": None, u"after": None,
+                 u"change": u"StartApplication()", u"started": 11,
+                 u"finished": 15, u"succeeded": True, u"bytes": None}],
+        }
+        destinations = [
+            NodeTarget(node=FakeNode([b"{}", dumps(profile)]),
+                       hostname=hostname)
+            for hostname, profile in profiles.items()]
+        running = self.run_script(destinations, [b"--profile"])
+
+        def ran(ignored):
+            self.assertEqual(
+                ([b"--profile", b"--profile"],
+                 profile_report(profiles).encode("utf-8")),
+                ([target.node.remote_command[1] for target in destinations],
+                 self.output.getvalue()))
+        running.addCallback(ran)
+        return running
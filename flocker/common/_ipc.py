@@ -31,6 +31,19 @@ class INode(Interface):
         :return: file-like object that can be written to.
         """
 
+    def read(remote_command):
+        """Context manager that runs a remote command and return its stdout.
+
+        Unlike ``get_output()`` the output is streamed rather than collected
+        in memory.  The returned file-like object will be closed by this
+        object.
+
+        :param remote_command: ``list`` of ``bytes``, the command to run
+            remotely along with its arguments.
+
+        :return: file-like object that can be read from.
+        """
+
     def get_output(remote_command):
         """Run a remote command and return its stdout.
 
@@ -74,10 +87,30 @@ class ProcessNode(object):
         finally:
             process.stdin.close()
             exit_code = process.wait()
-            if exit_code:
-                # We should really capture this and stderr better:
-                # https://github.com/ClusterHQ/flocker/issues/155
-                raise IOError("Bad exit", remote_command, exit_code)
+        # Only reached if the body succeeded, so that a failing exit status
+        # doesn't hide the body's own exception:
+        if exit_code:
+            # We should really capture this and stderr better:
+            # https://github.com/ClusterHQ/flocker/issues/155
+            raise IOError("Bad exit", remote_command, exit_code)
+
+    @contextmanager
+    def read(self, remote_command):
+        process = Popen(
+            self.initial_command_arguments +
+            tuple(map(self._quote, remote_command)),
+            stdout=PIPE)
+        try:
+            yield process.stdout
+        finally:
+            process.stdout.close()
+            exit_code = process.wait()
+        # Only reached if the body succeeded, so that a failing exit status
+        # doesn't hide the body's own exception:
+        if exit_code:
+            # We should really capture this and stderr better:
+            # https://github.com/ClusterHQ/flocker/issues/155
+            raise IOError("Bad exit", remote_command, exit_code)
 
     def get_output(self, remote_command):
         try:
@@ -127,19 +160,19 @@ class FakeNode(object):
 
     This is useful for testing.
 
-    :ivar remote_command: The arguments to the last call to ``run()`` or
-        ``get_output()``.
+    :ivar remote_command: The arguments to the last call to ``run()``,
+        ``read()`` or ``get_output()``.
 
     :ivar stdin: `BytesIO` returned from last call to ``run()``.
 
-    :ivar thread_id: The ID of the thread ``run()`` or ``get_output()``
-        ran in.
+    :ivar thread_id: The ID of the thread ``run()``, ``read()`` or
+        ``get_output()`` ran in.
     """
     def __init__(self, outputs=()):
         """
-        :param outputs: Sequence of results for ``get_output()``, either
-            exceptions or ``bytes``. Exceptions will be raised, otherwise the
-            object will be returned.
+        :param outputs: Sequence of results for ``read()`` and
+            ``get_output()``, either exceptions or ``bytes``. Exceptions will
+            be raised, otherwise the object will be returned.
         """
         self._outputs = list(outputs)
 
@@ -154,6 +187,14 @@ class FakeNode(object):
         yield self.stdin
         self.stdin.seek(0, 0)
 
+    @contextmanager
+    def read(self, remote_command):
+        """
+        Return (or if an exception, raise) the next remaining output of the
+        ones passed to the constructor, as an in-memory "stdout".
+        """
+        yield BytesIO(self.get_output(remote_command))
+
     def get_output(self, remote_command):
         """
         Return (or if an exception, raise) the next remaining output of the
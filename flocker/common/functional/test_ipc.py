@@ -66,6 +66,52 @@ class ProcessNodeTests(TestCase):
         else:
             self.fail("No IOError")
 
+    def test_run_bad_exit_exception(self):
+        """
+        If the context manager raises an exception, ``run()`` raises that
+        rather than an ``IOError`` for a non-zero exit code.
+        """
+        node = ProcessNode(initial_command_arguments=[])
+
+        def run():
+            with node.run([b"false"]):
+                raise ZeroDivisionError()
+        self.assertRaises(ZeroDivisionError, run)
+
+    def test_read_stdout(self):
+        """
+        ``ProcessNode.read()`` context manager returns the subprocess'
+        stdout.
+        """
+        node = ProcessNode(initial_command_arguments=[b"sh", b"-c"])
+        with node.read([b"echo -n hello"]) as stdout:
+            result = stdout.read()
+        self.assertEqual(result, b"hello")
+
+    def test_read_bad_exit(self):
+        """
+        ``read()`` raises ``IOError`` if subprocess has non-zero exit code.
+        """
+        node = ProcessNode(initial_command_arguments=[])
+        nonexistent = self.mktemp()
+
+        def read():
+            with node.read([b"ls", nonexistent]) as stdout:
+                stdout.read()
+        self.assertRaises(IOError, read)
+
+    def test_read_bad_exit_exception(self):
+        """
+        If the context manager raises an exception, ``read()`` raises that
+        rather than an ``IOError`` for a non-zero exit code.
+        """
+        node = ProcessNode(initial_command_arguments=[])
+
+        def read():
+            with node.read([b"false"]):
+                raise ZeroDivisionError()
+        self.assertRaises(ZeroDivisionError, read)
+
     def test_get_output_runs_command(self):
         """
         ``ProcessNode.get_output()`` runs a command that is the combination of
@@ -74,6 +74,24 @@ def make_inode_tests(fixture):
                 writer.write(b"hello")
                 writer.write(b"there")
 
+        def test_read_no_fd_leakage(self):
+            """
+            No file descriptors are leaked by ``read()``.
+            """
+            node = fixture(self)
+            with assertNoFDsLeaked(self):
+                with node.read([b"echo", b"hello"]) as reader:
+                    reader.read()
+
+        def test_read_readable(self):
+            """
+            The returned object from ``read()`` can be read from, giving
+            ``bytes``.
+            """
+            node = fixture(self)
+            with node.read([b"echo", b"hello"]) as reader:
+                self.assertIsInstance(reader.read(), bytes)
+
         def test_get_output_no_leakage(self):
             """
             No file descriptors are leaked by ``get_output()``.
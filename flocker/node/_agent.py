@@ -0,0 +1,185 @@
+# Copyright Hybrid Logic Ltd.  See LICENSE file for details.
+# -*- test-case-name: flocker.node.test.test_agent -*-
+
+"""
+A long-running agent which keeps a node converged on its desired state.
+"""
+
+from twisted.application.service import Service
+from twisted.internet.defer import Deferred, maybeDeferred, succeed
+from twisted.internet.task import LoopingCall
+from twisted.python.failure import Failure
+
+from eliot import Logger, writeFailure
+
+
+# How often, in seconds, to converge again even if the desired state hasn't
+# changed, e.g. to restart applications which have exited:
+CONVERGE_INTERVAL = 60
+
+_LOG_SYSTEM = u"flocker:node:agent"
+
+
+class ConvergenceAgent(Service):
+    """
+    Hold the desired state of a node and repeatedly change the node to match
+    it.
+
+    Unlike running ``flocker-changestate`` for each deployment, the
+    ``Deployer`` and the services it uses stay running between convergences.
+
+    Only one convergence runs at a time.  Updates to the desired state which
+    arrive while one is running are merged into a single convergence once it
+    has finished.
+
+    :ivar Deployer deployer: The ``Deployer`` used to change the node's state.
+    :ivar float interval: How often to converge when nothing else has caused
+        a convergence.
+    :ivar Deployment desired_state: The most recently supplied desired
+        configuration of the cluster, or ``None`` if there isn't one yet.
+    :ivar Deployment current_cluster_state: The configuration of the cluster
+        as of the last successful convergence, as most recently supplied, or
+        with this node's part refreshed after a convergence failed.
+    :ivar unicode hostname: The hostname of this node, or ``None`` if no
+        desired state has been supplied yet.
+    """
+    logger = Logger()
+
+    def __init__(self, deployer, interval=CONVERGE_INTERVAL):
+        self.deployer = deployer
+        self.interval = interval
+        self.desired_state = None
+        self.current_cluster_state = None
+        self.hostname = None
+        # The running convergence, if any:
+        self._converging = None
+        # ``Deferred``\ s for callers waiting for a convergence which hasn't
+        # started yet:
+        self._waiting = []
+        # ``Deferred``\ s for callers waiting for no convergence to be
+        # running or queued:
+        self._idle = []
+        self._loop = LoopingCall(self._periodic_converge)
+        self._loop.clock = deployer.reactor
+
+    def startService(self):
+        Service.startService(self)
+        self._loop.start(self.interval, now=False)
+
+    def stopService(self):
+        """
+        Stop converging periodically.
+
+        :return: A ``Deferred`` which fires once any running convergence,
+            and any queued to run after it, has finished.
+        """
+        Service.stopService(self)
+        if self._loop.running:
+            self._loop.stop()
+        if self._converging is None:
+            return succeed(None)
+        idle = Deferred()
+        self._idle.append(idle)
+        return idle
+
+    def set_desired_state(self, desired_state, current_cluster_state,
+                          hostname):
+        """
+        Change the state the node is converging on.
+
+        :param Deployment desired_state: The intended configuration of the
+            cluster.
+        :param Deployment current_cluster_state: The current configuration of
+            the cluster.
+        :param unicode hostname: The hostname of this node.
+
+        :return: A ``Deferred`` which fires with the ``ChangeProfile`` of
+            the convergence which applied the new state once the node has
+            converged on it, or fails if the convergence failed.
+        """
+        self.desired_state = desired_state
+        self.current_cluster_state = current_cluster_state
+        self.hostname = hostname
+        return self.converge()
+
+    def converge(self):
+        """
+        Change the node to match the desired state.
+
+        :return: A ``Deferred`` which fires with the ``ChangeProfile`` of a
+            convergence which started after this call when it has finished,
+            or fails if it failed.  If there is no desired state yet it fires
+            with ``None`` instead.
+        """
+        converged = Deferred()
+        self._waiting.append(converged)
+        if self._converging is None:
+            self._start()
+        return converged
+
+    def _start(self):
+        """
+        Start a convergence on behalf of everything waiting for one.
+        """
+        waiting, self._waiting = self._waiting, []
+        if self.desired_state is None:
+            for d in waiting:
+                d.callback(None)
+            return
+        desired_state = self.desired_state
+        current_cluster_state = self.current_cluster_state
+        hostname = self.hostname
+        self._converging = maybeDeferred(
+            self.deployer.change_node_state,
+            desired_state=desired_state,
+            current_cluster_state=current_cluster_state,
+            hostname=hostname)
+        # The deployer starts a new profile for each convergence, so a later
+        # convergence mustn't be reported to callers waiting for this one:
+        profile = self.deployer.profile
+        self._converging.addCallback(lambda _: profile)
+
+        def failed(reason):
+            # Some changes may have been made, so the next convergence
+            # mustn't be planned relative to the old state of this node, or
+            # it would repeat e.g. volume handoffs which already happened:
+            refreshing = maybeDeferred(
+                self.deployer.refresh_cluster_state,
+                current_cluster_state, hostname)
+
+            def refreshed(cluster_state):
+                if self.current_cluster_state is current_cluster_state:
+                    self.current_cluster_state = cluster_state
+            refreshing.addCallbacks(
+                refreshed, writeFailure,
+                errbackArgs=(self.logger, _LOG_SYSTEM))
+            refreshing.addCallback(lambda _: reason)
+            return refreshing
+        self._converging.addErrback(failed)
+
+        def finished(result):
+            self._converging = None
+            if (not isinstance(result, Failure) and
+                    self.desired_state is desired_state):
+                # This node now matches the desired state, so future
+                # convergences mustn't repeat changes like volume handoffs
+                # which were planned relative to the old cluster state.
+                self.current_cluster_state = desired_state
+            for d in waiting:
+                d.callback(result)
+            if self._waiting:
+                self._start()
+            else:
+                idle, self._idle = self._idle, []
+                for d in idle:
+                    d.callback(None)
+        self._converging.addBoth(finished)
+
+    def _periodic_converge(self):
+        """
+        Converge unless a convergence is already running or about to run.
+        """
+        if self._converging is not None:
+            return
+        d = self.converge()
+        d.addErrback(writeFailure, self.logger, _LOG_SYSTEM)
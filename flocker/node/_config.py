@@ -8,6 +8,7 @@ APIs for parsing and validating configuration.
 from __future__ import unicode_literals, absolute_import
 
 import os
+import re
 import types
 
 from twisted.python.filepath import FilePath
@@ -88,6 +89,16 @@ def _check_type(value, types, description, application_name):
             ))
 
 
+# Storage properties which Flocker sets itself and which therefore can't be
+# overridden in a volume's configuration:
+_MANAGED_VOLUME_PROPERTIES = frozenset({"mountpoint", "readonly"})
+
+# What the storage backend accepts as property names and values; they are
+# passed to it as ASCII command line arguments:
+_VOLUME_PROPERTY_NAME = re.compile(r"\A[a-z0-9:._-]{1,255}\Z")
+_VOLUME_PROPERTY_VALUE = re.compile(r"\A[\x20-\x7e]+\Z")
+
+
 class ApplicationMarshaller(object):
     """
     Convert ``Application`` instances or their properties to a ``dict``
@@ -126,6 +137,9 @@ class ApplicationMarshaller(object):
         volume = self.convert_volume()
         if volume:
             config['volume'] = volume
+        stop_timeout = self.convert_stop_timeout()
+        if stop_timeout is not None:
+            config['stop_timeout'] = stop_timeout
         return config
 
     def convert_image(self):
@@ -167,6 +181,15 @@ class ApplicationMarshaller(object):
             return dict(self._application.environment)
         return None
 
+    def convert_stop_timeout(self):
+        """
+        Return the ``Application`` stop timeout.
+
+        :returns: The number of seconds, or ``None`` if Docker's default is
+            used.
+        """
+        return self._application.stop_timeout
+
     def convert_links(self):
         """
         Parse an ``Application`` instance for its links and return
@@ -194,7 +217,11 @@ class ApplicationMarshaller(object):
         logic will need refactoring in future if this changes.
         """
         if self._application.volume:
-            return {u'mountpoint': self._application.volume.mountpoint.path}
+            volume = {u'mountpoint': self._application.volume.mountpoint.path}
+            if self._application.volume.properties:
+                volume[u'properties'] = dict(
+                    self._application.volume.properties)
+            return volume
         return None
 
 
@@ -638,7 +665,7 @@ class FlockerConfiguration(object):
         self._application_configuration = application_configuration
         self._allowed_keys = {
             "image", "environment", "ports",
-            "links", "volume"
+            "links", "volume", "stop_timeout"
         }
         self._applications = {}
 
@@ -765,6 +792,40 @@ class FlockerConfiguration(object):
             environment = frozenset(environment.items())
         return environment
 
+    def _parse_stop_timeout_config(self, application_name, config):
+        """
+        Validate and return an application config's stop timeout.
+
+        :param unicode application_name: The name of the application.
+
+        :param dict config: The config of a single ``Application`` instance,
+            as extracted from the ``applications`` ``dict`` in
+            ``_applications_from_configuration``.
+
+        :raises ConfigurationError: if the ``stop_timeout`` element of
+            ``config`` is not a non-negative integer.
+
+        :returns: ``None`` if there is no ``stop_timeout`` element in the
+            config, otherwise the number of seconds.
+        """
+        stop_timeout = config.pop('stop_timeout', None)
+        if stop_timeout is not None:
+            # bool is a subclass of int, but not a number of seconds:
+            if isinstance(stop_timeout, bool):
+                raise ConfigurationError(
+                    "Application '{application_name}' has a config error. "
+                    "'stop_timeout' must be an integer; got type "
+                    "'bool'.".format(application_name=application_name))
+            _check_type(value=stop_timeout, types=(int, long),
+                        description="'stop_timeout' must be an integer",
+                        application_name=application_name)
+            if stop_timeout < 0:
+                raise ConfigurationError(
+                    "Application '{application_name}' has a config error. "
+                    "'stop_timeout' must not be negative.".format(
+                        application_name=application_name))
+        return stop_timeout
+
     def _parse_link_configuration(self, application_name, config):
         """
         Validate and retrun an application config's links.
@@ -828,6 +889,54 @@ class FlockerConfiguration(object):
 
         return frozenset(links)
 
+    def _parse_volume_properties(self, properties):
+        """
+        Validate and return a volume config's storage properties.
+
+        YAML parses unquoted values like ``off`` and ``2`` as booleans and
+        integers, so these are converted back to the strings the storage
+        backend expects.
+
+        :param dict properties: The ``properties`` stanza of a volume
+            configuration.
+
+        :raises ValueError: if the properties are not a mapping of names to
+            simple values, if a name or value isn't one the storage backend
+            accepts, or if they include a property which is managed by
+            Flocker itself.
+
+        :returns: A ``frozenset`` of (name, value) ``tuple``\ s.
+        """
+        if not isinstance(properties, dict):
+            raise ValueError(
+                "'properties' must be a dictionary of key/value pairs.")
+        result = []
+        for name, value in properties.items():
+            if not isinstance(name, types.StringTypes):
+                raise ValueError("Property names must be strings.")
+            if _VOLUME_PROPERTY_NAME.match(name) is None:
+                raise ValueError(
+                    "Property name '{name}' is invalid. Names may only "
+                    "contain lowercase letters, digits, ':', '.', '_' and "
+                    "'-'.".format(name=name))
+            if name in _MANAGED_VOLUME_PROPERTIES:
+                raise ValueError(
+                    "Property '{name}' is managed by Flocker.".format(
+                        name=name))
+            if isinstance(value, bool):
+                value = "on" if value else "off"
+            elif isinstance(value, (int, long)):
+                value = unicode(value)
+            elif not isinstance(value, types.StringTypes):
+                raise ValueError(
+                    "Property '{name}' must be a string.".format(name=name))
+            if _VOLUME_PROPERTY_VALUE.match(value) is None:
+                raise ValueError(
+                    "Property '{name}' must be a non-empty string of "
+                    "printable ASCII characters.".format(name=name))
+            result.append((name, value))
+        return frozenset(result)
+
     def _parse(self):
         """
         Validate and parse a given application configuration from flocker's
@@ -905,6 +1014,8 @@ class FlockerConfiguration(object):
                             )
                         )
                     configured_volume.pop('mountpoint')
+                    properties = self._parse_volume_properties(
+                        configured_volume.pop('properties', {}))
                     if configured_volume:
                         raise ValueError(
                             "Unrecognised keys: {keys}.".format(
@@ -915,7 +1026,8 @@ class FlockerConfiguration(object):
 
                     volume = AttachedVolume(
                         name=application_name,
-                        mountpoint=mountpoint
+                        mountpoint=mountpoint,
+                        properties=properties,
                         )
                 except ValueError as e:
                     raise ConfigurationError(
@@ -930,13 +1042,17 @@ class FlockerConfiguration(object):
             environment = self._parse_environment_config(
                 application_name, config)
 
+            stop_timeout = self._parse_stop_timeout_config(
+                application_name, config)
+
             self._applications[application_name] = Application(
                 name=application_name,
                 image=image,
                 volume=volume,
                 ports=frozenset(ports),
                 links=links,
-                environment=environment)
+                environment=environment,
+                stop_timeout=stop_timeout)
 
 
 def deployment_from_configuration(deployment_configuration, all_applications):
@@ -1048,7 +1164,8 @@ def marshal_configuration(state):
     :return: An object representing the node configuration in a structure
         roughly compatible with the configuration file format.  Only "simple"
         (easily serialized) Python types will be used: ``dict``, ``list``,
-        ``int``, ``unicode``, etc.
+        ``int``, ``unicode``, etc.  The names of the applications which are
+        running, rather than just existing, are listed under ``running``.
     """
     result = {}
     for application in state.running + state.not_running:
@@ -1059,5 +1176,6 @@ def marshal_configuration(state):
     return {
         "version": 1,
         "applications": result,
+        "running": sorted(application.name for application in state.running),
         "used_ports": sorted(state.used_ports),
     }
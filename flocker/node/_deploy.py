@@ -5,23 +5,53 @@
 Deploy applications on nodes.
 """
 
+import json
+from contextlib import contextmanager
+from functools import wraps
+from hashlib import sha256
+
 from zope.interface import Interface, implementer
 
-from characteristic import attributes
+from characteristic import attributes, Attribute
+
+from twisted.internet.defer import (
+    Deferred, DeferredSemaphore, gatherResults, fail, maybeDeferred, succeed,
+)
+from twisted.internet.task import LoopingCall
+from twisted.internet.threads import deferToThread
+from twisted.python.constants import Names, NamedConstant
+from twisted.python.failure import Failure
 
-from twisted.internet.defer import gatherResults, fail, succeed
+from yaml import safe_load
 
+from ._config import ApplicationMarshaller
+from ._profile import ChangeProfile
 from ._docker import DockerClient, PortMap, Environment, Volume as DockerVolume
 from ._model import (
     Application, VolumeChanges, AttachedVolume, VolumeHandoff,
-    NodeState, DockerImage, Port, Link
+    NodeState, DockerImage, Port, Link, Node, Deployment
     )
-from ..route import make_host_network, Proxy
-from ..volume._ipc import RemoteVolumeManager, standard_node
+from ..route import make_host_network, Proxy, ITransactionalNetwork
+from ..volume._ipc import (
+    IRemoteVolumeManager, RemoteVolumeManager, standard_node)
 from ..volume.service import VolumeName
 from ..common import gather_deferreds
 
 
+# How often to check whether an application is running on another node:
+WAIT_FOR_APPLICATION_INTERVAL = 1
+
+# How many seconds to wait for an application to run on another node before
+# giving up:
+WAIT_FOR_APPLICATION_TIMEOUT = 600
+
+
+class ApplicationNotStarted(Exception):
+    """
+    An application didn't start running on another node in time.
+    """
+
+
 def _to_volume_name(name):
     """
     Convert unicode name to ``VolumeName`` with ``u"default"`` namespace.
@@ -36,6 +66,99 @@ def _to_volume_name(name):
     return VolumeName(namespace=u"default", id=name)
 
 
+class Resource(Names):
+    """
+    The kinds of resource which state changes use, for limiting how many
+    changes use each at once.
+
+    :cvar DOCKER: The Docker daemon.
+    :cvar ZFS: Local volume storage.
+    :cvar NETWORK: The node's proxy configuration.
+    :cvar TRANSFER: Copying volumes to other nodes.
+    :cvar IMAGES: Downloading Docker images.
+    """
+    DOCKER = NamedConstant()
+    ZFS = NamedConstant()
+    NETWORK = NamedConstant()
+    TRANSFER = NamedConstant()
+    IMAGES = NamedConstant()
+
+
+class ConcurrencyLimiter(object):
+    """
+    Limit how many state changes run at once, overall and for each
+    ``Resource``.
+
+    Changes beyond a limit are queued, and each starts as soon as a running
+    change using the same capacity finishes.
+
+    :ivar total: The maximum number of changes to run at once, or ``None``
+        for no limit.
+    :ivar dict resources: Mapping from ``Resource`` to the maximum number of
+        changes using that resource to run at once.  Resources which aren't
+        included aren't limited.
+    """
+    def __init__(self, total=None, resources=None):
+        """
+        :param total: See ``total``.
+        :param resources: See ``resources``.  Default is no limits.
+        """
+        if resources is None:
+            resources = {}
+        self.total = total
+        self.resources = resources
+        self._total = None
+        if total is not None:
+            self._total = DeferredSemaphore(total)
+        self._resources = {resource: DeferredSemaphore(limit)
+                           for resource, limit in resources.items()}
+
+    def run(self, resource, f, *args, **kwargs):
+        """
+        Call a function once there is capacity for it.
+
+        :param Resource resource: The resource the call will use.
+        :param f: The function to call.
+        :param args: Positional arguments for ``f``.
+        :param kwargs: Keyword arguments for ``f``.
+
+        :return: ``Deferred`` firing with the result of ``f``, after which
+            its capacity is released.
+        """
+        # Acquire the resource's capacity before the overall capacity, so
+        # calls queued for a busy resource don't hold up other resources.
+        semaphores = [semaphore for semaphore in
+                      (self._resources.get(resource), self._total)
+                      if semaphore is not None]
+
+        def acquire(semaphores):
+            if not semaphores:
+                return maybeDeferred(f, *args, **kwargs)
+            return semaphores[0].run(acquire, semaphores[1:])
+        return acquire(semaphores)
+
+
+def _limited(resource):
+    """
+    Decorate an ``IStateChange.run`` implementation so that it is run
+    within the limits of the deployer's ``ConcurrencyLimiter``.
+
+    Only changes which do work themselves should be limited; changes which
+    run other changes would otherwise use up capacity their sub-changes
+    need.
+
+    :param Resource resource: The resource the change uses.
+
+    :return: A decorator.
+    """
+    def decorator(run):
+        @wraps(run)
+        def limited_run(self, deployer):
+            return deployer.limiter.run(resource, run, self, deployer)
+        return limited_run
+    return decorator
+
+
 class IStateChange(Interface):
     """
     An operation that changes the state of the local node.
@@ -44,6 +167,9 @@ class IStateChange(Interface):
         """
         Run the change.
 
+        Changes which run other changes do so with the deployer's
+        ``ChangeProfile``, so that every change is timed and logged.
+
         :param Deployer deployer: The ``Deployer`` to use.
 
         :return: ``Deferred`` firing when the change is done.
@@ -70,8 +196,13 @@ class Sequentially(object):
     """
     def run(self, deployer):
         d = succeed(None)
+        previous = None
         for change in self.changes:
-            d.addCallback(lambda _, change=change: change.run(deployer))
+            d.addCallback(
+                lambda _, change=change, previous=previous:
+                deployer.profile.run(change, deployer, parent=self,
+                                     after=previous))
+            previous = change
         return d
 
 
@@ -81,11 +212,75 @@ class InParallel(object):
     """
     Run a series of changes in parallel.
 
+    Changes are still subject to the deployer's ``ConcurrencyLimiter``, so
+    some may be queued until others finish.
+
     Failures in one change do not prevent other changes from continuing.
     """
     def run(self, deployer):
         return gather_deferreds(
-            [change.run(deployer) for change in self.changes])
+            [deployer.profile.run(change, deployer, parent=self)
+             for change in self.changes])
+
+
+@implementer(IStateChange)
+@attributes(["dependencies"])
+class InDependencyOrder(object):
+    """
+    Run each change as soon as all the changes it depends on are done.
+
+    Changes which don't depend on each other run in parallel, so a slow
+    change only delays the changes which depend on it.
+
+    A change is not run if any change it depends on fails, but failures do
+    not prevent unrelated changes from continuing.
+
+    :ivar dict dependencies: A mapping from each change to run to a
+        ``frozenset`` of the changes which must succeed before it is run.
+        Every change which is depended on must itself be a key, and there
+        must be no cycles.
+    """
+    def run(self, deployer):
+        waiting = {change: set(prerequisites)
+                   for change, prerequisites in self.dependencies.items()}
+        dependents = {}
+        for change, prerequisites in self.dependencies.items():
+            for prerequisite in prerequisites:
+                dependents.setdefault(prerequisite, set()).add(change)
+        results = []
+        done = Deferred()
+        # The number of changes which are running, plus one while the changes
+        # with no dependencies are being started:
+        outstanding = [1]
+
+        def finished(result=None):
+            outstanding[0] -= 1
+            if not outstanding[0]:
+                done.callback(None)
+            return result
+
+        def succeeded(result, change):
+            for dependent in dependents.get(change, ()):
+                prerequisites = waiting[dependent]
+                prerequisites.remove(change)
+                if not prerequisites:
+                    start(dependent, after=change)
+            return result
+
+        def start(change, after=None):
+            outstanding[0] += 1
+            d = deployer.profile.run(change, deployer, parent=self,
+                                     after=after)
+            d.addCallback(succeeded, change)
+            d.addBoth(finished)
+            results.append(d)
+
+        for change, prerequisites in self.dependencies.items():
+            if not prerequisites:
+                start(change)
+        finished()
+        done.addCallback(lambda _: gather_deferreds(results))
+        return done
 
 
 @implementer(IStateChange)
@@ -99,6 +294,7 @@ class StartApplication(object):
 
     :ivar unicode hostname: The hostname of the application is running on.
     """
+    @_limited(Resource.DOCKER)
     def run(self, deployer):
         application = self.application
 
@@ -160,7 +356,7 @@ def _link_environment(protocol, alias, local_port, hostname, remote_port):
     :param unicode hostname: The remote hostname to connect to.
     :param int remote_port: The remote port to connect to.
     """
-    alias = alias.upper().replace(u'-', u"_")
+    alias = _link_alias(alias)
     base = u'%s_PORT_%d_%s' % (alias, local_port, protocol.upper())
 
     return {
@@ -171,18 +367,115 @@ def _link_environment(protocol, alias, local_port, hostname, remote_port):
     }
 
 
+def _link_alias(alias):
+    """
+    :param unicode alias: The name of a link.
+
+    :return: The form of ``alias`` used in environment variables, which is
+        all that can be discovered about it from a running container.
+    """
+    return alias.upper().replace(u'-', u"_")
+
+
+def _parse_environment(environment):
+    """
+    Separate the variables generated by ``_link_environment`` from the rest
+    of a container's environment.
+
+    :param Environment environment: The environment of a container, or
+        ``None``.
+
+    :return: A ``tuple`` of a ``frozenset`` of the ``Link``\ s described by
+        the environment, and a ``frozenset`` of the remaining ``(key,
+        value)`` tuples or ``None`` if there are none.
+    """
+    if environment is None:
+        return frozenset(), None
+    variables = environment.to_dict()
+    links = set()
+    link_labels = set()
+    for label, value in variables.items():
+        # <ALIAS>_PORT_<PORTNUM>_TCP_PORT=<value>
+        parts = label.rsplit(b"_", 4)
+        try:
+            alias, pad_a, port, pad_b, pad_c = parts
+            local_port = int(port)
+            remote_port = int(value)
+        except ValueError:
+            continue
+        if (pad_a, pad_b, pad_c) == (b"PORT", b"TCP", b"PORT"):
+            links.add(Link(
+                local_port=local_port,
+                remote_port=remote_port,
+                alias=alias,
+            ))
+            base = label[:-len(b"_PORT")]
+            link_labels.update(
+                base + suffix for suffix in
+                (b"", b"_ADDR", b"_PORT", b"_PROTO"))
+    remaining = frozenset(
+        (label, value) for label, value in variables.items()
+        if label not in link_labels)
+    return frozenset(links), remaining or None
+
+
+def _differs(desired, current):
+    """
+    Determine whether a running application needs to be restarted to match
+    its configuration.
+
+    :param Application desired: The application's configuration.
+    :param Application current: The application as discovered from Docker.
+
+    :return: ``True`` if they differ in anything which can be discovered,
+        otherwise ``False``.
+    """
+    def discoverable(application):
+        return Application(
+            name=application.name,
+            image=application.image,
+            ports=application.ports,
+            volume=application.volume,
+            links=frozenset(
+                Link(local_port=link.local_port,
+                     remote_port=link.remote_port,
+                     alias=_link_alias(link.alias))
+                for link in application.links),
+            environment=application.environment or None,
+        )
+    return discoverable(desired) != discoverable(current)
+
+
+@implementer(IStateChange)
+@attributes(["image"])
+class PullImage(object):
+    """
+    Make sure an image is available locally, so that starting containers
+    from it doesn't have to wait for it to be downloaded.
+
+    :ivar DockerImage image: The image to pull.
+    """
+    @_limited(Resource.IMAGES)
+    def run(self, deployer):
+        return deployer.docker_client.pull(self.image.full_name)
+
+
 @implementer(IStateChange)
-@attributes(["application"])
+@attributes(["application", Attribute("stop_timeout", default_value=None)])
 class StopApplication(object):
     """
     Stop and disable the given application.
 
     :ivar Application application: The ``Application`` to stop.
+    :ivar stop_timeout: How many seconds to give the application to stop
+        before it is killed, or ``None`` for the Docker client's default.
     """
+    @_limited(Resource.DOCKER)
     def run(self, deployer):
         application = self.application
         unit_name = application.name
-        return deployer.docker_client.remove(unit_name)
+        return deployer.docker_client.remove(
+            unit_name, stop_timeout=self.stop_timeout)
 
 
 @implementer(IStateChange)
@@ -191,11 +484,70 @@ class CreateVolume(object):
     """
     Create a new locally-owned volume.
 
-    :ivar AttachedVolume volume: Volume to create.
+    :ivar AttachedVolume volume: Volume to create.  Its storage properties
+        are applied to the new volume's filesystem.
     """
+    @_limited(Resource.ZFS)
     def run(self, deployer):
         return deployer.volume_service.create(
-            _to_volume_name(self.volume.name))
+            _to_volume_name(self.volume.name),
+            properties=self.volume.properties)
+
+
+@implementer(IStateChange)
+@attributes(["application", "hostname",
+             Attribute("timeout", default_value=WAIT_FOR_APPLICATION_TIMEOUT)])
+class WaitForApplication(object):
+    """
+    Wait for an application to be running on another node.
+
+    Polls the other node's state by running ``flocker-reportstate`` on it.
+
+    :ivar Application application: The application to wait for.
+    :ivar unicode hostname: The hostname of the node it will run on.
+    :ivar timeout: How many seconds to wait before failing with
+        ``ApplicationNotStarted``, so changes which depend on the
+        application running elsewhere, like stopping it here, aren't run.
+    """
+    def run(self, deployer):
+        # XXX The remote command is blocking, like the rest of the
+        # inter-node communication, so it is run in a thread. See
+        # https://github.com/ClusterHQ/flocker/issues/154
+        node = standard_node(self.hostname.encode("ascii"))
+        result = Deferred()
+
+        def check_for_application():
+            d = deferToThread(node.get_output, [b"flocker-reportstate"])
+            d.addCallback(safe_load)
+
+            def got_state(state):
+                # Applications which exist but aren't running are reported
+                # too, so only those listed as running count:
+                if self.application.name in state.get(u"running", ()):
+                    call.stop()
+            d.addCallback(got_state)
+            return d
+
+        call = LoopingCall(check_for_application)
+        call.clock = deployer.reactor
+
+        def give_up():
+            if call.running:
+                call.stop()
+            result.errback(ApplicationNotStarted(
+                self.application.name, self.hostname))
+        deadline = deployer.reactor.callLater(self.timeout, give_up)
+
+        def finished(outcome):
+            # Once the deadline has passed the outcome no longer matters:
+            if deadline.active():
+                deadline.cancel()
+                if isinstance(outcome, Failure):
+                    result.errback(outcome)
+                else:
+                    result.callback(None)
+        call.start(WAIT_FOR_APPLICATION_INTERVAL).addBoth(finished)
+        return result
 
 
 @implementer(IStateChange)
@@ -211,6 +563,78 @@ class WaitForVolume(object):
             _to_volume_name(self.volume.name))
 
 
+@implementer(IRemoteVolumeManager)
+class _CountingVolumeManager(object):
+    """
+    Count how much data is written to another volume manager.
+
+    :ivar IRemoteVolumeManager manager: The volume manager to pass calls on
+        to.
+    :ivar int bytes: How many bytes have been written to volumes received by
+        ``manager``.
+    """
+    def __init__(self, manager):
+        self.manager = manager
+        self.bytes = 0
+
+    def snapshots(self, volume):
+        return self.manager.snapshots(volume)
+
+    @contextmanager
+    def receive(self, volume):
+        with self.manager.receive(volume) as receiver:
+            yield _CountingWriter(receiver, self)
+
+    def acquire(self, volume):
+        return self.manager.acquire(volume)
+
+    def clone_to(self, parent, name):
+        return self.manager.clone_to(parent, name)
+
+
+class _CountingWriter(object):
+    """
+    A file-like object which counts the bytes written through it.
+    """
+    def __init__(self, original, counter):
+        """
+        :param original: The file-like object to write to.
+        :param _CountingVolumeManager counter: Where to add up the bytes.
+        """
+        self._original = original
+        self._counter = counter
+
+    def write(self, data):
+        self._counter.bytes += len(data)
+        self._original.write(data)
+
+
+def _transfer(change, deployer, transfer):
+    """
+    Copy a volume to another node, recording how much data was copied in
+    the deployer's ``ChangeProfile``.
+
+    :param IStateChange change: The change copying the volume, which has
+        ``volume`` and ``hostname`` attributes.
+    :param Deployer deployer: The ``Deployer`` running ``change``.
+    :param transfer: ``VolumeService.push`` or ``VolumeService.handoff``.
+
+    :return: The result of ``transfer``.
+    """
+    service = deployer.volume_service
+    destination = _CountingVolumeManager(
+        RemoteVolumeManager(standard_node(change.hostname)))
+    d = maybeDeferred(
+        transfer, service.get(_to_volume_name(change.volume.name)),
+        destination)
+
+    def transferred(result):
+        deployer.profile.transferred(change, destination.bytes)
+        return result
+    d.addBoth(transferred)
+    return d
+
+
 @implementer(IStateChange)
 @attributes(["volume", "hostname"])
 class HandoffVolume(object):
@@ -224,11 +648,9 @@ class HandoffVolume(object):
     :ivar bytes hostname: The hostname of the node to which the volume is
          meant to be handed off.
     """
+    @_limited(Resource.TRANSFER)
     def run(self, deployer):
-        service = deployer.volume_service
-        destination = standard_node(self.hostname)
-        return service.handoff(service.get(_to_volume_name(self.volume.name)),
-                               RemoteVolumeManager(destination))
+        return _transfer(self, deployer, deployer.volume_service.handoff)
 
 
 @implementer(IStateChange)
@@ -244,11 +666,9 @@ class PushVolume(object):
     :ivar bytes hostname: The hostname of the node to which the volume is
          meant to be pushed.
     """
+    @_limited(Resource.TRANSFER)
     def run(self, deployer):
-        service = deployer.volume_service
-        destination = standard_node(self.hostname)
-        return service.push(service.get(_to_volume_name(self.volume.name)),
-                            RemoteVolumeManager(destination))
+        return _transfer(self, deployer, deployer.volume_service.push)
 
 
 @implementer(IStateChange)
@@ -257,18 +677,31 @@ class SetProxies(object):
     """
     Set the ports which will be forwarded to other nodes.
 
+    Only the proxies which differ from the existing ones are deleted or
+    created, so traffic to unchanged ports isn't interrupted.  Networks
+    which can change all their proxies in one transaction are asked to do
+    so.
+
     :ivar ports: A collection of ``Port`` objects.
     """
+    @_limited(Resource.NETWORK)
     def run(self, deployer):
+        if ITransactionalNetwork.providedBy(deployer.network):
+            return deployer.network.set_proxies(self.ports)
         results = []
+        current = set(deployer.network.enumerate_proxies())
+        desired = set(self.ports)
         # XXX: The proxy manipulation operations are blocking. Convert to a
         # non-blocking API. See https://github.com/ClusterHQ/flocker/issues/320
-        for proxy in deployer.network.enumerate_proxies():
+        #
+        # Delete first, since a proxy for a port may be being moved to a
+        # different address:
+        for proxy in current - desired:
             try:
                 deployer.network.delete_proxy(proxy)
             except:
                 results.append(fail())
-        for proxy in self.ports:
+        for proxy in desired - current:
             try:
                 deployer.network.create_proxy_to(proxy.ip, proxy.port)
             except:
@@ -276,6 +709,117 @@ class SetProxies(object):
         return gather_deferreds(results)
 
 
+def _application_digest(application):
+    """
+    Hash the configuration of an application.
+
+    :param Application application: The application.
+
+    :return: The hex-encoded SHA-256 ``bytes`` of its marshalled
+        configuration.
+    """
+    return sha256(json.dumps(ApplicationMarshaller(application).convert(),
+                             sort_keys=True)).hexdigest()
+
+
+def _node_configuration(desired_state, hostname):
+    """
+    Find the parts of a desired configuration which determine what runs on a
+    node: its own applications and the proxies to applications on other
+    nodes.  Changes to other nodes which don't affect this one don't change
+    them.
+
+    :param Deployment desired_state: The intended configuration of all
+        nodes.
+    :param unicode hostname: The hostname of the node.
+
+    :return: A tuple of a ``dict`` mapping the names of the node's
+        applications to their ``_application_digest``, and a ``frozenset``
+        of the ``Proxy`` instances it should have.
+    """
+    applications = {}
+    proxies = set()
+    for node in desired_state.nodes:
+        for application in node.applications:
+            if node.hostname == hostname:
+                applications[application.name] = _application_digest(
+                    application)
+            else:
+                for port in application.ports:
+                    proxies.add(Proxy(ip=node.hostname,
+                                      port=port.external_port))
+    return applications, frozenset(proxies)
+
+
+@attributes(["applications", "proxies"])
+class AppliedState(object):
+    """
+    The desired configuration a node was last successfully changed to match.
+
+    :ivar dict applications: Maps the names of the applications which were
+        left running on the node to the ``_application_digest`` of their
+        configuration.
+    :ivar frozenset proxies: The ``Proxy`` instances which were left
+        configured on the node.
+    """
+
+
+class AppliedStateStore(object):
+    """
+    A file recording a node's ``AppliedState``, so that being asked to
+    converge on a configuration only involves the applications whose
+    configuration has changed since, or which have changed behind Flocker's
+    back.
+
+    :ivar FilePath path: The file.
+    """
+    def __init__(self, path):
+        self.path = path
+
+    def load(self):
+        """
+        :return: The recorded ``AppliedState``, or ``None`` if there is none
+            or it can't be read.
+        """
+        try:
+            content = json.loads(self.path.getContent())
+            if content[u"version"] != 2:
+                return None
+            return AppliedState(
+                applications={
+                    name: digest.encode("ascii")
+                    for name, digest in content[u"applications"].items()},
+                proxies=frozenset(Proxy(ip=ip, port=port)
+                                  for ip, port in content[u"proxies"]))
+        except (IOError, ValueError, KeyError, TypeError, AttributeError):
+            return None
+
+    def save(self, state):
+        """
+        Record an ``AppliedState``, replacing any earlier one atomically.
+
+        :param AppliedState state: The state to record.
+        """
+        parent = self.path.parent()
+        if not parent.exists():
+            parent.makedirs()
+        temporary = self.path.temporarySibling()
+        temporary.setContent(json.dumps({
+            u"version": 2,
+            u"applications": state.applications,
+            u"proxies": sorted([proxy.ip, proxy.port]
+                               for proxy in state.proxies),
+        }))
+        temporary.moveTo(self.path)
+
+    def clear(self):
+        """
+        Forget the recorded state, if any.
+        """
+        if self.path.exists():
+            self.path.remove()
+
+
 class Deployer(object):
     """
     Start and stop applications.
@@ -285,8 +829,24 @@ class Deployer(object):
         deployment operations. Default ``DockerClient``.
     :ivar INetwork network: The network routing API to use in
         deployment operations. Default is iptables-based implementation.
+    :ivar ConcurrencyLimiter limiter: Limits how many state changes run at
+        once.  Default is no limits.
+    :ivar reactor: The reactor to use for scheduling. Default is the global
+        reactor.
+    :ivar AppliedStateStore applied_state: Where to record the configuration
+        the node was last changed to match, or ``None`` to always plan
+        changes for every application.  Default is ``None``.
+    :ivar ChangeProfile profile: Runs, times and logs the state changes of
+        the most recent call to ``change_node_state``.
     """
-    def __init__(self, volume_service, docker_client=None, network=None):
+    def __init__(self, volume_service, docker_client=None, network=None,
+                 limiter=None, reactor=None, applied_state=None):
+        if reactor is None:
+            from twisted.internet import reactor
+        self.reactor = reactor
+        if limiter is None:
+            limiter = ConcurrencyLimiter()
+        self.limiter = limiter
         if docker_client is None:
             docker_client = DockerClient()
         self.docker_client = docker_client
@@ -294,6 +854,8 @@ class Deployer(object):
             network = make_host_network()
         self.network = network
         self.volume_service = volume_service
+        self.applied_state = applied_state
+        self.profile = ChangeProfile(reactor)
 
     def discover_node_configuration(self):
         """
@@ -302,13 +864,77 @@ class Deployer(object):
         :returns: A ``Deferred`` which fires with a ``NodeState``
             instance.
         """
+        d = self._discover_applications()
+        d.addCallback(lambda state: NodeState(
+            running=state.running,
+            not_running=state.not_running,
+            used_ports=self.network.enumerate_used_ports()
+        ))
+        return d
+
+    def refresh_cluster_state(self, cluster_state, hostname):
+        """
+        Bring this node's part of a configuration of the cluster up to date,
+        e.g. after changing the node's state partly failed.
+
+        :param Deployment cluster_state: The configuration of the cluster
+            the failed changes were planned relative to.
+        :param unicode hostname: The hostname of this node.
+
+        :return: A ``Deferred`` which fires with a ``Deployment`` in which
+            this node has the applications found on it, plus those of its
+            previous applications whose volumes it still owns, so handoffs
+            and pushes which finished aren't repeated but those which didn't
+            are.
+        """
+        volumes = self.volume_service.enumerate()
+        volumes.addCallback(lambda volumes: {
+            volume.name.id for volume in volumes
+            if volume.uuid == self.volume_service.uuid})
+        d = gatherResults([self._discover_applications(), volumes])
+
+        def refreshed(result):
+            state, owned = result
+            applications = {
+                application.name: application
+                for application in state.running + state.not_running}
+            nodes = set()
+            for node in cluster_state.nodes:
+                if node.hostname != hostname:
+                    nodes.add(node)
+                    continue
+                for application in node.applications:
+                    if (application.volume is not None and
+                            application.volume.name in owned):
+                        applications.setdefault(application.name,
+                                                application)
+            nodes.add(Node(hostname=hostname,
+                           applications=frozenset(applications.values())))
+            return Deployment(nodes=frozenset(nodes))
+        d.addCallback(refreshed)
+        return d
+
+    def _discover_applications(self, names=None):
+        """
+        List all the ``Application``\ s on this node, without the more
+        expensive discovery of which ports are in use.
+
+        :param names: The names of the only applications to list, or
+            ``None`` to list all of them.
+
+        :returns: A ``Deferred`` which fires with a ``NodeState``
+            instance with no ``used_ports``.
+        """
+        if names is not None and not names:
+            return succeed(NodeState(running=[], not_running=[]))
         # Add real namespace support in
         # https://github.com/ClusterHQ/flocker/issues/737; for now we just
         # strip the namespace since there will only ever be one.
         volumes = self.volume_service.enumerate()
-        volumes.addCallback(lambda volumes: set(
-            volume.name.id for volume in volumes
-            if volume.uuid == self.volume_service.uuid))
+        volumes.addCallback(lambda volumes: {
+            volume.name.id: volume.get_filesystem().get_path()
+            for volume in volumes
+            if volume.uuid == self.volume_service.uuid})
         d = gatherResults([self.docker_client.list(), volumes])
 
         def applications_from_units(result):
@@ -317,11 +943,26 @@ class Deployer(object):
             running = []
             not_running = []
             for unit in units:
+                if names is not None and unit.name not in names:
+                    continue
                 image = DockerImage.from_string(unit.container_image)
                 if unit.name in available_volumes:
                     # XXX we only support one volume per container at this time
                     # https://github.com/ClusterHQ/flocker/issues/49
-                    volume = AttachedVolume.from_unit(unit).pop()
+                    # Images may declare volumes of their own, so prefer the
+                    # one backed by our filesystem:
+                    mounted = [
+                        docker_volume for docker_volume in unit.volumes
+                        if docker_volume.node_path ==
+                        available_volumes[unit.name]]
+                    if mounted:
+                        volume = AttachedVolume(
+                            name=unit.name,
+                            mountpoint=mounted[0].container_path)
+                    elif unit.volumes:
+                        volume = AttachedVolume.from_unit(unit).pop()
+                    else:
+                        volume = None
                 else:
                     volume = None
                 ports = []
@@ -330,29 +971,14 @@ class Deployer(object):
                         internal_port=portmap.internal_port,
                         external_port=portmap.external_port
                     ))
-                links = []
-                if unit.environment:
-                    environment_dict = unit.environment.to_dict()
-                    for label, value in environment_dict.items():
-                        # <ALIAS>_PORT_<PORTNUM>_TCP_PORT=<value>
-                        parts = label.rsplit(b"_", 4)
-                        try:
-                            alias, pad_a, port, pad_b, pad_c = parts
-                            local_port = int(port)
-                        except ValueError:
-                            continue
-                        if (pad_a, pad_b, pad_c) == (b"PORT", b"TCP", b"PORT"):
-                            links.append(Link(
-                                local_port=local_port,
-                                remote_port=int(value),
-                                alias=alias,
-                            ))
+                links, environment = _parse_environment(unit.environment)
                 application = Application(
                     name=unit.name,
                     image=image,
                     ports=frozenset(ports),
                     volume=volume,
-                    links=frozenset(links)
+                    links=links,
+                    environment=environment,
                 )
                 if unit.activation_state == u"active":
                     running.append(application)
@@ -361,26 +987,38 @@ class Deployer(object):
             return NodeState(
                 running=running,
                 not_running=not_running,
-                used_ports=self.network.enumerate_used_ports()
             )
         d.addCallback(applications_from_units)
         return d
 
     def calculate_necessary_state_changes(self, desired_state,
-                                          current_cluster_state, hostname):
+                                          current_cluster_state, hostname,
+                                          applications=None):
         """
         Work out which changes need to happen to the local state to match
         the given desired state.
 
-        Currently this involves the following phases:
-
-        1. Change proxies to point to new addresses (should really be
-           last, see https://github.com/ClusterHQ/flocker/issues/380)
-        2. Stop all relevant containers.
-        3. Handoff volumes.
-        4. Wait for volumes.
-        5. Create volumes.
-        6. Start and restart any relevant containers.
+        The changes are run in dependency order rather than in global
+        phases, so unrelated changes don't wait for each other:
+
+        * Proxies are changed to point to new addresses immediately (should
+          really be last, see https://github.com/ClusterHQ/flocker/issues/380)
+          except for those to applications without volumes which are moving
+          away from this node.
+        * Applications without volumes which are moving away are left
+          running until they are running on their new node.  Only then are
+          proxies pointed at the new node and the old instance stopped.
+        * Volumes moving away are pushed immediately and handed off once the
+          push is done and the application using them has stopped.
+        * Volumes moving here are waited for, and new volumes created,
+          immediately.
+        * Images of applications to be started are pulled immediately, in
+          parallel with copying volumes.
+        * Applications are started once their image has been pulled, their
+          volume is available, any applications they replace or whose ports
+          they need have stopped, and, if they have links, proxies have been
+          changed.  Those applications are only stopped once the image has
+          been pulled.
 
         :param Deployment desired_state: The intended configuration of all
             nodes.
@@ -390,28 +1028,41 @@ class Deployer(object):
             again to ensure we have absolute latest information.
         :param unicode hostname: The hostname of the node that this is running
             on.
+        :param applications: The names of the only applications, and their
+            volumes, to discover and plan changes for, e.g. because the
+            others are known to be as configured already, or ``None`` to
+            plan for all of them.  Proxies are always planned.
 
-        :return: A ``Deferred`` which fires with a ``IStateChange``
-            provider.
+        :return: A ``Deferred`` which fires with a ``InDependencyOrder``.
         """
-        phases = []
+        # Maps each change to the changes it depends on:
+        dependencies = {}
 
         desired_proxies = set()
         desired_node_applications = []
+        # Maps the name of each application desired on another node to that
+        # node's hostname and the application:
+        remote_applications = {}
         for node in desired_state.nodes:
             if node.hostname == hostname:
-                desired_node_applications = node.applications
+                desired_node_applications = [
+                    application for application in node.applications
+                    if applications is None or
+                    application.name in applications]
             else:
                 for application in node.applications:
+                    remote_applications[application.name] = (
+                        node.hostname, application)
                     for port in application.ports:
                         # XXX: also need to do DNS resolution. See
                         # https://github.com/ClusterHQ/flocker/issues/322
                         desired_proxies.add(Proxy(ip=node.hostname,
                                                   port=port.external_port))
-        if desired_proxies != set(self.network.enumerate_proxies()):
-            phases.append(SetProxies(ports=desired_proxies))
+        current_proxies = set(self.network.enumerate_proxies())
 
-        d = self.discover_node_configuration()
+        # Used ports aren't needed for planning, and finding them would
+        # enumerate the proxies a second time:
+        d = self._discover_applications(applications)
 
         def find_differences(current_node_state):
             current_node_applications = current_node_state.running
@@ -432,22 +1083,157 @@ class Deployer(object):
             stop_names = {app.name for app in all_applications}.difference(
                 desired_local_state)
 
-            start_containers = [
-                StartApplication(application=app, hostname=hostname)
-                for app in desired_node_applications
-                if app.name in start_names
-            ]
-            stop_containers = [
-                StopApplication(application=app) for app in all_applications
-                if app.name in stop_names
-            ]
-            restart_containers = [
-                Sequentially(changes=[StopApplication(application=app),
-                                      StartApplication(application=app,
-                                                       hostname=hostname)])
-                for app in desired_node_applications
-                if app.name in not_running
-            ]
+            # Running applications without volumes which are moving to
+            # another node, mapped to the change waiting for them to run
+            # there:
+            moving = {}
+            for app in current_node_applications:
+                if app.name in stop_names and app.name in remote_applications:
+                    remote_hostname, remote_application = (
+                        remote_applications[app.name])
+                    if remote_application.volume is None:
+                        moving[app] = WaitForApplication(
+                            application=remote_application,
+                            hostname=remote_hostname)
+                        dependencies[moving[app]] = frozenset()
+            moving_proxies = {
+                Proxy(ip=wait.hostname, port=port.external_port)
+                for wait in moving.values()
+                for port in wait.application.ports}
+
+            # Until they are running elsewhere, the moving applications
+            # keep receiving their traffic here:
+            set_proxies = None
+            if desired_proxies - moving_proxies != current_proxies:
+                set_proxies = SetProxies(
+                    ports=frozenset(desired_proxies - moving_proxies))
+                dependencies[set_proxies] = frozenset()
+            switch_proxies = None
+            if moving:
+                switch_proxies = SetProxies(ports=frozenset(desired_proxies))
+                prerequisites = set(moving.values())
+                if set_proxies is not None:
+                    prerequisites.add(set_proxies)
+                dependencies[switch_proxies] = frozenset(prerequisites)
+
+            # Applications discovered from Docker don't know how long they
+            # may take to stop, so use what the configuration says:
+            stop_timeouts = {}
+            for node in desired_state.nodes:
+                for application in node.applications:
+                    stop_timeouts[application.name] = (
+                        application.stop_timeout)
+            for node in current_cluster_state.nodes:
+                if node.hostname == hostname:
+                    for application in node.applications:
+                        if application.stop_timeout is not None:
+                            stop_timeouts[application.name] = (
+                                application.stop_timeout)
+
+            stops = {}
+            for app in all_applications:
+                if app.name in stop_names:
+                    stops[app] = StopApplication(
+                        application=app,
+                        stop_timeout=stop_timeouts.get(app.name))
+                    if app in moving:
+                        dependencies[stops[app]] = frozenset({switch_proxies})
+                    else:
+                        dependencies[stops[app]] = frozenset()
+
+            # Find any applications with volumes that are moving to or from
+            # this node - or that are being newly created by this new
+            # configuration.
+            volumes = find_volume_changes(hostname, current_cluster_state,
+                                          desired_state)
+            if applications is not None:
+                volumes = VolumeChanges(
+                    going={handoff for handoff in volumes.going
+                           if handoff.volume.name in applications},
+                    coming={volume for volume in volumes.coming
+                            if volume.name in applications},
+                    creating={volume for volume in volumes.creating
+                              if volume.name in applications})
+
+            # The names of the local applications using each volume, as
+            # far as the cluster state knows:
+            volume_users = {}
+            for node in current_cluster_state.nodes:
+                if node.hostname == hostname:
+                    for application in node.applications:
+                        if application.volume is not None:
+                            volume_users.setdefault(
+                                application.volume.name, set()).add(
+                                    application.name)
+
+            for handoff in volumes.going:
+                # Do an initial push of all volumes that are going to move,
+                # so that the final push which happens during handoff is a
+                # quick incremental push. This should significantly reduces
+                # the application downtime caused by the time it takes to
+                # copy data.
+                push = PushVolume(volume=handoff.volume,
+                                  hostname=handoff.hostname)
+                dependencies[push] = frozenset()
+                # The volume mustn't be in use when it is handed off:
+                users = {stop for app, stop in stops.items()
+                         if app.name in volume_users.get(
+                             handoff.volume.name, ())}
+                dependencies[HandoffVolume(
+                    volume=handoff.volume, hostname=handoff.hostname)] = (
+                    frozenset({push} | users))
+
+            # The change after which each volume is available locally:
+            volume_ready = {}
+            for volume in volumes.coming:
+                volume_ready[volume.name] = WaitForVolume(volume=volume)
+            for volume in volumes.creating:
+                volume_ready[volume.name] = CreateVolume(volume=volume)
+            for change in volume_ready.values():
+                dependencies[change] = frozenset()
+
+            def start(application, replacing=None):
+                """
+                Add a ``StartApplication`` and its dependencies.
+
+                :param Application application: The application to start.
+                :param Application replacing: An existing application of the
+                    same name to stop first, or ``None``.
+                """
+                # Download the image before stopping anything it replaces,
+                # so the download doesn't add to the downtime:
+                pull = PullImage(image=application.image)
+                dependencies[pull] = frozenset()
+                prerequisites = {pull}
+                if replacing is not None:
+                    stop = StopApplication(
+                        application=replacing,
+                        stop_timeout=stop_timeouts.get(replacing.name))
+                    dependencies[stop] = frozenset({pull})
+                    prerequisites.add(stop)
+                if (application.volume is not None and
+                        application.volume.name in volume_ready):
+                    prerequisites.add(volume_ready[application.volume.name])
+                # Proxies may be using ports it needs:
+                ports = {port.external_port for port in application.ports}
+                if set_proxies is not None and (
+                        application.links or
+                        ports & {proxy.port for proxy in current_proxies}):
+                    prerequisites.add(set_proxies)
+                # Applications being stopped may be using ports it needs:
+                for app, stop in stops.items():
+                    if ports & {port.external_port for port in app.ports}:
+                        dependencies[stop] = dependencies[stop] | {pull}
+                        prerequisites.add(stop)
+                dependencies[StartApplication(
+                    application=application, hostname=hostname)] = (
+                    frozenset(prerequisites))
+
+            for app in desired_node_applications:
+                if app.name in start_names:
+                    start(app)
+                elif app.name in not_running:
+                    start(app, replacing=app)
 
             applications_to_inspect = current_state & desired_local_state
             current_applications_dict = dict(zip(
@@ -461,54 +1247,11 @@ class Deployer(object):
             for application_name in applications_to_inspect:
                 inspect_desired = desired_applications_dict[application_name]
                 inspect_current = current_applications_dict[application_name]
-                if inspect_desired != inspect_current:
-                    changes = [
-                        StopApplication(application=inspect_current),
-                        StartApplication(application=inspect_desired,
-                                         hostname=hostname)
-                    ]
-                    sequence = Sequentially(changes=changes)
-                    if sequence not in restart_containers:
-                        restart_containers.append(sequence)
-
-            # Find any applications with volumes that are moving to or from
-            # this node - or that are being newly created by this new
-            # configuration.
-            volumes = find_volume_changes(hostname, current_cluster_state,
-                                          desired_state)
-
-            # Do an initial push of all volumes that are going to move, so
-            # that the final push which happens during handoff is a quick
-            # incremental push. This should significantly reduces the
-            # application downtime caused by the time it takes to copy
-            # data.
-            if volumes.going:
-                phases.append(InParallel(changes=[
-                    PushVolume(volume=handoff.volume,
-                               hostname=handoff.hostname)
-                    for handoff in volumes.going]))
-
-            if stop_containers:
-                phases.append(InParallel(changes=stop_containers))
-            if volumes.going:
-                phases.append(InParallel(changes=[
-                    HandoffVolume(volume=handoff.volume,
-                                  hostname=handoff.hostname)
-                    for handoff in volumes.going]))
-            if volumes.coming:
-                phases.append(InParallel(changes=[
-                    WaitForVolume(volume=volume)
-                    for volume in volumes.coming]))
-            if volumes.creating:
-                phases.append(InParallel(changes=[
-                    CreateVolume(volume=volume)
-                    for volume in volumes.creating]))
-            start_restart = start_containers + restart_containers
-            if start_restart:
-                phases.append(InParallel(changes=start_restart))
+                if _differs(inspect_desired, inspect_current):
+                    start(inspect_desired, replacing=inspect_current)
 
         d.addCallback(find_differences)
-        d.addCallback(lambda _: Sequentially(changes=phases))
+        d.addCallback(lambda _: InDependencyOrder(dependencies=dependencies))
         return d
 
     def change_node_state(self, desired_state,
@@ -524,15 +1267,107 @@ class Deployer(object):
         :param unicode hostname: The hostname of the node that this is running
             on.
 
+        If ``applied_state`` records the configuration the node was last
+        changed to match, only the applications whose configuration differs
+        from the record, or which were stopped, removed or started since,
+        are discovered and planned for, along with the proxies.  If nothing
+        differs the changes aren't planned at all.
+
+        The changes are run, timed and logged by a new ``profile``.
+
+        :return: ``Deferred`` that fires when the necessary changes are done.
+        """
+        self.profile = ChangeProfile(self.reactor)
+        if self.applied_state is None:
+            return self._change_node_state(
+                desired_state, current_cluster_state, hostname)
+
+        applications, proxies = _node_configuration(desired_state, hostname)
+        d = self._changed_since_applied(applications, proxies)
+
+        def change(changed):
+            if changed is None:
+                names = None
+            else:
+                names, proxies_changed = changed
+                if not names and not proxies_changed:
+                    return None
+            # Once changes start the node no longer matches the record:
+            self.applied_state.clear()
+            changing = self._change_node_state(
+                desired_state, current_cluster_state, hostname, names)
+            changing.addCallback(self._record_applied, applications, proxies)
+            return changing
+        d.addCallback(change)
+        return d
+
+    def _change_node_state(self, desired_state, current_cluster_state,
+                           hostname, applications=None):
+        """
+        Plan and run the changes needed to match the desired state.
+
+        :param applications: See ``calculate_necessary_state_changes``.
+
         :return: ``Deferred`` that fires when the necessary changes are done.
         """
         d = self.calculate_necessary_state_changes(
             desired_state=desired_state,
             current_cluster_state=current_cluster_state,
-            hostname=hostname)
-        d.addCallback(lambda change: change.run(self))
+            hostname=hostname, applications=applications)
+        d.addCallback(lambda change: self.profile.run(change, self))
         return d
 
+    def _changed_since_applied(self, applications, proxies):
+        """
+        Find what differs from the configuration recorded by
+        ``applied_state``.
+
+        This is much cheaper than planning for every application: volumes
+        aren't enumerated and containers aren't compared with their
+        configuration, only checked to be the ones which should be running.
+
+        :param dict applications: The node's desired applications, as found
+            by ``_node_configuration``.
+        :param frozenset proxies: The node's desired proxies.
+
+        :return: A ``Deferred`` which fires with ``None`` if nothing was
+            recorded, otherwise with a tuple of a ``frozenset`` of the names
+            of the applications to plan for, and whether the proxies differ
+            from the record.
+        """
+        applied = self.applied_state.load()
+        if applied is None:
+            return succeed(None)
+        proxies_changed = (
+            proxies != applied.proxies or
+            frozenset(self.network.enumerate_proxies()) != applied.proxies)
+        changed = {
+            name for name in set(applications) | set(applied.applications)
+            if applications.get(name) != applied.applications.get(name)}
+        d = self.docker_client.list()
+
+        def drifted(units):
+            found = {(unit.name, unit.activation_state) for unit in units}
+            left = {(name, u"active") for name in applied.applications}
+            changed.update(name for name, _ in found ^ left)
+            return frozenset(changed), proxies_changed
+        d.addCallback(drifted)
+        return d
+
+    def _record_applied(self, result, applications, proxies):
+        """
+        Record that the node now matches the desired state.
+
+        :param dict applications: The node's applications, as found by
+            ``_node_configuration``.
+        :param frozenset proxies: The node's proxies.
+
+        :return: ``result``.
+        """
+        self.applied_state.save(AppliedState(
+            applications=applications, proxies=proxies))
+        return result
+
 
 def find_volume_changes(hostname, current_state, desired_state):
     """
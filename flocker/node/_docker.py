@@ -6,21 +6,44 @@ Docker API client.
 
 from __future__ import absolute_import
 
-from time import sleep
+from io import BytesIO
+from json import dumps, loads
+from threading import Lock, Thread
+from time import sleep, time
+from urllib import quote, urlencode
 
 from zope.interface import Interface, implementer
 
 from docker import Client
 from docker.errors import APIError
+from docker.utils import parse_repository_tag
+from requests import Response
 
 from characteristic import attributes, Attribute
 
 from twisted.python.components import proxyForInterface
+from twisted.python.failure import Failure
 from twisted.python.filepath import FilePath
-from twisted.internet.defer import succeed, fail
-from twisted.internet.threads import deferToThread
+from twisted.python.threadpool import ThreadPool
+from twisted.application.service import Service
+from twisted.internet.defer import (
+    Deferred, DeferredSemaphore, FirstError, gatherResults, succeed, fail)
+from twisted.internet.endpoints import UNIXClientEndpoint
+from twisted.internet.task import deferLater
+from twisted.internet.threads import deferToThreadPool
+from twisted.web.client import (
+    FileBodyProducer, HTTPConnectionPool, ProxyAgent, readBody)
+from twisted.web.http_headers import Headers
 from twisted.web.http import NOT_FOUND, INTERNAL_SERVER_ERROR
 
+from eliot import Logger, writeFailure
+from eliot.twisted import DeferredContext
+
+from ._logging import STOP_CONTAINER, DOCKER_CALL
+
+
+_LOG_SYSTEM = u"flocker:node:docker"
+
 
 class AlreadyExists(Exception):
     """A unit with the given name already exists."""
@@ -136,6 +159,15 @@ class IDockerClient(Interface):
             :class:`AlreadyExists` if a unit by that name already exists.
         """
 
+    def pull(image_name):
+        """
+        Make sure an image is available locally, downloading it if it isn't.
+
+        :param unicode image_name: The Docker image to make available.
+
+        :return: ``Deferred`` that fires once the image is available.
+        """
+
     def exists(unit_name):
         """
         Check whether the unit exists.
@@ -147,18 +179,36 @@ class IDockerClient(Interface):
             otherwise ``False``.
         """
 
-    def remove(unit_name):
+    def remove(unit_name, stop_timeout=None):
         """
         Stop and delete the given unit.
 
         This can be done multiple times in a row for the same unit.
 
         :param unicode unit_name: The name of the unit to stop.
+        :param stop_timeout: How many seconds the unit is given to stop
+            before it is killed, or ``None`` for ``STOP_TIMEOUT``.
 
         :return: ``Deferred`` that fires once the unit has been stopped
             and removed.
         """
 
+    def remove_many(units):
+        """
+        Stop and delete several units at once, deleting each as soon as it
+        has stopped rather than waiting for the others.
+
+        :param dict units: Maps the name of each unit to remove to how many
+            seconds it is given to stop before it is killed, or ``None`` for
+            ``STOP_TIMEOUT``.
+
+        :return: ``Deferred`` that fires once all of the units have been
+            stopped and removed, with a ``dict`` mapping the name of each
+            unit to how many seconds it took to stop.  If any can't be
+            removed it fails with the first error, once the others have been
+            removed.
+        """
+
     def list():
         """
         List all known units.
@@ -174,6 +224,9 @@ class FakeDockerClient(object):
     The state the the simulated units is stored in memory.
 
     :ivar dict _units: See ``units`` of ``__init__``\ .
+    :ivar set _images: The names of the images which have been pulled.
+    :ivar dict _stop_timeouts: Maps the name of each removed unit to the
+        ``stop_timeout`` it was removed with.
     """
 
     def __init__(self, units=None):
@@ -186,6 +239,8 @@ class FakeDockerClient(object):
         if units is None:
             units = {}
         self._units = units
+        self._images = set()
+        self._stop_timeouts = {}
 
     def add(self, unit_name, image_name, ports=frozenset(), environment=None,
             volumes=frozenset()):
@@ -202,14 +257,24 @@ class FakeDockerClient(object):
         )
         return succeed(None)
 
+    def pull(self, image_name):
+        self._images.add(image_name)
+        return succeed(None)
+
     def exists(self, unit_name):
         return succeed(unit_name in self._units)
 
-    def remove(self, unit_name):
+    def remove(self, unit_name, stop_timeout=None):
         if unit_name in self._units:
             del self._units[unit_name]
+        self._stop_timeouts[unit_name] = stop_timeout
         return succeed(None)
 
+    def remove_many(self, units):
+        for unit_name, stop_timeout in units.items():
+            self.remove(unit_name, stop_timeout)
+        return succeed({unit_name: 0.0 for unit_name in units})
+
     def list(self):
         units = set(self._units.values())
         return succeed(units)
@@ -226,27 +291,215 @@ class PortMap(object):
     """
 
 
+def _gather(deferreds):
+    """
+    Wait for several ``Deferred``\ s.
+
+    :param list deferreds: The ``Deferred``\ s to wait for.
+
+    :return: A ``Deferred`` firing with a ``list`` of their results, or
+        failing with the first of them to fail.
+    """
+    gathering = gatherResults(deferreds, consumeErrors=True)
+
+    def failed(failure):
+        failure.trap(FirstError)
+        return failure.value.subFailure
+    gathering.addErrback(failed)
+    return gathering
+
+
+def _ignore_gone(failure):
+    """
+    Ignore the failure of a request to stop or delete a container which
+    has already been stopped or deleted.
+
+    :param Failure failure: The failure of the request.
+
+    :return: ``None`` if the failure is ignored, otherwise ``failure``.
+    """
+    failure.trap(APIError)
+    # 500 error code is used for "this was already stopped" in older
+    # versions of Docker. Newer versions of Docker API give NOT_MODIFIED
+    # instead, so we can fix this when we upgrade:
+    # https://github.com/ClusterHQ/flocker/issues/721
+    if failure.value.response.status_code in (
+            NOT_FOUND, INTERNAL_SERVER_ERROR):
+        return None
+    return failure
+
+
+# How much of an image to hold in memory at once when loading it from
+# another node:
+IMAGE_CHUNK_SIZE = 1024 * 1024
+
 # Basic namespace for Flocker containers:
 BASE_NAMESPACE = u"flocker--"
 BASE_DOCKER_API_URL = u'unix://var/run/docker.sock'
 
+# How many containers to inspect at once when listing units:
+LIST_CONCURRENCY = 8
+
+# How many seconds a container is given to stop before Docker kills it, if
+# its application doesn't say:
+STOP_TIMEOUT = 10
+
+# How many blocking Docker API calls a DockerClient makes at once:
+DOCKER_THREADS = 10
+
+# How many seconds to wait before checking again whether Docker knows about a
+# container it has just created, and the most to wait between checks:
+CONTAINER_POLL_INTERVAL = 0.01
+CONTAINER_POLL_MAX_INTERVAL = 1.0
+
+
+def _poll_intervals():
+    """
+    Generate the delays between checks for a container which has just been
+    created, starting at ``CONTAINER_POLL_INTERVAL`` and doubling each time
+    up to ``CONTAINER_POLL_MAX_INTERVAL``.
+    """
+    interval = CONTAINER_POLL_INTERVAL
+    while True:
+        yield interval
+        interval = min(interval * 2, CONTAINER_POLL_MAX_INTERVAL)
+
+
+def _daemon_thread(*args, **kwargs):
+    """
+    Create a daemon thread, so that idle workers don't keep the process
+    running if the reactor is never shut down.
+    """
+    thread = Thread(*args, **kwargs)
+    thread.daemon = True
+    return thread
+
+
+class DockerWorkers(object):
+    """
+    A thread pool dedicated to blocking Docker API calls, so that slow ones
+    (e.g. pulling an image) don't starve other users of the reactor's thread
+    pool.
+
+    Each call is logged as a ``flocker:node:docker:call`` action, giving
+    how many calls were queued when it was made, how long it waited for a
+    thread and how long it ran.
+
+    :ivar int size: The largest number of threads in the pool.
+    :ivar int queued: How many calls are waiting for a thread.
+    """
+    logger = Logger()
+
+    def __init__(self, reactor, size=DOCKER_THREADS):
+        """
+        :param reactor: The reactor to deliver results in.  The pool is
+            stopped when it shuts down.
+        :param int size: See ``size``.
+        """
+        self._reactor = reactor
+        self.size = size
+        self.queued = 0
+        self._lock = Lock()
+        self._pool = None
+
+    def _started_pool(self):
+        """
+        :return: The ``ThreadPool``, started the first time it is needed so
+            that clients which are never used don't create threads.
+        """
+        if self._pool is None:
+            self._pool = ThreadPool(minthreads=0, maxthreads=self.size,
+                                    name=b"docker")
+            self._pool.threadFactory = _daemon_thread
+            self._pool.start()
+            self._reactor.addSystemEventTrigger(
+                "during", "shutdown", self._pool.stop)
+        return self._pool
+
+    def run(self, function, *args, **kwargs):
+        """
+        Call a function in the pool.
+
+        :param function: The blocking callable.
+        :param args: Positional arguments for ``function``.
+        :param kwargs: Keyword arguments for ``function``.
+
+        :return: A ``Deferred`` firing with the result of ``function``.
+        """
+        pool = self._started_pool()
+        with self._lock:
+            self.queued += 1
+            queue_length = self.queued
+        submitted = time()
+        timing = {}
+
+        def call():
+            started = time()
+            with self._lock:
+                self.queued -= 1
+            try:
+                return function(*args, **kwargs)
+            finally:
+                timing[u"waited"] = started - submitted
+                timing[u"duration"] = time() - started
+
+        action = DOCKER_CALL(self.logger, function=function,
+                             queue_length=queue_length)
+        with action.context():
+            d = DeferredContext(
+                deferToThreadPool(self._reactor, pool, call))
+
+        def finished(result):
+            action.addSuccessFields(**timing)
+            return result
+        d.addCallback(finished)
+        d.addActionFinish()
+        return d.result
+
 
 @implementer(IDockerClient)
 class DockerClient(object):
     """
     Talk to the real Docker server directly.
 
-    Some operations can take a while (e.g. stopping a container), so we
-    use a thread pool. See https://github.com/ClusterHQ/flocker/issues/718
-    for using a custom thread pool.
+    Some operations can take a while (e.g. stopping a container), so they
+    are run in a ``DockerWorkers`` thread pool of the client's own.
 
     :ivar unicode namespace: A namespace prefix to add to container names
         so we don't clobber other applications interacting with Docker.
+    :ivar int list_concurrency: How many containers ``list`` inspects at
+        once.
+    :ivar DockerWorkers workers: The thread pool blocking calls are run in.
     """
+    logger = Logger()
+
     def __init__(self, namespace=BASE_NAMESPACE,
-                 base_url=BASE_DOCKER_API_URL):
+                 base_url=BASE_DOCKER_API_URL, image_peers=None,
+                 list_concurrency=LIST_CONCURRENCY, threads=DOCKER_THREADS,
+                 reactor=None):
+        """
+        :param image_peers: A callable which is passed the name of an image
+            and returns a sequence of ``INode`` providers for other nodes
+            which may have that image, in order of preference.  Images which
+            aren't available locally are copied from these nodes (using
+            ``docker save`` and ``docker load``) in preference to pulling
+            them from a registry.  Default is no other nodes.
+        :param int list_concurrency: See ``list_concurrency``.
+        :param int threads: How many blocking calls to make at once.
+        :param reactor: The reactor to run the thread pool with, or ``None``
+            for the global reactor.
+        """
+        if reactor is None:
+            from twisted.internet import reactor
         self.namespace = namespace
+        self.list_concurrency = list_concurrency
+        self.workers = DockerWorkers(reactor, threads)
         self._client = Client(version="1.12", base_url=base_url)
+        if image_peers is None:
+            image_peers = lambda image_name: []
+        self._image_peers = image_peers
+        # The ``Deferred``\ s waiting for each image being pulled:
+        self._pulling = {}
 
     def _to_container_name(self, unit_name):
         """
@@ -291,6 +544,97 @@ class DockerClient(object):
                     ports.append(portmap)
         return ports
 
+    def _parse_listed_ports(self, data):
+        """
+        Parse the ports of a container in the format returned by
+        ``self._client.containers``.
+
+        :param list data: The ``Ports`` of the container, a ``dict`` for
+            each port it exposes, e.g.
+            {"PrivatePort": 3306, "PublicPort": 53306, "Type": "tcp",
+             "IP": "0.0.0.0"}
+            Ports which aren't bound on the host have no ``PublicPort``.
+
+        :return list: A list that is either empty or contains ``PortMap``
+            instances.
+        """
+        return [PortMap(internal_port=int(port[u"PrivatePort"]),
+                        external_port=int(port[u"PublicPort"]))
+                for port in data or () if port.get(u"PublicPort")]
+
+    def _unit_name(self, names):
+        """
+        Find the unit name of a container from the names listed by
+        ``self._client.containers``.
+
+        :param list names: The container's names, e.g. ``[u"/flocker--foo"]``.
+            Links add further names of the form ``u"/other/alias"``.
+
+        :return: The ``unicode`` unit name, or ``None`` if the container is
+            outside this client's namespace.
+        """
+        prefix = u"/" + self.namespace
+        for name in names or ():
+            if name.startswith(prefix) and u"/" not in name[1:]:
+                return name[len(prefix):]
+        return None
+
+    def _parse_environment(self, variables, defaults):
+        """
+        Parse the environment of a container, as returned by
+        ``self._client.inspect_container``, into an ``Environment``.
+
+        Docker merges the environment of the image into the container's, so
+        variables set identically by the image are left out; they weren't
+        supplied when the container was created.
+
+        :param variables: A ``list`` of ``u"KEY=value"`` strings from the
+            container's ``Config.Env``, or ``None``.
+        :param frozenset defaults: The ``(key, value)`` tuples set by the
+            container's image.
+
+        :return: An ``Environment``, or ``None`` if no variables remain.
+        """
+        if not variables:
+            return None
+        environment = frozenset(
+            tuple(variable.split(u"=", 1)) for variable in variables
+            if u"=" in variable) - defaults
+        if not environment:
+            return None
+        return Environment(variables=environment)
+
+    def _image_environment(self, image_name):
+        """
+        Blocking API to find the environment variables an image sets.
+
+        :param unicode image_name: The image to inspect.
+
+        :return: A ``frozenset`` of ``(key, value)`` tuples, empty if the
+            image no longer exists.
+        """
+        try:
+            data = self._client.inspect_image(image_name)
+        except APIError as e:
+            if e.response.status_code != NOT_FOUND:
+                raise
+            return frozenset()
+        return self._parse_image_environment(data)
+
+    def _parse_image_environment(self, data):
+        """
+        Parse the environment variables an image sets.
+
+        :param dict data: The image as returned by
+            ``self._client.inspect_image``.
+
+        :return: A ``frozenset`` of ``(key, value)`` tuples.
+        """
+        config = data.get(u"Config") or {}
+        return frozenset(
+            tuple(variable.split(u"=", 1))
+            for variable in config.get(u"Env") or () if u"=" in variable)
+
     def add(self, unit_name, image_name, ports=None, environment=None,
             volumes=()):
         container_name = self._to_container_name(unit_name)
@@ -308,24 +652,7 @@ class DockerClient(object):
                 volumes=list(volume.container_path.path for volume in volumes),
                 ports=[p.internal_port for p in ports])
 
-        def _add():
-            try:
-                _create()
-            except APIError as e:
-                if e.response.status_code == NOT_FOUND:
-                    # Image was not found, so we need to pull it first:
-                    self._client.pull(image_name)
-                    _create()
-                else:
-                    raise
-            # Just because we got a response doesn't mean Docker has
-            # actually updated any internal state yet! So if e.g. we did a
-            # stop on this container Docker might well complain it knows
-            # not the container of which we speak. To prevent this we poll
-            # until it does exist.
-            while not self._blocking_exists(container_name):
-                sleep(0.001)
-                continue
+        def _start():
             self._client.start(container_name,
                                binds={volume.node_path.path:
                                       {u"bind": volume.container_path.path,
@@ -333,7 +660,14 @@ class DockerClient(object):
                                       for volume in volumes},
                                port_bindings={p.internal_port: p.external_port
                                               for p in ports})
-        d = deferToThread(_add)
+        d = self._create_with_image(image_name,
+                                    lambda: self.workers.run(_create))
+        # Just because we got a response doesn't mean Docker has actually
+        # updated any internal state yet! So if e.g. we did a stop on this
+        # container Docker might well complain it knows not the container of
+        # which we speak. To prevent this we wait until it does exist.
+        d.addCallback(lambda _: self._wait_for_container(container_name))
+        d.addCallback(lambda _: self.workers.run(_start))
 
         def _extract_error(failure):
             failure.trap(APIError)
@@ -344,6 +678,134 @@ class DockerClient(object):
         d.addErrback(_extract_error)
         return d
 
+    def _create_with_image(self, image_name, create):
+        """
+        Create a container, pulling its image first if it is missing.
+
+        If the image is already being pulled the container isn't created
+        until the pull has finished, rather than failing to find the image
+        and pulling it again.
+
+        :param unicode image_name: The container's image.
+        :param create: A callable which creates the container, returning a
+            ``Deferred`` which fails with ``APIError`` if Docker can't find
+            the image.
+
+        :return: A ``Deferred`` which fires once the container is created.
+        """
+        if image_name in self._pulling:
+            d = self.pull(image_name)
+            # If the pull failed, creating the container will find the image
+            # missing and pull it again:
+            d.addErrback(lambda _: None)
+        else:
+            d = succeed(None)
+        d.addCallback(lambda _: create())
+
+        def _image_missing(failure):
+            failure.trap(APIError)
+            if failure.value.response.status_code != NOT_FOUND:
+                return failure
+            # Image was not found, so we need to pull it first.
+            d = self.pull(image_name)
+            d.addCallback(lambda _: create())
+            return d
+        d.addErrback(_image_missing)
+        return d
+
+    def _wait_for_container(self, container_name):
+        """
+        Wait for Docker to know about a container which has just been
+        created, by polling until it exists.
+
+        :param unicode container_name: The name of the container.
+
+        :return: A ``Deferred`` which fires once the container exists.
+        """
+        def _wait():
+            intervals = _poll_intervals()
+            while not self._blocking_exists(container_name):
+                sleep(next(intervals))
+        return self.workers.run(_wait)
+
+    def _blocking_pull(self, image_name):
+        """
+        Blocking API to download an image, from another node which has it if
+        possible, otherwise from a registry.
+
+        :param unicode image_name: The Docker image to download.
+        """
+        if not self._blocking_load_from_peers(image_name):
+            self._client.pull(image_name)
+
+    def _blocking_load_from_peers(self, image_name):
+        """
+        Blocking API to copy an image from another node which has it.
+
+        :param unicode image_name: The Docker image to copy.
+
+        :return: ``True`` if the image was copied, ``False`` if no node could
+            supply it.
+        """
+        for peer in self._image_peers(image_name):
+            try:
+                with peer.read([b"docker", b"save",
+                                image_name.encode("ascii")]) as image:
+                    # A generator is sent chunked, so the image is streamed
+                    # to Docker rather than read into memory first:
+                    self._client.load_image(
+                        iter(lambda: image.read(IMAGE_CHUNK_SIZE), b""))
+                self._client.inspect_image(image_name)
+            except (IOError, APIError):
+                # Try the next node, and failing that the registry.
+                continue
+            return True
+        return False
+
+    def pull(self, image_name):
+        """
+        Make sure an image is available locally, downloading it if it isn't.
+
+        Only one download of each image runs at once; callers asking for an
+        image which is already being downloaded wait for that download.
+        Otherwise Docker is always asked whether the image is present, since
+        it may have been removed since it was last downloaded.
+
+        :param unicode image_name: The Docker image to make available.
+
+        :return: ``Deferred`` that fires once the image is available.
+        """
+        waiting = Deferred()
+        if image_name in self._pulling:
+            self._pulling[image_name].append(waiting)
+            return waiting
+        self._pulling[image_name] = [waiting]
+
+        def _pulled(result):
+            for d in self._pulling.pop(image_name):
+                d.callback(result)
+        self._pull_image(image_name).addBoth(_pulled)
+        return waiting
+
+    def _pull_image(self, image_name):
+        """
+        Make sure an image is available locally, downloading it if it isn't.
+
+        :param unicode image_name: The Docker image to make available.
+
+        :return: ``Deferred`` that fires once the image is available.
+        """
+        def _pull():
+            try:
+                self._client.inspect_image(image_name)
+            except APIError as e:
+                if e.response.status_code != NOT_FOUND:
+                    raise
+                self._blocking_pull(image_name)
+                # The pull doesn't report failures, so check it worked:
+                self._client.inspect_image(image_name)
+        return self.workers.run(_pull)
+
     def _blocking_exists(self, container_name):
         """
         Blocking API to check if container exists.
@@ -361,63 +823,879 @@ class DockerClient(object):
 
     def exists(self, unit_name):
         container_name = self._to_container_name(unit_name)
-        return deferToThread(self._blocking_exists, container_name)
+        return self.workers.run(self._blocking_exists, container_name)
+
+    def remove(self, unit_name, stop_timeout=None):
+        d = self._remove(unit_name, stop_timeout)
+        d.addCallback(lambda _: None)
+        return d
+
+    def remove_many(self, units):
+        names = sorted(units)
+        d = _gather([self._remove(unit_name, units[unit_name])
+                     for unit_name in names])
+        d.addCallback(lambda durations: dict(zip(names, durations)))
+        return d
 
-    def remove(self, unit_name):
+    def _remove(self, unit_name, stop_timeout):
+        """
+        Stop and delete a unit, timing how long it takes to stop.
+
+        See ``IDockerClient.remove`` for the parameters.
+
+        :return: A ``Deferred`` which fires with how many seconds the unit
+            took to stop, once it has been deleted.
+        """
         container_name = self._to_container_name(unit_name)
+        if stop_timeout is None:
+            stop_timeout = STOP_TIMEOUT
+
+        action = STOP_CONTAINER(self.logger, container=container_name,
+                                stop_timeout=stop_timeout)
+        with action.context():
+            started = time()
+            d = DeferredContext(
+                self._stop_container(container_name, stop_timeout))
+            d.addErrback(_ignore_gone)
+
+            def stopped(_):
+                duration = time() - started
+                action.addSuccessFields(duration=duration)
+                return duration
+            d.addCallback(stopped)
+            d.addActionFinish()
+        # Delete the container as soon as it has stopped, even if it had
+        # already stopped:
+        d = d.result
+
+        def delete(duration):
+            deleting = self._delete_container(container_name)
+            deleting.addErrback(_ignore_gone)
+            deleting.addCallback(lambda _: duration)
+            return deleting
+        d.addCallback(delete)
+        return d
 
-        def _remove():
-            try:
-                self._client.stop(container_name)
-                self._client.remove_container(container_name)
-            except APIError as e:
-                # 500 error code is used for "this was already stopped" in
-                # older versions of Docker. Newer versions of Docker API
-                # give NOT_MODIFIED instead, so we can fix this when we
-                # upgrade: https://github.com/ClusterHQ/flocker/issues/721
-                if e.response.status_code in (
-                        NOT_FOUND, INTERNAL_SERVER_ERROR):
-                    return
-                # Can't figure out how to get test coverage for this, but
-                # it's definitely necessary:
+    def _stop_container(self, container_name, stop_timeout):
+        """
+        Stop a container.
+
+        :param unicode container_name: The name of the container.
+        :param int stop_timeout: How many seconds it is given to stop before
+            it is killed.
+
+        :return: A ``Deferred`` which fires once it has stopped, or fails
+            with ``APIError``.
+        """
+        return self.workers.run(
+            self._client.stop, container_name, timeout=stop_timeout)
+
+    def _delete_container(self, container_name):
+        """
+        Delete a stopped container.
+
+        :param unicode container_name: The name of the container.
+
+        :return: A ``Deferred`` which fires once it has been deleted, or
+            fails with ``APIError``.
+        """
+        return self.workers.run(
+            self._client.remove_container, container_name)
+
+    def _blocking_unit(self, name, container, image_environments):
+        """
+        Blocking API to find out the rest of what ``list`` reports about a
+        container by inspecting it.
+
+        :param unicode name: The unit name of the container.
+        :param dict container: The container as returned by
+            ``self._client.containers``.
+        :param dict image_environments: Maps image names to the result of
+            ``_image_environment``, shared between containers since many
+            typically use the same image.
+
+        :return: A ``Unit``, or ``None`` if the container was removed since
+            it was listed.
+        """
+        try:
+            data = self._client.inspect_container(container[u"Id"])
+        except APIError as e:
+            if e.response.status_code != NOT_FOUND:
                 raise
-        d = deferToThread(_remove)
+            return None
+        image = data[u"Config"][u"Image"]
+        if image not in image_environments:
+            image_environments[image] = self._image_environment(image)
+        return self._unit(name, data, self._listed_state(container),
+                          self._parse_listed_ports(container[u"Ports"]),
+                          image_environments[image])
+
+    def _blocking_inspect_unit(self, container):
+        """
+        Blocking API to find out everything ``list`` reports about a single
+        container, by inspecting it.
+
+        :param unicode container: The ID or name of the container.
+
+        :return: A tuple of the container's ID, unit name and ``Unit``, or
+            ``None`` if the container is outside this client's namespace.
+
+        :raise APIError: With ``NOT_FOUND`` if the container doesn't exist.
+        """
+        data = self._client.inspect_container(container)
+        name = self._unit_name([data[u"Name"]])
+        if name is None:
+            return None
+        state = (u"active" if data[u"State"][u"Running"]
+                 else u"inactive")
+        port_mappings = data[u"NetworkSettings"][u"Ports"]
+        if port_mappings is not None:
+            ports = self._parse_container_ports(port_mappings)
+        else:
+            ports = list()
+        return (data[u"Id"], name,
+                self._unit(name, data, state, ports, self._image_environment(
+                    data[u"Config"][u"Image"])))
+
+    def _listed_state(self, container):
+        """
+        :param dict container: The container as returned by
+            ``self._client.containers``.
+
+        :return: The container's activation state.
+        """
+        return (u"active" if container[u"Status"].startswith(u"Up")
+                else u"inactive")
+
+    def _unit(self, name, data, state, ports, image_environment):
+        """
+        Create the ``Unit`` describing a container.
+
+        :param unicode name: The unit name of the container.
+        :param dict data: The container as returned by
+            ``self._client.inspect_container``.
+        :param unicode state: The container's activation state.
+        :param list ports: The container's ``PortMap``\ s.
+        :param frozenset image_environment: The result of
+            ``_image_environment`` for the container's image.
+
+        :return: A ``Unit``.
+        """
+        # The listing gives the image as Docker resolved it,
+        # e.g. "busybox:latest", rather than as it was given when the
+        # container was created, so the image comes from inspecting it:
+        image = data[u"Config"][u"Image"]
+        volumes = []
+        for container_path, node_path in data[u"Volumes"].items():
+            volumes.append(
+                Volume(container_path=FilePath(container_path),
+                       node_path=FilePath(node_path))
+            )
+        environment = self._parse_environment(
+            data[u"Config"][u"Env"], image_environment)
+        return Unit(name=name,
+                    container_name=self._to_container_name(name),
+                    activation_state=state,
+                    container_image=image,
+                    ports=frozenset(ports),
+                    environment=environment,
+                    volumes=frozenset(volumes))
+
+    def _list_units(self):
+        """
+        List the units in the namespace.
+
+        :return: ``Deferred`` firing with a ``dict`` mapping the IDs of the
+            containers to their ``Unit``\ s.
+        """
+        # Docker 1.12 can't filter the listing by name, so containers
+        # outside the namespace are left out here, before any are
+        # inspected.  The listing lacks the environment and volumes, so the
+        # remaining containers are still inspected, several at a time.
+        listing = self.workers.run(self._client.containers, all=True)
+
+        def got_containers(containers):
+            semaphore = DeferredSemaphore(self.list_concurrency)
+            image_environments = {}
+            inspecting = []
+            identifiers = []
+            for container in containers:
+                name = self._unit_name(container[u"Names"])
+                if name is None:
+                    continue
+                identifiers.append(container[u"Id"])
+                inspecting.append(semaphore.run(
+                    self.workers.run, self._blocking_unit, name, container,
+                    image_environments))
+            gathering = _gather(inspecting)
+            gathering.addCallback(
+                lambda units: {identifier: unit for identifier, unit
+                               in zip(identifiers, units)
+                               if unit is not None})
+            return gathering
+        listing.addCallback(got_containers)
+        return listing
+
+    def list(self):
+        listing = self._list_units()
+        listing.addCallback(lambda units: set(units.values()))
+        return listing
+
+
+# How long to wait, in seconds, before reconnecting to Docker's event stream
+# after it is lost:
+EVENTS_RECONNECT_DELAY = 1
+
+
+@implementer(IDockerClient)
+class CachingDockerClient(DockerClient, Service):
+    """
+    A ``DockerClient`` for long-running processes which keeps the units in
+    its namespace in memory, up to date with Docker's event stream.
+
+    While running and following the event stream, ``list`` and ``exists``
+    are answered from memory, and ``add`` waits for Docker's notification
+    that the container was created rather than polling for it.  Otherwise
+    it behaves like ``DockerClient``.
+
+    :ivar dict _units: Maps unit names to their ``Unit``, or is ``None`` if
+        the units are not currently known from the event stream.
+    """
+
+    def __init__(self, reactor, **kwargs):
+        """
+        :param reactor: The reactor to deliver events in, and to run the
+            thread pool with.
+        :param kwargs: Passed on to ``DockerClient``.
+        """
+        DockerClient.__init__(self, reactor=reactor, **kwargs)
+        self._reactor = reactor
+        self._units = None
+        # Maps the IDs of containers in the namespace to their unit names:
+        self._ids = {}
+        # The sequence number of the most recently started refresh, and of
+        # the last refresh applied to each unit, so that refreshes which
+        # finish out of order don't leave stale units behind:
+        self._refreshes = 0
+        self._applied = {}
+        # Containers changed while the units were being listed:
+        self._changed_while_syncing = None
+        # Maps container names to the ``Deferred``\ s waiting for them to
+        # be created:
+        self._creating = {}
+
+    def _start_thread(self, target):
+        """
+        Run a function in a daemon thread, so that a blocked read of the
+        event stream doesn't stop the process exiting.
+
+        :param target: The function to run.
+        """
+        thread = Thread(target=target, name=b"docker-events")
+        thread.daemon = True
+        thread.start()
+
+    def startService(self):
+        Service.startService(self)
+        self._start_thread(self._follow_events)
+
+    def stopService(self):
+        Service.stopService(self)
+        self._lost_events()
+
+    def _blocking_subscribe(self):
+        """
+        Blocking API to start receiving Docker's events.
+
+        :return: An iterator of JSON-encoded events.
+        """
+        # docker-py's ``events`` only sends the request once the first event
+        # is read, too late to know when events started being received:
+        response = self._client.get(self._client._url(u"/events"),
+                                    stream=True)
+        self._client._raise_for_status(response)
+        return self._client._stream_helper(response)
+
+    def _follow_events(self):
+        """
+        Blocking API to follow Docker's event stream until it ends, passing
+        each event to the reactor thread.
+        """
+        try:
+            events = self._blocking_subscribe()
+            self._reactor.callFromThread(self._subscribed)
+            for event in events:
+                self._reactor.callFromThread(self._event, loads(event))
+        except Exception:
+            self._reactor.callFromThread(self._disconnected, Failure())
+        else:
+            self._reactor.callFromThread(self._disconnected, None)
+
+    def _subscribed(self):
+        """
+        Called once events are being received: learn the current units, after
+        which the events keep them up to date.
+
+        :return: A ``Deferred`` which fires once the units are known.
+        """
+        if not self.running:
+            return succeed(None)
+        changed = self._changed_while_syncing = []
+        d = self._list_units()
+
+        def listed(units):
+            if self._changed_while_syncing is not changed:
+                # The stream was lost while listing.
+                return
+            self._changed_while_syncing = None
+            self._units = {unit.name: unit for unit in units.values()}
+            self._ids = {identifier: unit.name
+                         for identifier, unit in units.items()}
+            self._applied = {name: self._refreshes for name in self._units}
+            for container in changed:
+                self._refresh(container)
+            for container_name in list(self._creating):
+                if self._known(container_name):
+                    self._created(container_name)
+
+        def failed(failure):
+            if self._changed_while_syncing is changed:
+                self._changed_while_syncing = None
+            writeFailure(failure, self.logger, _LOG_SYSTEM)
+        d.addCallbacks(listed, failed)
+        return d
+
+    def _event(self, event):
+        """
+        Called with each event from Docker: find out how the container it
+        concerns has changed.
+
+        :param dict event: The decoded event.
+
+        :return: A ``Deferred`` which fires once the units are up to date.
+        """
+        container = event.get(u"id")
+        if container is None:
+            return succeed(None)
+        if self._changed_while_syncing is not None:
+            self._changed_while_syncing.append(container)
+            return succeed(None)
+        if self._units is None:
+            return succeed(None)
+        return self._refresh(container)
+
+    def _refresh(self, container):
+        """
+        Inspect a container and update its unit.
+
+        :param unicode container: The ID or name of the container.
+
+        :return: A ``Deferred`` which fires once the unit has been updated.
+        """
+        self._refreshes += 1
+        refresh = self._refreshes
+        d = self.workers.run(self._blocking_inspect_unit, container)
+
+        def inspected(result):
+            if result is None:
+                self._ids.pop(container, None)
+                return
+            identifier, name, unit = result
+            self._ids[identifier] = name
+            self._update(name, unit, refresh)
+
+        def not_found(failure):
+            failure.trap(APIError)
+            if failure.value.response.status_code != NOT_FOUND:
+                return failure
+            name = self._ids.pop(container, None)
+            if name is None and container.startswith(self.namespace):
+                name = container[len(self.namespace):]
+            if name is not None:
+                self._update(name, None, refresh)
+
+        def failed(failure):
+            writeFailure(failure, self.logger, _LOG_SYSTEM)
+        d.addCallbacks(inspected, not_found)
+        d.addErrback(failed)
         return d
 
+    def _update(self, name, unit, refresh):
+        """
+        Record the result of a refresh, unless a later one has already been
+        recorded.
+
+        :param unicode name: The unit name.
+        :param unit: The ``Unit``, or ``None`` if it no longer exists.
+        :param int refresh: The sequence number of the refresh.
+        """
+        if self._units is None or self._applied.get(name, 0) > refresh:
+            return
+        self._applied[name] = refresh
+        if unit is None:
+            self._units.pop(name, None)
+        else:
+            self._units[name] = unit
+            self._created(unit.container_name)
+
+    def _known(self, container_name):
+        """
+        :return: Whether the named container is among the known units.
+        """
+        return (self._units is not None and
+                container_name[len(self.namespace):] in self._units)
+
+    def _created(self, container_name):
+        """
+        Notify anything waiting for a container to be created.
+
+        :param unicode container_name: The name of the container.
+        """
+        for d in self._creating.pop(container_name, []):
+            d.callback(None)
+
+    def _disconnected(self, reason):
+        """
+        Called when the event stream ends: forget the units, since they may
+        change unnoticed, and reconnect if still running.
+
+        :param reason: A ``Failure`` if the stream failed, otherwise ``None``.
+        """
+        if reason is not None:
+            writeFailure(reason, self.logger, _LOG_SYSTEM)
+        self._lost_events()
+        if self.running:
+            self._reactor.callLater(
+                EVENTS_RECONNECT_DELAY, self._start_thread,
+                self._follow_events)
+
+    def _lost_events(self):
+        """
+        Stop relying on events, falling back to asking Docker directly.
+        """
+        self._units = None
+        self._changed_while_syncing = None
+        creating, self._creating = self._creating, {}
+        for container_name, waiting in creating.items():
+            for d in waiting:
+                DockerClient._wait_for_container(
+                    self, container_name).chainDeferred(d)
+
+    def _wait_for_container(self, container_name):
+        if self._units is None:
+            return DockerClient._wait_for_container(self, container_name)
+        if self._known(container_name):
+            return succeed(None)
+        d = Deferred()
+        self._creating.setdefault(container_name, []).append(d)
+        return d
+
+    def add(self, unit_name, image_name, ports=None, environment=None,
+            volumes=()):
+        d = DockerClient.add(self, unit_name, image_name, ports=ports,
+                             environment=environment, volumes=volumes)
+        # Callers may list the units as soon as this fires, before the
+        # event for the container starting is received:
+        d.addCallback(lambda _: self._refresh_known(
+            self._to_container_name(unit_name)))
+        return d
+
+    def _remove(self, unit_name, stop_timeout):
+        d = DockerClient._remove(self, unit_name, stop_timeout)
+
+        def removed(duration):
+            refreshing = self._refresh_known(
+                self._to_container_name(unit_name))
+            refreshing.addCallback(lambda _: duration)
+            return refreshing
+        d.addCallback(removed)
+        return d
+
+    def _refresh_known(self, container_name):
+        """
+        Update a unit after changing it, if the units are known.
+
+        :param unicode container_name: The name of the container.
+
+        :return: A ``Deferred`` which fires with ``None`` once it is updated.
+        """
+        if self._units is None:
+            return succeed(None)
+        d = self._refresh(container_name)
+        d.addCallback(lambda _: None)
+        return d
+
+    def exists(self, unit_name):
+        if self._units is None:
+            return DockerClient.exists(self, unit_name)
+        return succeed(unit_name in self._units)
+
     def list(self):
-        def _list():
-            result = set()
-            ids = [d[u"Id"] for d in
-                   self._client.containers(quiet=True, all=True)]
-            for i in ids:
-                data = self._client.inspect_container(i)
-                state = (u"active" if data[u"State"][u"Running"]
-                         else u"inactive")
-                name = data[u"Name"]
-                image = data[u"Config"][u"Image"]
-                port_mappings = data[u"NetworkSettings"][u"Ports"]
-                if port_mappings is not None:
-                    ports = self._parse_container_ports(port_mappings)
-                else:
-                    ports = list()
-                volumes = []
-                for container_path, node_path in data[u"Volumes"].items():
-                    volumes.append(
-                        Volume(container_path=FilePath(container_path),
-                               node_path=FilePath(node_path))
-                    )
-                if name.startswith(u"/" + self.namespace):
-                    name = name[1 + len(self.namespace):]
-                else:
-                    continue
-                result.add(Unit(name=name,
-                                container_name=self._to_container_name(name),
-                                activation_state=state,
-                                container_image=image,
-                                ports=frozenset(ports),
-                                volumes=frozenset(volumes)))
-            return result
-        return deferToThread(_list)
+        if self._units is None:
+            return DockerClient.list(self)
+        return succeed(set(self._units.values()))
+
+
+# The Docker server's UNIX socket:
+DOCKER_SOCKET = FilePath(b"/var/run/docker.sock")
+
+# The version of the Docker API the clients speak:
+DOCKER_API_VERSION = b"1.12"
+
+
+def _api_error(code, body):
+    """
+    Create the error docker-py raises for a failed request, so that callers
+    handle failures from either client the same way.
+
+    :param int code: The response code.
+    :param bytes body: The response body.
+
+    :return: An ``APIError``.
+    """
+    response = Response()
+    response.status_code = code
+    response._content = body
+    return APIError(b"Docker request failed", response)
+
+
+@implementer(IDockerClient)
+class AsyncDockerClient(DockerClient):
+    """
+    Talk to the Docker server over its UNIX socket from the reactor thread,
+    using Twisted's HTTP client rather than docker-py in a thread pool.
+
+    Connections are kept open and reused between requests.  Images copied
+    from other nodes are still loaded using docker-py in a thread, since the
+    output of ``docker save`` on a peer is read by blocking; the docker-py
+    client and its ``DockerWorkers`` pool are only created the first time
+    that happens.
+
+    :ivar workers: The ``DockerWorkers`` pool images are loaded from other
+        nodes in, or ``None`` until the first is loaded.
+    """
+    def __init__(self, reactor, namespace=BASE_NAMESPACE,
+                 socket_path=DOCKER_SOCKET, image_peers=None,
+                 list_concurrency=LIST_CONCURRENCY, threads=DOCKER_THREADS):
+        """
+        :param reactor: The reactor to connect with.
+        :param FilePath socket_path: The Docker server's UNIX socket.
+        :param int threads: How many images to load from other nodes at
+            once.
+
+        See ``DockerClient`` for the other parameters.
+        """
+        self.namespace = namespace
+        self.list_concurrency = list_concurrency
+        if image_peers is None:
+            image_peers = lambda image_name: []
+        self._image_peers = image_peers
+        # The ``Deferred``\ s waiting for each image being pulled:
+        self._pulling = {}
+        self._reactor = reactor
+        self._socket_path = socket_path
+        self._threads = threads
+        self.workers = None
+        self._client = None
+        self._pool = HTTPConnectionPool(reactor)
+        # A proxy agent sends every request over the same endpoint, whatever
+        # the host in the URL:
+        self._agent = ProxyAgent(
+            UNIXClientEndpoint(reactor, socket_path.path), reactor,
+            pool=self._pool)
+
+    def _request(self, method, path, query=None, body=None):
+        """
+        Make a request of the Docker API.
+
+        :param bytes method: The HTTP method.
+        :param unicode path: The API path, e.g. ``u"/containers/json"``.
+        :param dict query: The query arguments, if any.
+        :param body: An object to send encoded as JSON, or ``None``.
+
+        :return: A ``Deferred`` firing with the response body, or failing
+            with ``APIError`` if the response code is an error.
+        """
+        url = b"/v%s%s" % (
+            DOCKER_API_VERSION, quote(path.encode("utf-8"), safe=b"/:"))
+        if query:
+            url += b"?" + urlencode(
+                sorted((key, value.encode("utf-8")
+                        if isinstance(value, unicode) else value)
+                       for key, value in query.items()))
+        # The request is sent as given, so name a host explicitly:
+        headers = Headers({b"host": [b"docker"]})
+        producer = None
+        if body is not None:
+            headers.addRawHeader(b"content-type", b"application/json")
+            producer = FileBodyProducer(BytesIO(dumps(body)))
+        requesting = self._agent.request(method, url, headers, producer)
+
+        def got_response(response):
+            reading = readBody(response)
+
+            def got_body(data):
+                if response.code >= 400:
+                    raise _api_error(response.code, data)
+                return data
+            reading.addCallback(got_body)
+            return reading
+        requesting.addCallback(got_response)
+        return requesting
+
+    def _request_json(self, method, path, query=None, body=None):
+        """
+        Make a request of the Docker API whose response is JSON.
+
+        See ``_request`` for the parameters.
+
+        :return: A ``Deferred`` firing with the decoded response body.
+        """
+        d = self._request(method, path, query, body)
+        d.addCallback(loads)
+        return d
+
+    def _trap_not_found(self, failure, result):
+        """
+        Handle a failed request for something which doesn't exist.
+
+        :param Failure failure: The failure of the request.
+        :param result: The result to give instead if Docker responded with
+            ``NOT_FOUND``.
+
+        :return: ``result``, or ``failure`` for other failures.
+        """
+        failure.trap(APIError)
+        if failure.value.response.status_code != NOT_FOUND:
+            return failure
+        return result
+
+    def add(self, unit_name, image_name, ports=None, environment=None,
+            volumes=()):
+        container_name = self._to_container_name(unit_name)
+
+        if environment is not None:
+            environment = [u"%s=%s" % variable
+                           for variable in sorted(environment.variables)]
+        if ports is None:
+            ports = []
+        config = {
+            u"Image": image_name,
+            u"Env": environment,
+            u"ExposedPorts": {u"%d/tcp" % (p.internal_port,): {}
+                              for p in ports},
+            u"Volumes": {volume.container_path.path: {}
+                         for volume in volumes},
+        }
+
+        def _create():
+            return self._request(b"POST", u"/containers/create",
+                                 {b"name": container_name}, config)
+
+        def _start(_):
+            return self._request(
+                b"POST", u"/containers/%s/start" % (container_name,),
+                body={
+                    u"Binds": [u"%s:%s:rw" % (volume.node_path.path,
+                                              volume.container_path.path)
+                               for volume in volumes],
+                    u"PortBindings": {
+                        u"%d/tcp" % (p.internal_port,): [
+                            {u"HostIp": u"",
+                             u"HostPort": u"%d" % (p.external_port,)}]
+                        for p in ports},
+                })
+        d = self._create_with_image(image_name, _create)
+        d.addCallback(lambda _: self._wait_for_container(container_name))
+        d.addCallback(_start)
+
+        def _extract_error(failure):
+            failure.trap(APIError)
+            code = failure.value.response.status_code
+            if code == 409:
+                raise AlreadyExists(unit_name)
+            return failure
+        d.addErrback(_extract_error)
+        return d
+
+    def _wait_for_container(self, container_name, intervals=None):
+        """
+        See ``DockerClient._wait_for_container``.
+
+        :param intervals: An iterator of the delays between checks, or
+            ``None`` to start with ``CONTAINER_POLL_INTERVAL``.
+        """
+        if intervals is None:
+            intervals = _poll_intervals()
+        d = self._exists(container_name)
+
+        def _check(exists):
+            if not exists:
+                return deferLater(self._reactor, next(intervals),
+                                  self._wait_for_container, container_name,
+                                  intervals)
+        d.addCallback(_check)
+        return d
+
+    def _inspect_image(self, image_name):
+        """
+        :param unicode image_name: The image to inspect.
+
+        :return: A ``Deferred`` firing with the image as described by Docker,
+            or failing with ``APIError`` if it isn't present.
+        """
+        return self._request_json(b"GET", u"/images/%s/json" % (image_name,))
+
+    def _pull_image(self, image_name):
+        d = self._inspect_image(image_name)
+
+        def _missing(failure):
+            failure.trap(APIError)
+            if failure.value.response.status_code != NOT_FOUND:
+                return failure
+            d = self._load_from_peers(image_name)
+            d.addCallback(_loaded)
+            # The pull doesn't report failures, so check it worked:
+            d.addCallback(lambda _: self._inspect_image(image_name))
+            return d
+
+        def _loaded(loaded):
+            if loaded:
+                return
+            repository, tag = parse_repository_tag(image_name)
+            query = {b"fromImage": repository}
+            if tag is not None:
+                query[b"tag"] = tag
+            return self._request(b"POST", u"/images/create", query)
+        d.addErrback(_missing)
+        d.addCallback(lambda _: None)
+        return d
+
+    def _load_from_peers(self, image_name):
+        """
+        Copy an image from another node which has it, using docker-py in a
+        thread.
+
+        :param unicode image_name: The Docker image to copy.
+
+        :return: A ``Deferred`` firing with ``True`` if the image was copied,
+            ``False`` if no node could supply it.
+        """
+        if not list(self._image_peers(image_name)):
+            return succeed(False)
+        if self.workers is None:
+            self.workers = DockerWorkers(self._reactor, self._threads)
+            self._client = Client(version=DOCKER_API_VERSION,
+                                  base_url=u"unix:/" + self._socket_path.path)
+        return self.workers.run(self._blocking_load_from_peers, image_name)
+
+    def _exists(self, container_name):
+        """
+        :param unicode container_name: The name of the container.
+
+        :return: A ``Deferred`` firing with ``True`` if the container exists,
+            otherwise ``False``.
+        """
+        d = self._request(b"GET", u"/containers/%s/json" % (container_name,))
+
+        def _missing(failure):
+            failure.trap(APIError)
+            return False
+        d.addCallbacks(lambda _: True, _missing)
+        return d
+
+    def exists(self, unit_name):
+        return self._exists(self._to_container_name(unit_name))
+
+    def _stop_container(self, container_name, stop_timeout):
+        d = self._request(b"POST", u"/containers/%s/stop" % (container_name,),
+                          {b"t": b"%d" % (stop_timeout,)})
+        d.addCallback(lambda _: None)
+        return d
+
+    def _delete_container(self, container_name):
+        d = self._request(b"DELETE", u"/containers/%s" % (container_name,))
+        d.addCallback(lambda _: None)
+        return d
+
+    def _list_units(self):
+        listing = self._request_json(b"GET", u"/containers/json",
+                                     {b"all": b"1"})
+
+        def got_containers(containers):
+            semaphore = DeferredSemaphore(self.list_concurrency)
+            listed = []
+            for container in containers:
+                name = self._unit_name(container[u"Names"])
+                if name is not None:
+                    listed.append((name, container))
+            inspecting = _gather([
+                semaphore.run(self._inspect_container, container[u"Id"])
+                for _, container in listed])
+            inspecting.addCallback(got_inspected, listed, semaphore)
+            return inspecting
+
+        def got_inspected(inspected, listed, semaphore):
+            # Many containers typically share an image:
+            images = sorted({data[u"Config"][u"Image"]
+                             for data in inspected if data is not None})
+            d = _gather([semaphore.run(self._image_environment, image)
+                         for image in images])
+            d.addCallback(
+                lambda environments: self._units(
+                    listed, inspected, dict(zip(images, environments))))
+            return d
+        listing.addCallback(got_containers)
+        return listing
+
+    def _units(self, listed, inspected, image_environments):
+        """
+        Create the units for the listed containers.
+
+        :param list listed: Tuples of the unit name and the container as
+            returned by the container listing.
+        :param list inspected: The result of ``_inspect_container`` for each
+            listed container.
+        :param dict image_environments: Maps image names to the result of
+            ``_image_environment``.
+
+        :return: A ``dict`` mapping the IDs of the containers which still
+            exist to their ``Unit``\ s.
+        """
+        units = {}
+        for (name, container), data in zip(listed, inspected):
+            if data is None:
+                continue
+            units[container[u"Id"]] = self._unit(
+                name, data, self._listed_state(container),
+                self._parse_listed_ports(container[u"Ports"]),
+                image_environments[data[u"Config"][u"Image"]])
+        return units
+
+    def _inspect_container(self, container):
+        """
+        :param unicode container: The ID or name of a container.
+
+        :return: A ``Deferred`` firing with the container as described by
+            Docker, or ``None`` if it doesn't exist.
+        """
+        d = self._request_json(b"GET", u"/containers/%s/json" % (container,))
+        d.addErrback(self._trap_not_found, None)
+        return d
+
+    def _image_environment(self, image_name):
+        """
+        Find the environment variables an image sets.
+
+        :param unicode image_name: The image to inspect.
+
+        :return: A ``Deferred`` firing with a ``frozenset`` of
+            ``(key, value)`` tuples, empty if the image no longer exists.
+        """
+        d = self._inspect_image(image_name)
+        d.addCallback(self._parse_image_environment)
+        d.addErrback(self._trap_not_found, frozenset())
+        return d
 
 
 class NamespacedDockerClient(proxyForInterface(IDockerClient, "_client")):
@@ -0,0 +1,89 @@
+# Copyright Hybrid Logic Ltd.  See LICENSE file for details.
+
+"""
+Eliot log events emitted while changing a node's state.
+"""
+
+from eliot import Field, ActionType
+
+
+def _system(name):
+    return u"flocker:node:" + name
+
+
+def _serialize_change(change):
+    return repr(change).decode("ascii", "replace")
+
+
+def _serialize_function(function):
+    return getattr(function, "__name__", repr(function)).decode(
+        "ascii", "replace")
+
+
+CHANGE = Field(
+    u"change", _serialize_change,
+    u"The state change being run.")
+
+
+BYTES = Field.forTypes(
+    u"bytes", [int, long, None],
+    u"How many bytes the change copied to another node, or null if it "
+    u"doesn't copy data.")
+
+
+STATE_CHANGE = ActionType(
+    _system(u"state_change"),
+    [CHANGE],
+    [BYTES],
+    u"Flocker is running a change to the state of the node.")
+
+
+CONTAINER = Field.forTypes(
+    u"container", [unicode],
+    u"The name of the Docker container.")
+
+
+STOP_TIMEOUT = Field.forTypes(
+    u"stop_timeout", [int, long],
+    u"How many seconds the container is given to stop before it is killed.")
+
+
+STOP_DURATION = Field.forTypes(
+    u"duration", [float],
+    u"How many seconds the container took to stop.")
+
+
+STOP_CONTAINER = ActionType(
+    _system(u"docker:stop"),
+    [CONTAINER, STOP_TIMEOUT],
+    [STOP_DURATION],
+    u"Flocker is stopping a Docker container, which it removes once it has "
+    u"stopped.")
+
+
+FUNCTION = Field(
+    u"function", _serialize_function,
+    u"The blocking function being called.")
+
+
+QUEUE_LENGTH = Field.forTypes(
+    u"queue_length", [int],
+    u"How many Docker calls were waiting for a thread, including this one.")
+
+
+WAITED = Field.forTypes(
+    u"waited", [float],
+    u"How many seconds the call waited for a thread.")
+
+
+DURATION = Field.forTypes(
+    u"duration", [float],
+    u"How many seconds the call took once it had a thread.")
+
+
+DOCKER_CALL = ActionType(
+    _system(u"docker:call"),
+    [FUNCTION, QUEUE_LENGTH],
+    [WAITED, DURATION],
+    u"Flocker is making a blocking Docker API call in its Docker thread "
+    u"pool.")
@@ -5,7 +5,7 @@
 Record types for representing deployment models.
 """
 
-from characteristic import attributes
+from characteristic import attributes, Attribute
 
 
 @attributes(["repository", "tag"], defaults=dict(tag=u'latest'))
@@ -49,7 +49,9 @@ class DockerImage(object):
         return cls(**kwargs)
 
 
-@attributes(["name", "mountpoint"])
+@attributes(["name", "mountpoint",
+             Attribute("properties", default_value=frozenset(),
+                       exclude_from_cmp=True)])
 class AttachedVolume(object):
     """
     A volume attached to an application to be deployed.
@@ -61,6 +63,12 @@ class AttachedVolume(object):
 
     :ivar FilePath mountpoint: The path within the container where this
         volume should be mounted.
+
+    :ivar frozenset properties: A ``frozenset`` of ``tuple``\ s mapping
+        storage property names to values, e.g. ``(u"recordsize", u"8k")``,
+        which are applied to the volume's filesystem when it is created.
+        Properties can't be discovered from a running container so they
+        are not considered when comparing volumes.
     """
 
     @classmethod
@@ -86,9 +94,11 @@ class AttachedVolume(object):
             return None
 
 
-@attributes(["name", "image", "ports", "volume", "links", "environment"],
+@attributes(["name", "image", "ports", "volume", "links", "environment",
+             "stop_timeout"],
             defaults=dict(ports=frozenset(), volume=None,
-                          links=frozenset(), environment=None))
+                          links=frozenset(), environment=None,
+                          stop_timeout=None))
 class Application(object):
     """
     A single `application <http://12factor.net/>`_ to be deployed.
@@ -117,6 +127,9 @@ class Application(object):
         that should be exposed in the ``Application`` container, or ``None``
         if no environment variables are specified. A ``frozenset`` of
         variables contains a ``tuple`` series mapping (key, value).
+
+    :ivar stop_timeout: How many seconds the application is given to stop
+        gracefully before it is killed, or ``None`` for Docker's default.
     """
 
 
@@ -0,0 +1,222 @@
+# Copyright Hybrid Logic Ltd.  See LICENSE file for details.
+# -*- test-case-name: flocker.node.test.test_profile -*-
+
+"""
+Timing the state changes run on a node, and reporting on where the time
+went in a deployment across the cluster.
+"""
+
+from characteristic import attributes
+
+from twisted.internet.defer import maybeDeferred
+from twisted.python.failure import Failure
+
+from eliot import Logger
+from eliot.twisted import DeferredContext
+
+from ._logging import CHANGE, STATE_CHANGE
+
+
+@attributes(["identifier", "parent", "after", "change", "started",
+             "finished", "succeeded", "bytes"])
+class ChangeTiming(object):
+    """
+    How long a state change took.
+
+    :ivar int identifier: The position of the change in the order changes
+        were started.
+    :ivar parent: The ``identifier`` of the change which ran this one, or
+        ``None`` if it wasn't run by another change.
+    :ivar after: The ``identifier`` of the change whose completion
+        triggered this one, or ``None`` if it started as soon as its parent
+        did.
+    :ivar unicode change: A description of the change.
+    :ivar float started: When the change started, in seconds since the
+        epoch.
+    :ivar float finished: When the change finished, or ``None`` if it is
+        still running.
+    :ivar succeeded: ``True`` if the change succeeded, ``False`` if it
+        failed or ``None`` if it is still running.
+    :ivar bytes: How many bytes the change copied to another node, or
+        ``None`` if it doesn't copy data.
+    """
+    def marshal(self):
+        """
+        :return: A ``dict`` of this timing's attributes, suitable for
+            encoding as JSON.
+        """
+        return {
+            u"identifier": self.identifier,
+            u"parent": self.parent,
+            u"after": self.after,
+            u"change": self.change,
+            u"started": self.started,
+            u"finished": self.finished,
+            u"succeeded": self.succeeded,
+            u"bytes": self.bytes,
+        }
+
+
+class ChangeProfile(object):
+    """
+    Run state changes, timing them and logging each as a
+    ``flocker:node:state_change`` action.
+
+    :ivar list timings: The ``ChangeTiming`` of each change run so far, in
+        the order they were started.
+    """
+    logger = Logger()
+
+    def __init__(self, reactor):
+        """
+        :param reactor: The ``IReactorTime`` provider to read the time from.
+        """
+        self._reactor = reactor
+        self.timings = []
+        # Maps the id() of each change run so far to its timing, since
+        # changes which run other changes aren't hashable:
+        self._running = {}
+        self._bytes = {}
+
+    def _identifier(self, change):
+        """
+        :return: The ``identifier`` of the timing of a change, or ``None``
+            if ``change`` is ``None`` or wasn't run by this profile.
+        """
+        timing = self._running.get(id(change))
+        if timing is None:
+            return None
+        return timing.identifier
+
+    def run(self, change, deployer, parent=None, after=None):
+        """
+        Run and time a state change.
+
+        :param IStateChange change: The change to run.
+        :param Deployer deployer: The ``Deployer`` to run it with.
+        :param IStateChange parent: The change running ``change``, or
+            ``None``.
+        :param IStateChange after: The change whose completion triggered
+            ``change``, or ``None``.
+
+        :return: The result of ``change.run``.
+        """
+        timing = ChangeTiming(
+            identifier=len(self.timings), parent=self._identifier(parent),
+            after=self._identifier(after),
+            change=CHANGE.serialize(change),
+            started=self._reactor.seconds(), finished=None, succeeded=None,
+            bytes=None)
+        self.timings.append(timing)
+        self._running[id(change)] = timing
+
+        action = STATE_CHANGE(self.logger, change=change)
+        with action.context():
+            d = DeferredContext(maybeDeferred(change.run, deployer))
+
+        def finished(result):
+            timing.finished = self._reactor.seconds()
+            timing.succeeded = not isinstance(result, Failure)
+            timing.bytes = self._bytes.pop(id(change), None)
+            action.addSuccessFields(bytes=timing.bytes)
+            return result
+        d.addBoth(finished)
+        d.addActionFinish()
+        return d.result
+
+    def transferred(self, change, count):
+        """
+        Record data copied to another node by a running change.
+
+        :param IStateChange change: The change which copied the data.
+        :param int count: How many bytes it copied.
+        """
+        self._bytes[id(change)] = self._bytes.get(id(change), 0) + count
+
+    def marshal(self):
+        """
+        :return: A ``list`` of the marshalled ``ChangeTiming``\ s, suitable
+            for encoding as JSON and passing to ``profile_report``.
+        """
+        return [timing.marshal() for timing in self.timings]
+
+
+def _critical_path(timing, children, timings):
+    """
+    Find the changes which determined when a change finished.
+
+    :param dict timing: A marshalled ``ChangeTiming``.
+    :param dict children: Maps the ``identifier`` of each change to the
+        ``list`` of marshalled timings of the finished changes it ran.
+    :param dict timings: Maps each ``identifier`` to its marshalled timing.
+
+    :return: A ``list`` of the marshalled timings of the changes which
+        didn't run other changes, in the order they ran.
+    """
+    below = children.get(timing[u"identifier"])
+    if not below:
+        return [timing]
+    path = []
+    current = max(below, key=lambda child: child[u"finished"])
+    while current is not None:
+        path = _critical_path(current, children, timings) + path
+        current = timings.get(current[u"after"])
+    return path
+
+
+def profile_report(profiles):
+    """
+    Describe where the time went in a deployment.
+
+    :param dict profiles: Maps the hostname of each node to the result of
+        ``ChangeProfile.marshal`` for the changes run on it.
+
+    :return: A ``unicode`` report giving when each node finished, relative
+        to when the first change on any node started, and the critical path:
+        the chain of changes on the last node to finish which each had to
+        wait for the one before.
+    """
+    finished = {}
+    for hostname, timings in profiles.items():
+        finished[hostname] = [timing for timing in timings
+                              if timing[u"finished"] is not None]
+    starts = [timing[u"started"]
+              for timings in finished.values() for timing in timings]
+    if not starts:
+        return u"No state changes were run.\n"
+    origin = min(starts)
+
+    def end(hostname):
+        return max([timing[u"finished"] for timing in finished[hostname]] +
+                   [origin])
+
+    lines = [u"%-40s %10s %8s" % (u"Node", u"Finished", u"Changes")]
+    for hostname in sorted(finished, key=end):
+        ran = {timing[u"parent"] for timing in finished[hostname]}
+        lines.append(u"%-40s %9.2fs %8d" % (
+            hostname, end(hostname) - origin,
+            len([timing for timing in finished[hostname]
+                 if timing[u"identifier"] not in ran])))
+
+    slowest = max([hostname for hostname in finished if finished[hostname]],
+                  key=end)
+    timings = {timing[u"identifier"]: timing for timing in finished[slowest]}
+    children = {}
+    for timing in finished[slowest]:
+        children.setdefault(timing[u"parent"], []).append(timing)
+    top = max([timing for timing in finished[slowest]
+               if timing[u"parent"] not in timings],
+              key=lambda timing: timing[u"finished"])
+    lines.extend([
+        u"",
+        u"Critical path, on %s:" % (slowest,),
+        u"%10s %10s %12s  %s" % (u"Start", u"Duration", u"Bytes", u"Change"),
+    ])
+    for timing in _critical_path(top, children, timings):
+        lines.append(u"%9.2fs %9.2fs %12s  %s%s" % (
+            timing[u"started"] - origin,
+            timing[u"finished"] - timing[u"started"],
+            u"-" if timing[u"bytes"] is None else timing[u"bytes"],
+            timing[u"change"],
+            u"" if timing[u"succeeded"] else u" (failed)"))
+    return u"\n".join(lines) + u"\n"
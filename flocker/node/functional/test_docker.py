@@ -296,6 +296,26 @@ CMD sh -c "trap \"\" 2; sleep 3"
         d.addCallback(started)
         return d
 
+    def test_list_with_environment(self):
+        """
+        ``DockerClient.list`` reports the environment variables supplied when
+        a container was added, but not those set by its image.
+        """
+        unit_name = random_name()
+        variables = frozenset({(u"key1", u"value1"), (u"key2", u"value2")})
+        d = self.start_container(
+            unit_name=unit_name,
+            environment=Environment(variables=variables),
+        )
+        d.addCallback(lambda client: client.list())
+
+        def got_list(units):
+            [unit] = [unit for unit in units if unit.name == unit_name]
+            self.assertEqual(Environment(variables=variables),
+                             unit.environment)
+        d.addCallback(got_list)
+        return d
+
     def test_pull_image_if_necessary(self):
         """
         The Docker image is pulled if it is unavailable locally.
@@ -316,6 +336,33 @@ CMD sh -c "trap \"\" 2; sleep 3"
         d.addCallback(lambda _: self.assertTrue(docker.inspect_image(image)))
         return d
 
+    def test_pull(self):
+        """
+        ``DockerClient.pull`` makes an image which is unavailable locally
+        available.
+        """
+        image = u"busybox"
+        # Make sure image is gone:
+        docker = Client()
+        try:
+            docker.remove_image(image)
+        except APIError as e:
+            if e.response.status_code != 404:
+                raise
+
+        client = self.make_client()
+        d = client.pull(image)
+        d.addCallback(lambda _: self.assertTrue(docker.inspect_image(image)))
+        return d
+
+    def test_pull_missing_image(self):
+        """
+        ``DockerClient.pull`` fails if the image doesn't exist.
+        """
+        client = self.make_client()
+        d = client.pull(u"clusterhq/nonexistent-" + random_name())
+        return self.assertFailure(d, APIError)
+
     def test_namespacing(self):
         """
         Containers are created with a namespace prefixed to their container
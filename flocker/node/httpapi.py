@@ -0,0 +1,100 @@
+# Copyright Hybrid Logic Ltd.  See LICENSE file for details.
+# -*- test-case-name: flocker.node.test.test_httpapi -*-
+
+"""
+A HTTP REST API for giving a node's ``ConvergenceAgent`` a new desired state.
+"""
+
+from yaml import safe_load
+from yaml.error import YAMLError
+
+from twisted.internet.address import IPv4Address
+from twisted.web.server import Request, Site
+
+from klein import Klein
+
+from ..restapi import structured
+from ..restapi._error import makeBadRequest
+from ._config import (
+    ConfigurationError, FlockerConfiguration, model_from_configuration,
+    current_from_configuration,
+)
+
+
+# The body of a request to change the desired state, with the same YAML
+# documents and hostname which are given to ``flocker-changestate``:
+STATE_SCHEMA = {
+    u"type": u"object",
+    u"properties": {
+        u"deployment_config": {u"type": u"string"},
+        u"application_config": {u"type": u"string"},
+        u"current_config": {u"type": u"string"},
+        u"hostname": {u"type": u"string"},
+    },
+    u"required": [
+        u"deployment_config", u"application_config", u"current_config",
+        u"hostname",
+    ],
+    u"additionalProperties": False,
+}
+
+
+class ConvergenceAPIUser(object):
+    """
+    A user accessing the API.
+
+    :ivar ConvergenceAgent agent: The agent to give new desired states to.
+    """
+    app = Klein()
+
+    def __init__(self, agent):
+        self.agent = agent
+
+    @app.route("/state", methods=["POST"])
+    @structured(STATE_SCHEMA, {})
+    def set_state(self, deployment_config, application_config,
+                  current_config, hostname):
+        """
+        Change the desired state of the node.
+
+        :return: A ``Deferred`` which fires with the marshalled
+            ``ChangeProfile`` of the convergence once the node has converged
+            on the new state.
+        """
+        try:
+            deployment = model_from_configuration(
+                applications=FlockerConfiguration(
+                    safe_load(application_config)).applications(),
+                deployment_configuration=safe_load(deployment_config))
+            current = current_from_configuration(safe_load(current_config))
+        except (YAMLError, ConfigurationError) as e:
+            raise makeBadRequest(description=unicode(e))
+        d = self.agent.set_desired_state(
+            desired_state=deployment, current_cluster_state=current,
+            hostname=hostname)
+        d.addCallback(lambda profile: profile.marshal())
+        return d
+
+
+class _UNIXRequest(Request):
+    """
+    A request received on a UNIX socket.
+
+    Klein needs the server's port number, which UNIX socket addresses don't
+    have, so the server claims to be the local HTTP port.
+    """
+    def getHost(self):
+        return IPv4Address("TCP", b"127.0.0.1", 80)
+
+
+def convergence_site(agent):
+    """
+    Create a ``Site`` serving the convergence API over a UNIX socket.
+
+    :param ConvergenceAgent agent: The agent to give new desired states to.
+
+    :return: The ``Site``.
+    """
+    site = Site(ConvergenceAPIUser(agent).app.resource())
+    site.requestFactory = _UNIXRequest
+    return site
@@ -2,14 +2,24 @@
 # -*- test-case-name: flocker.node.test.test_script -*-
 
 """
-The command-line ``flocker-changestate`` and ``flocker-reportstate``
-tools.
+The command-line ``flocker-changestate``, ``flocker-reportstate`` and
+``flocker-serve`` tools.
 """
 
 import sys
+from io import BytesIO
+from json import dumps, loads
 
 from twisted.python.usage import Options, UsageError
-from twisted.internet.defer import Deferred, maybeDeferred
+from twisted.python.filepath import FilePath
+from twisted.internet.defer import Deferred, fail, maybeDeferred
+from twisted.internet.error import ConnectError
+from twisted.internet.endpoints import UNIXClientEndpoint, UNIXServerEndpoint
+from twisted.application.internet import StreamServerEndpointService
+from twisted.application.service import MultiService
+from twisted.web.client import FileBodyProducer, ProxyAgent, readBody
+from twisted.web.http import OK
+from twisted.web.http_headers import Headers
 
 from yaml import safe_load, safe_dump
 from yaml.error import YAMLError
@@ -22,9 +32,15 @@ from ..volume.service import (
     ICommandLineVolumeScript, VolumeScript)
 from ..volume.script import flocker_volume_options
 from ..common.script import (
-    flocker_standard_options, FlockerScriptRunner)
+    flocker_standard_options, FlockerScriptRunner, ICommandLineScript)
 from . import (ConfigurationError, model_from_configuration, Deployer,
                FlockerConfiguration, current_from_configuration)
+from ._agent import CONVERGE_INTERVAL, ConvergenceAgent
+from ._deploy import AppliedStateStore, ConcurrencyLimiter, Resource
+from ._docker import CachingDockerClient, AsyncDockerClient, DOCKER_THREADS
+from .httpapi import convergence_site
+from ..volume._ipc import standard_node
+from ..route import make_host_network
 
 __all__ = [
     "flocker_changestate_main",
@@ -33,8 +49,163 @@ __all__ = [
 ]
 
 
+# How many state changes using each resource to run at once, unless
+# overridden on the command line:
+DEFAULT_RESOURCE_LIMITS = {
+    Resource.DOCKER: 8,
+    Resource.ZFS: 4,
+    Resource.TRANSFER: 2,
+    Resource.IMAGES: 4,
+}
+
+# Where ``flocker-serve`` accepts new desired states for its node:
+AGENT_SOCKET = FilePath(b"/var/run/flocker/agent.sock")
+
+# Where a node records the configuration it was last changed to match:
+APPLIED_STATE = FilePath(b"/var/lib/flocker/applied.json")
+
+
+def _positive_integer(value):
+    """
+    :param bytes value: A command line argument.
+
+    :raise ValueError: If ``value`` isn't a positive integer.
+
+    :return: ``value`` as an ``int``.
+    """
+    result = int(value)
+    if result < 1:
+        raise ValueError("%r is not positive" % (value,))
+    return result
+
+
+def _concurrency_options(cls):
+    """
+    A class decorator to add command line options limiting how many state
+    changes are run at once, and how many blocking Docker API calls.
+
+    :param cls: The class to decorate.
+    :return: The decorated class.
+    """
+    original_parameters = getattr(cls, "optParameters", [])
+    cls.optParameters = original_parameters + [
+        ["concurrency", None, None,
+         "The maximum number of state changes to run at once. "
+         "Default is no limit.", _positive_integer],
+        ["docker-threads", None, DOCKER_THREADS,
+         "The maximum number of blocking Docker API calls to make at once.",
+         _positive_integer],
+    ]
+
+    original_init = cls.__init__
+
+    def __init__(self, *args, **kwargs):
+        original_init(self, *args, **kwargs)
+        self["limits"] = DEFAULT_RESOURCE_LIMITS.copy()
+    cls.__init__ = __init__
+
+    def opt_limit(self, value):
+        """
+        Limit how many state changes using a resource run at once, as
+        <resource>=<number>, e.g. docker=4. Resources are docker, zfs,
+        network, transfer and images. May be given more than once.
+        """
+        try:
+            name, limit = value.split(b"=", 1)
+            resource = Resource.lookupByName(name.upper())
+            self["limits"][resource] = _positive_integer(limit)
+        except ValueError:
+            raise UsageError("Invalid limit: {value}".format(value=value))
+    cls.opt_limit = opt_limit
+
+    return cls
+
+
+def _agent_socket_options(cls):
+    """
+    A class decorator to add a command line option giving the socket on
+    which ``flocker-serve`` accepts new desired states.
+
+    :param cls: The class to decorate.
+    :return: The decorated class.
+    """
+    original_parameters = getattr(cls, "optParameters", [])
+    cls.optParameters = original_parameters + [
+        ["agent-socket", None, AGENT_SOCKET.path,
+         "The UNIX socket of the flocker-serve convergence agent."],
+    ]
+
+    original_postOptions = cls.postOptions
+
+    def postOptions(self):
+        self["agent-socket"] = FilePath(self["agent-socket"])
+        original_postOptions(self)
+    cls.postOptions = postOptions
+
+    return cls
+
+
+def _applied_state_options(cls):
+    """
+    A class decorator to add a command line option giving the file in which
+    the node records the configuration it was last changed to match.
+
+    :param cls: The class to decorate.
+    :return: The decorated class.
+    """
+    original_parameters = getattr(cls, "optParameters", [])
+    cls.optParameters = original_parameters + [
+        ["applied-state", None, APPLIED_STATE.path,
+         "The file recording the configuration the node was last changed to "
+         "match, so that only the applications which have changed since are "
+         "planned for."],
+    ]
+
+    original_postOptions = cls.postOptions
+
+    def postOptions(self):
+        self["applied-state"] = FilePath(self["applied-state"])
+        original_postOptions(self)
+    cls.postOptions = postOptions
+
+    return cls
+
+
+def _network_options(cls):
+    """
+    A class decorator to add a command line option choosing how the node's
+    proxies are set up.
+
+    :param cls: The class to decorate.
+    :return: The decorated class.
+    """
+    original_flags = getattr(cls, "optFlags", [])
+    cls.optFlags = original_flags + [
+        ["proxy-dispatch", None,
+         "Look the ports of proxied connections up in ipsets, with one "
+         "iptables rule per destination rather than per proxied port. "
+         "Requires ipset."],
+    ]
+    return cls
+
+
+def _limiter_from_options(options):
+    """
+    :param options: Options parsed by a class decorated with
+        ``_concurrency_options``.
+
+    :return: A ``ConcurrencyLimiter`` with the limits from ``options``.
+    """
+    return ConcurrencyLimiter(total=options["concurrency"],
+                              resources=options["limits"])
+
+
 @flocker_standard_options
 @flocker_volume_options
+@_concurrency_options
+@_agent_socket_options
+@_applied_state_options
+@_network_options
 class ChangeStateOptions(Options):
     """
     Command line options for ``flocker-changestate`` management tool.
@@ -56,6 +227,12 @@ class ChangeStateOptions(Options):
     * hostname: The hostname of this node. Used by the node to identify which
         applications from deployment_configuration should be running.
     """
+    optFlags = [
+        ["profile", None,
+         "Once done, write how long each state change took to standard "
+         "output, as JSON."],
+    ]
+
     synopsis = ("Usage: flocker-changestate [OPTIONS] "
                 "<deployment configuration> <application configuration> "
                 "<cluster configuration> <hostname>")
@@ -82,6 +259,9 @@ class ChangeStateOptions(Options):
         :raises UsageError: If the configuration files cannot be parsed as YAML
             or if the hostname can not be decoded as ASCII.
         """
+        deployment_config_yaml = deployment_config
+        application_config_yaml = application_config
+        current_config_yaml = current_config
         try:
             deployment_config = safe_load(deployment_config)
         except YAMLError as e:
@@ -121,6 +301,30 @@ class ChangeStateOptions(Options):
         # Current configuration is not written by a human, so don't bother
         # with nice error for failure to parse:
         self["current"] = current_from_configuration(current_config)
+        self["deployment_config"] = deployment_config_yaml
+        self["application_config"] = application_config_yaml
+        self["current_config"] = current_config_yaml
+
+
+def _image_peers(current, hostname):
+    """
+    Find the other nodes which should have an image, so it can be copied
+    from them rather than downloaded from a registry.
+
+    :param Deployment current: The current configuration of the cluster.
+    :param unicode hostname: The hostname of this node.
+
+    :return: A callable suitable for ``DockerClient``'s ``image_peers``,
+        returning ``INode`` providers for the other nodes currently running
+        applications using the image.
+    """
+    def peers(image_name):
+        return [standard_node(node.hostname.encode("ascii"))
+                for node in current.nodes
+                if node.hostname != hostname and any(
+                    application.image.full_name == image_name
+                    for application in node.applications)]
+    return peers
 
 
 @implementer(ICommandLineVolumeScript)
@@ -133,25 +337,160 @@ class ChangeStateScript(object):
     :ivar DockerClient _docker_client: See the ``docker_client`` parameter to
         ``__init__``.
     """
-    def __init__(self, docker_client=None):
+    def __init__(self, docker_client=None, network=None):
         """
         :param DockerClient docker_client: The object to use to talk to the
-            Docker server.
+            Docker server.  Default is an ``AsyncDockerClient`` which copies
+            images from other nodes running them where possible.
+
+        :param INetwork network: The object to use to interact with the node's
+            network configuration.  Default is the host's network, using
+            ipsets if the ``proxy-dispatch`` option is given.
         """
         self._docker_client = docker_client
+        self._network = network
 
     def main(self, reactor, options, volume_service):
-        deployer = Deployer(volume_service, self._docker_client)
-        return deployer.change_node_state(
+        """
+        See ``ICommandLineVolumeScript.main``.
+
+        :return: A ``Deferred`` which fires with the marshalled
+            ``ChangeProfile`` of the changes once the node's state has been
+            changed.
+        """
+        docker_client = self._docker_client
+        if docker_client is None:
+            docker_client = AsyncDockerClient(
+                reactor, image_peers=_image_peers(
+                    options["current"], options["hostname"]),
+                threads=options["docker-threads"])
+        network = self._network
+        if network is None:
+            network = make_host_network(
+                reactor, dispatch=options["proxy-dispatch"])
+        deployer = Deployer(
+            volume_service, docker_client, network,
+            limiter=_limiter_from_options(options), reactor=reactor,
+            applied_state=AppliedStateStore(options["applied-state"]))
+        d = deployer.change_node_state(
             desired_state=options['deployment'],
             current_cluster_state=options['current'],
             hostname=options['hostname']
         )
+        d.addCallback(lambda _: deployer.profile.marshal())
+        return d
+
+
+def _set_agent_state(reactor, path, options):
+    """
+    Give the ``flocker-serve`` agent a new desired state.
+
+    :param reactor: The reactor to use to connect to the agent.
+    :param FilePath path: The agent's socket.
+    :param options: ``ChangeStateOptions`` describing the new state.
+
+    :return: A ``Deferred`` which fires with the marshalled
+        ``ChangeProfile`` of the agent's convergence once the node has
+        converged on the new state, or fails with ``SystemExit`` if the agent
+        failed to converge.
+    """
+    agent = ProxyAgent(UNIXClientEndpoint(reactor, path.path), reactor)
+    body = dumps({
+        u"deployment_config": options["deployment_config"],
+        u"application_config": options["application_config"],
+        u"current_config": options["current_config"],
+        u"hostname": options["hostname"],
+    })
+    d = agent.request(
+        b"POST", b"/state",
+        Headers({b"content-type": [b"application/json"]}),
+        FileBodyProducer(BytesIO(body)))
+
+    def got_response(response):
+        reading = readBody(response)
+        if response.code != OK:
+            def failed(body):
+                raise SystemExit(
+                    b"flocker-serve failed to change the state of this "
+                    b"node: " + body)
+            reading.addCallback(failed)
+        return reading
+    d.addCallback(got_response)
+    d.addCallback(lambda body: loads(body)[u"result"])
+    return d
+
+
+def _local_only_options(options):
+    """
+    :param options: ``ChangeStateOptions``.
+
+    :return: A ``list`` of the ``bytes`` names of the options given which
+        only apply when changing the state directly, since a running agent
+        uses those ``flocker-serve`` was started with.
+    """
+    given = []
+    if options["concurrency"] is not None:
+        given.append(b"--concurrency")
+    if options["limits"] != DEFAULT_RESOURCE_LIMITS:
+        given.append(b"--limit")
+    if options["docker-threads"] != DOCKER_THREADS:
+        given.append(b"--docker-threads")
+    if options["applied-state"] != APPLIED_STATE:
+        given.append(b"--applied-state")
+    return given
+
+
+@implementer(ICommandLineScript)
+class AgentChangeStateScript(object):
+    """
+    A command to hand a node's desired state to the convergence agent run by
+    ``flocker-serve``, which already has the node's state to hand, or to
+    change the node's state directly if the agent isn't running.
+
+    The agent is used if its socket exists, unless nothing is listening on
+    it, e.g. because ``flocker-serve`` stopped without removing it.  Options
+    which only apply to changing the state directly are rejected when the
+    socket exists.
+
+    With ``--profile``, how long each state change took is written to
+    standard output once done.
+    """
+    _stdout = sys.stdout
+
+    def __init__(self, local_script):
+        """
+        :param ICommandLineScript local_script: The script which changes the
+            state directly, firing with the marshalled ``ChangeProfile`` of
+            the changes.
+        """
+        self._local_script = local_script
+
+    def main(self, reactor, options):
+        path = options["agent-socket"]
+        local_only = _local_only_options(options)
+        if not path.exists():
+            d = maybeDeferred(self._local_script.main, reactor, options)
+        elif local_only:
+            d = fail(SystemExit(
+                b", ".join(local_only) + b" can't be used while flocker-serve "
+                b"is running on this node; it uses its own options."))
+        else:
+            d = _set_agent_state(reactor, path, options)
+
+            def no_agent(failure):
+                failure.trap(ConnectError)
+                return self._local_script.main(reactor, options)
+            d.addErrback(no_agent)
+        if options["profile"]:
+            d.addCallback(lambda profile: self._stdout.write(
+                dumps(profile) + b"\n"))
+        d.addCallback(lambda _: None)
+        return d
 
 
 def flocker_changestate_main():
     return FlockerScriptRunner(
-        script=VolumeScript(ChangeStateScript()),
+        script=AgentChangeStateScript(VolumeScript(ChangeStateScript())),
         options=ChangeStateOptions()
     ).main()
 
@@ -250,22 +589,97 @@ def _main_for_service(reactor, service):
 
 @flocker_standard_options
 @flocker_volume_options
+@_concurrency_options
+@_agent_socket_options
+@_applied_state_options
+@_network_options
 class ServeOptions(Options):
     """
     Command line options for ``flocker-serve`` cluster management process.
     """
-    # Maybe options for things like what port to listen on or perhaps where to
-    # find certificate material to use for TLS.
+    optParameters = [
+        ["converge-interval", None, CONVERGE_INTERVAL,
+         "How often, in seconds, to converge on the desired state when it "
+         "hasn't changed.", float],
+    ]
+
+    optFlags = [
+        ["async-docker", None,
+         "Talk to Docker over its socket from the main thread, rather than "
+         "keeping the containers up to date from Docker's events."],
+    ]
 
 
 @implementer(ICommandLineVolumeScript)
 class ServeScript(object):
     """
-    A command to start a long-running process to manage volumes on one node of
-    a Flocker cluster.
+    A command to start a long-running process to manage one node of a Flocker
+    cluster: its volumes, and a ``ConvergenceAgent`` which keeps the node in
+    the desired state it is given through a local HTTP API.
+
+    :ivar DockerClient _docker_client: See the ``docker_client`` parameter to
+        ``__init__``.
     """
+    def __init__(self, docker_client=None, network=None):
+        """
+        :param DockerClient docker_client: The object to use to talk to the
+            Docker server.  Default is a ``CachingDockerClient``, running for
+            as long as the process does, or an ``AsyncDockerClient`` if the
+            ``async-docker`` option is given.  Either copies images from
+            other nodes running them where possible.
+
+        :param INetwork network: The object to use to interact with the node's
+            network configuration.  Default is the host's network, using
+            ipsets if the ``proxy-dispatch`` option is given.
+        """
+        self._docker_client = docker_client
+        self._network = network
+
     def main(self, reactor, options, volume_service):
-        return _main_for_service(reactor, volume_service)
+        service = MultiService()
+        volume_service.setServiceParent(service)
+
+        agent = None
+        docker_client = self._docker_client
+        if docker_client is None:
+            def image_peers(image_name):
+                if agent.current_cluster_state is None:
+                    return []
+                return _image_peers(
+                    agent.current_cluster_state, agent.hostname)(image_name)
+            if options["async-docker"]:
+                docker_client = AsyncDockerClient(
+                    reactor, image_peers=image_peers,
+                    threads=options["docker-threads"])
+            else:
+                docker_client = CachingDockerClient(
+                    reactor, image_peers=image_peers,
+                    threads=options["docker-threads"])
+                docker_client.setServiceParent(service)
+        network = self._network
+        if network is None:
+            network = make_host_network(
+                reactor, dispatch=options["proxy-dispatch"])
+        deployer = Deployer(
+            volume_service, docker_client, network,
+            limiter=_limiter_from_options(options), reactor=reactor,
+            applied_state=AppliedStateStore(options["applied-state"]))
+        agent = ConvergenceAgent(deployer,
+                                 interval=options["converge-interval"])
+        agent.setServiceParent(service)
+
+        path = options["agent-socket"]
+        if not path.parent().exists():
+            path.parent().makedirs()
+        # Only root may change what runs on the node:
+        endpoint = UNIXServerEndpoint(reactor, path.path, mode=0600,
+                                      wantPID=True)
+        StreamServerEndpointService(
+            endpoint, convergence_site(agent)).setServiceParent(service)
+
+        d = _main_for_service(reactor, service)
+        d.addCallback(lambda _: None)
+        return d
 
 
 def flocker_serve_main():
@@ -0,0 +1,287 @@
+# Copyright Hybrid Logic Ltd.  See LICENSE file for details.
+
+"""
+Tests for ``flocker.node._agent``.
+"""
+
+from twisted.internet.defer import Deferred, fail, succeed
+from twisted.internet.task import Clock
+from twisted.trial.unittest import SynchronousTestCase
+
+from eliot.testing import validateLogging
+
+from .._agent import CONVERGE_INTERVAL, ConvergenceAgent
+from .._profile import ChangeProfile
+from .._model import Deployment, Node
+
+
+class ControllableDeployer(object):
+    """
+    A stand-in for ``Deployer`` whose changes to the node's state finish when
+    the test says so.
+
+    :ivar Clock reactor: The reactor to schedule convergences with.
+    :ivar list calls: The arguments of each call to ``change_node_state``.
+    :ivar list results: The unfired ``Deferred`` returned by each call to
+        ``change_node_state``.
+    :ivar list refreshes: The arguments of each call to
+        ``refresh_cluster_state``.
+    :ivar refreshed: The result of ``refresh_cluster_state``.
+    :ivar list profiles: The new ``ChangeProfile`` started by each call to
+        ``change_node_state``.
+    """
+    def __init__(self):
+        self.reactor = Clock()
+        self.calls = []
+        self.results = []
+        self.profiles = []
+        self.refreshes = []
+        self.refreshed = succeed(REFRESHED)
+
+    def change_node_state(self, desired_state, current_cluster_state,
+                          hostname):
+        self.calls.append((desired_state, current_cluster_state, hostname))
+        self.profile = ChangeProfile(self.reactor)
+        self.profiles.append(self.profile)
+        self.results.append(Deferred())
+        return self.results[-1]
+
+    def refresh_cluster_state(self, cluster_state, hostname):
+        self.refreshes.append((cluster_state, hostname))
+        return self.refreshed
+
+
+def deployment(hostname):
+    """
+    :param unicode hostname: The hostname of the only node.
+
+    :return: A distinctive ``Deployment``.
+    """
+    return Deployment(nodes=frozenset([
+        Node(hostname=hostname, applications=frozenset())]))
+
+
+DESIRED = deployment(u"desired.example.com")
+CURRENT = deployment(u"current.example.com")
+REFRESHED = deployment(u"refreshed.example.com")
+
+
+class ConvergenceAgentTests(SynchronousTestCase):
+    """
+    Tests for ``ConvergenceAgent``.
+    """
+    def setUp(self):
+        self.deployer = ControllableDeployer()
+        self.agent = ConvergenceAgent(self.deployer)
+
+    def test_default_interval(self):
+        """
+        By default the agent converges every ``CONVERGE_INTERVAL`` seconds.
+        """
+        self.assertEqual(CONVERGE_INTERVAL, self.agent.interval)
+
+    def test_set_desired_state(self):
+        """
+        ``ConvergenceAgent.set_desired_state`` changes the node's state and
+        returns a ``Deferred`` which fires with the ``ChangeProfile`` of the
+        convergence once it has been changed.
+        """
+        d = self.agent.set_desired_state(DESIRED, CURRENT, u"node1")
+        self.assertNoResult(d)
+        self.deployer.results[0].callback(None)
+        self.assertEqual(
+            ([(DESIRED, CURRENT, u"node1")], self.deployer.profiles[0]),
+            (self.deployer.calls, self.successResultOf(d)))
+
+    def test_converged_state_is_current(self):
+        """
+        Once the node has converged, later convergences treat the desired
+        state as the current state of the cluster.
+        """
+        self.agent.set_desired_state(DESIRED, CURRENT, u"node1")
+        self.deployer.results[0].callback(None)
+        self.agent.converge()
+        self.assertEqual((DESIRED, DESIRED, u"node1"),
+                         self.deployer.calls[1])
+
+    def test_failure(self):
+        """
+        If changing the node's state fails, the ``Deferred`` returned by
+        ``ConvergenceAgent.set_desired_state`` fails and this node's part of
+        the current state of the cluster is refreshed, so the next
+        convergence doesn't repeat changes which were made.
+        """
+        d = self.agent.set_desired_state(DESIRED, CURRENT, u"node1")
+        self.deployer.results[0].errback(ZeroDivisionError())
+        self.failureResultOf(d, ZeroDivisionError)
+        self.assertEqual(
+            ([(CURRENT, u"node1")], REFRESHED),
+            (self.deployer.refreshes, self.agent.current_cluster_state))
+
+    def test_retry_after_failure(self):
+        """
+        The convergence after a failed one is planned relative to the
+        refreshed state of the cluster.
+        """
+        d = self.agent.set_desired_state(DESIRED, CURRENT, u"node1")
+        self.deployer.results[0].errback(ZeroDivisionError())
+        self.failureResultOf(d, ZeroDivisionError)
+        self.agent.converge()
+        self.assertEqual((DESIRED, REFRESHED, u"node1"),
+                         self.deployer.calls[1])
+
+    def test_refresh_waited_for(self):
+        """
+        The ``Deferred`` returned by ``ConvergenceAgent.set_desired_state``
+        doesn't fire until the refresh after a failure has finished, and no
+        other convergence starts before then.
+        """
+        self.deployer.refreshed = Deferred()
+        d = self.agent.set_desired_state(DESIRED, CURRENT, u"node1")
+        self.deployer.results[0].errback(ZeroDivisionError())
+        self.agent.converge()
+        self.assertNoResult(d)
+        self.assertEqual(1, len(self.deployer.calls))
+        self.deployer.refreshed.callback(REFRESHED)
+        self.failureResultOf(d, ZeroDivisionError)
+
+    @validateLogging(None)
+    def test_refresh_failure(self, logger):
+        """
+        If refreshing the state of the cluster fails, the failure is logged
+        and the current state of the cluster is left as it was.
+        """
+        self.agent.logger = logger
+        self.deployer.refreshed = fail(RuntimeError())
+        d = self.agent.set_desired_state(DESIRED, CURRENT, u"node1")
+        self.deployer.results[0].errback(ZeroDivisionError())
+        self.failureResultOf(d, ZeroDivisionError)
+        self.assertEqual(
+            (CURRENT, 1),
+            (self.agent.current_cluster_state,
+             len(logger.flushTracebacks(RuntimeError))))
+
+    def test_newer_state_not_replaced(self):
+        """
+        If a new current state of the cluster is supplied while a failed
+        convergence is being refreshed after, the new one is kept.
+        """
+        self.deployer.refreshed = Deferred()
+        d = self.agent.set_desired_state(DESIRED, CURRENT, u"node1")
+        self.deployer.results[0].errback(ZeroDivisionError())
+        newer = deployment(u"newer.example.com")
+        self.agent.set_desired_state(DESIRED, newer, u"node1")
+        self.deployer.refreshed.callback(REFRESHED)
+        self.failureResultOf(d, ZeroDivisionError)
+        self.assertEqual((DESIRED, newer, u"node1"), self.deployer.calls[1])
+
+    def test_one_at_a_time(self):
+        """
+        Desired states given while a convergence is running are merged into a
+        single convergence on the latest of them, which starts once the
+        running one has finished.
+        """
+        first = self.agent.set_desired_state(CURRENT, CURRENT, u"node1")
+        second = self.agent.set_desired_state(CURRENT, CURRENT, u"node1")
+        third = self.agent.set_desired_state(DESIRED, CURRENT, u"node1")
+        calls_while_running = len(self.deployer.calls)
+        self.deployer.results[0].callback(None)
+        self.assertEqual(
+            (1, [(DESIRED, CURRENT, u"node1")], self.deployer.profiles[0]),
+            (calls_while_running, self.deployer.calls[1:],
+             self.successResultOf(first)))
+        self.assertNoResult(second)
+        self.deployer.results[1].callback(None)
+        self.assertEqual([self.deployer.profiles[1]] * 2,
+                         [self.successResultOf(second),
+                          self.successResultOf(third)])
+
+    def test_profile_of_own_convergence(self):
+        """
+        The ``Deferred`` returned by ``ConvergenceAgent.set_desired_state``
+        fires with the ``ChangeProfile`` of the convergence which applied
+        that state, even if a later convergence has already started.
+        """
+        d = self.agent.set_desired_state(DESIRED, CURRENT, u"node1")
+        self.agent.converge()
+        self.deployer.results[0].callback(None)
+        self.assertEqual(
+            (self.deployer.profiles[1], self.deployer.profiles[0]),
+            (self.deployer.profile, self.successResultOf(d)))
+
+    def test_no_desired_state(self):
+        """
+        Before a desired state is given, ``ConvergenceAgent.converge`` does
+        nothing.
+        """
+        d = self.agent.converge()
+        self.assertEqual(([], None),
+                         (self.deployer.calls, self.successResultOf(d)))
+
+    def test_periodic(self):
+        """
+        While running, the agent converges again every ``interval`` seconds.
+        """
+        agent = ConvergenceAgent(self.deployer, interval=5)
+        agent.set_desired_state(DESIRED, CURRENT, u"node1")
+        self.deployer.results[0].callback(None)
+        agent.startService()
+        self.deployer.reactor.advance(4)
+        calls_before = len(self.deployer.calls)
+        self.deployer.reactor.advance(1)
+        self.assertEqual((1, 2), (calls_before, len(self.deployer.calls)))
+
+    def test_periodic_skipped_while_converging(self):
+        """
+        A periodic convergence doesn't queue another convergence if one is
+        already running.
+        """
+        agent = ConvergenceAgent(self.deployer, interval=5)
+        agent.set_desired_state(DESIRED, CURRENT, u"node1")
+        agent.startService()
+        self.deployer.reactor.advance(5)
+        self.deployer.results[0].callback(None)
+        self.assertEqual(1, len(self.deployer.calls))
+
+    @validateLogging(None)
+    def test_periodic_failure_logged(self, logger):
+        """
+        Failures of periodic convergences are logged.
+        """
+        agent = ConvergenceAgent(self.deployer, interval=5)
+        agent.logger = logger
+        agent.set_desired_state(DESIRED, CURRENT, u"node1")
+        self.deployer.results[0].callback(None)
+        agent.startService()
+        self.deployer.reactor.advance(5)
+        self.deployer.results[1].errback(ZeroDivisionError())
+        self.assertEqual(1, len(logger.flushTracebacks(ZeroDivisionError)))
+
+    def test_stop(self):
+        """
+        ``ConvergenceAgent.stopService`` stops periodic convergence and
+        returns a ``Deferred`` which fires once the running convergence has
+        finished.
+        """
+        self.agent.startService()
+        self.agent.set_desired_state(DESIRED, CURRENT, u"node1")
+        d = self.agent.stopService()
+        self.assertNoResult(d)
+        self.deployer.results[0].callback(None)
+        self.successResultOf(d)
+        self.assertEqual([], self.deployer.reactor.getDelayedCalls())
+
+    def test_stop_waits_for_queued(self):
+        """
+        The ``Deferred`` returned by ``ConvergenceAgent.stopService`` doesn't
+        fire until a convergence queued behind the running one has finished
+        too.
+        """
+        self.agent.startService()
+        self.agent.set_desired_state(DESIRED, CURRENT, u"node1")
+        self.agent.set_desired_state(DESIRED, CURRENT, u"node1")
+        d = self.agent.stopService()
+        self.deployer.results[0].callback(None)
+        self.assertNoResult(d)
+        self.deployer.results[1].callback(None)
+        self.successResultOf(d)
@@ -294,6 +294,31 @@ class ApplicationsToFlockerYAMLTests(SynchronousTestCase):
             {'mountpoint': '/var/lib/data'}
         )
 
+    def test_has_volume_properties(self):
+        """
+        The YAML for a single application entry returned by
+        ``applications_to_flocker_yaml`` includes the volume's storage
+        properties.
+        """
+        config = {
+            'version': 1,
+            'applications': {
+                'postgres': {
+                    'image': 'sample/postgres',
+                    'volume': {'mountpoint': b'/var/lib/data',
+                               'properties': {'compression': 'lz4'}},
+                }
+            }
+        }
+        applications = FlockerConfiguration(config).applications()
+        yaml = applications_to_flocker_yaml(applications)
+        parsed = safe_load(yaml)
+        self.assertEqual(
+            parsed['applications']['postgres']['volume'],
+            {'mountpoint': '/var/lib/data',
+             'properties': {'compression': 'lz4'}}
+        )
+
 
 class ApplicationsFromFigConfigurationTests(SynchronousTestCase):
     """
@@ -1219,6 +1244,78 @@ class ApplicationsFromConfigurationTests(SynchronousTestCase):
         }.items())
         self.assertEqual(expected_result, environment_vars)
 
+    def test_stop_timeout_none_if_missing(self):
+        """
+        ``Configuration._parse_stop_timeout_config`` returns ``None`` if
+        passed an application config that does not include a
+        ``stop_timeout`` key.
+        """
+        parser = FlockerConfiguration({})
+        self.assertIsNone(parser._parse_stop_timeout_config(
+            'mysql-hybridcluster', {'image': 'flocker/mysql'}))
+
+    def test_stop_timeout(self):
+        """
+        ``Configuration.applications`` gives each ``Application`` the
+        ``stop_timeout`` from its configuration.
+        """
+        config = dict(
+            version=1,
+            applications={
+                'mysql-hybridcluster': dict(
+                    image='flocker/mysql:v1.0.0', stop_timeout=30),
+            }
+        )
+        parser = FlockerConfiguration(config)
+        applications = parser.applications()
+        self.assertEqual(
+            30, applications['mysql-hybridcluster'].stop_timeout)
+
+    def test_error_on_stop_timeout_not_integer(self):
+        """
+        ``Configuration._parse_stop_timeout_config`` raises a
+        ``ConfigurationError`` if the ``stop_timeout`` is not an integer.
+        """
+        parser = FlockerConfiguration({})
+        exception = self.assertRaises(
+            ConfigurationError, parser._parse_stop_timeout_config,
+            'mysql-hybridcluster',
+            {'image': 'flocker/mysql', 'stop_timeout': '30'})
+        self.assertEqual(
+            "Application 'mysql-hybridcluster' has a config error. "
+            "'stop_timeout' must be an integer; got type 'unicode'.",
+            exception.message)
+
+    def test_error_on_stop_timeout_bool(self):
+        """
+        ``Configuration._parse_stop_timeout_config`` raises a
+        ``ConfigurationError`` if the ``stop_timeout`` is a boolean.
+        """
+        parser = FlockerConfiguration({})
+        exception = self.assertRaises(
+            ConfigurationError, parser._parse_stop_timeout_config,
+            'mysql-hybridcluster',
+            {'image': 'flocker/mysql', 'stop_timeout': True})
+        self.assertEqual(
+            "Application 'mysql-hybridcluster' has a config error. "
+            "'stop_timeout' must be an integer; got type 'bool'.",
+            exception.message)
+
+    def test_error_on_stop_timeout_negative(self):
+        """
+        ``Configuration._parse_stop_timeout_config`` raises a
+        ``ConfigurationError`` if the ``stop_timeout`` is negative.
+        """
+        parser = FlockerConfiguration({})
+        exception = self.assertRaises(
+            ConfigurationError, parser._parse_stop_timeout_config,
+            'mysql-hybridcluster',
+            {'image': 'flocker/mysql', 'stop_timeout': -1})
+        self.assertEqual(
+            "Application 'mysql-hybridcluster' has a config error. "
+            "'stop_timeout' must not be negative.",
+            exception.message)
+
     def test_dict_of_applications(self):
         """
         ``Configuration.applications`` returns a ``dict``
@@ -1701,6 +1798,170 @@ class ApplicationsFromConfigurationTests(SynchronousTestCase):
             exception.message
         )
 
+    def test_volume_properties(self):
+        """
+        ``Configuration.applications`` returns an ``Application`` whose
+        ``AttachedVolume`` has the storage properties given in the volume's
+        ``properties`` dictionary.  Booleans and integers, as produced by
+        YAML for unquoted values like ``off``, are converted to strings.
+        """
+        config = dict(
+            version=1,
+            applications={'postgres': dict(
+                image='busybox',
+                volume={'mountpoint': b'/var/lib/postgres',
+                        'properties': {'recordsize': '8k',
+                                       'atime': False,
+                                       'copies': 2}},
+            )}
+        )
+        parser = FlockerConfiguration(config)
+        applications = parser.applications()
+        self.assertEqual(
+            frozenset([('recordsize', '8k'), ('atime', 'off'),
+                       ('copies', '2')]),
+            applications['postgres'].volume.properties)
+
+    def test_error_on_volume_properties_not_dict(self):
+        """
+        ``Configuration.applications`` raises a ``ConfigurationError`` if
+        the volume's ``properties`` is not a dictionary.
+        """
+        config = dict(
+            version=1,
+            applications={'postgres': dict(
+                image='busybox',
+                volume={'mountpoint': b'/var/lib/postgres',
+                        'properties': ['recordsize=8k']},
+            )}
+        )
+        parser = FlockerConfiguration(config)
+        exception = self.assertRaises(ConfigurationError,
+                                      parser.applications)
+        self.assertEqual(
+            "Application 'postgres' has a config error. "
+            "Invalid volume specification. 'properties' must be a "
+            "dictionary of key/value pairs.",
+            exception.message
+        )
+
+    def test_error_on_volume_properties_invalid_value(self):
+        """
+        ``Configuration.applications`` raises a ``ConfigurationError`` if a
+        volume property value is not a simple value.
+        """
+        config = dict(
+            version=1,
+            applications={'postgres': dict(
+                image='busybox',
+                volume={'mountpoint': b'/var/lib/postgres',
+                        'properties': {'recordsize': ['8k']}},
+            )}
+        )
+        parser = FlockerConfiguration(config)
+        exception = self.assertRaises(ConfigurationError,
+                                      parser.applications)
+        self.assertEqual(
+            "Application 'postgres' has a config error. "
+            "Invalid volume specification. Property 'recordsize' must be "
+            "a string.",
+            exception.message
+        )
+
+    def test_error_on_volume_properties_managed(self):
+        """
+        ``Configuration.applications`` raises a ``ConfigurationError`` if
+        the volume's properties include one which Flocker sets itself.
+        """
+        config = dict(
+            version=1,
+            applications={'postgres': dict(
+                image='busybox',
+                volume={'mountpoint': b'/var/lib/postgres',
+                        'properties': {'readonly': 'on'}},
+            )}
+        )
+        parser = FlockerConfiguration(config)
+        exception = self.assertRaises(ConfigurationError,
+                                      parser.applications)
+        self.assertEqual(
+            "Application 'postgres' has a config error. "
+            "Invalid volume specification. Property 'readonly' is managed "
+            "by Flocker.",
+            exception.message
+        )
+
+    def test_error_on_volume_properties_invalid_name(self):
+        """
+        ``Configuration.applications`` raises a ``ConfigurationError`` if a
+        volume property name isn't one the storage backend accepts, such as
+        one with uppercase, non-ASCII or whitespace characters, or an empty
+        one.
+        """
+        for name in ['RecordSize', 'caf\xe9:size', 'record size', '']:
+            config = dict(
+                version=1,
+                applications={'postgres': dict(
+                    image='busybox',
+                    volume={'mountpoint': b'/var/lib/postgres',
+                            'properties': {name: '8k'}},
+                )}
+            )
+            parser = FlockerConfiguration(config)
+            exception = self.assertRaises(ConfigurationError,
+                                          parser.applications)
+            self.assertEqual(
+                "Application 'postgres' has a config error. "
+                "Invalid volume specification. Property name '{name}' is "
+                "invalid. Names may only contain lowercase letters, digits, "
+                "':', '.', '_' and '-'.".format(name=name),
+                exception.message
+            )
+
+    def test_error_on_volume_properties_malformed_value(self):
+        """
+        ``Configuration.applications`` raises a ``ConfigurationError`` if a
+        volume property value is empty or contains non-ASCII or control
+        characters.
+        """
+        for value in ['', 'caf\xe9', '8k\n']:
+            config = dict(
+                version=1,
+                applications={'postgres': dict(
+                    image='busybox',
+                    volume={'mountpoint': b'/var/lib/postgres',
+                            'properties': {'recordsize': value}},
+                )}
+            )
+            parser = FlockerConfiguration(config)
+            exception = self.assertRaises(ConfigurationError,
+                                          parser.applications)
+            self.assertEqual(
+                "Application 'postgres' has a config error. "
+                "Invalid volume specification. Property 'recordsize' must "
+                "be a non-empty string of printable ASCII characters.",
+                exception.message
+            )
+
+    def test_volume_properties_user_property(self):
+        """
+        ``Configuration.applications`` accepts user property names, which
+        contain ``:`` and may contain ``.``, ``_`` and ``-``.
+        """
+        config = dict(
+            version=1,
+            applications={'postgres': dict(
+                image='busybox',
+                volume={'mountpoint': b'/var/lib/postgres',
+                        'properties': {'com.example:backup-policy_v2':
+                                       'daily'}},
+            )}
+        )
+        parser = FlockerConfiguration(config)
+        self.assertEqual(
+            frozenset([('com.example:backup-policy_v2', 'daily')]),
+            parser.applications()['postgres'].volume.properties)
+
 
 class DeploymentFromConfigurationTests(SynchronousTestCase):
     """
@@ -1915,6 +2176,7 @@ class MarshalConfigurationTests(SynchronousTestCase):
         expected = {
             'applications': {},
             'used_ports': [],
+            'running': [],
             'version': 1,
         }
         self.assertEqual(expected, result)
@@ -1936,6 +2198,7 @@ class MarshalConfigurationTests(SynchronousTestCase):
             NodeState(running=applications, not_running=[]))
         expected = {
             'used_ports': [],
+            'running': ['mysql-hybridcluster'],
             'applications': {
                 'mysql-hybridcluster': {'image': u'flocker/mysql:v1.0.0'}
             },
@@ -1963,6 +2226,7 @@ class MarshalConfigurationTests(SynchronousTestCase):
             NodeState(running=applications, not_running=[]))
         expected = {
             'used_ports': [],
+            'running': ['mysql-hybridcluster', 'site-hybridcluster'],
             'applications': {
                 'site-hybridcluster': {
                     'image': u'flocker/wordpress:v1.0.0'
@@ -1973,6 +2237,25 @@ class MarshalConfigurationTests(SynchronousTestCase):
         }
         self.assertEqual(expected, result)
 
+    def test_application_stop_timeout(self):
+        """
+        The dictionary includes the ``stop_timeout`` of an ``Application``
+        which has one.
+        """
+        applications = [
+            Application(
+                name='mysql-hybridcluster',
+                image=DockerImage(repository='flocker/mysql',
+                                  tag='v1.0.0'),
+                stop_timeout=30,
+            )
+        ]
+        result = marshal_configuration(
+            NodeState(running=applications, not_running=[]))
+        self.assertEqual(
+            {'image': u'flocker/mysql:v1.0.0', 'stop_timeout': 30},
+            result['applications']['mysql-hybridcluster'])
+
     def test_application_ports(self):
         """
         The dictionary includes a representation of each supplied application,
@@ -1992,6 +2275,7 @@ class MarshalConfigurationTests(SynchronousTestCase):
             NodeState(running=applications, not_running=[]))
         expected = {
             'used_ports': [],
+            'running': ['site-hybridcluster'],
             'applications': {
                 'site-hybridcluster': {
                     'image': u'flocker/wordpress:v1.0.0',
@@ -2022,6 +2306,7 @@ class MarshalConfigurationTests(SynchronousTestCase):
             NodeState(running=applications, not_running=[]))
         expected = {
             'used_ports': [],
+            'running': ['site-hybridcluster'],
             'applications': {
                 'site-hybridcluster': {
                     'image': u'flocker/wordpress:v1.0.0',
@@ -2059,6 +2344,7 @@ class MarshalConfigurationTests(SynchronousTestCase):
             NodeState(running=applications, not_running=[]))
         expected = {
             'used_ports': [],
+            'running': ['mysql-hybridcluster', 'site-hybridcluster'],
             'applications': {
                 'site-hybridcluster': {
                     'image': u'flocker/wordpress:v1.0.0',
@@ -2100,6 +2386,7 @@ class MarshalConfigurationTests(SynchronousTestCase):
 
         expected = {
             'used_ports': [],
+            'running': ['mysql-hybridcluster'],
             'applications': {
                 'site-hybridcluster': {
                     'image': u'flocker/wordpress:v1.0.0',
@@ -2123,6 +2410,7 @@ class MarshalConfigurationTests(SynchronousTestCase):
         state = NodeState(running=[], not_running=[], used_ports=used_ports)
         expected = {
             'used_ports': sorted(used_ports),
+            'running': [],
             'applications': {},
             'version': 1,
         }
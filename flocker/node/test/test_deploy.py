@@ -4,31 +4,47 @@
 Tests for ``flocker.node._deploy``.
 """
 
+from contextlib import contextmanager
+from io import BytesIO
+from json import dumps
 from uuid import uuid4
 
 from zope.interface.verify import verifyObject
 from zope.interface import implementer
 
-from twisted.internet.defer import fail, FirstError, succeed, Deferred
+from twisted.internet.defer import (
+    fail, FirstError, succeed, Deferred, maybeDeferred)
+from twisted.internet.task import Clock
 from twisted.trial.unittest import SynchronousTestCase
 from twisted.python.filepath import FilePath
 
+from yaml import safe_dump
+
 from .. import (
     Deployer, Application, DockerImage, Deployment, Node, Port, Link,
     NodeState)
 from .._deploy import (
-    IStateChange, Sequentially, InParallel, StartApplication, StopApplication,
-    CreateVolume, WaitForVolume, HandoffVolume, SetProxies, PushVolume,
-    _link_environment, _to_volume_name)
+    IStateChange, Sequentially, InParallel, InDependencyOrder,
+    ConcurrencyLimiter, Resource,
+    StartApplication, StopApplication, CreateVolume, WaitForVolume,
+    WaitForApplication, HandoffVolume, SetProxies, PushVolume, PullImage,
+    WAIT_FOR_APPLICATION_INTERVAL, WAIT_FOR_APPLICATION_TIMEOUT,
+    ApplicationNotStarted, AppliedState, AppliedStateStore,
+    _CountingVolumeManager, _link_environment, _to_volume_name)
+from .._profile import ChangeProfile
+from .. import _deploy
 from .._model import AttachedVolume
 from .._docker import (
     FakeDockerClient, AlreadyExists, Unit, PortMap, Environment,
     DockerClient, Volume as DockerVolume)
-from ...route import Proxy, make_memory_network
-from ...route._iptables import HostNetwork
+from ...route import Proxy, make_memory_network, ITransactionalNetwork
+from ...route._iptables import RestoreNetwork
+from ...route._memory import MemoryNetwork
 from ...volume.service import Volume, VolumeName
 from ...volume.testtools import create_volume_service
-from ...volume._ipc import RemoteVolumeManager, standard_node
+from ...volume._ipc import (
+    IRemoteVolumeManager, RemoteVolumeManager, standard_node)
+from ...common import FakeNode
 
 
 class DeployerAttributesTests(SynchronousTestCase):
@@ -57,9 +73,9 @@ class DeployerAttributesTests(SynchronousTestCase):
 
     def test_network_default(self):
         """
-        ``Deployer._network`` is a ``HostNetwork`` by default.
+        ``Deployer._network`` is a ``RestoreNetwork`` by default.
         """
-        self.assertIsInstance(Deployer(None).network, HostNetwork)
+        self.assertIsInstance(Deployer(None).network, RestoreNetwork)
 
     def test_network_override(self):
         """
@@ -72,6 +88,41 @@ class DeployerAttributesTests(SynchronousTestCase):
                      network=dummy_network).network
         )
 
+    def test_reactor_default(self):
+        """
+        ``Deployer.reactor`` is the global reactor by default.
+        """
+        from twisted.internet import reactor
+        self.assertIs(reactor, Deployer(create_volume_service(self)).reactor)
+
+    def test_reactor_override(self):
+        """
+        ``Deployer.reactor`` can be overridden in the constructor.
+        """
+        clock = Clock()
+        self.assertIs(
+            clock, Deployer(create_volume_service(self), reactor=clock).reactor
+        )
+
+    def test_limiter_default(self):
+        """
+        ``Deployer.limiter`` is an unlimited ``ConcurrencyLimiter`` by
+        default.
+        """
+        limiter = Deployer(create_volume_service(self)).limiter
+        self.assertEqual((ConcurrencyLimiter, None, {}),
+                         (type(limiter), limiter.total, limiter.resources))
+
+    def test_limiter_override(self):
+        """
+        ``Deployer.limiter`` can be overridden in the constructor.
+        """
+        limiter = ConcurrencyLimiter(total=1)
+        self.assertIs(
+            limiter,
+            Deployer(create_volume_service(self), limiter=limiter).limiter
+        )
+
 
 def make_istatechange_tests(klass, kwargs1, kwargs2):
     """
@@ -113,14 +164,22 @@ SequentiallyIStateChangeTests = make_istatechange_tests(
     Sequentially, dict(changes=[1]), dict(changes=[2]))
 InParallelIStateChangeTests = make_istatechange_tests(
     InParallel, dict(changes=[1]), dict(changes=[2]))
+InDependencyOrderIStateChangeTests = make_istatechange_tests(
+    InDependencyOrder, dict(dependencies={1: frozenset()}),
+    dict(dependencies={2: frozenset()}))
 StartApplicationIStateChangeTests = make_istatechange_tests(
     StartApplication,
     dict(application=1, hostname="node1.example.com"),
     dict(application=2, hostname="node2.example.com"))
+PullImageIStateChangeTests = make_istatechange_tests(
+    PullImage, dict(image=1), dict(image=2))
 StopApplicationIStageChangeTests = make_istatechange_tests(
     StopApplication, dict(application=1), dict(application=2))
 SetProxiesIStateChangeTests = make_istatechange_tests(
     SetProxies, dict(ports=[1]), dict(ports=[2]))
+WaitForApplicationIStateChangeTests = make_istatechange_tests(
+    WaitForApplication, dict(application=1, hostname=u"node1.example.com"),
+    dict(application=2, hostname=u"node1.example.com"))
 WaitForVolumeIStateChangeTests = make_istatechange_tests(
     WaitForVolume, dict(volume=1), dict(volume=2))
 CreateVolumeIStateChangeTests = make_istatechange_tests(
@@ -170,6 +229,17 @@ class FakeChange(object):
         return True
 
 
+class ProfilingDeployer(object):
+    """
+    A stand-in for ``Deployer`` with only what changes which run other
+    changes need.
+
+    :ivar ChangeProfile profile: The profile to run sub-changes with.
+    """
+    def __init__(self):
+        self.profile = ChangeProfile(Clock())
+
+
 class SequentiallyTests(SynchronousTestCase):
     """
     Tests for ``Sequentially``.
@@ -180,7 +250,7 @@ class SequentiallyTests(SynchronousTestCase):
         """
         subchanges = [FakeChange(succeed(None)), FakeChange(succeed(None))]
         change = Sequentially(changes=subchanges)
-        deployer = object()
+        deployer = ProfilingDeployer()
         change.run(deployer)
         self.assertEqual([c.deployer for c in subchanges],
                          [deployer, deployer])
@@ -192,7 +262,7 @@ class SequentiallyTests(SynchronousTestCase):
         not_done1, not_done2 = Deferred(), Deferred()
         subchanges = [FakeChange(not_done1), FakeChange(not_done2)]
         change = Sequentially(changes=subchanges)
-        deployer = object()
+        deployer = ProfilingDeployer()
         result = change.run(deployer)
         self.assertNoResult(result)
         not_done1.callback(None)
@@ -210,7 +280,7 @@ class SequentiallyTests(SynchronousTestCase):
         not_done = Deferred()
         subchanges = [FakeChange(not_done), FakeChange(succeed(None))]
         change = Sequentially(changes=subchanges)
-        deployer = object()
+        deployer = ProfilingDeployer()
         # Run the sequential change. We expect the first FakeChange's
         # run() to be called, but we expect second one *not* to be called
         # yet, since first one has finished.
@@ -229,7 +299,7 @@ class SequentiallyTests(SynchronousTestCase):
         not_done = Deferred()
         subchanges = [FakeChange(not_done), FakeChange(succeed(None))]
         change = Sequentially(changes=subchanges)
-        deployer = object()
+        deployer = ProfilingDeployer()
         result = change.run(deployer)
         called = [subchanges[1].was_run_called()]
         exception = RuntimeError()
@@ -238,6 +308,20 @@ class SequentiallyTests(SynchronousTestCase):
                        self.failureResultOf(result).value])
         self.assertEqual(called, [False, False, exception])
 
+    def test_profiled(self):
+        """
+        ``Sequentially.run`` runs sub-changes with the deployer's
+        ``ChangeProfile``, each after the one before it.
+        """
+        subchanges = [FakeChange(succeed(None)), FakeChange(succeed(None))]
+        change = Sequentially(changes=subchanges)
+        deployer = ProfilingDeployer()
+        deployer.profile.run(change, deployer)
+        self.assertEqual(
+            [(None, None), (0, None), (0, 1)],
+            [(timing.parent, timing.after)
+             for timing in deployer.profile.timings])
+
 
 class InParallelTests(SynchronousTestCase):
     """
@@ -249,7 +333,7 @@ class InParallelTests(SynchronousTestCase):
         """
         subchanges = [FakeChange(succeed(None)), FakeChange(succeed(None))]
         change = InParallel(changes=subchanges)
-        deployer = object()
+        deployer = ProfilingDeployer()
         change.run(deployer)
         self.assertEqual([c.deployer for c in subchanges],
                          [deployer, deployer])
@@ -261,7 +345,7 @@ class InParallelTests(SynchronousTestCase):
         not_done1, not_done2 = Deferred(), Deferred()
         subchanges = [FakeChange(not_done1), FakeChange(not_done2)]
         change = InParallel(changes=subchanges)
-        deployer = object()
+        deployer = ProfilingDeployer()
         result = change.run(deployer)
         self.assertNoResult(result)
         not_done1.callback(None)
@@ -277,7 +361,7 @@ class InParallelTests(SynchronousTestCase):
         # expect the second one to be run() nonetheless.
         subchanges = [FakeChange(Deferred()), FakeChange(succeed(None))]
         change = InParallel(changes=subchanges)
-        deployer = object()
+        deployer = ProfilingDeployer()
         change.run(deployer)
         called = [subchanges[0].was_run_called(),
                   subchanges[1].was_run_called()]
@@ -289,7 +373,7 @@ class InParallelTests(SynchronousTestCase):
         """
         subchanges = [FakeChange(fail(RuntimeError()))]
         change = InParallel(changes=subchanges)
-        result = change.run(object())
+        result = change.run(ProfilingDeployer())
         failure = self.failureResultOf(result, FirstError)
         self.assertEqual(failure.value.subFailure.type, RuntimeError)
         self.flushLoggedErrors(RuntimeError)
@@ -305,7 +389,7 @@ class InParallelTests(SynchronousTestCase):
             FakeChange(fail(ZeroDivisionError('e3'))),
         ]
         change = InParallel(changes=subchanges)
-        result = change.run(deployer=object())
+        result = change.run(deployer=ProfilingDeployer())
         self.failureResultOf(result, FirstError)
 
         self.assertEqual(
@@ -313,6 +397,256 @@ class InParallelTests(SynchronousTestCase):
             len(self.flushLoggedErrors(ZeroDivisionError))
         )
 
+    def test_profiled(self):
+        """
+        ``InParallel.run`` runs sub-changes with the deployer's
+        ``ChangeProfile``, all as soon as it starts.
+        """
+        subchanges = [FakeChange(succeed(None)), FakeChange(succeed(None))]
+        change = InParallel(changes=subchanges)
+        deployer = ProfilingDeployer()
+        deployer.profile.run(change, deployer)
+        self.assertEqual(
+            [(None, None), (0, None), (0, None)],
+            [(timing.parent, timing.after)
+             for timing in deployer.profile.timings])
+
+
+class InDependencyOrderTests(SynchronousTestCase):
+    """
+    Tests for ``InDependencyOrder``.
+    """
+    def test_subchanges_get_deployer(self):
+        """
+        ``InDependencyOrder.run`` runs sub-changes with the given deployer.
+        """
+        first, second = FakeChange(succeed(None)), FakeChange(succeed(None))
+        change = InDependencyOrder(
+            dependencies={first: frozenset(), second: frozenset({first})})
+        deployer = ProfilingDeployer()
+        change.run(deployer)
+        self.assertEqual([first.deployer, second.deployer],
+                         [deployer, deployer])
+
+    def test_no_changes(self):
+        """
+        ``InDependencyOrder.run`` succeeds immediately if there are no
+        changes.
+        """
+        change = InDependencyOrder(dependencies={})
+        self.successResultOf(change.run(ProfilingDeployer()))
+
+    def test_dependencies_first(self):
+        """
+        ``InDependencyOrder.run`` only runs a sub-change once all of the
+        changes it depends on have finished.
+        """
+        not_done1, not_done2 = Deferred(), Deferred()
+        first, second = FakeChange(not_done1), FakeChange(not_done2)
+        last = FakeChange(succeed(None))
+        change = InDependencyOrder(dependencies={
+            first: frozenset(), second: frozenset(),
+            last: frozenset({first, second})})
+        change.run(ProfilingDeployer())
+        called = [last.was_run_called()]
+        not_done1.callback(None)
+        called.append(last.was_run_called())
+        not_done2.callback(None)
+        called.append(last.was_run_called())
+        self.assertEqual(called, [False, False, True])
+
+    def test_independent_changes(self):
+        """
+        ``InDependencyOrder.run`` runs a sub-change without waiting for
+        changes it doesn't depend on.
+        """
+        slow = FakeChange(Deferred())
+        first = FakeChange(succeed(None))
+        second = FakeChange(succeed(None))
+        change = InDependencyOrder(dependencies={
+            slow: frozenset(), first: frozenset(),
+            second: frozenset({first})})
+        change.run(ProfilingDeployer())
+        self.assertEqual([True, True, True],
+                         [slow.was_run_called(), first.was_run_called(),
+                          second.was_run_called()])
+
+    def test_result(self):
+        """
+        The result of ``InDependencyOrder.run`` fires when all changes are
+        done.
+        """
+        not_done1, not_done2 = Deferred(), Deferred()
+        first, second = FakeChange(not_done1), FakeChange(not_done2)
+        change = InDependencyOrder(dependencies={
+            first: frozenset(), second: frozenset({first})})
+        result = change.run(ProfilingDeployer())
+        self.assertNoResult(result)
+        not_done1.callback(None)
+        self.assertNoResult(result)
+        not_done2.callback(None)
+        self.successResultOf(result)
+
+    def test_failure_skips_dependents(self):
+        """
+        If a sub-change fails, the changes which depend on it aren't run but
+        unrelated changes are, and ``InDependencyOrder.run`` fails with the
+        failure once they are done.
+        """
+        not_done = Deferred()
+        failing = FakeChange(fail(RuntimeError()))
+        dependent = FakeChange(succeed(None))
+        unrelated = FakeChange(not_done)
+        change = InDependencyOrder(dependencies={
+            failing: frozenset(), dependent: frozenset({failing}),
+            unrelated: frozenset()})
+        result = change.run(ProfilingDeployer())
+        self.assertNoResult(result)
+        not_done.callback(None)
+        failure = self.failureResultOf(result, FirstError)
+        self.assertEqual(
+            (failure.value.subFailure.type, dependent.was_run_called(),
+             unrelated.was_run_called()),
+            (RuntimeError, False, True))
+        self.flushLoggedErrors(RuntimeError)
+
+    def test_profiled(self):
+        """
+        ``InDependencyOrder.run`` runs sub-changes with the deployer's
+        ``ChangeProfile``, each after the last of the changes it depends on
+        to finish.
+        """
+        not_done1, not_done2 = Deferred(), Deferred()
+        first, second = FakeChange(not_done1), FakeChange(not_done2)
+        last = FakeChange(succeed(None))
+        change = InDependencyOrder(dependencies={
+            first: frozenset(), second: frozenset(),
+            last: frozenset({first, second})})
+        deployer = ProfilingDeployer()
+        deployer.profile.run(change, deployer)
+        not_done2.callback(None)
+        not_done1.callback(None)
+        timings = {timing.change: timing
+                   for timing in deployer.profile.timings}
+
+        def timing(subchange):
+            return timings[repr(subchange).decode("ascii")]
+        self.assertEqual(
+            [(0, None), (0, None), (0, timing(first).identifier)],
+            [(timing(subchange).parent, timing(subchange).after)
+             for subchange in [first, second, last]])
+
+    def test_failure_all_logged(self):
+        """
+        Errors in the async operations performed by ``InDependencyOrder.run``
+        are all logged.
+        """
+        subchanges = [
+            FakeChange(fail(ZeroDivisionError('e1'))),
+            FakeChange(fail(ZeroDivisionError('e2'))),
+        ]
+        change = InDependencyOrder(
+            dependencies={subchange: frozenset() for subchange in subchanges})
+        result = change.run(deployer=ProfilingDeployer())
+        self.failureResultOf(result, FirstError)
+        self.assertEqual(
+            len(subchanges),
+            len(self.flushLoggedErrors(ZeroDivisionError))
+        )
+
+
+class ConcurrencyLimiterTests(SynchronousTestCase):
+    """
+    Tests for ``ConcurrencyLimiter``.
+    """
+    def test_unlimited(self):
+        """
+        ``ConcurrencyLimiter.run`` with no limits calls the function
+        immediately, however many calls are outstanding, and returns its
+        result.
+        """
+        limiter = ConcurrencyLimiter()
+        for i in range(10):
+            limiter.run(Resource.DOCKER, Deferred)
+        result = limiter.run(Resource.DOCKER, lambda x: x * 2, 3)
+        self.assertEqual(6, self.successResultOf(result))
+
+    def test_resource_limit(self):
+        """
+        Calls beyond a resource's limit are queued until an earlier call for
+        that resource finishes.
+        """
+        limiter = ConcurrencyLimiter(resources={Resource.DOCKER: 1})
+        not_done = Deferred()
+        limiter.run(Resource.DOCKER, lambda: not_done)
+        called = []
+        limiter.run(Resource.DOCKER, called.append, 1)
+        result = [list(called)]
+        not_done.callback(None)
+        result.append(called)
+        self.assertEqual([[], [1]], result)
+
+    def test_other_resources_unaffected(self):
+        """
+        Calls for a resource aren't held up by another resource's limit.
+        """
+        limiter = ConcurrencyLimiter(resources={Resource.DOCKER: 1})
+        limiter.run(Resource.DOCKER, Deferred)
+        called = []
+        limiter.run(Resource.ZFS, called.append, 1)
+        self.assertEqual([1], called)
+
+    def test_total_limit(self):
+        """
+        Calls beyond the overall limit are queued until an earlier call for
+        any resource finishes.
+        """
+        limiter = ConcurrencyLimiter(total=1)
+        not_done = Deferred()
+        limiter.run(Resource.ZFS, lambda: not_done)
+        called = []
+        limiter.run(Resource.DOCKER, called.append, 1)
+        result = [list(called)]
+        not_done.callback(None)
+        result.append(called)
+        self.assertEqual([[], [1]], result)
+
+    def test_released_on_failure(self):
+        """
+        A call which fails releases its capacity, and its failure is the
+        result.
+        """
+        limiter = ConcurrencyLimiter(total=1)
+        result = limiter.run(Resource.DOCKER, lambda: 1 / 0)
+        self.failureResultOf(result, ZeroDivisionError)
+        self.successResultOf(limiter.run(Resource.DOCKER, lambda: None))
+
+    def test_state_changes_limited(self):
+        """
+        State changes run by ``InParallel`` are queued by the deployer's
+        ``ConcurrencyLimiter``.
+        """
+        unit = Unit(name=u'site-example.com',
+                    container_name=u'site-example.com',
+                    container_image=u'flocker/wordpress:v1.0.0',
+                    activation_state=u'active')
+        docker = FakeDockerClient(units={unit.name: unit})
+        limiter = ConcurrencyLimiter(resources={Resource.DOCKER: 1})
+        api = Deployer(create_volume_service(self), docker_client=docker,
+                       network=make_memory_network(), limiter=limiter)
+        not_done = Deferred()
+        limiter.run(Resource.DOCKER, lambda: not_done)
+        change = InParallel(changes=[StopApplication(
+            application=Application(
+                name=unit.name,
+                image=DockerImage.from_string(unit.container_image)))])
+        result = change.run(api)
+        running = [unit.name in docker._units]
+        not_done.callback(None)
+        self.successResultOf(result)
+        running.append(unit.name in docker._units)
+        self.assertEqual([True, False], running)
+
 
 class StartApplicationTests(SynchronousTestCase):
     """
@@ -522,6 +856,24 @@ class LinkEnviromentTests(SynchronousTestCase):
             })
 
 
+class PullImageTests(SynchronousTestCase):
+    """
+    Tests for ``PullImage``.
+    """
+    def test_pull(self):
+        """
+        ``PullImage.run()`` pulls the image using the deployer's Docker
+        client.
+        """
+        docker = FakeDockerClient()
+        api = Deployer(create_volume_service(self), docker_client=docker,
+                       network=make_memory_network())
+        image = DockerImage.from_string(u"clusterhq/postgres:9.1")
+        result = PullImage(image=image).run(api)
+        self.assertEqual((None, {u"clusterhq/postgres:9.1"}),
+                         (self.successResultOf(result), docker._images))
+
+
 class StopApplicationTests(SynchronousTestCase):
     """
     Tests for ``StopApplication``.
@@ -572,6 +924,21 @@ class StopApplicationTests(SynchronousTestCase):
 
         self.assertIs(None, result)
 
+    def test_stop_timeout(self):
+        """
+        ``StopApplication.run()`` removes the container with its
+        ``stop_timeout``.
+        """
+        fake_docker = FakeDockerClient()
+        api = Deployer(create_volume_service(self), docker_client=fake_docker)
+        application = Application(
+            name=b'site-example.com',
+            image=DockerImage(repository=u'clusterhq/flocker',
+                              tag=u'release-14.0'),
+        )
+        StopApplication(application=application, stop_timeout=30).run(api)
+        self.assertEqual({application.name: 30}, fake_docker._stop_timeouts)
+
 
 # This models an application that has a volume.
 APPLICATION_WITH_VOLUME_NAME = b"psql-clusterhq"
@@ -602,6 +969,80 @@ DISCOVERED_APPLICATION_WITH_VOLUME = Application(
 )
 
 
+class DeployerRefreshClusterStateTests(SynchronousTestCase):
+    """
+    Tests for ``Deployer.refresh_cluster_state``.
+    """
+    def setUp(self):
+        self.volume_service = create_volume_service(self)
+        unit = Unit(name=u"site-example.com",
+                    container_name=u"site-example.com",
+                    container_image=u"clusterhq/wordpress:latest",
+                    activation_state=u"active")
+        self.running = Application(
+            name=unit.name,
+            image=DockerImage.from_string(unit.container_image))
+        self.deployer = Deployer(
+            self.volume_service,
+            docker_client=FakeDockerClient(units={unit.name: unit}),
+            network=make_memory_network())
+        self.other = Node(hostname=u"node2.example.com",
+                          applications=frozenset([self.running]))
+
+    def refresh(self, applications):
+        """
+        Refresh a cluster state in which this node has the given
+        applications.
+
+        :return: The applications this node has in the refreshed state.
+        """
+        cluster_state = Deployment(nodes=frozenset([
+            Node(hostname=u"node1.example.com",
+                 applications=frozenset(applications)),
+            self.other]))
+        refreshed = self.successResultOf(
+            self.deployer.refresh_cluster_state(
+                cluster_state, u"node1.example.com"))
+        [node] = [node for node in refreshed.nodes
+                  if node.hostname == u"node1.example.com"]
+        self.assertIn(self.other, refreshed.nodes)
+        return node.applications
+
+    def test_discovered(self):
+        """
+        This node has the applications found on it, rather than those it
+        had before.
+        """
+        gone = Application(
+            name=u"gone", image=DockerImage.from_string(u"busybox"))
+        self.assertEqual(frozenset([self.running]), self.refresh([gone]))
+
+    def test_volume_owned(self):
+        """
+        Applications whose volumes this node still owns are kept, so a
+        handoff which didn't happen is retried.
+        """
+        self.successResultOf(
+            self.volume_service.create(_to_volume_name(u"mysql")))
+        mysql = Application(
+            name=u"mysql", image=DockerImage.from_string(u"mysql"),
+            volume=AttachedVolume(name=u"mysql",
+                                  mountpoint=FilePath(b"/var/lib/mysql")))
+        self.assertEqual(frozenset([self.running, mysql]),
+                         self.refresh([mysql]))
+
+    def test_volume_handed_off(self):
+        """
+        Applications whose volumes this node no longer owns are dropped, so
+        a handoff which happened isn't repeated.
+        """
+        mysql = Application(
+            name=u"mysql", image=DockerImage.from_string(u"mysql"),
+            volume=AttachedVolume(name=u"mysql",
+                                  mountpoint=FilePath(b"/var/lib/mysql")))
+        self.assertEqual(frozenset([self.running]), self.refresh([mysql]))
+
+
 class DeployerDiscoverNodeConfigurationTests(SynchronousTestCase):
     """
     Tests for ``Deployer.discover_node_configuration``.
@@ -712,6 +1153,32 @@ class DeployerDiscoverNodeConfigurationTests(SynchronousTestCase):
         self.assertEqual(sorted(applications),
                          sorted(self.successResultOf(d).running))
 
+    def test_discover_application_with_environment(self):
+        """
+        An ``Application`` is discovered with the environment variables of
+        its ``Unit``, apart from those describing links.
+        """
+        fake_docker = FakeDockerClient()
+        application = Application(
+            name=u'site-example.com',
+            image=DockerImage.from_string(u'clusterhq/wordpress:latest'),
+            links=frozenset([
+                Link(local_port=80, remote_port=8080, alias='APACHE')
+            ]),
+            environment=frozenset({(u'WORDPRESS_DB', u'wordpress')}),
+        )
+        api = Deployer(
+            self.volume_service,
+            docker_client=fake_docker,
+            network=self.network
+        )
+        StartApplication(
+            hostname='node1.example.com', application=application
+        ).run(api)
+        d = api.discover_node_configuration()
+
+        self.assertEqual([application], self.successResultOf(d).running)
+
     def test_discover_application_with_ports(self):
         """
         An ``Application`` with ``Port`` objects is discovered from a ``Unit``
@@ -797,6 +1264,41 @@ class DeployerDiscoverNodeConfigurationTests(SynchronousTestCase):
         self.assertEqual(sorted(applications),
                          sorted(self.successResultOf(d).running))
 
+    def test_discover_volume_among_image_volumes(self):
+        """
+        If a ``Unit`` has other volumes besides the locally owned volume of
+        the same name, such as those declared by its image, the discovered
+        ``AttachedVolume`` is the one backed by the locally owned volume.
+        """
+        volume = self.successResultOf(self.volume_service.create(
+            _to_volume_name(u"site-example.com")))
+        unit = Unit(name=u'site-example.com',
+                    container_name=u'site-example.com',
+                    container_image=u"clusterhq/wordpress:latest",
+                    volumes=frozenset([
+                        DockerVolume(
+                            node_path=FilePath(b'/var/lib/docker/vfs/1'),
+                            container_path=FilePath(b'/var/log')),
+                        DockerVolume(
+                            node_path=volume.get_filesystem().get_path(),
+                            container_path=FilePath(b'/var/lib/data')),
+                        DockerVolume(
+                            node_path=FilePath(b'/var/lib/docker/vfs/2'),
+                            container_path=FilePath(b'/tmp')),
+                    ]),
+                    activation_state=u'active')
+        api = Deployer(
+            self.volume_service,
+            docker_client=FakeDockerClient(units={unit.name: unit}),
+            network=self.network
+        )
+        d = api.discover_node_configuration()
+
+        self.assertEqual(
+            AttachedVolume(name=unit.name,
+                           mountpoint=FilePath(b'/var/lib/data')),
+            self.successResultOf(d).running[0].volume)
+
     def test_discover_remotely_owned_volumes_ignored(self):
         """
         Remotely owned volumes are not added to the discovered ``Application``
@@ -905,9 +1407,65 @@ class DeployerCalculateNecessaryStateChangesTests(SynchronousTestCase):
         d = api.calculate_necessary_state_changes(desired_state=desired,
                                                   current_cluster_state=EMPTY,
                                                   hostname=u'node.example.com')
-        expected = Sequentially(changes=[])
+        expected = InDependencyOrder(dependencies={})
         self.assertEqual(expected, self.successResultOf(d))
 
+    def test_unchanged_application_not_restarted(self):
+        """
+        ``Deployer.calculate_necessary_state_changes`` doesn't restart a
+        running application whose configuration is unchanged, including its
+        environment variables, links and volume.
+        """
+        volume_service = create_volume_service(self)
+        api = Deployer(volume_service, docker_client=FakeDockerClient(),
+                       network=make_memory_network())
+        application = Application(
+            name=u'wordpress-example',
+            image=DockerImage.from_string(u'clusterhq/wordpress:latest'),
+            ports=frozenset([Port(internal_port=80, external_port=8080)]),
+            volume=AttachedVolume(name=u'wordpress-example',
+                                  mountpoint=FilePath(b'/var/www')),
+            links=frozenset([
+                Link(local_port=5432, remote_port=5432, alias=u'pg-db')]),
+            environment=frozenset({(u'WORDPRESS_DB', u'wordpress'),
+                                   (u'DEBUG', u'')}),
+        )
+        self.successResultOf(volume_service.create(
+            _to_volume_name(application.name)))
+        StartApplication(hostname=u'node1.example.com',
+                         application=application).run(api)
+        desired = Deployment(nodes=frozenset({
+            Node(hostname=u'node1.example.com',
+                 applications=frozenset({application})),
+        }))
+        d = api.calculate_necessary_state_changes(
+            desired_state=desired, current_cluster_state=desired,
+            hostname=u'node1.example.com')
+        self.assertEqual(InDependencyOrder(dependencies={}),
+                         self.successResultOf(d))
+
+    def test_proxies_enumerated_once(self):
+        """
+        ``Deployer.calculate_necessary_state_changes`` only enumerates the
+        existing proxies once, and doesn't look for used ports.
+        """
+        network = make_memory_network()
+        calls = []
+        enumerate_proxies = network.enumerate_proxies
+
+        def record_enumerate():
+            calls.append(u"enumerate_proxies")
+            return enumerate_proxies()
+        network.enumerate_proxies = record_enumerate
+        network.enumerate_used_ports = lambda: calls.append(
+            u"enumerate_used_ports")
+        api = Deployer(create_volume_service(self),
+                       docker_client=FakeDockerClient(), network=network)
+        self.successResultOf(api.calculate_necessary_state_changes(
+            desired_state=EMPTY, current_cluster_state=EMPTY,
+            hostname=u'node.example.com'))
+        self.assertEqual([u"enumerate_proxies"], calls)
+
     def test_proxy_needs_creating(self):
         """
         ``Deployer.calculate_necessary_state_changes`` returns a
@@ -942,7 +1500,8 @@ class DeployerCalculateNecessaryStateChangesTests(SynchronousTestCase):
             hostname=u'node2.example.com')
         proxy = Proxy(ip=expected_destination_host,
                       port=expected_destination_port)
-        expected = Sequentially(changes=[SetProxies(ports=frozenset([proxy]))])
+        expected = InDependencyOrder(dependencies={
+            SetProxies(ports=frozenset([proxy])): frozenset()})
         self.assertEqual(expected, self.successResultOf(d))
 
     def test_proxy_empty(self):
@@ -961,7 +1520,8 @@ class DeployerCalculateNecessaryStateChangesTests(SynchronousTestCase):
         d = api.calculate_necessary_state_changes(
             desired_state=desired, current_cluster_state=EMPTY,
             hostname=u'node2.example.com')
-        expected = Sequentially(changes=[SetProxies(ports=frozenset())])
+        expected = InDependencyOrder(dependencies={
+            SetProxies(ports=frozenset()): frozenset()})
         self.assertEqual(expected, self.successResultOf(d))
 
     def test_application_needs_stopping(self):
@@ -984,7 +1544,60 @@ class DeployerCalculateNecessaryStateChangesTests(SynchronousTestCase):
         to_stop = StopApplication(application=Application(
             name=unit.name, image=DockerImage.from_string(
                 unit.container_image)))
-        expected = Sequentially(changes=[InParallel(changes=[to_stop])])
+        expected = InDependencyOrder(dependencies={to_stop: frozenset()})
+        self.assertEqual(expected, self.successResultOf(d))
+
+    def test_only_given_applications(self):
+        """
+        Given the names of the applications to plan for,
+        ``Deployer.calculate_necessary_state_changes`` leaves the others
+        alone, and doesn't enumerate volumes if there are none.
+        """
+        unit = Unit(name=u'site-example.com',
+                    container_name=u'site-example.com',
+                    container_image=u'flocker/wordpress:v1.0.0',
+                    activation_state=u'active')
+
+        fake_docker = FakeDockerClient(units={unit.name: unit})
+        volume_service = create_volume_service(self)
+        self.patch(volume_service, "enumerate", lambda: 1 / 0)
+        api = Deployer(volume_service, docker_client=fake_docker,
+                       network=make_memory_network())
+        desired = Deployment(nodes=frozenset())
+        d = api.calculate_necessary_state_changes(desired_state=desired,
+                                                  current_cluster_state=EMPTY,
+                                                  hostname=u'node.example.com',
+                                                  applications=frozenset())
+        self.assertEqual(InDependencyOrder(dependencies={}),
+                         self.successResultOf(d))
+
+    def test_application_stop_timeout(self):
+        """
+        ``Deployer.calculate_necessary_state_changes`` stops an application
+        with the ``stop_timeout`` it has in the current cluster state.
+        """
+        unit = Unit(name=u'site-example.com',
+                    container_name=u'site-example.com',
+                    container_image=u'flocker/wordpress:v1.0.0',
+                    activation_state=u'active')
+
+        fake_docker = FakeDockerClient(units={unit.name: unit})
+        api = Deployer(create_volume_service(self), docker_client=fake_docker,
+                       network=make_memory_network())
+        application = Application(
+            name=unit.name, image=DockerImage.from_string(
+                unit.container_image))
+        current = Deployment(nodes=frozenset([
+            Node(hostname=u'node.example.com',
+                 applications=frozenset([Application(
+                     name=application.name, image=application.image,
+                     stop_timeout=30)]))]))
+        desired = Deployment(nodes=frozenset())
+        d = api.calculate_necessary_state_changes(
+            desired_state=desired, current_cluster_state=current,
+            hostname=u'node.example.com')
+        to_stop = StopApplication(application=application, stop_timeout=30)
+        expected = InDependencyOrder(dependencies={to_stop: frozenset()})
         self.assertEqual(expected, self.successResultOf(d))
 
     def test_application_needs_starting(self):
@@ -1013,9 +1626,11 @@ class DeployerCalculateNecessaryStateChangesTests(SynchronousTestCase):
         d = api.calculate_necessary_state_changes(desired_state=desired,
                                                   current_cluster_state=EMPTY,
                                                   hostname=u'node.example.com')
-        expected = Sequentially(changes=[InParallel(
-            changes=[StartApplication(application=application,
-                                      hostname="node.example.com")])])
+        pull = PullImage(image=application.image)
+        expected = InDependencyOrder(dependencies={
+            pull: frozenset(),
+            StartApplication(application=application,
+                             hostname="node.example.com"): frozenset({pull})})
         self.assertEqual(expected, self.successResultOf(d))
 
     def test_only_this_node(self):
@@ -1044,7 +1659,7 @@ class DeployerCalculateNecessaryStateChangesTests(SynchronousTestCase):
         d = api.calculate_necessary_state_changes(desired_state=desired,
                                                   current_cluster_state=EMPTY,
                                                   hostname=u'node.example.com')
-        expected = Sequentially(changes=[])
+        expected = InDependencyOrder(dependencies={})
         self.assertEqual(expected, self.successResultOf(d))
 
     def test_no_change_needed(self):
@@ -1080,7 +1695,7 @@ class DeployerCalculateNecessaryStateChangesTests(SynchronousTestCase):
         d = api.calculate_necessary_state_changes(desired_state=desired,
                                                   current_cluster_state=EMPTY,
                                                   hostname=u'node.example.com')
-        expected = Sequentially(changes=[])
+        expected = InDependencyOrder(dependencies={})
         self.assertEqual(expected, self.successResultOf(d))
 
     def test_node_not_described(self):
@@ -1107,7 +1722,7 @@ class DeployerCalculateNecessaryStateChangesTests(SynchronousTestCase):
                 image=DockerImage.from_string(unit.container_image)
             )
         )
-        expected = Sequentially(changes=[InParallel(changes=[to_stop])])
+        expected = InDependencyOrder(dependencies={to_stop: frozenset()})
         self.assertEqual(expected, self.successResultOf(d))
 
     def test_volume_created(self):
@@ -1156,11 +1771,14 @@ class DeployerCalculateNecessaryStateChangesTests(SynchronousTestCase):
             name=APPLICATION_WITH_VOLUME_NAME,
             mountpoint=APPLICATION_WITH_VOLUME_MOUNTPOINT
         )
-        expected = Sequentially(changes=[
-            InParallel(changes=[CreateVolume(volume=volume)]),
-            InParallel(changes=[StartApplication(
+        ready = CreateVolume(volume=volume)
+        pull = PullImage(image=APPLICATION_WITH_VOLUME.image)
+        expected = InDependencyOrder(dependencies={
+            ready: frozenset(),
+            pull: frozenset(),
+            StartApplication(
                 application=APPLICATION_WITH_VOLUME,
-                hostname="node1.example.com")])])
+                hostname="node1.example.com"): frozenset({ready, pull})})
         self.assertEqual(expected, changes)
 
     def test_volume_wait(self):
@@ -1209,11 +1827,14 @@ class DeployerCalculateNecessaryStateChangesTests(SynchronousTestCase):
             name=APPLICATION_WITH_VOLUME_NAME,
             mountpoint=APPLICATION_WITH_VOLUME_MOUNTPOINT,
         )
-        expected = Sequentially(changes=[
-            InParallel(changes=[WaitForVolume(volume=volume)]),
-            InParallel(changes=[StartApplication(
+        ready = WaitForVolume(volume=volume)
+        pull = PullImage(image=APPLICATION_WITH_VOLUME.image)
+        expected = InDependencyOrder(dependencies={
+            ready: frozenset(),
+            pull: frozenset(),
+            StartApplication(
                 application=APPLICATION_WITH_VOLUME,
-                hostname="node1.example.com")])])
+                hostname="node1.example.com"): frozenset({ready, pull})})
         self.assertEqual(expected, changes)
 
     def test_volume_handoff(self):
@@ -1269,17 +1890,17 @@ class DeployerCalculateNecessaryStateChangesTests(SynchronousTestCase):
             mountpoint=APPLICATION_WITH_VOLUME_MOUNTPOINT,
         )
 
-        expected = Sequentially(changes=[
-            InParallel(changes=[PushVolume(
-                volume=volume, hostname=another_node.hostname)]),
-            InParallel(changes=[StopApplication(
-                application=Application(name=APPLICATION_WITH_VOLUME_NAME,
-                                        image=DockerImage.from_string(
-                                            unit.container_image
-                                        )),)]),
-            InParallel(changes=[HandoffVolume(
-                volume=volume, hostname=another_node.hostname)]),
-        ])
+        push = PushVolume(volume=volume, hostname=another_node.hostname)
+        stop = StopApplication(
+            application=Application(name=APPLICATION_WITH_VOLUME_NAME,
+                                    image=DockerImage.from_string(
+                                        unit.container_image)))
+        handoff = HandoffVolume(volume=volume, hostname=another_node.hostname)
+        expected = InDependencyOrder(dependencies={
+            push: frozenset(),
+            stop: frozenset(),
+            handoff: frozenset({push, stop}),
+        })
         self.assertEqual(expected, changes)
 
     def test_no_volume_changes(self):
@@ -1336,7 +1957,7 @@ class DeployerCalculateNecessaryStateChangesTests(SynchronousTestCase):
 
         changes = self.successResultOf(calculating)
 
-        expected = Sequentially(changes=[])
+        expected = InDependencyOrder(dependencies={})
         self.assertEqual(expected, changes)
 
     def test_local_not_running_applications_restarted(self):
@@ -1368,11 +1989,15 @@ class DeployerCalculateNecessaryStateChangesTests(SynchronousTestCase):
                                                   current_cluster_state=EMPTY,
                                                   hostname=u'n.example.com')
 
-        expected = Sequentially(changes=[InParallel(changes=[
-            Sequentially(changes=[StopApplication(application=application),
-                                  StartApplication(application=application,
-                                                   hostname="n.example.com")]),
-        ])])
+        pull = PullImage(image=application.image)
+        stop = StopApplication(application=application)
+        expected = InDependencyOrder(dependencies={
+            pull: frozenset(),
+            stop: frozenset({pull}),
+            StartApplication(application=application,
+                             hostname="n.example.com"): frozenset(
+                                 {pull, stop}),
+        })
         self.assertEqual(expected, self.successResultOf(d))
 
     def test_not_local_not_running_applications_stopped(self):
@@ -1397,13 +2022,13 @@ class DeployerCalculateNecessaryStateChangesTests(SynchronousTestCase):
             name=unit.name,
             image=DockerImage.from_string(unit.container_image)
         )
-        expected = Sequentially(changes=[InParallel(changes=[
-            StopApplication(application=to_stop)])])
+        expected = InDependencyOrder(dependencies={
+            StopApplication(application=to_stop): frozenset()})
         self.assertEqual(expected, self.successResultOf(d))
 
-    def test_handoff_precedes_wait(self):
+    def test_handoff_independent_of_wait(self):
         """
-        Volume handoffs happen before volume waits, to prevent deadlocks
+        Volume handoffs don't depend on volume waits, to prevent deadlocks
         between two nodes that are swapping volumes.
         """
         # The application is running here.
@@ -1481,20 +2106,24 @@ class DeployerCalculateNecessaryStateChangesTests(SynchronousTestCase):
             name=u"another",
             mountpoint=FilePath(b"/blah"),
         )
-        expected = Sequentially(changes=[
-            InParallel(changes=[PushVolume(
-                volume=volume, hostname=another_node.hostname)]),
-            InParallel(changes=[StopApplication(
-                application=Application(name=APPLICATION_WITH_VOLUME_NAME,
-                                        image=DockerImage.from_string(
-                                            u'clusterhq/postgresql:9.1'),),)]),
-            InParallel(changes=[HandoffVolume(
-                volume=volume, hostname=another_node.hostname)]),
-            InParallel(changes=[WaitForVolume(volume=volume2)]),
-            InParallel(changes=[
-                StartApplication(application=another_application,
-                                 hostname="node1.example.com")]),
-        ])
+        push = PushVolume(volume=volume, hostname=another_node.hostname)
+        stop = StopApplication(
+            application=Application(name=APPLICATION_WITH_VOLUME_NAME,
+                                    image=DockerImage.from_string(
+                                        u'clusterhq/postgresql:9.1')))
+        wait = WaitForVolume(volume=volume2)
+        pull = PullImage(image=another_application.image)
+        handoff = HandoffVolume(volume=volume, hostname=another_node.hostname)
+        expected = InDependencyOrder(dependencies={
+            push: frozenset(),
+            stop: frozenset(),
+            handoff: frozenset({push, stop}),
+            wait: frozenset(),
+            pull: frozenset(),
+            StartApplication(application=another_application,
+                             hostname="node1.example.com"): frozenset(
+                                 {wait, pull}),
+        })
         self.assertEqual(expected, changes)
 
     def test_restart_application_once_only(self):
@@ -1544,20 +2173,18 @@ class DeployerCalculateNecessaryStateChangesTests(SynchronousTestCase):
             hostname=u'node1.example.com'
         )
 
-        expected = Sequentially(changes=[
-            InParallel(changes=[
-                CreateVolume(volume=AttachedVolume(
-                    name='postgres-example', mountpoint='/var/lib/data')
-                )]
-            ),
-            InParallel(changes=[
-                Sequentially(changes=[
-                    StopApplication(application=new_postgres_app),
-                    StartApplication(application=new_postgres_app,
-                                     hostname=u'node1.example.com')
-                ])
-            ])
-        ])
+        create = CreateVolume(volume=AttachedVolume(
+            name='postgres-example', mountpoint='/var/lib/data'))
+        pull = PullImage(image=new_postgres_app.image)
+        stop = StopApplication(application=new_postgres_app)
+        start = StartApplication(application=new_postgres_app,
+                                 hostname=u'node1.example.com')
+        expected = InDependencyOrder(dependencies={
+            create: frozenset(),
+            pull: frozenset(),
+            stop: frozenset({pull}),
+            start: frozenset({create, pull, stop}),
+        })
         self.assertEqual(expected, self.successResultOf(d))
 
     def test_app_with_changed_image_restarted(self):
@@ -1606,13 +2233,15 @@ class DeployerCalculateNecessaryStateChangesTests(SynchronousTestCase):
             hostname=u'node1.example.com'
         )
 
-        expected = Sequentially(changes=[InParallel(changes=[
-            Sequentially(changes=[
-                StopApplication(application=old_postgres_app),
-                StartApplication(application=new_postgres_app,
-                                 hostname="node1.example.com")
-                ]),
-        ])])
+        pull = PullImage(image=new_postgres_app.image)
+        stop = StopApplication(application=old_postgres_app)
+        expected = InDependencyOrder(dependencies={
+            pull: frozenset(),
+            stop: frozenset({pull}),
+            StartApplication(application=new_postgres_app,
+                             hostname="node1.example.com"): frozenset(
+                                 {pull, stop}),
+        })
 
         self.assertEqual(expected, self.successResultOf(d))
 
@@ -1675,13 +2304,15 @@ class DeployerCalculateNecessaryStateChangesTests(SynchronousTestCase):
             hostname=u'node1.example.com'
         )
 
-        expected = Sequentially(changes=[InParallel(changes=[
-            Sequentially(changes=[
-                StopApplication(application=old_postgres_app),
-                StartApplication(application=new_postgres_app,
-                                 hostname="node1.example.com")
-                ]),
-        ])])
+        pull = PullImage(image=new_postgres_app.image)
+        stop = StopApplication(application=old_postgres_app)
+        expected = InDependencyOrder(dependencies={
+            pull: frozenset(),
+            stop: frozenset({pull}),
+            StartApplication(application=new_postgres_app,
+                             hostname="node1.example.com"): frozenset(
+                                 {pull, stop}),
+        })
 
         self.assertEqual(expected, self.successResultOf(d))
 
@@ -1742,21 +2373,272 @@ class DeployerCalculateNecessaryStateChangesTests(SynchronousTestCase):
             hostname=u'node1.example.com'
         )
 
-        expected = Sequentially(changes=[InParallel(changes=[
-            Sequentially(changes=[
-                StopApplication(application=old_wordpress_app),
-                StartApplication(application=new_wordpress_app,
-                                 hostname="node1.example.com")
-                ]),
-        ])])
+        pull = PullImage(image=new_wordpress_app.image)
+        stop = StopApplication(application=old_wordpress_app)
+        expected = InDependencyOrder(dependencies={
+            pull: frozenset(),
+            stop: frozenset({pull}),
+            StartApplication(application=new_wordpress_app,
+                             hostname="node1.example.com"): frozenset(
+                                 {pull, stop}),
+        })
 
         self.assertEqual(expected, self.successResultOf(d))
 
+    def test_linked_application_waits_for_proxies(self):
+        """
+        An ``Application`` with links is only started once the proxies have
+        been changed, while one without links doesn't wait for them.
+        """
+        api = Deployer(create_volume_service(self),
+                       docker_client=FakeDockerClient(),
+                       network=make_memory_network())
+        linked = Application(
+            name=u'wordpress-example',
+            image=DockerImage.from_string(u'clusterhq/wordpress:latest'),
+            links=frozenset([
+                Link(local_port=5432, remote_port=5432, alias='POSTGRES')]))
+        unlinked = Application(
+            name=u'memcached-example',
+            image=DockerImage.from_string(u'clusterhq/memcached:latest'))
+        remote = Application(
+            name=u'postgres-example',
+            image=DockerImage.from_string(u'clusterhq/postgres:latest'),
+            ports=frozenset([Port(internal_port=5432, external_port=5432)]))
+        desired = Deployment(nodes=frozenset({
+            Node(hostname=u'node1.example.com',
+                 applications=frozenset({linked, unlinked})),
+            Node(hostname=u'node2.example.com',
+                 applications=frozenset({remote})),
+        }))
+        d = api.calculate_necessary_state_changes(
+            desired_state=desired,
+            current_cluster_state=EMPTY,
+            hostname=u'node1.example.com'
+        )
+
+        proxies = SetProxies(ports=frozenset(
+            [Proxy(ip=u'node2.example.com', port=5432)]))
+        pull_linked = PullImage(image=linked.image)
+        pull_unlinked = PullImage(image=unlinked.image)
+        start_linked = StartApplication(application=linked,
+                                        hostname="node1.example.com")
+        expected = InDependencyOrder(dependencies={
+            proxies: frozenset(),
+            pull_linked: frozenset(),
+            pull_unlinked: frozenset(),
+            start_linked: frozenset({proxies, pull_linked}),
+            StartApplication(application=unlinked,
+                             hostname="node1.example.com"): frozenset(
+                                 {pull_unlinked}),
+        })
+        self.assertEqual(expected, self.successResultOf(d))
+
+    def test_stateless_move_away(self):
+        """
+        An ``Application`` without a volume which is moving to another node
+        is only stopped once it is running on that node and proxies have
+        been pointed at it there.
+        """
+        unit = Unit(name=u'site-example.com',
+                    container_name=u'site-example.com',
+                    container_image=u'clusterhq/nginx:latest',
+                    ports=frozenset([PortMap(internal_port=80,
+                                             external_port=8080)]),
+                    activation_state=u'active')
+        api = Deployer(create_volume_service(self),
+                       docker_client=FakeDockerClient(units={unit.name: unit}),
+                       network=make_memory_network())
+        application = Application(
+            name=u'site-example.com',
+            image=DockerImage.from_string(u'clusterhq/nginx:latest'),
+            ports=frozenset([Port(internal_port=80, external_port=8080)]))
+        desired = Deployment(nodes=frozenset({
+            Node(hostname=u'node1.example.com', applications=frozenset()),
+            Node(hostname=u'node2.example.com',
+                 applications=frozenset({application})),
+        }))
+        d = api.calculate_necessary_state_changes(
+            desired_state=desired,
+            current_cluster_state=EMPTY,
+            hostname=u'node1.example.com'
+        )
+
+        wait = WaitForApplication(application=application,
+                                  hostname=u'node2.example.com')
+        switch = SetProxies(ports=frozenset(
+            [Proxy(ip=u'node2.example.com', port=8080)]))
+        expected = InDependencyOrder(dependencies={
+            wait: frozenset(),
+            switch: frozenset({wait}),
+            StopApplication(application=application): frozenset({switch}),
+        })
+        self.assertEqual(expected, self.successResultOf(d))
+
+    def test_stateless_move_other_proxies(self):
+        """
+        While an ``Application`` without a volume is moving away, proxies to
+        other nodes are changed immediately, and all the proxies are changed
+        again once it is running on its new node.
+        """
+        unit = Unit(name=u'site-example.com',
+                    container_name=u'site-example.com',
+                    container_image=u'clusterhq/nginx:latest',
+                    activation_state=u'active')
+        api = Deployer(create_volume_service(self),
+                       docker_client=FakeDockerClient(units={unit.name: unit}),
+                       network=make_memory_network())
+        application = Application(
+            name=u'site-example.com',
+            image=DockerImage.from_string(u'clusterhq/nginx:latest'),
+            ports=frozenset([Port(internal_port=80, external_port=8080)]))
+        other = Application(
+            name=u'mysql-example',
+            image=DockerImage.from_string(u'clusterhq/mysql:latest'),
+            ports=frozenset([Port(internal_port=3306, external_port=3306)]))
+        desired = Deployment(nodes=frozenset({
+            Node(hostname=u'node1.example.com', applications=frozenset()),
+            Node(hostname=u'node2.example.com',
+                 applications=frozenset({application, other})),
+        }))
+        d = api.calculate_necessary_state_changes(
+            desired_state=desired,
+            current_cluster_state=EMPTY,
+            hostname=u'node1.example.com'
+        )
+
+        wait = WaitForApplication(application=application,
+                                  hostname=u'node2.example.com')
+        initial = SetProxies(ports=frozenset(
+            [Proxy(ip=u'node2.example.com', port=3306)]))
+        switch = SetProxies(ports=frozenset(
+            [Proxy(ip=u'node2.example.com', port=3306),
+             Proxy(ip=u'node2.example.com', port=8080)]))
+        stop = StopApplication(application=Application(
+            name=unit.name,
+            image=DockerImage.from_string(unit.container_image)))
+        expected = InDependencyOrder(dependencies={
+            wait: frozenset(),
+            initial: frozenset(),
+            switch: frozenset({wait, initial}),
+            stop: frozenset({switch}),
+        })
+        self.assertEqual(expected, self.successResultOf(d))
+
+    def test_start_waits_for_proxy_removal(self):
+        """
+        An ``Application`` is only started once any proxy using one of its
+        external ports has been removed.
+        """
+        network = make_memory_network()
+        network.create_proxy_to(ip=u'node2.example.com', port=8080)
+        api = Deployer(create_volume_service(self),
+                       docker_client=FakeDockerClient(),
+                       network=network)
+        application = Application(
+            name=u'site-example.com',
+            image=DockerImage.from_string(u'clusterhq/nginx:latest'),
+            ports=frozenset([Port(internal_port=80, external_port=8080)]))
+        desired = Deployment(nodes=frozenset({
+            Node(hostname=u'node1.example.com',
+                 applications=frozenset({application})),
+        }))
+        d = api.calculate_necessary_state_changes(
+            desired_state=desired,
+            current_cluster_state=EMPTY,
+            hostname=u'node1.example.com'
+        )
+
+        proxies = SetProxies(ports=frozenset())
+        pull = PullImage(image=application.image)
+        expected = InDependencyOrder(dependencies={
+            proxies: frozenset(),
+            pull: frozenset(),
+            StartApplication(application=application,
+                             hostname="node1.example.com"): frozenset(
+                                 {proxies, pull}),
+        })
+        self.assertEqual(expected, self.successResultOf(d))
+
+    def test_start_waits_for_stop_freeing_port(self):
+        """
+        An ``Application`` is only started once any application being stopped
+        which uses one of the same external ports has stopped.
+        """
+        api = Deployer(create_volume_service(self),
+                       docker_client=FakeDockerClient(),
+                       network=make_memory_network())
+        old_app = Application(
+            name=u'old-site',
+            image=DockerImage.from_string(u'clusterhq/nginx:latest'),
+            ports=frozenset([Port(internal_port=80, external_port=8080)]))
+        StartApplication(hostname=u'node1.example.com',
+                         application=old_app).run(api)
+        new_app = Application(
+            name=u'new-site',
+            image=DockerImage.from_string(u'clusterhq/nginx:latest'),
+            ports=frozenset([Port(internal_port=80, external_port=8080)]))
+        desired = Deployment(nodes=frozenset({
+            Node(hostname=u'node1.example.com',
+                 applications=frozenset({new_app})),
+        }))
+        d = api.calculate_necessary_state_changes(
+            desired_state=desired,
+            current_cluster_state=EMPTY,
+            hostname=u'node1.example.com'
+        )
+
+        pull = PullImage(image=new_app.image)
+        stop = StopApplication(application=old_app)
+        expected = InDependencyOrder(dependencies={
+            pull: frozenset(),
+            stop: frozenset({pull}),
+            StartApplication(application=new_app,
+                             hostname="node1.example.com"): frozenset(
+                                 {pull, stop}),
+        })
+        self.assertEqual(expected, self.successResultOf(d))
+
+
+@implementer(ITransactionalNetwork)
+class TransactionalNetwork(MemoryNetwork):
+    """
+    A ``MemoryNetwork`` which changes its proxies in one transaction.
+
+    :ivar list transactions: The proxies passed to each call of
+        ``set_proxies``.
+    """
+    def __init__(self):
+        MemoryNetwork.__init__(self, used_ports=frozenset())
+        self.transactions = []
+
+    def set_proxies(self, proxies):
+        self.transactions.append(frozenset(proxies))
+        self._proxies = set(proxies)
+        return succeed(None)
+
 
 class SetProxiesTests(SynchronousTestCase):
     """
     Tests for ``SetProxies``.
     """
+    def test_transactional(self):
+        """
+        An ``ITransactionalNetwork`` is asked to change all of its proxies
+        at once, rather than one at a time.
+        """
+        network = TransactionalNetwork()
+        network.create_proxy_to(ip=u'192.0.2.100', port=3306)
+        network.delete_proxy = network.create_proxy_to = None
+        api = Deployer(
+            create_volume_service(self), docker_client=FakeDockerClient(),
+            network=network)
+        proxy = Proxy(ip=u'192.0.2.101', port=8080)
+        self.successResultOf(SetProxies(ports=[proxy]).run(api))
+        self.assertEqual(
+            ([frozenset([proxy])], [proxy]),
+            (network.transactions, network.enumerate_proxies()))
+
     def test_proxies_added(self):
         """
         Proxies which are required are added.
@@ -1818,6 +2700,40 @@ class SetProxiesTests(SynchronousTestCase):
             set(fake_network.enumerate_proxies())
         )
 
+    def test_unchanged_proxies_untouched(self):
+        """
+        Proxies which exist on the node and which are still required are
+        neither deleted nor recreated; only those which differ are.
+        """
+        fake_network = make_memory_network()
+        unchanged = fake_network.create_proxy_to(ip=u'192.0.2.100',
+                                                 port=3306)
+        moved = fake_network.create_proxy_to(ip=u'192.0.2.100', port=8080)
+        changes = []
+        delete_proxy = fake_network.delete_proxy
+        create_proxy_to = fake_network.create_proxy_to
+
+        def record_delete(proxy):
+            changes.append((u"delete", proxy))
+            return delete_proxy(proxy)
+
+        def record_create(ip, port):
+            changes.append((u"create", Proxy(ip=ip, port=port)))
+            return create_proxy_to(ip, port)
+        fake_network.delete_proxy = record_delete
+        fake_network.create_proxy_to = record_create
+
+        api = Deployer(
+            create_volume_service(self), docker_client=FakeDockerClient(),
+            network=fake_network)
+        replacement = Proxy(ip=u'192.0.2.101', port=8080)
+        self.successResultOf(
+            SetProxies(ports=[unchanged, replacement]).run(api))
+        self.assertEqual(
+            ([(u"delete", moved), (u"create", replacement)],
+             {unchanged, replacement}),
+            (changes, set(fake_network.enumerate_proxies())))
+
     def test_delete_proxy_errors_as_errbacks(self):
         """
         Exceptions raised in `delete_proxy` operations are reported as
@@ -1985,7 +2901,8 @@ class DeployerChangeNodeStateTests(SynchronousTestCase):
     def test_arguments(self):
         """
         The passed in arguments are passed on in turn to
-        ``calculate_necessary_state_changes``.
+        ``calculate_necessary_state_changes``, planning for every
+        application.
         """
         desired = object()
         state = object()
@@ -1995,12 +2912,263 @@ class DeployerChangeNodeStateTests(SynchronousTestCase):
                        network=make_memory_network())
         arguments = []
 
-        def calculate(desired_state, current_cluster_state, hostname):
-            arguments.extend([desired_state, current_cluster_state, hostname])
+        def calculate(desired_state, current_cluster_state, hostname,
+                      applications):
+            arguments.extend([desired_state, current_cluster_state, hostname,
+                              applications])
             return succeed(FakeChange(succeed(None)))
         api.calculate_necessary_state_changes = calculate
         api.change_node_state(desired, state, host)
-        self.assertEqual(arguments, [desired, state, host])
+        self.assertEqual(arguments, [desired, state, host, None])
+
+
+APPLIED_APPLICATION = Application(
+    name=u"mysql-hybridcluster",
+    image=DockerImage.from_string(u"clusterhq/mysql:5.6.17"),
+)
+
+REMOTE_APPLICATION = Application(
+    name=u"site-example.com",
+    image=DockerImage.from_string(u"clusterhq/wordpress:latest"),
+    ports=frozenset([Port(internal_port=80, external_port=8080)]),
+)
+
+APPLIED_DEPLOYMENT = Deployment(nodes=frozenset([
+    Node(hostname=u"node1.example.com",
+         applications=frozenset([APPLIED_APPLICATION])),
+    Node(hostname=u"node2.example.com",
+         applications=frozenset([REMOTE_APPLICATION])),
+]))
+
+
+class DeployerAppliedStateTests(SynchronousTestCase):
+    """
+    Tests for ``Deployer.change_node_state`` with an ``AppliedStateStore``.
+    """
+    def setUp(self):
+        self.docker = FakeDockerClient(units={})
+        self.network = make_memory_network()
+        self.store = AppliedStateStore(FilePath(self.mktemp()))
+        self.deployer = Deployer(
+            create_volume_service(self), docker_client=self.docker,
+            network=self.network, applied_state=self.store)
+
+    def change(self, desired=APPLIED_DEPLOYMENT):
+        """
+        Change the node's state.
+
+        :param Deployment desired: The desired configuration.
+
+        :return: The result of ``Deployer.change_node_state``.
+        """
+        return self.deployer.change_node_state(
+            desired_state=desired, current_cluster_state=EMPTY,
+            hostname=u"node1.example.com")
+
+    def planned(self, desired=APPLIED_DEPLOYMENT):
+        """
+        :param Deployment desired: The desired configuration.
+
+        :return: A ``list`` of the ``applications`` argument of each call to
+            ``calculate_necessary_state_changes`` made while changing the
+            node's state.
+        """
+        planned = []
+        original = self.deployer.calculate_necessary_state_changes
+
+        def calculate(**kwargs):
+            planned.append(kwargs[u"applications"])
+            return original(**kwargs)
+        self.patch(self.deployer, "calculate_necessary_state_changes",
+                   calculate)
+        self.successResultOf(self.change(desired))
+        return planned
+
+    def plans(self, desired=APPLIED_DEPLOYMENT):
+        """
+        :param Deployment desired: The desired configuration.
+
+        :return: Whether changing the node's state plans the changes.
+        """
+        return bool(self.planned(desired))
+
+    def test_records_applied(self):
+        """
+        Once the node has been changed, the applications left running and
+        the proxies left configured are recorded.
+        """
+        self.successResultOf(self.change())
+        applied = self.store.load()
+        self.assertEqual(
+            (frozenset([APPLIED_APPLICATION.name]),
+             frozenset([Proxy(ip=u"node2.example.com", port=8080)])),
+            (frozenset(applied.applications), applied.proxies))
+
+    def test_first_plans_all(self):
+        """
+        With nothing recorded, changes are planned for every application.
+        """
+        self.assertEqual([None], self.planned())
+
+    def test_unchanged_not_planned(self):
+        """
+        Changes aren't planned when the desired configuration is the one the
+        node was last changed to match and nothing has changed since.
+        """
+        self.successResultOf(self.change())
+        self.assertFalse(self.plans())
+
+    def test_other_node_changes_not_planned(self):
+        """
+        Changes to other nodes which don't affect this one's applications or
+        proxies don't cause changes to be planned.
+        """
+        self.successResultOf(self.change())
+        desired = Deployment(nodes=APPLIED_DEPLOYMENT.nodes | frozenset([
+            Node(hostname=u"node3.example.com",
+                 applications=frozenset([Application(
+                     name=u"cache",
+                     image=DockerImage.from_string(u"memcached"))]))]))
+        self.assertFalse(self.plans(desired))
+
+    def test_changed_planned(self):
+        """
+        Changes are planned when this node's part of the desired
+        configuration differs from the one it was last changed to match.
+        """
+        self.successResultOf(self.change())
+        desired = Deployment(nodes=frozenset([
+            Node(hostname=u"node1.example.com", applications=frozenset()),
+            Node(hostname=u"node2.example.com",
+                 applications=frozenset([REMOTE_APPLICATION])),
+        ]))
+        self.assertEqual(
+            ([frozenset([APPLIED_APPLICATION.name])], {}),
+            (self.planned(desired), self.store.load().applications))
+
+    def test_only_changed_planned(self):
+        """
+        Only the applications whose configuration differs from the one the
+        node was last changed to match are planned for, and the rest are
+        left running.
+        """
+        self.successResultOf(self.change())
+        new = Application(name=u"cache",
+                          image=DockerImage.from_string(u"memcached"))
+        desired = Deployment(nodes=frozenset([
+            Node(hostname=u"node1.example.com",
+                 applications=frozenset([APPLIED_APPLICATION, new])),
+            Node(hostname=u"node2.example.com",
+                 applications=frozenset([REMOTE_APPLICATION])),
+        ]))
+        self.assertEqual(
+            ([frozenset([new.name])],
+             {(APPLIED_APPLICATION.name, u"active"),
+              (new.name, u"active")}),
+            (self.planned(desired),
+             {(unit.name, unit.activation_state)
+              for unit in self.successResultOf(self.docker.list())}))
+
+    def test_stopped_application_planned(self):
+        """
+        Changes are planned if an application has stopped since the node was
+        last changed.
+        """
+        self.successResultOf(self.change())
+        self.docker.remove(APPLIED_APPLICATION.name)
+        self.assertEqual(
+            ([frozenset([APPLIED_APPLICATION.name])],
+             [APPLIED_APPLICATION.name]),
+            (self.planned(), [unit.name for unit in
+                              self.successResultOf(self.docker.list())]))
+
+    def test_extra_application_planned(self):
+        """
+        Changes are planned if an application has been started since the node
+        was last changed.
+        """
+        self.successResultOf(self.change())
+        self.docker.add(u"intruder", u"busybox")
+        self.assertEqual([frozenset([u"intruder"])], self.planned())
+
+    def test_proxy_drift_planned(self):
+        """
+        Changes are planned if the proxies have changed since the node was
+        last changed.
+        """
+        self.successResultOf(self.change())
+        for proxy in self.network.enumerate_proxies():
+            self.network.delete_proxy(proxy)
+        self.assertEqual(
+            ([frozenset()], [Proxy(ip=u"node2.example.com", port=8080)]),
+            (self.planned(), self.network.enumerate_proxies()))
+
+    def test_failure_forgets_applied(self):
+        """
+        If changing the node fails, the record of what it was last changed to
+        match is removed, since the node may have been partially changed.
+        """
+        self.successResultOf(self.change())
+        desired = Deployment(nodes=frozenset())
+        self.patch(self.deployer, "calculate_necessary_state_changes",
+                   lambda **kwargs: succeed(FakeChange(
+                       fail(ZeroDivisionError()))))
+        self.failureResultOf(self.change(desired), ZeroDivisionError)
+        self.assertIs(None, self.store.load())
+
+
+class AppliedStateStoreTests(SynchronousTestCase):
+    """
+    Tests for ``AppliedStateStore``.
+    """
+    def test_round_trip(self):
+        """
+        ``AppliedStateStore.load`` returns the ``AppliedState`` most recently
+        passed to ``AppliedStateStore.save``.
+        """
+        store = AppliedStateStore(FilePath(self.mktemp()).child(b"applied"))
+        state = AppliedState(
+            applications={u"app": b"abc"},
+            proxies=frozenset([Proxy(ip=u"node2.example.com", port=8080)]))
+        store.save(state)
+        self.assertEqual(state, store.load())
+
+    def test_missing(self):
+        """
+        ``AppliedStateStore.load`` returns ``None`` if nothing was recorded.
+        """
+        store = AppliedStateStore(FilePath(self.mktemp()))
+        self.assertIs(None, store.load())
+
+    def test_corrupt(self):
+        """
+        ``AppliedStateStore.load`` returns ``None`` if the file can't be
+        parsed.
+        """
+        path = FilePath(self.mktemp())
+        path.setContent(b"{not json")
+        self.assertIs(None, AppliedStateStore(path).load())
+
+    def test_old_version(self):
+        """
+        ``AppliedStateStore.load`` returns ``None`` for a file written by an
+        earlier version, which recorded a single digest of the node's
+        configuration rather than one per application.
+        """
+        path = FilePath(self.mktemp())
+        path.setContent(dumps({
+            u"version": 1, u"digest": u"abc", u"applications": [u"app"],
+            u"proxies": []}))
+        self.assertIs(None, AppliedStateStore(path).load())
+
+    def test_clear(self):
+        """
+        ``AppliedStateStore.clear`` forgets the recorded state.
+        """
+        store = AppliedStateStore(FilePath(self.mktemp()))
+        store.save(AppliedState(applications={}, proxies=frozenset()))
+        store.clear()
+        self.assertIs(None, store.load())
 
 
 class CreateVolumeTests(SynchronousTestCase):
@@ -2038,6 +3206,29 @@ class CreateVolumeTests(SynchronousTestCase):
         self.assertEqual(result, deployer.volume_service.get(
             _to_volume_name(u"myvol")))
 
+    def test_properties(self):
+        """
+        ``CreateVolume.run()`` creates the volume with the storage
+        properties of the ``AttachedVolume``.
+        """
+        volume_service = create_volume_service(self)
+        result = []
+
+        def _create(name, properties):
+            result.extend([name, properties])
+            return succeed(None)
+        self.patch(volume_service, "create", _create)
+        deployer = Deployer(volume_service,
+                            docker_client=FakeDockerClient(),
+                            network=make_memory_network())
+        properties = frozenset([(u"recordsize", u"8k")])
+        create = CreateVolume(
+            volume=AttachedVolume(name=u"myvol",
+                                  mountpoint=FilePath(u"/var"),
+                                  properties=properties))
+        create.run(deployer)
+        self.assertEqual(result, [_to_volume_name(u"myvol"), properties])
+
 
 class WaitForVolumeTests(SynchronousTestCase):
     """
@@ -2096,7 +3287,7 @@ class HandoffVolumeTests(SynchronousTestCase):
         result = []
 
         def _handoff(volume, destination):
-            result.extend([volume, destination])
+            result.extend([volume, destination.manager])
         self.patch(volume_service, "handoff", _handoff)
         deployer = Deployer(volume_service,
                             docker_client=FakeDockerClient(),
@@ -2130,6 +3321,160 @@ class HandoffVolumeTests(SynchronousTestCase):
         handoff_result = handoff.run(deployer)
         self.assertIs(handoff_result, result)
 
+    def test_bytes(self):
+        """
+        ``HandoffVolume.run()`` records how many bytes were copied to the
+        destination in the deployer's ``ChangeProfile``.
+        """
+        volume_service = create_volume_service(self)
+
+        def _handoff(volume, destination):
+            destination.bytes += 1234
+            return succeed(None)
+        self.patch(volume_service, "handoff", _handoff)
+        deployer = Deployer(volume_service,
+                            docker_client=FakeDockerClient(),
+                            network=make_memory_network())
+        handoff = HandoffVolume(
+            volume=AttachedVolume(name=u"myvol",
+                                  mountpoint=FilePath(u"/var")),
+            hostname=b"dest.example.com")
+        deployer.profile.run(handoff, deployer)
+        self.assertEqual([1234], [timing.bytes
+                                  for timing in deployer.profile.timings])
+
+
+def reportstate(applications, running):
+    """
+    :param list applications: The names of the applications on a node.
+    :param list running: The names of those which are running.
+
+    :return: ``flocker-reportstate`` output for the node.
+    """
+    return safe_dump({u"version": 1, u"used_ports": [], u"running": running,
+                      u"applications": {name: {} for name in applications}})
+
+
+class WaitForApplicationTests(SynchronousTestCase):
+    """
+    Tests for ``WaitForApplication``.
+    """
+    def setUp(self):
+        self.clock = Clock()
+        self.deployer = Deployer(create_volume_service(self),
+                                 docker_client=FakeDockerClient(),
+                                 network=make_memory_network(),
+                                 reactor=self.clock)
+        self.wait = WaitForApplication(
+            application=Application(
+                name=u"site-example.com",
+                image=DockerImage.from_string(u"clusterhq/nginx:latest")),
+            hostname=u"node2.example.com")
+        # Run the blocking calls as soon as they are made, recording them:
+        self.in_thread = []
+
+        def defer_to_thread(function, *args):
+            self.in_thread.append(function)
+            return maybeDeferred(function, *args)
+        self.patch(_deploy, "deferToThread", defer_to_thread)
+
+    def patch_node(self, outputs):
+        """
+        Make the remote node a ``FakeNode``.
+
+        :param outputs: The outputs for ``FakeNode``.
+
+        :return: A ``list`` to which the hostname of each node created is
+            appended.
+        """
+        hostnames = []
+
+        def node(hostname):
+            hostnames.append(hostname)
+            return self.node
+        self.node = FakeNode(outputs)
+        self.patch(_deploy, "standard_node", node)
+        return hostnames
+
+    def test_reportstate(self):
+        """
+        ``WaitForApplication.run()`` runs ``flocker-reportstate`` on the
+        application's new node, in a thread since it blocks.
+        """
+        hostnames = self.patch_node(
+            [reportstate([u"site-example.com"], [u"site-example.com"])])
+        self.wait.run(self.deployer)
+        self.assertEqual(
+            ([b"node2.example.com"], [b"flocker-reportstate"],
+             [self.node.get_output]),
+            (hostnames, self.node.remote_command, self.in_thread))
+
+    def test_waits(self):
+        """
+        ``WaitForApplication.run()`` returns a ``Deferred`` which fires once
+        the application is reported as running by its new node.
+        """
+        self.patch_node(
+            [reportstate([], []),
+             reportstate([u"site-example.com"], [u"site-example.com"])])
+        result = self.wait.run(self.deployer)
+        self.assertNoResult(result)
+        self.clock.advance(WAIT_FOR_APPLICATION_INTERVAL)
+        self.assertIs(None, self.successResultOf(result))
+
+    def test_not_running(self):
+        """
+        An application which exists on the new node but isn't running
+        doesn't count.
+        """
+        self.patch_node([reportstate([u"site-example.com"], [])])
+        self.assertNoResult(self.wait.run(self.deployer))
+
+    def test_default_timeout(self):
+        """
+        By default ``WaitForApplication`` waits for
+        ``WAIT_FOR_APPLICATION_TIMEOUT`` seconds.
+        """
+        self.assertEqual(WAIT_FOR_APPLICATION_TIMEOUT, self.wait.timeout)
+
+    def test_timeout(self):
+        """
+        If the application isn't running by the time the timeout passes, the
+        ``Deferred`` returned by ``WaitForApplication.run()`` fails with
+        ``ApplicationNotStarted`` and the new node is no longer polled.
+        """
+        self.patch_node([reportstate([], [])] * 4)
+        wait = WaitForApplication(
+            application=self.wait.application, hostname=self.wait.hostname,
+            timeout=3 * WAIT_FOR_APPLICATION_INTERVAL)
+        result = wait.run(self.deployer)
+        self.clock.pump([WAIT_FOR_APPLICATION_INTERVAL] * 3)
+        self.failureResultOf(result, ApplicationNotStarted)
+        self.assertEqual([], self.clock.getDelayedCalls())
+
+    def test_timeout_while_checking(self):
+        """
+        If the timeout passes while the new node is being checked, the
+        ``Deferred`` returned by ``WaitForApplication.run()`` fails at once.
+        """
+        checking = Deferred()
+        self.patch(_deploy, "deferToThread", lambda f, *args: checking)
+        self.patch_node([])
+        result = self.wait.run(self.deployer)
+        self.clock.advance(WAIT_FOR_APPLICATION_TIMEOUT)
+        self.failureResultOf(result, ApplicationNotStarted)
+        checking.callback(
+            reportstate([u"site-example.com"], [u"site-example.com"]))
+
+    def test_error(self):
+        """
+        If the new node's state can't be found the ``Deferred`` returned by
+        ``WaitForApplication.run()`` fails.
+        """
+        self.patch_node([RuntimeError()])
+        self.failureResultOf(self.wait.run(self.deployer), RuntimeError)
+        self.assertEqual([], self.clock.getDelayedCalls())
+
 
 class PushVolumeTests(SynchronousTestCase):
     """
@@ -2146,7 +3491,7 @@ class PushVolumeTests(SynchronousTestCase):
         result = []
 
         def _push(volume, destination):
-            result.extend([volume, destination])
+            result.extend([volume, destination.manager])
         self.patch(volume_service, "push", _push)
         deployer = Deployer(volume_service,
                             docker_client=FakeDockerClient(),
@@ -2179,3 +3524,60 @@ class PushVolumeTests(SynchronousTestCase):
             hostname=b"dest.example.com")
         push_result = push.run(deployer)
         self.assertIs(push_result, result)
+
+    def test_bytes(self):
+        """
+        ``PushVolume.run()`` records how many bytes were copied to the
+        destination in the deployer's ``ChangeProfile``, even if the push
+        fails part way through.
+        """
+        volume_service = create_volume_service(self)
+
+        def _push(volume, destination):
+            destination.bytes += 1234
+            return fail(ZeroDivisionError())
+        self.patch(volume_service, "push", _push)
+        deployer = Deployer(volume_service,
+                            docker_client=FakeDockerClient(),
+                            network=make_memory_network())
+        push = PushVolume(
+            volume=AttachedVolume(name=u"myvol",
+                                  mountpoint=FilePath(u"/var")),
+            hostname=b"dest.example.com")
+        self.failureResultOf(deployer.profile.run(push, deployer),
+                             ZeroDivisionError)
+        self.assertEqual([1234], [timing.bytes
+                                  for timing in deployer.profile.timings])
+
+
+class CountingVolumeManagerTests(SynchronousTestCase):
+    """
+    Tests for ``_CountingVolumeManager``.
+    """
+    def test_interface(self):
+        """
+        ``_CountingVolumeManager`` implements ``IRemoteVolumeManager``.
+        """
+        self.assertTrue(verifyObject(
+            IRemoteVolumeManager, _CountingVolumeManager(None)))
+
+    def test_receive(self):
+        """
+        Data written to volumes received with
+        ``_CountingVolumeManager.receive`` is written to the wrapped volume
+        manager and counted.
+        """
+        volume_service = create_volume_service(self)
+        volume = self.successResultOf(volume_service.create(
+            _to_volume_name(u"myvol")))
+        written = BytesIO()
+
+        class Manager(object):
+            @contextmanager
+            def receive(self, volume):
+                yield written
+        counting = _CountingVolumeManager(Manager())
+        with counting.receive(volume) as receiver:
+            receiver.write(b"abc")
+            receiver.write(b"de")
+        self.assertEqual((b"abcde", 5), (written.getvalue(), counting.bytes))
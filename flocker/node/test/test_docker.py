@@ -2,15 +2,36 @@
 
 """Tests for :module:`flocker.node._docker`."""
 
+from json import dumps, loads
+from tempfile import mkdtemp
+from threading import Event, current_thread
+
 from zope.interface.verify import verifyObject
 
+from docker.errors import APIError
+from requests import Response
+
 from twisted.trial.unittest import TestCase
+from twisted.internet import reactor
+from twisted.internet.defer import Deferred, gatherResults, succeed
+from twisted.internet.task import Clock, deferLater
+from twisted.python.failure import Failure
 from twisted.python.filepath import FilePath
+from twisted.web.server import Site
+
+from klein import Klein
 
+from eliot.testing import validateLogging, assertHasAction, LoggedAction
+
+from ...common import FakeNode
 from ...testtools import random_name, make_with_init_tests
+from ..httpapi import _UNIXRequest
 from .._docker import (
     IDockerClient, FakeDockerClient, AlreadyExists, PortMap, Unit,
-    Environment, Volume)
+    Environment, Volume, DockerClient, LIST_CONCURRENCY, CachingDockerClient,
+    EVENTS_RECONNECT_DELAY, AsyncDockerClient, STOP_TIMEOUT, DOCKER_THREADS,
+    DockerWorkers, CONTAINER_POLL_INTERVAL, CONTAINER_POLL_MAX_INTERVAL)
+from .._logging import STOP_CONTAINER, DOCKER_CALL
 
 
 def make_idockerclient_tests(fixture):
@@ -53,6 +74,13 @@ def make_idockerclient_tests(fixture):
             d.addCallback(lambda exc: self.assertEqual(exc.args[0], name))
             return d
 
+        def test_pull(self):
+            """Pulling an image succeeds, whether or not it is present."""
+            client = fixture(self)
+            d = client.pull(u"busybox")
+            d.addCallback(lambda _: client.pull(u"busybox"))
+            return d
+
         def test_remove_nonexistent_is_ok(self):
             """Removing a non-existent unit does not result in a error."""
             client = fixture(self)
@@ -136,6 +164,29 @@ def make_idockerclient_tests(fixture):
             d.addCallback(got_list)
             return d
 
+        def test_remove_many(self):
+            """
+            ``remove_many`` removes all of the given units and fires with how
+            many seconds each took to stop.
+            """
+            client = fixture(self)
+            names = [random_name(), random_name()]
+            d = gatherResults([client.add(name, u"busybox")
+                               for name in names])
+            d.addCallback(lambda _: client.remove_many(
+                {names[0]: None, names[1]: 1}))
+
+            def removed(durations):
+                self.assertEqual(
+                    (set(names), True),
+                    (set(durations),
+                     all(isinstance(duration, float) and duration >= 0
+                         for duration in durations.values())))
+                return gatherResults([client.exists(name) for name in names])
+            d.addCallback(removed)
+            d.addCallback(self.assertEqual, [False, False])
+            return d
+
         def test_removed_is_not_listed(self):
             """A removed unit is not included in the output of ``list()``."""
             client = fixture(self)
@@ -195,6 +246,39 @@ class FakeDockerClientImplementationTests(TestCase):
                               container_image=u'flocker/flocker:v1.0.0')}
         self.assertEqual(units, FakeDockerClient(units=units)._units)
 
+    def test_pull_records_image(self):
+        """
+        ``FakeDockerClient.pull`` records the image in
+        ``FakeDockerClient._images``.
+        """
+        client = FakeDockerClient()
+        client.pull(u"busybox")
+        self.assertEqual({u"busybox"}, client._images)
+
+    def test_remove_records_stop_timeout(self):
+        """
+        ``FakeDockerClient.remove`` records the ``stop_timeout`` in
+        ``FakeDockerClient._stop_timeouts``.
+        """
+        client = FakeDockerClient()
+        client.remove(u"app", stop_timeout=30)
+        self.assertEqual({u"app": 30}, client._stop_timeouts)
+
+    def test_remove_many(self):
+        """
+        ``FakeDockerClient.remove_many`` removes every unit, records each
+        ``stop_timeout`` and fires with a zero stop duration for each unit.
+        """
+        client = FakeDockerClient(units={
+            name: Unit(name=name, container_name=name,
+                       container_image=u"busybox", activation_state=u"active")
+            for name in [u"app", u"db"]})
+        d = client.remove_many({u"app": 30, u"db": None})
+        d.addCallback(lambda durations: self.assertEqual(
+            ({u"app": 0.0, u"db": 0.0}, {u"app": 30, u"db": None}, {}),
+            (durations, client._stop_timeouts, client._units)))
+        return d
+
 
 class PortMapInitTests(
         make_with_init_tests(
@@ -350,3 +434,1325 @@ class VolumeInitTests(
     """
     Tests for ``Volume.__init__``.
     """
+
+
+def api_error(code):
+    """
+    :param int code: An HTTP status code.
+
+    :return: An ``APIError`` as raised by ``docker.Client`` for a response
+        with that status.
+    """
+    response = Response()
+    response.status_code = code
+    response._content = b""
+    return APIError("error", response)
+
+
+class StubImageAPI(object):
+    """
+    A stand-in for the image methods of ``docker.Client``.
+
+    :ivar set images: The names of the images which are present.
+    :ivar list loaded: The data passed to each call to ``load_image``.
+    :ivar list pulled: The names passed to each call to ``pull``.
+    """
+    def __init__(self, loads=None):
+        """
+        :param loads: The name of the image each call to ``load_image`` adds,
+            or ``None`` for calls which fail.
+        """
+        self.images = set()
+        self.loaded = []
+        self.pulled = []
+        self._loads = list(loads or [])
+
+    def inspect_image(self, image_name):
+        if image_name not in self.images:
+            raise api_error(404)
+        return {}
+
+    def load_image(self, data):
+        self.loaded.append(b"".join(data))
+        image_name = self._loads.pop(0)
+        if image_name is None:
+            raise api_error(500)
+        self.images.add(image_name)
+
+    def pull(self, image_name):
+        self.pulled.append(image_name)
+        self.images.add(image_name)
+
+
+class DockerClientImagePeersTests(TestCase):
+    """
+    Tests for how ``DockerClient`` downloads images from other nodes.
+    """
+    def client(self, peers, api):
+        """
+        :param list peers: The ``INode`` providers to offer as having any
+            image.
+        :param StubImageAPI api: The Docker API to use.
+
+        :return: A ``DockerClient`` using them.
+        """
+        client = DockerClient(image_peers=lambda image_name: peers)
+        client._client = api
+        return client
+
+    def test_no_peers(self):
+        """
+        By default images are pulled from a registry.
+        """
+        api = StubImageAPI()
+        client = DockerClient()
+        client._client = api
+        client._blocking_pull(u"busybox")
+        self.assertEqual([u"busybox"], api.pulled)
+
+    def test_load_from_peer(self):
+        """
+        An image is loaded from the output of ``docker save`` on a peer
+        rather than pulled from a registry.
+        """
+        peer = FakeNode([b"image data"])
+        api = StubImageAPI(loads=[u"busybox"])
+        self.client([peer], api)._blocking_pull(u"busybox")
+        self.assertEqual(
+            ([b"docker", b"save", b"busybox"], [b"image data"], []),
+            (peer.remote_command, api.loaded, api.pulled))
+
+    def test_peer_fails(self):
+        """
+        If copying the image from a peer fails, the next peer is tried.
+        """
+        peers = [FakeNode([IOError()]), FakeNode([b"bad data"]),
+                 FakeNode([b"image data"])]
+        api = StubImageAPI(loads=[None, u"busybox"])
+        self.client(peers, api)._blocking_pull(u"busybox")
+        self.assertEqual(([b"bad data", b"image data"], []),
+                         (api.loaded, api.pulled))
+
+    def test_peer_lacks_image(self):
+        """
+        If a peer's image doesn't turn out to be the one needed, the registry
+        is used.
+        """
+        api = StubImageAPI(loads=[u"something-else"])
+        self.client([FakeNode([b"image data"])], api)._blocking_pull(
+            u"busybox")
+        self.assertEqual([u"busybox"], api.pulled)
+
+    def test_pull_uses_peers(self):
+        """
+        ``DockerClient.pull`` copies missing images from peers.
+        """
+        api = StubImageAPI(loads=[u"busybox"])
+        client = self.client([FakeNode([b"image data"])], api)
+        d = client.pull(u"busybox")
+        d.addCallback(lambda _: self.assertEqual(
+            ([b"image data"], []), (api.loaded, api.pulled)))
+        return d
+
+
+class DockerClientEnvironmentTests(TestCase):
+    """
+    Tests for how ``DockerClient`` discovers the environment of containers.
+    """
+    def test_image_environment(self):
+        """
+        ``DockerClient._image_environment`` returns the variables set by an
+        image.
+        """
+        api = StubImageAPI()
+        api.inspect_image = lambda image_name: {
+            u"Config": {u"Env": [u"PATH=/bin", u"EMPTY="]}}
+        client = DockerClient()
+        client._client = api
+        self.assertEqual(
+            frozenset({(u"PATH", u"/bin"), (u"EMPTY", u"")}),
+            client._image_environment(u"busybox"))
+
+    def test_missing_image_environment(self):
+        """
+        ``DockerClient._image_environment`` returns no variables for an image
+        which no longer exists.
+        """
+        client = DockerClient()
+        client._client = StubImageAPI()
+        self.assertEqual(frozenset(),
+                         client._image_environment(u"busybox"))
+
+    def test_image_defaults_omitted(self):
+        """
+        ``DockerClient._parse_environment`` leaves out variables set the same
+        way by the image, but keeps those the container overrides.
+        """
+        environment = DockerClient()._parse_environment(
+            [u"PATH=/bin", u"HOME=/root", u"KEY=a=b"],
+            frozenset({(u"PATH", u"/bin"), (u"HOME", u"/")}))
+        self.assertEqual(
+            Environment(variables=frozenset(
+                {(u"HOME", u"/root"), (u"KEY", u"a=b")})),
+            environment)
+
+    def test_no_environment(self):
+        """
+        ``DockerClient._parse_environment`` returns ``None`` if only the
+        image's variables are set.
+        """
+        client = DockerClient()
+        self.assertEqual(
+            [None, None],
+            [client._parse_environment(None, frozenset()),
+             client._parse_environment(
+                 [u"PATH=/bin"], frozenset({(u"PATH", u"/bin")}))])
+
+
+class StubContainerAPI(StubImageAPI):
+    """
+    A stand-in for the container listing methods of ``docker.Client``.
+
+    :ivar dict containers_data: Maps container IDs to a tuple of the
+        container as returned by ``containers`` and as returned by
+        ``inspect_container``.
+    :ivar list inspected: The IDs passed to each call to
+        ``inspect_container``.
+    """
+    def __init__(self):
+        StubImageAPI.__init__(self)
+        self.containers_data = {}
+        self.inspected = []
+
+    def add_container(self, identifier, name, image=u"busybox",
+                      status=u"Up 3 seconds", ports=(), env=(),
+                      volumes=None):
+        """
+        Add a container.
+        """
+        bindings = {}
+        for port in ports:
+            if u"PublicPort" in port:
+                bindings.setdefault(
+                    u"%d/tcp" % (port[u"PrivatePort"],), []).append(
+                        {u"HostIp": u"0.0.0.0",
+                         u"HostPort": unicode(port[u"PublicPort"])})
+        self.containers_data[identifier] = (
+            {u"Id": identifier, u"Names": [name],
+             u"Image": image + u":latest", u"Status": status,
+             u"Ports": list(ports)},
+            {u"Id": identifier, u"Name": name,
+             u"State": {u"Running": status.startswith(u"Up")},
+             u"NetworkSettings": {u"Ports": bindings},
+             u"Config": {u"Image": image, u"Env": list(env)},
+             u"Volumes": volumes or {}})
+
+    def containers(self, all):
+        return [listed for listed, inspected
+                in self.containers_data.values()]
+
+    def inspect_container(self, identifier):
+        self.inspected.append(identifier)
+        for listed, inspected in self.containers_data.values():
+            if identifier in (inspected[u"Id"], inspected[u"Name"][1:]):
+                return inspected
+        raise api_error(404)
+
+
+class DockerClientListTests(TestCase):
+    """
+    Tests for ``DockerClient.list``.
+    """
+    def setUp(self):
+        self.api = StubContainerAPI()
+        self.client = DockerClient()
+        self.client._client = self.api
+
+    def test_default_concurrency(self):
+        """
+        By default ``DockerClient.list`` inspects ``LIST_CONCURRENCY``
+        containers at once.
+        """
+        self.assertEqual(LIST_CONCURRENCY, self.client.list_concurrency)
+
+    def test_only_namespace_inspected(self):
+        """
+        Containers outside the client's namespace, including links to
+        containers within it, are neither listed nor inspected.
+        """
+        self.api.add_container(u"1", u"/flocker--app")
+        self.api.add_container(u"2", u"/unrelated")
+        self.api.containers_data[u"1"][0][u"Names"].append(
+            u"/unrelated/flocker--alias")
+        d = self.client.list()
+        d.addCallback(lambda units: self.assertEqual(
+            ([u"app"], [u"1"]),
+            ([unit.name for unit in units], self.api.inspected)))
+        return d
+
+    def test_unit(self):
+        """
+        The state and ports of a unit come from the container listing, and
+        its image, environment and volumes from inspecting it.
+        """
+        self.api.add_container(
+            u"1", u"/flocker--app", status=u"Exited (0) 3 seconds ago",
+            ports=[{u"PrivatePort": 80, u"PublicPort": 8080,
+                    u"Type": u"tcp", u"IP": u"0.0.0.0"},
+                   {u"PrivatePort": 22, u"Type": u"tcp"}],
+            env=[u"KEY=value"], volumes={u"/data": u"/flocker/data"})
+        d = self.client.list()
+        d.addCallback(self.assertEqual, {Unit(
+            name=u"app", container_name=u"flocker--app",
+            activation_state=u"inactive", container_image=u"busybox",
+            ports=frozenset([PortMap(internal_port=80, external_port=8080)]),
+            environment=Environment(
+                variables=frozenset([(u"KEY", u"value")])),
+            volumes=frozenset([Volume(node_path=FilePath(u"/flocker/data"),
+                                      container_path=FilePath(u"/data"))]))})
+        return d
+
+    def test_active(self):
+        """
+        Containers whose status is ``Up`` are active.
+        """
+        self.api.add_container(u"1", u"/flocker--app",
+                               status=u"Up 2 hours (Paused)")
+        d = self.client.list()
+        d.addCallback(lambda units: self.assertEqual(
+            [u"active"], [unit.activation_state for unit in units]))
+        return d
+
+    def test_removed_while_listing(self):
+        """
+        Containers removed between being listed and being inspected are left
+        out.
+        """
+        self.api.add_container(u"1", u"/flocker--app")
+        self.api.add_container(u"2", u"/flocker--gone")
+        real_inspect = self.api.inspect_container
+
+        def inspect_container(identifier):
+            if identifier == u"2":
+                raise api_error(404)
+            return real_inspect(identifier)
+        self.api.inspect_container = inspect_container
+        d = self.client.list()
+        d.addCallback(lambda units: self.assertEqual(
+            [u"app"], [unit.name for unit in units]))
+        return d
+
+    def test_inspect_fails(self):
+        """
+        If inspecting a container fails, ``DockerClient.list`` fails with
+        the error Docker gave.
+        """
+        self.api.add_container(u"1", u"/flocker--app")
+
+        def inspect_container(identifier):
+            raise api_error(500)
+        self.api.inspect_container = inspect_container
+        return self.assertFailure(self.client.list(), APIError)
+
+    def test_many_containers(self):
+        """
+        All the containers are listed when there are more of them than are
+        inspected at once.
+        """
+        self.client.list_concurrency = 2
+        for i in range(5):
+            self.api.add_container(unicode(i), u"/flocker--app%d" % (i,))
+        d = self.client.list()
+        d.addCallback(lambda units: self.assertEqual(
+            {u"app%d" % (i,) for i in range(5)},
+            {unit.name for unit in units}))
+        return d
+
+
+class DockerClientRemoveTests(TestCase):
+    """
+    Tests for ``DockerClient.remove``.
+    """
+    def setUp(self):
+        self.api = StubContainerAPI()
+        self.stopped = []
+        self.deleted = []
+        self.api.stop = lambda container_name, timeout: self.stopped.append(
+            (container_name, timeout))
+        self.api.remove_container = self.deleted.append
+        self.client = DockerClient()
+        self.client._client = self.api
+
+    def test_default_stop_timeout(self):
+        """
+        By default the container is given ``STOP_TIMEOUT`` seconds to stop,
+        then deleted.
+        """
+        d = self.client.remove(u"app")
+        d.addCallback(lambda _: self.assertEqual(
+            ([(u"flocker--app", STOP_TIMEOUT)], [u"flocker--app"]),
+            (self.stopped, self.deleted)))
+        return d
+
+    def test_stop_timeout(self):
+        """
+        The container is given ``stop_timeout`` seconds to stop.
+        """
+        d = self.client.remove(u"app", stop_timeout=0)
+        d.addCallback(lambda _: self.assertEqual(
+            [(u"flocker--app", 0)], self.stopped))
+        return d
+
+    def test_already_stopped(self):
+        """
+        A container which Docker says is already stopped is still deleted.
+        """
+        def stop(container_name, timeout):
+            raise api_error(500)
+        self.api.stop = stop
+        d = self.client.remove(u"app")
+        d.addCallback(lambda _: self.assertEqual(
+            [u"flocker--app"], self.deleted))
+        return d
+
+    def test_stop_fails(self):
+        """
+        If stopping the container fails for another reason it isn't deleted
+        and ``DockerClient.remove`` fails with the error Docker gave.
+        """
+        def stop(container_name, timeout):
+            raise api_error(409)
+        self.api.stop = stop
+        d = self.assertFailure(self.client.remove(u"app"), APIError)
+        d.addCallback(lambda _: self.assertEqual([], self.deleted))
+        return d
+
+    @validateLogging(None)
+    def test_logged(self, logger):
+        """
+        Stopping the container is logged as a ``flocker:node:docker:stop``
+        action, so how long it took to shut down is recorded.
+        """
+        self.client.logger = logger
+        d = self.client.remove(u"app", stop_timeout=5)
+        d.addCallback(lambda _: assertHasAction(
+            self, logger, STOP_CONTAINER, True,
+            {u"container": u"flocker--app", u"stop_timeout": 5}))
+        return d
+
+    @validateLogging(None)
+    def test_duration_logged(self, logger):
+        """
+        How many seconds the container took to stop is logged as the
+        ``duration`` of the ``flocker:node:docker:stop`` action.
+        """
+        self.client.logger = logger
+        d = self.client.remove(u"app")
+
+        def removed(_):
+            [action] = LoggedAction.ofType(logger.messages, STOP_CONTAINER)
+            self.assertIsInstance(action.endMessage[u"duration"], float)
+        d.addCallback(removed)
+        return d
+
+    def test_remove_many(self):
+        """
+        ``DockerClient.remove_many`` stops and deletes every unit, each with
+        its own ``stop_timeout``.
+        """
+        d = self.client.remove_many({u"app": 3, u"db": None})
+        d.addCallback(lambda _: self.assertEqual(
+            ([(u"flocker--app", 3), (u"flocker--db", STOP_TIMEOUT)],
+             [u"flocker--app", u"flocker--db"]),
+            (sorted(self.stopped), sorted(self.deleted))))
+        return d
+
+    def test_remove_many_durations(self):
+        """
+        ``DockerClient.remove_many`` fires with how many seconds each unit
+        took to stop.
+        """
+        d = self.client.remove_many({u"app": None, u"db": None})
+        d.addCallback(lambda durations: self.assertEqual(
+            [u"app", u"db"], sorted(durations)))
+        return d
+
+    def test_remove_many_deletes_stopped(self):
+        """
+        ``DockerClient.remove_many`` deletes each unit as soon as it has
+        stopped, without waiting for the others to stop.
+        """
+        stopping = {}
+
+        def stop(container_name, timeout):
+            stopping[container_name] = Deferred()
+            return stopping[container_name]
+        self.client._stop_container = stop
+
+        def delete(container_name):
+            self.deleted.append(container_name)
+            return succeed(None)
+        self.client._delete_container = delete
+        d = self.client.remove_many({u"app": None, u"db": None})
+        stopping[u"flocker--app"].callback(None)
+        self.assertEqual([u"flocker--app"], self.deleted)
+        stopping[u"flocker--db"].callback(None)
+        return d
+
+
+class DockerWorkersTests(TestCase):
+    """
+    Tests for ``DockerWorkers``.
+    """
+    def setUp(self):
+        self.workers = DockerWorkers(reactor, size=1)
+
+    def test_default_size(self):
+        """
+        By default a ``DockerClient`` makes ``DOCKER_THREADS`` blocking calls
+        at once.
+        """
+        self.assertEqual(DOCKER_THREADS, DockerClient().workers.size)
+
+    def test_result(self):
+        """
+        ``DockerWorkers.run`` returns a ``Deferred`` firing with the result
+        of calling the function with the given arguments.
+        """
+        d = self.workers.run(lambda a, b: (a, b), 1, b=2)
+        d.addCallback(self.assertEqual, (1, 2))
+        return d
+
+    def test_failure(self):
+        """
+        If the function raises an exception the ``Deferred`` returned by
+        ``DockerWorkers.run`` fails with it.
+        """
+        return self.assertFailure(
+            self.workers.run(lambda: 1 / 0), ZeroDivisionError)
+
+    def test_dedicated_threads(self):
+        """
+        The function is called in one of the workers' own threads, rather
+        than the reactor's thread pool.
+        """
+        d = self.workers.run(lambda: current_thread().name)
+        d.addCallback(lambda name: self.assertTrue(
+            name.startswith(b"PoolThread-docker-"), name))
+        return d
+
+    def test_queued(self):
+        """
+        ``DockerWorkers.queued`` counts the calls waiting for a thread.
+        """
+        release = Event()
+        self.addCleanup(release.set)
+        started = Event()
+
+        def block():
+            started.set()
+            release.wait()
+        first = self.workers.run(block)
+        started.wait()
+        second = self.workers.run(lambda: None)
+        queued = self.workers.queued
+        release.set()
+        d = gatherResults([first, second])
+        d.addCallback(lambda _: self.assertEqual(
+            (1, 0), (queued, self.workers.queued)))
+        return d
+
+    @validateLogging(None)
+    def test_logged(self, logger):
+        """
+        Each call is logged as a ``flocker:node:docker:call`` action, with
+        the queue length when it was made, how long it waited for a thread
+        and how long it ran.
+        """
+        self.workers.logger = logger
+
+        def pull():
+            pass
+        d = self.workers.run(pull)
+
+        def ran(_):
+            action = assertHasAction(
+                self, logger, DOCKER_CALL, True,
+                {u"function": pull, u"queue_length": 1})
+            self.assertTrue(
+                action.endMessage[u"waited"] >= 0 and
+                action.endMessage[u"duration"] >= 0, action.endMessage)
+        d.addCallback(ran)
+        return d
+
+
+class EventReactor(Clock):
+    """
+    A ``Clock`` which records the calls made to it from other threads.
+
+    :ivar list from_threads: The function and arguments of each call to
+        ``callFromThread``.
+    """
+    def __init__(self):
+        Clock.__init__(self)
+        self.from_threads = []
+
+    def callFromThread(self, f, *args):
+        self.from_threads.append((f,) + args)
+
+
+class CachingDockerClientTests(TestCase):
+    """
+    Tests for ``CachingDockerClient``.
+    """
+    def setUp(self):
+        self.api = StubContainerAPI()
+        self.api.add_container(u"1", u"/flocker--app")
+        self.reactor = EventReactor()
+        self.client = CachingDockerClient(self.reactor)
+        self.client._client = self.api
+        # The event reactor doesn't deliver results from other threads, so
+        # run blocking calls with the real one:
+        self.client.workers = DockerWorkers(reactor)
+        self.threads = []
+        self.client._start_thread = self.threads.append
+
+    def test_workers_reactor(self):
+        """
+        ``CachingDockerClient`` runs its thread pool with the reactor it is
+        given.
+        """
+        client = CachingDockerClient(self.reactor, threads=2)
+        self.assertEqual((self.reactor, 2),
+                         (client.workers._reactor, client.workers.size))
+
+    def following(self):
+        """
+        Start the client and let it learn the units as if it had subscribed
+        to Docker's events.
+
+        :return: A ``Deferred`` which fires once the units are known.
+        """
+        self.client.startService()
+        d = self.client._subscribed()
+        d.addCallback(self.forget_inspected)
+        return d
+
+    def forget_inspected(self, ignored=None):
+        """
+        Forget which containers have been inspected so far.
+        """
+        del self.api.inspected[:]
+
+    def assertListed(self, names):
+        """
+        Assert which units the client lists, without asking Docker.
+
+        :param list names: The names of the expected units.
+        """
+        d = self.client.list()
+        d.addCallback(lambda units: self.assertEqual(
+            (sorted(names), []),
+            (sorted(unit.name for unit in units), self.api.inspected)))
+        return d
+
+    def test_start_follows_events(self):
+        """
+        ``CachingDockerClient.startService`` starts following Docker's events
+        in another thread.
+        """
+        self.client.startService()
+        self.assertEqual([self.client._follow_events], self.threads)
+
+    def test_follow_events(self):
+        """
+        ``CachingDockerClient._follow_events`` tells the reactor thread once
+        it has subscribed, about each event and when the stream ends.
+        """
+        self.client._blocking_subscribe = lambda: iter(
+            [b'{"status": "start", "id": "1"}\n'])
+        self.client._follow_events()
+        self.assertEqual(
+            [(self.client._subscribed,),
+             (self.client._event, {u"status": u"start", u"id": u"1"}),
+             (self.client._disconnected, None)],
+            self.reactor.from_threads)
+
+    def test_follow_events_fails(self):
+        """
+        If subscribing to Docker's events fails, the reactor thread is told
+        why.
+        """
+        def subscribe():
+            raise api_error(500)
+        self.client._blocking_subscribe = subscribe
+        self.client._follow_events()
+        [(disconnected, reason)] = self.reactor.from_threads
+        self.assertEqual((self.client._disconnected, APIError),
+                         (disconnected, reason.type))
+
+    def test_not_following(self):
+        """
+        Until it is following Docker's events, ``CachingDockerClient.list``
+        asks Docker.
+        """
+        d = self.client.list()
+        d.addCallback(lambda units: self.assertEqual(
+            ([u"app"], [u"1"]),
+            ([unit.name for unit in units], self.api.inspected)))
+        return d
+
+    def test_list_from_memory(self):
+        """
+        Once following Docker's events, ``CachingDockerClient.list`` answers
+        from memory.
+        """
+        d = self.following()
+        d.addCallback(lambda _: self.assertListed([u"app"]))
+        return d
+
+    def test_exists_from_memory(self):
+        """
+        Once following Docker's events, ``CachingDockerClient.exists``
+        answers from memory.
+        """
+        d = self.following()
+        d.addCallback(lambda _: self.client.exists(u"app"))
+        d.addCallback(lambda exists: self.assertEqual(
+            (True, []), (exists, self.api.inspected)))
+        return d
+
+    def test_event_updates(self):
+        """
+        When Docker reports that a container changed, its unit is updated.
+        """
+        d = self.following()
+
+        def stopped(_):
+            self.api.add_container(u"1", u"/flocker--app",
+                                   status=u"Exited (0) 1 second ago")
+            return self.client._event({u"status": u"die", u"id": u"1"})
+        d.addCallback(stopped)
+        d.addCallback(lambda _: self.client.list())
+        d.addCallback(lambda units: self.assertEqual(
+            [u"inactive"], [unit.activation_state for unit in units]))
+        return d
+
+    def test_event_adds(self):
+        """
+        When Docker reports that a container in the namespace was created, it
+        is listed.
+        """
+        d = self.following()
+
+        def created(_):
+            self.api.add_container(u"2", u"/flocker--new")
+            return self.client._event({u"status": u"create", u"id": u"2"})
+        d.addCallback(created)
+        d.addCallback(self.forget_inspected)
+        d.addCallback(lambda _: self.assertListed([u"app", u"new"]))
+        return d
+
+    def test_event_outside_namespace(self):
+        """
+        Containers created outside the namespace aren't listed.
+        """
+        d = self.following()
+
+        def created(_):
+            self.api.add_container(u"2", u"/unrelated")
+            return self.client._event({u"status": u"create", u"id": u"2"})
+        d.addCallback(created)
+        d.addCallback(self.forget_inspected)
+        d.addCallback(lambda _: self.assertListed([u"app"]))
+        return d
+
+    def test_event_removes(self):
+        """
+        When Docker reports that a container was destroyed, it is no longer
+        listed.
+        """
+        d = self.following()
+
+        def destroyed(_):
+            del self.api.containers_data[u"1"]
+            return self.client._event({u"status": u"destroy", u"id": u"1"})
+        d.addCallback(destroyed)
+        d.addCallback(self.forget_inspected)
+        d.addCallback(lambda _: self.assertListed([]))
+        return d
+
+    def test_stale_refresh_ignored(self):
+        """
+        A unit isn't overwritten by a refresh which started before the one
+        which last updated it.
+        """
+        d = self.following()
+
+        def refreshed(_):
+            self.client._update(u"app", None, 3)
+            self.client._update(
+                u"app", Unit(name=u"app", container_name=u"flocker--app",
+                             activation_state=u"active"), 2)
+        d.addCallback(refreshed)
+        d.addCallback(lambda _: self.assertListed([]))
+        return d
+
+    def test_wait_for_container(self):
+        """
+        While following events, ``CachingDockerClient._wait_for_container``
+        waits for the container to be reported as created.
+        """
+        d = self.following()
+
+        def wait(_):
+            waiting = self.client._wait_for_container(u"flocker--new")
+            self.assertNoResult(waiting)
+            self.api.add_container(u"2", u"/flocker--new")
+            self.client._event({u"status": u"create", u"id": u"2"})
+            return waiting
+        d.addCallback(wait)
+        return d
+
+    def test_wait_for_known_container(self):
+        """
+        ``CachingDockerClient._wait_for_container`` fires immediately for a
+        container which is already known.
+        """
+        d = self.following()
+        d.addCallback(
+            lambda _: self.client._wait_for_container(u"flocker--app"))
+        return d
+
+    def test_add(self):
+        """
+        Once ``CachingDockerClient.add`` has finished, the new unit is
+        listed.
+        """
+        def create_container(image_name, name, **kwargs):
+            self.api.add_container(u"2", u"/" + name,
+                                   status=u"Exited (0) 1 second ago")
+            reactor.callFromThread(
+                self.client._event, {u"status": u"create", u"id": u"2"})
+
+        def start(container_name, **kwargs):
+            self.api.add_container(u"2", u"/" + container_name)
+        self.api.create_container = create_container
+        self.api.start = start
+        d = self.following()
+        d.addCallback(lambda _: self.client.add(u"new", u"busybox"))
+        d.addCallback(lambda _: self.client.list())
+        d.addCallback(lambda units: self.assertEqual(
+            {u"app": u"active", u"new": u"active"},
+            {unit.name: unit.activation_state for unit in units}))
+        return d
+
+    def test_remove(self):
+        """
+        Once ``CachingDockerClient.remove`` has finished, the unit is no
+        longer listed.
+        """
+        def remove_container(container_name):
+            del self.api.containers_data[u"1"]
+        self.api.stop = lambda container_name, timeout: None
+        self.api.remove_container = remove_container
+        d = self.following()
+        d.addCallback(lambda _: self.client.remove(u"app"))
+        d.addCallback(lambda _: self.client.list())
+        d.addCallback(self.assertEqual, set())
+        return d
+
+    @validateLogging(None)
+    def test_disconnected(self, logger):
+        """
+        When the event stream is lost, the failure is logged, the client asks
+        Docker directly and it reconnects after ``EVENTS_RECONNECT_DELAY``
+        seconds.
+        """
+        self.client.logger = logger
+        d = self.following()
+
+        def disconnected(_):
+            self.client._disconnected(Failure(ZeroDivisionError()))
+            self.reactor.advance(EVENTS_RECONNECT_DELAY)
+            self.assertEqual(
+                (1, [self.client._follow_events] * 2),
+                (len(logger.flushTracebacks(ZeroDivisionError)),
+                 self.threads))
+            return self.client.list()
+        d.addCallback(disconnected)
+        d.addCallback(lambda _: self.assertEqual([u"1"], self.api.inspected))
+        return d
+
+    def test_disconnected_waiting(self):
+        """
+        When the event stream is lost, anything waiting for a container to be
+        created polls for it instead.
+        """
+        d = self.following()
+
+        def disconnected(_):
+            waiting = self.client._wait_for_container(u"flocker--app2")
+            self.api.add_container(u"2", u"/flocker--app2")
+            self.client._disconnected(None)
+            return waiting
+        d.addCallback(disconnected)
+        return d
+
+    def test_stop(self):
+        """
+        Once stopped, the client asks Docker directly and doesn't reconnect.
+        """
+        d = self.following()
+
+        def stopped(_):
+            self.client.stopService()
+            self.client._disconnected(None)
+            self.reactor.advance(EVENTS_RECONNECT_DELAY)
+            self.assertEqual(1, len(self.threads))
+            return self.client.list()
+        d.addCallback(stopped)
+        d.addCallback(lambda _: self.assertEqual([u"1"], self.api.inspected))
+        return d
+
+
+class FakeDockerServer(object):
+    """
+    An in-memory stand-in for the parts of the Docker HTTP API used by
+    ``AsyncDockerClient``.
+
+    :ivar dict images: Maps the names of the images which are present to the
+        environment variables they set.
+    :ivar dict containers: Maps container names to the container as returned
+        by inspecting it.
+    :ivar list pulled: The name of each image pulled from the registry.
+    :ivar list inspected: The ID or name of each container inspected.
+    :ivar list stopped: The ID or name of each container stopped, and the
+        timeout it was given.
+    :ivar int connections: How many connections have been made.
+    :ivar bool pulls_fail: Whether pulls leave the image missing.
+    """
+    app = Klein()
+
+    def __init__(self):
+        self.images = {}
+        self.containers = {}
+        self.pulled = []
+        self.inspected = []
+        self.stopped = []
+        self.connections = 0
+        self.pulls_fail = False
+
+    def listen(self, reactor, path):
+        """
+        Serve the API on a UNIX socket.
+
+        :param reactor: The reactor to listen with.
+        :param FilePath path: The path of the socket.
+
+        :return: The listening port.
+        """
+        server = self
+
+        class CountingSite(Site):
+            def buildProtocol(self, addr):
+                server.connections += 1
+                return Site.buildProtocol(self, addr)
+        site = CountingSite(self.app.resource())
+        site.requestFactory = _UNIXRequest
+        return reactor.listenUNIX(path.path, site)
+
+    def add_container(self, name, image, running=True):
+        """
+        Add a container directly.
+
+        :param unicode name: The name of the container.
+        :param unicode image: The name of its image.
+        :param bool running: Whether it is running.
+        """
+        self.containers[name] = {
+            u"Id": u"%064x" % (len(self.containers) + 1,),
+            u"Name": u"/" + name,
+            u"State": {u"Running": running},
+            u"Config": {u"Image": image,
+                        u"Env": list(self.images.get(image, []))},
+            u"NetworkSettings": {u"Ports": None},
+            u"Volumes": {},
+        }
+
+    def _container(self, request, container):
+        """
+        :return: The container with the given ID or name, or ``None`` after
+            setting a ``NOT_FOUND`` response if there isn't one.
+        """
+        for data in self.containers.values():
+            if container in (data[u"Id"], data[u"Name"][1:]):
+                return data
+        request.setResponseCode(404)
+        return None
+
+    @app.route("/v1.12/containers/create", methods=["POST"])
+    def create(self, request):
+        name = request.args[b"name"][0].decode("utf-8")
+        config = loads(request.content.read())
+        if config[u"Image"] not in self.images:
+            request.setResponseCode(404)
+            return b"No such image"
+        if name in self.containers:
+            request.setResponseCode(409)
+            return b"Conflict"
+        self.add_container(name, config[u"Image"], running=False)
+        self.containers[name][u"Config"][u"Env"].extend(
+            config[u"Env"] or [])
+        request.setResponseCode(201)
+        return dumps({u"Id": self.containers[name][u"Id"]})
+
+    @app.route("/v1.12/containers/<container>/start", methods=["POST"])
+    def start(self, request, container):
+        data = self._container(request, container)
+        if data is None:
+            return b""
+        config = loads(request.content.read())
+        data[u"State"][u"Running"] = True
+        data[u"Volumes"] = dict(reversed(bind.split(u":")[:2])
+                                for bind in config[u"Binds"])
+        data[u"NetworkSettings"][u"Ports"] = {
+            port: [{u"HostIp": u"0.0.0.0",
+                    u"HostPort": bindings[0][u"HostPort"]}]
+            for port, bindings in config[u"PortBindings"].items()}
+        request.setResponseCode(204)
+        return b""
+
+    @app.route("/v1.12/containers/<container>/stop", methods=["POST"])
+    def stop(self, request, container):
+        self.stopped.append((container, int(request.args[b"t"][0])))
+        data = self._container(request, container)
+        if data is not None:
+            request.setResponseCode(
+                204 if data[u"State"][u"Running"] else 304)
+            data[u"State"][u"Running"] = False
+        return b""
+
+    @app.route("/v1.12/containers/<container>", methods=["DELETE"])
+    def delete(self, request, container):
+        data = self._container(request, container)
+        if data is not None:
+            del self.containers[data[u"Name"][1:]]
+            request.setResponseCode(204)
+        return b""
+
+    @app.route("/v1.12/containers/json", methods=["GET"])
+    def containers_json(self, request):
+        listed = []
+        for data in self.containers.values():
+            ports = data[u"NetworkSettings"][u"Ports"] or {}
+            listed.append({
+                u"Id": data[u"Id"],
+                u"Names": [data[u"Name"]],
+                u"Image": data[u"Config"][u"Image"] + u":latest",
+                u"Status": (u"Up 1 second" if data[u"State"][u"Running"]
+                            else u"Exited (0) 1 second ago"),
+                u"Ports": [{u"PrivatePort": int(port.split(u"/")[0]),
+                            u"PublicPort": int(bindings[0][u"HostPort"]),
+                            u"Type": u"tcp", u"IP": u"0.0.0.0"}
+                           for port, bindings in ports.items()],
+            })
+        return dumps(listed)
+
+    @app.route("/v1.12/containers/<container>/json", methods=["GET"])
+    def inspect_container(self, request, container):
+        self.inspected.append(container)
+        data = self._container(request, container)
+        if data is None:
+            return b"No such container"
+        return dumps(data)
+
+    @app.route("/v1.12/images/<path:image>/json", methods=["GET"])
+    def inspect_image(self, request, image):
+        if image not in self.images:
+            request.setResponseCode(404)
+            return b"No such image"
+        return dumps({u"Config": {u"Env": self.images[image]}})
+
+    @app.route("/v1.12/images/create", methods=["POST"])
+    def pull(self, request):
+        image = request.args[b"fromImage"][0].decode("utf-8")
+        if b"tag" in request.args:
+            image += u":" + request.args[b"tag"][0].decode("utf-8")
+        self.pulled.append(image)
+        if not self.pulls_fail:
+            self.images[image] = [u"PATH=/usr/bin:/bin"]
+        return dumps({u"status": u"Download complete"})
+
+
+def async_docker_client(test):
+    """
+    Create an ``AsyncDockerClient`` talking to a ``FakeDockerServer``, which
+    is recorded on the test as ``docker_server``.
+    """
+    # UNIX socket paths are short, so this can't be under the test's
+    # temporary directory:
+    directory = FilePath(mkdtemp())
+    test.addCleanup(directory.remove)
+    socket = directory.child(b"docker.sock")
+    test.docker_server = FakeDockerServer()
+    port = test.docker_server.listen(reactor, socket)
+    test.addCleanup(port.stopListening)
+    client = AsyncDockerClient(reactor, socket_path=socket)
+    test.addCleanup(client._pool.closeCachedConnections)
+    return client
+
+
+class AsyncIDockerClientTests(
+        make_idockerclient_tests(async_docker_client)):
+    """
+    ``IDockerClient`` tests for ``AsyncDockerClient``, against a
+    ``FakeDockerServer``.
+    """
+
+
+class AsyncDockerClientTests(TestCase):
+    """
+    Tests for ``AsyncDockerClient``.
+    """
+    def setUp(self):
+        self.client = async_docker_client(self)
+        self.server = self.docker_server
+
+    def test_connection_reused(self):
+        """
+        Requests reuse the same connection to the Docker server.
+        """
+        d = self.client.exists(u"app")
+        d.addCallback(lambda _: self.client.exists(u"app"))
+        d.addCallback(lambda _: self.assertEqual(1, self.server.connections))
+        return d
+
+    def test_wait_for_container_backoff(self):
+        """
+        ``AsyncDockerClient._wait_for_container`` checks again after
+        ``CONTAINER_POLL_INTERVAL`` seconds, doubling the delay after each
+        check up to ``CONTAINER_POLL_MAX_INTERVAL``.
+        """
+        clock = Clock()
+        client = AsyncDockerClient(clock, socket_path=FilePath(b"/unused"))
+        checks = []
+
+        def exists(container_name):
+            checks.append(clock.seconds())
+            return succeed(len(checks) > 8)
+        client._exists = exists
+        delays = []
+        d = client._wait_for_container(u"flocker--app")
+        while clock.getDelayedCalls():
+            [call] = clock.getDelayedCalls()
+            delays.append(call.getTime() - clock.seconds())
+            clock.advance(delays[-1])
+        self.successResultOf(d)
+        expected = [CONTAINER_POLL_INTERVAL * 2 ** n for n in range(8)]
+        self.assertEqual(
+            [round(min(delay, CONTAINER_POLL_MAX_INTERVAL), 6)
+             for delay in expected],
+            [round(delay, 6) for delay in delays])
+
+    def test_no_threads(self):
+        """
+        ``AsyncDockerClient`` creates no thread pool or docker-py client when
+        no image is loaded from another node.
+        """
+        d = self.client.add(u"app", u"busybox")
+        d.addCallback(lambda _: self.client.list())
+        d.addCallback(lambda _: self.client.remove(u"app"))
+        d.addCallback(lambda _: self.assertEqual(
+            (None, None), (self.client.workers, self.client._client)))
+        return d
+
+    def test_peers_loaded_in_thread(self):
+        """
+        ``AsyncDockerClient`` creates a ``DockerWorkers`` pool with the given
+        number of threads the first time it loads an image from another
+        node, and pulls it from the registry if no node supplies it.
+        """
+        client = AsyncDockerClient(
+            reactor, socket_path=self.client._socket_path,
+            image_peers=lambda image_name: [object()], threads=3)
+        self.addCleanup(client._pool.closeCachedConnections)
+        client._blocking_load_from_peers = lambda image_name: False
+        d = client.pull(u"busybox")
+        d.addCallback(lambda _: self.assertEqual(
+            (3, [u"busybox"]), (client.workers.size, self.server.pulled)))
+        return d
+
+    def test_image_pulled_once(self):
+        """
+        ``AsyncDockerClient.add`` pulls an image which is missing, but not
+        one which is present.
+        """
+        d = self.client.add(u"first", u"busybox")
+        d.addCallback(lambda _: self.client.add(u"second", u"busybox"))
+        d.addCallback(lambda _: self.assertEqual([u"busybox"],
+                                                 self.server.pulled))
+        return d
+
+    def test_pull_tag(self):
+        """
+        ``AsyncDockerClient.pull`` pulls the tag given in the image name.
+        """
+        d = self.client.pull(u"busybox:1.0")
+        d.addCallback(lambda _: self.assertEqual([u"busybox:1.0"],
+                                                 self.server.pulled))
+        return d
+
+    def test_pull_fails(self):
+        """
+        If the image is still missing after pulling it,
+        ``AsyncDockerClient.pull`` fails.
+        """
+        self.server.pulls_fail = True
+        return self.assertFailure(self.client.pull(u"busybox"), APIError)
+
+    def test_environment(self):
+        """
+        The environment of a container, leaving out the variables set the same
+        way by its image, is listed.
+        """
+        environment = Environment(variables=frozenset(
+            [(u"KEY", u"value"), (u"PATH", u"/sbin")]))
+        d = self.client.add(u"app", u"busybox", environment=environment)
+        d.addCallback(lambda _: self.client.list())
+        d.addCallback(lambda units: self.assertEqual(
+            [environment], [unit.environment for unit in units]))
+        return d
+
+    def test_only_namespace_inspected(self):
+        """
+        Containers outside the client's namespace are neither listed nor
+        inspected.
+        """
+        self.server.add_container(u"unrelated", u"busybox")
+        self.server.add_container(u"flocker--app", u"busybox")
+        d = self.client.list()
+        d.addCallback(lambda units: self.assertEqual(
+            ([u"app"], [self.server.containers[u"flocker--app"][u"Id"]]),
+            ([unit.name for unit in units], self.server.inspected)))
+        return d
+
+    def test_inactive(self):
+        """
+        Containers which aren't running are listed as inactive.
+        """
+        self.server.add_container(u"flocker--app", u"busybox", running=False)
+        d = self.client.list()
+        d.addCallback(lambda units: self.assertEqual(
+            [u"inactive"], [unit.activation_state for unit in units]))
+        return d
+
+    def test_stop_timeout(self):
+        """
+        ``AsyncDockerClient.remove`` gives the container ``stop_timeout``
+        seconds to stop, or ``STOP_TIMEOUT`` by default.
+        """
+        self.server.add_container(u"flocker--app", u"busybox")
+        d = self.client.remove(u"app", stop_timeout=3)
+        d.addCallback(lambda _: self.client.remove(u"other"))
+        d.addCallback(lambda _: self.assertEqual(
+            ([(u"flocker--app", 3), (u"flocker--other", STOP_TIMEOUT)], {}),
+            (self.server.stopped, self.server.containers)))
+        return d
+
+
+class DockerClientPullTests(TestCase):
+    """
+    Tests for how ``DockerClient`` coordinates pulls of the same image.
+    """
+    def setUp(self):
+        self.api = StubContainerAPI()
+        self.client = DockerClient()
+        self.client._client = self.api
+        self.pulls = []
+
+        def pull_image(image_name):
+            self.pulls.append((image_name, Deferred()))
+            return self.pulls[-1][1]
+        self.client._pull_image = pull_image
+
+    def test_single_flight(self):
+        """
+        Pulls of an image which is already being pulled wait for that pull.
+        """
+        first = self.client.pull(u"busybox")
+        second = self.client.pull(u"busybox")
+        other = self.client.pull(u"postgres")
+        self.assertEqual([u"busybox", u"postgres"],
+                         [image_name for image_name, d in self.pulls])
+        self.assertNoResult(second)
+        self.pulls[0][1].callback(None)
+        self.assertEqual([None, None], [self.successResultOf(first),
+                                        self.successResultOf(second)])
+        self.assertNoResult(other)
+
+    def test_failure_shared(self):
+        """
+        If a pull fails, everything waiting for it fails, and the image is
+        pulled again next time.
+        """
+        first = self.client.pull(u"busybox")
+        second = self.client.pull(u"busybox")
+        self.pulls[0][1].errback(api_error(500))
+        self.failureResultOf(first, APIError)
+        self.failureResultOf(second, APIError)
+        self.client.pull(u"busybox")
+        self.assertEqual(2, len(self.pulls))
+
+    def test_pulled_again(self):
+        """
+        Once a pull has finished, pulling the image again asks Docker again,
+        in case the image has been removed since.
+        """
+        self.client.pull(u"busybox")
+        self.pulls[0][1].callback(None)
+        self.client.pull(u"busybox")
+        self.assertEqual(2, len(self.pulls))
+
+    def test_add_waits_for_pull(self):
+        """
+        ``DockerClient.add`` waits for a pull of its image which is already
+        running, rather than finding the image missing and pulling it too.
+        """
+        created = []
+
+        def create_container(image_name, name, **kwargs):
+            created.append(name)
+            self.api.add_container(u"1", u"/" + name)
+        self.api.create_container = create_container
+        self.api.start = lambda container_name, **kwargs: None
+        self.client.pull(u"busybox")
+        d = self.client.add(u"app", u"busybox")
+        self.assertEqual([], created)
+        self.pulls[0][1].callback(None)
+        d.addCallback(lambda _: self.assertEqual(
+            ([u"flocker--app"], 1), (created, len(self.pulls))))
+        return d
+
+    def test_add_missing_image(self):
+        """
+        If ``DockerClient.add`` finds its image missing, the image is pulled
+        once for all concurrent adds.
+        """
+        def create_container(image_name, name, **kwargs):
+            if image_name not in self.api.images:
+                raise api_error(404)
+            self.api.add_container(name, u"/" + name)
+        self.api.create_container = create_container
+        self.api.start = lambda container_name, **kwargs: None
+
+        def pull_image(image_name):
+            self.pulls.append(image_name)
+            self.api.images.add(image_name)
+            # Docker is slow to pull, so both adds find the image missing:
+            return deferLater(reactor, 0.01, lambda: None)
+        self.client._pull_image = pull_image
+        d = gatherResults([self.client.add(u"first", u"busybox"),
+                           self.client.add(u"second", u"busybox")])
+        d.addCallback(lambda _: self.assertEqual([u"busybox"], self.pulls))
+        return d
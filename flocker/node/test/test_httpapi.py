@@ -0,0 +1,99 @@
+# Copyright Hybrid Logic Ltd.  See LICENSE file for details.
+"""
+Tests for ``flocker.node.httpapi``.
+"""
+
+from io import BytesIO
+
+from yaml import safe_dump
+
+from twisted.web.client import FileBodyProducer, readBody
+from twisted.web.http import BAD_REQUEST
+from twisted.web.http_headers import Headers
+
+from ...restapi.testtools import (
+    buildIntegrationTests, dumps, loads, goodResult)
+
+from ..httpapi import ConvergenceAPIUser
+from .._model import Deployment, Node
+from .test_script import RecordingAgent
+
+
+class APITestsMixin(object):
+    """
+    Integration tests for the convergence agent API.
+    """
+    def set_state(self, **body):
+        """
+        Make a request to change the desired state.
+
+        :param body: The fields of the request body.
+
+        :return: A ``Deferred`` which fires with the response code and the
+            decoded response body.
+        """
+        requesting = self.agent.request(
+            b"POST", b"/state",
+            Headers({b"content-type": [b"application/json"]}),
+            FileBodyProducer(BytesIO(dumps(body))))
+
+        def got_response(response):
+            reading = readBody(response)
+            reading.addCallback(lambda body: (response.code, loads(body)))
+            return reading
+        requesting.addCallback(got_response)
+        return requesting
+
+    def test_set_state(self):
+        """
+        ``POST /state`` gives the agent the parsed desired and current states
+        and returns the marshalled ``ChangeProfile`` of the convergence once
+        the node has converged.
+        """
+        requesting = self.set_state(
+            deployment_config=safe_dump(
+                {u"nodes": {u"node1.example.com": []}, u"version": 1}),
+            application_config=u"{applications: {}, version: 1}",
+            current_config=u"{}",
+            hostname=u"node1.example.com")
+
+        def got_result(result):
+            self.assertEqual(
+                ((200, goodResult(
+                    self.recording_agent.deployer.profile.marshal())),
+                 [(Deployment(nodes=frozenset([
+                     Node(hostname=u"node1.example.com",
+                          applications=frozenset())])),
+                   Deployment(nodes=frozenset()), u"node1.example.com")]),
+                (result, self.recording_agent.states))
+        requesting.addCallback(got_result)
+        return requesting
+
+    def test_invalid_configuration(self):
+        """
+        ``POST /state`` with a configuration which can't be parsed fails with
+        a ``BAD_REQUEST`` response and doesn't change the desired state.
+        """
+        requesting = self.set_state(
+            deployment_config=u"{nodes: {}, version: 1}",
+            application_config=u"{applications: {}}",
+            current_config=u"{}",
+            hostname=u"node1.example.com")
+
+        def got_result(result):
+            self.assertEqual((BAD_REQUEST, []),
+                             (result[0], self.recording_agent.states))
+        requesting.addCallback(got_result)
+        return requesting
+
+
+def _fixture(test):
+    """
+    Create the API application with a stand-in agent, recorded on the test.
+    """
+    test.recording_agent = RecordingAgent()
+    return ConvergenceAPIUser(test.recording_agent).app
+
+
+RealTestsAPI, MemoryTestsAPI = buildIntegrationTests(
+    APITestsMixin, "API", _fixture)
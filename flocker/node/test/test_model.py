@@ -77,9 +77,9 @@ class ApplicationInitTests(make_with_init_tests(
     kwargs=dict(
         name=u'site-example.com', image=object(),
         ports=None, volume=None, environment=None,
-        links=frozenset(),
+        links=frozenset(), stop_timeout=None,
     ),
-    expected_defaults={'links': frozenset()},
+    expected_defaults={'links': frozenset(), 'stop_timeout': None},
 )):
     """
     Tests for ``Application.__init__``.
@@ -98,7 +98,8 @@ class ApplicationTests(SynchronousTestCase):
                                   ports=None, links=frozenset())
         self.assertEqual(
             "<Application(name=u'site-example.com', image=None, ports=None, "
-            "volume=None, links=frozenset([]), environment=None)>",
+            "volume=None, links=frozenset([]), environment=None, "
+            "stop_timeout=None)>",
             repr(application)
         )
 
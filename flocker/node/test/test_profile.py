@@ -0,0 +1,229 @@
+# Copyright Hybrid Logic Ltd.  See LICENSE file for details.
+
+"""
+Tests for ``flocker.node._profile``.
+"""
+
+from twisted.internet.defer import Deferred, fail, succeed
+from twisted.internet.task import Clock
+from twisted.trial.unittest import SynchronousTestCase
+
+from eliot.testing import validateLogging, assertHasAction
+
+from .._deploy import Sequentially
+from .._logging import STATE_CHANGE
+from .._profile import ChangeProfile, ChangeTiming, profile_report
+
+
+class TimedChange(object):
+    """
+    A change which takes a given time to run on a ``Clock``.
+
+    :ivar bytes name: The name of the change, used as its ``repr``.
+    """
+    def __init__(self, name, clock, duration, copied=None, result=None):
+        """
+        :param bytes name: See ``name``.
+        :param Clock clock: The clock to advance while running.
+        :param float duration: How long the change takes.
+        :param copied: How many bytes the change copies to another node, or
+            ``None``.
+        :param result: The ``Deferred`` to return, or ``None`` for one which
+            has succeeded.
+        """
+        self.name = name
+        self._clock = clock
+        self._duration = duration
+        self._copied = copied
+        self._result = result
+
+    def __repr__(self):
+        return self.name
+
+    def run(self, deployer):
+        self._clock.advance(self._duration)
+        if self._copied is not None:
+            deployer.profile.transferred(self, self._copied)
+        if self._result is None:
+            return succeed(None)
+        return self._result
+
+
+class ProfiledDeployer(object):
+    """
+    A stand-in for ``Deployer`` with only a ``ChangeProfile``.
+    """
+    def __init__(self, clock):
+        self.profile = ChangeProfile(clock)
+
+
+class ChangeProfileTests(SynchronousTestCase):
+    """
+    Tests for ``ChangeProfile``.
+    """
+    def setUp(self):
+        self.clock = Clock()
+        self.clock.advance(1000)
+        self.deployer = ProfiledDeployer(self.clock)
+
+    def test_result(self):
+        """
+        ``ChangeProfile.run`` returns the result of running the change.
+        """
+        result = Deferred()
+        change = TimedChange(b"change", self.clock, 0, result=result)
+        self.assertIs(result, self.deployer.profile.run(change, self.deployer))
+
+    def test_timing(self):
+        """
+        ``ChangeProfile.run`` records when the change started and finished,
+        whether it succeeded and how many bytes it copied.
+        """
+        change = TimedChange(b"push", self.clock, 2.5, copied=1024)
+        self.deployer.profile.run(change, self.deployer)
+        self.assertEqual(
+            [ChangeTiming(identifier=0, parent=None, after=None,
+                          change=u"push", started=1000, finished=1002.5,
+                          succeeded=True, bytes=1024)],
+            self.deployer.profile.timings)
+
+    def test_failure(self):
+        """
+        ``ChangeProfile.run`` records that a change failed.
+        """
+        change = TimedChange(b"fails", self.clock, 1,
+                             result=fail(ZeroDivisionError()))
+        self.failureResultOf(
+            self.deployer.profile.run(change, self.deployer),
+            ZeroDivisionError)
+        self.assertEqual(
+            [False],
+            [timing.succeeded for timing in self.deployer.profile.timings])
+
+    def test_unfinished(self):
+        """
+        A change which is still running has no finish time or outcome.
+        """
+        change = TimedChange(b"slow", self.clock, 1, result=Deferred())
+        self.deployer.profile.run(change, self.deployer)
+        self.assertEqual([(None, None)],
+                         [(timing.finished, timing.succeeded)
+                          for timing in self.deployer.profile.timings])
+
+    def test_marshal(self):
+        """
+        ``ChangeProfile.marshal`` returns the timings as ``dict``\ s.
+        """
+        first = TimedChange(b"first", self.clock, 1)
+        second = TimedChange(b"second", self.clock, 2, copied=10)
+        self.deployer.profile.run(
+            Sequentially(changes=[first, second]), self.deployer)
+        self.assertEqual(
+            [{u"identifier": 0, u"parent": None, u"after": None,
+              u"change": u"<Sequentially(changes=[first, second])>",
+              u"started": 1000, u"finished": 1003, u"succeeded": True,
+              u"bytes": None},
+             {u"identifier": 1, u"parent": 0, u"after": None,
+              u"change": u"first", u"started": 1000, u"finished": 1001,
+              u"succeeded": True, u"bytes": None},
+             {u"identifier": 2, u"parent": 0, u"after": 1,
+              u"change": u"second", u"started": 1001, u"finished": 1003,
+              u"succeeded": True, u"bytes": 10}],
+            self.deployer.profile.marshal())
+
+    @validateLogging(None)
+    def test_logged(self, logger):
+        """
+        ``ChangeProfile.run`` logs each change as a
+        ``flocker:node:state_change`` action, with the bytes it copied.
+        """
+        self.deployer.profile.logger = logger
+        change = TimedChange(b"push", self.clock, 1, copied=1024)
+        self.deployer.profile.run(change, self.deployer)
+        assertHasAction(self, logger, STATE_CHANGE, True,
+                        {u"change": change}, {u"bytes": 1024})
+
+    @validateLogging(None)
+    def test_failure_logged(self, logger):
+        """
+        A change which fails is logged as a failed action.
+        """
+        self.deployer.profile.logger = logger
+        change = TimedChange(b"fails", self.clock, 1,
+                             result=fail(ZeroDivisionError()))
+        self.failureResultOf(
+            self.deployer.profile.run(change, self.deployer),
+            ZeroDivisionError)
+        assertHasAction(self, logger, STATE_CHANGE, False, {u"change": change})
+
+
+def timing(identifier, change, started, finished, parent=0, after=None,
+           succeeded=True, copied=None):
+    """
+    Create a marshalled ``ChangeTiming``.
+    """
+    return ChangeTiming(
+        identifier=identifier, parent=parent, after=after, change=change,
+        started=started, finished=finished, succeeded=succeeded,
+        bytes=copied).marshal()
+
+
+class ProfileReportTests(SynchronousTestCase):
+    """
+    Tests for ``profile_report``.
+    """
+    def test_nothing_run(self):
+        """
+        If no changes finished, the report says so.
+        """
+        self.assertEqual(
+            u"No state changes were run.\n",
+            profile_report({u"node1.example.com": []}))
+
+    def test_report(self):
+        """
+        The report lists when each node finished relative to the first change
+        to start, and the chain of changes on the last node to finish which
+        each waited for the one before.
+        """
+        profiles = {
+            u"node1.example.com": [
+                timing(0, u"top", 100, 103, parent=None),
+                timing(1, u"stop", 100, 103),
+            ],
+            u"node2.example.com": [
+                timing(0, u"top", 101, 111, parent=None),
+                timing(1, u"pull", 101, 105),
+                timing(2, u"push", 101, 103, copied=2048),
+                timing(3, u"handoff", 103, 104, after=2, copied=512),
+                timing(4, u"start", 105, 111, after=1, succeeded=False),
+            ],
+        }
+        self.assertEqual(
+            u"Node                                       Finished  Changes\n"
+            u"node1.example.com                             3.00s        1\n"
+            u"node2.example.com                            11.00s        4\n"
+            u"\n"
+            u"Critical path, on node2.example.com:\n"
+            u"     Start   Duration        Bytes  Change\n"
+            u"     1.00s      4.00s            -  pull\n"
+            u"     5.00s      6.00s            -  start (failed)\n",
+            profile_report(profiles))
+
+    def test_nested(self):
+        """
+        Changes which ran other changes are replaced in the critical path by
+        the chain of changes they ran which determined when they finished.
+        """
+        profiles = {
+            u"node1.example.com": [
+                timing(0, u"top", 0, 10, parent=None),
+                timing(1, u"sequence", 0, 10),
+                timing(2, u"push", 0, 4, parent=1, copied=100),
+                timing(3, u"handoff", 4, 10, parent=1, after=2, copied=10),
+            ],
+        }
+        self.assertEqual(
+            [u"     0.00s      4.00s          100  push",
+             u"     4.00s      6.00s           10  handoff"],
+            profile_report(profiles).splitlines()[-2:])
@@ -4,13 +4,20 @@
 Tests for :module:`flocker.node.script`.
 """
 
+from json import loads
+from socket import socket, AF_UNIX
 from StringIO import StringIO
+from tempfile import mkdtemp
 
 from zope.interface import implementer
 
 from twisted.internet.interfaces import IReactorCore
-from twisted.internet.defer import Deferred
-from twisted.trial.unittest import SynchronousTestCase
+from twisted.internet.defer import Deferred, fail, succeed
+from twisted.internet import reactor
+from twisted.internet.task import Clock
+from twisted.trial.unittest import SynchronousTestCase, TestCase
+from twisted.test.proto_helpers import MemoryReactorClock
+from twisted.web.server import Site
 from twisted.python.usage import UsageError
 from twisted.python.filepath import FilePath
 from twisted.application.service import Service
@@ -19,14 +26,21 @@ from yaml import safe_dump, safe_load
 from ...testtools import StandardOptionsTestsMixin
 from ...volume.testtools import make_volume_options_tests
 from ...route import make_memory_network
+from ...route._iptables import DispatchNetwork, RestoreNetwork
 
 from ..script import (
-    ServeOptions, ServeScript,
-    ChangeStateOptions, ChangeStateScript,
+    DEFAULT_RESOURCE_LIMITS, AGENT_SOCKET, APPLIED_STATE, ServeOptions,
+    ServeScript, ChangeStateOptions, ChangeStateScript, AgentChangeStateScript,
     ReportStateOptions, ReportStateScript)
-from .._docker import FakeDockerClient, Unit
-from .._deploy import Deployer
+from .._agent import CONVERGE_INTERVAL
+from ..httpapi import convergence_site
+from .._docker import (
+    FakeDockerClient, Unit, CachingDockerClient, AsyncDockerClient,
+    DOCKER_THREADS)
+from .._deploy import Deployer, Resource, Sequentially
+from ...volume._ipc import standard_node
 from .._model import Application, Deployment, DockerImage, Node, AttachedVolume
+from .test_deploy import ProfilingDeployer
 
 from ...volume.testtools import create_volume_service
 
@@ -64,6 +78,7 @@ class ChangeStateScriptMainTests(SynchronousTestCase):
             """
             change_node_state_calls.append((desired_state,
                                             current_cluster_state, hostname))
+            return succeed(None)
 
         self.patch(
             Deployer, 'change_node_state', spy_change_node_state)
@@ -73,7 +88,11 @@ class ChangeStateScriptMainTests(SynchronousTestCase):
         expected_hostname = b'node1.example.com'
         options = dict(deployment=expected_deployment,
                        current=expected_current,
-                       hostname=expected_hostname)
+                       hostname=expected_hostname,
+                       concurrency=None, limits={})
+        options["applied-state"] = FilePath(self.mktemp())
+        options["docker-threads"] = DOCKER_THREADS
+        options["proxy-dispatch"] = False
         script.main(
             reactor=object(), options=options, volume_service=Service())
 
@@ -82,6 +101,204 @@ class ChangeStateScriptMainTests(SynchronousTestCase):
             change_node_state_calls
         )
 
+    def test_main_limits_deployer(self):
+        """
+        ``ChangeStateScript.main`` gives the ``Deployer`` a
+        ``ConcurrencyLimiter`` with the limits supplied on the command line.
+        """
+        script = ChangeStateScript()
+        limiters = []
+
+        def spy_change_node_state(self, desired_state, current_cluster_state,
+                                  hostname):
+            limiters.append(self.limiter)
+            return succeed(None)
+
+        self.patch(
+            Deployer, 'change_node_state', spy_change_node_state)
+
+        options = dict(deployment=object(), current=object(),
+                       hostname=b'node1.example.com',
+                       concurrency=10, limits={Resource.ZFS: 2})
+        options["applied-state"] = FilePath(self.mktemp())
+        options["docker-threads"] = DOCKER_THREADS
+        options["proxy-dispatch"] = False
+        script.main(
+            reactor=object(), options=options, volume_service=Service())
+        self.assertEqual(
+            [(10, {Resource.ZFS: 2})],
+            [(limiter.total, limiter.resources) for limiter in limiters])
+
+    def test_main_image_peers(self):
+        """
+        By default ``ChangeStateScript.main`` gives the ``Deployer`` a
+        ``DockerClient`` which copies images from the other nodes currently
+        running applications using them.
+        """
+        script = ChangeStateScript()
+        clients = []
+
+        def spy_change_node_state(self, desired_state, current_cluster_state,
+                                  hostname):
+            clients.append(self.docker_client)
+            return succeed(None)
+
+        self.patch(
+            Deployer, 'change_node_state', spy_change_node_state)
+
+        application = Application(
+            name=u'mysql-hybridcluster',
+            image=DockerImage.from_string(u'clusterhq/mysql:latest'))
+        current = Deployment(nodes=frozenset([
+            Node(hostname=u'node1.example.com',
+                 applications=frozenset([application])),
+            Node(hostname=u'node2.example.com',
+                 applications=frozenset([application])),
+            Node(hostname=u'node3.example.com',
+                 applications=frozenset()),
+        ]))
+        options = dict(deployment=object(), current=current,
+                       hostname=u'node1.example.com',
+                       concurrency=None, limits={})
+        options["applied-state"] = FilePath(self.mktemp())
+        options["docker-threads"] = DOCKER_THREADS
+        options["proxy-dispatch"] = False
+        script.main(
+            reactor=object(), options=options, volume_service=Service())
+        self.assertEqual(
+            [[standard_node(b'node2.example.com')], []],
+            [clients[0]._image_peers(u'clusterhq/mysql:latest'),
+             clients[0]._image_peers(u'clusterhq/postgres:latest')])
+
+    def test_main_docker_threads(self):
+        """
+        By default ``ChangeStateScript.main`` gives the ``Deployer`` an
+        ``AsyncDockerClient`` using the given reactor, which loads as many
+        images from other nodes at once as the command line allows.
+        """
+        script = ChangeStateScript()
+        clients = []
+
+        def spy_change_node_state(self, desired_state, current_cluster_state,
+                                  hostname):
+            clients.append(self.docker_client)
+            return succeed(None)
+
+        self.patch(
+            Deployer, 'change_node_state', spy_change_node_state)
+
+        options = dict(deployment=object(), current=Deployment(nodes=()),
+                       hostname=u'node1.example.com',
+                       concurrency=None, limits={})
+        options["applied-state"] = FilePath(self.mktemp())
+        options["docker-threads"] = 3
+        options["proxy-dispatch"] = False
+        reactor = object()
+        script.main(
+            reactor=reactor, options=options, volume_service=Service())
+        self.assertEqual(
+            [(AsyncDockerClient, 3, reactor)],
+            [(client.__class__, client._threads, client._reactor)
+             for client in clients])
+
+    def test_main_profile(self):
+        """
+        ``ChangeStateScript.main`` fires with the marshalled ``ChangeProfile``
+        of the changes it ran.
+        """
+        script = ChangeStateScript()
+
+        def spy_change_node_state(self, desired_state, current_cluster_state,
+                                  hostname):
+            return self.profile.run(Sequentially(changes=[]), self)
+
+        self.patch(
+            Deployer, 'change_node_state', spy_change_node_state)
+
+        options = dict(deployment=object(), current=object(),
+                       hostname=b'node1.example.com',
+                       concurrency=None, limits={})
+        options["applied-state"] = FilePath(self.mktemp())
+        options["docker-threads"] = DOCKER_THREADS
+        options["proxy-dispatch"] = False
+        result = script.main(
+            reactor=Clock(), options=options, volume_service=Service())
+        self.assertEqual(
+            [(u"<Sequentially(changes=[])>", True)],
+            [(timing[u"change"], timing[u"succeeded"])
+             for timing in self.successResultOf(result)])
+
+    def test_main_applied_state(self):
+        """
+        ``ChangeStateScript.main`` gives the ``Deployer`` an
+        ``AppliedStateStore`` using the file supplied on the command line.
+        """
+        script = ChangeStateScript()
+        stores = []
+
+        def spy_change_node_state(self, desired_state, current_cluster_state,
+                                  hostname):
+            stores.append(self.applied_state)
+            return succeed(None)
+
+        self.patch(
+            Deployer, 'change_node_state', spy_change_node_state)
+
+        path = FilePath(self.mktemp())
+        options = dict(deployment=object(), current=object(),
+                       hostname=b'node1.example.com',
+                       concurrency=None, limits={})
+        options["applied-state"] = path
+        options["docker-threads"] = DOCKER_THREADS
+        options["proxy-dispatch"] = False
+        script.main(
+            reactor=object(), options=options, volume_service=Service())
+        self.assertEqual([path], [store.path for store in stores])
+
+    def deployer_network(self, dispatch):
+        """
+        Run ``ChangeStateScript.main`` with its default network.
+
+        :param bool dispatch: The value of the ``proxy-dispatch`` option.
+
+        :return: The network of the ``Deployer``.
+        """
+        script = ChangeStateScript()
+        networks = []
+
+        def spy_change_node_state(self, desired_state, current_cluster_state,
+                                  hostname):
+            networks.append(self.network)
+            return succeed(None)
+
+        self.patch(
+            Deployer, 'change_node_state', spy_change_node_state)
+
+        options = dict(deployment=object(), current=object(),
+                       hostname=b'node1.example.com',
+                       concurrency=None, limits={})
+        options["applied-state"] = FilePath(self.mktemp())
+        options["docker-threads"] = DOCKER_THREADS
+        options["proxy-dispatch"] = dispatch
+        script.main(
+            reactor=Clock(), options=options, volume_service=Service())
+        [network] = networks
+        return network
+
+    def test_main_network(self):
+        """
+        By default ``ChangeStateScript.main`` gives the ``Deployer`` a
+        ``RestoreNetwork``.
+        """
+        self.assertIs(RestoreNetwork, self.deployer_network(False).__class__)
+
+    def test_main_proxy_dispatch(self):
+        """
+        With ``proxy-dispatch``, ``ChangeStateScript.main`` gives the
+        ``Deployer`` a ``DispatchNetwork``, like ``flocker-serve`` does.
+        """
+        self.assertIsInstance(self.deployer_network(True), DispatchNetwork)
+
 
 class StandardChangeStateOptionsTests(
         make_volume_options_tests(
@@ -293,6 +510,96 @@ class ChangeStateOptionsTests(StandardOptionsTestsMixin, SynchronousTestCase):
             (options['hostname'], type(options['hostname']))
         )
 
+    def test_default_limits(self):
+        """
+        By default there is no overall limit on concurrent state changes and
+        resources have the default limits.
+        """
+        options = self.options()
+        options.parseOptions(
+            [b'{nodes: {}, version: 1}',
+             b'{applications: {}, version: 1}',
+             b'{}',
+             b'node1.example.com'])
+        self.assertEqual((None, DEFAULT_RESOURCE_LIMITS),
+                         (options["concurrency"], options["limits"]))
+
+    def test_limits(self):
+        """
+        ``--concurrency`` sets the overall limit on concurrent state changes
+        and ``--limit`` sets the limit for a resource, leaving the others
+        with their defaults.
+        """
+        options = self.options()
+        options.parseOptions(
+            [b'--concurrency', b'20', b'--limit', b'docker=3',
+             b'--limit', b'network=1',
+             b'{nodes: {}, version: 1}',
+             b'{applications: {}, version: 1}',
+             b'{}',
+             b'node1.example.com'])
+        expected = DEFAULT_RESOURCE_LIMITS.copy()
+        expected.update({Resource.DOCKER: 3, Resource.NETWORK: 1})
+        self.assertEqual((20, expected),
+                         (options["concurrency"], options["limits"]))
+
+    def test_default_docker_threads(self):
+        """
+        By default up to ``DOCKER_THREADS`` blocking Docker API calls are made
+        at once.
+        """
+        options = self.options()
+        options.parseOptions(
+            [b'{nodes: {}, version: 1}',
+             b'{applications: {}, version: 1}',
+             b'{}',
+             b'node1.example.com'])
+        self.assertEqual(DOCKER_THREADS, options["docker-threads"])
+
+    def test_docker_threads(self):
+        """
+        ``--docker-threads`` sets how many blocking Docker API calls are made
+        at once.
+        """
+        options = self.options()
+        options.parseOptions(
+            [b'--docker-threads', b'4',
+             b'{nodes: {}, version: 1}',
+             b'{applications: {}, version: 1}',
+             b'{}',
+             b'node1.example.com'])
+        self.assertEqual(4, options["docker-threads"])
+
+    def test_invalid_docker_threads(self):
+        """
+        A ``UsageError`` is raised if ``--docker-threads`` isn't a positive
+        integer.
+        """
+        for value in [b'x', b'0']:
+            options = self.options()
+            self.assertRaises(
+                UsageError, options.parseOptions,
+                [b'--docker-threads', value,
+                 b'{nodes: {}, version: 1}',
+                 b'{applications: {}, version: 1}',
+                 b'{}',
+                 b'node1.example.com'])
+
+    def test_invalid_limit(self):
+        """
+        A ``UsageError`` is raised if ``--limit`` names an unknown resource
+        or gives a limit which isn't a positive integer.
+        """
+        for value in [b'docker', b'cpu=3', b'docker=x', b'docker=0']:
+            options = self.options()
+            self.assertRaises(
+                UsageError, options.parseOptions,
+                [b'--limit', value,
+                 b'{nodes: {}, version: 1}',
+                 b'{applications: {}, version: 1}',
+                 b'{}',
+                 b'node1.example.com'])
+
     def test_nonascii_hostname(self):
         """
         A ``UsageError`` is raised if the supplied hostname is not ASCII
@@ -314,6 +621,267 @@ class ChangeStateOptionsTests(StandardOptionsTestsMixin, SynchronousTestCase):
             str(e)
         )
 
+    def test_raw_configuration(self):
+        """
+        The configuration strings are also kept unparsed, so they can be
+        handed on to the ``flocker-serve`` agent, whose socket defaults to
+        ``AGENT_SOCKET``.
+        """
+        arguments = [b'{nodes: {}, version: 1}',
+                     b'{applications: {}, version: 1}',
+                     b'{}']
+        options = self.options()
+        options.parseOptions(arguments + [b'node1.example.com'])
+        self.assertEqual(
+            (arguments, AGENT_SOCKET),
+            ([options["deployment_config"], options["application_config"],
+              options["current_config"]], options["agent-socket"]))
+
+    def test_profile(self):
+        """
+        ``--profile`` asks for how long each state change took to be written
+        to standard output, which isn't done by default.
+        """
+        arguments = [b'{nodes: {}, version: 1}',
+                     b'{applications: {}, version: 1}',
+                     b'{}', b'node1.example.com']
+        default = self.options()
+        default.parseOptions(arguments)
+        profiling = self.options()
+        profiling.parseOptions([b'--profile'] + arguments)
+        self.assertEqual((False, True),
+                         (default["profile"], profiling["profile"]))
+
+    def test_default_applied_state(self):
+        """
+        By default the configuration the node was last changed to match is
+        recorded in ``APPLIED_STATE``.
+        """
+        options = self.options()
+        options.parseOptions(
+            [b'{nodes: {}, version: 1}', b'{applications: {}, version: 1}',
+             b'{}', b'node1.example.com'])
+        self.assertEqual(APPLIED_STATE, options["applied-state"])
+
+    def test_applied_state(self):
+        """
+        ``--applied-state`` gives the file in which to record the
+        configuration the node was last changed to match.
+        """
+        path = FilePath(self.mktemp())
+        options = self.options()
+        options.parseOptions(
+            [b'--applied-state', path.path,
+             b'{nodes: {}, version: 1}', b'{applications: {}, version: 1}',
+             b'{}', b'node1.example.com'])
+        self.assertEqual(path, options["applied-state"])
+
+    def test_proxy_dispatch(self):
+        """
+        ``--proxy-dispatch`` chooses ipset dispatch for the node's proxies,
+        which is off by default.
+        """
+        arguments = [b'{nodes: {}, version: 1}',
+                     b'{applications: {}, version: 1}',
+                     b'{}', b'node1.example.com']
+        default = self.options()
+        default.parseOptions(arguments)
+        dispatch = self.options()
+        dispatch.parseOptions([b'--proxy-dispatch'] + arguments)
+        self.assertEqual((False, True),
+                         (default["proxy-dispatch"],
+                          dispatch["proxy-dispatch"]))
+
+
+class RecordingAgent(object):
+    """
+    A stand-in for ``ConvergenceAgent`` which records the desired states it
+    is given.
+
+    :ivar list states: The arguments of each call to ``set_desired_state``.
+    :ivar deployer: A stand-in for the ``Deployer`` of the agent, with an
+        empty ``ChangeProfile``.
+    """
+    def __init__(self, result=None):
+        """
+        :param result: The ``Deferred`` to return from ``set_desired_state``,
+            or ``None`` to return one which has succeeded.
+        """
+        self.states = []
+        self._result = result
+        self.deployer = ProfilingDeployer()
+
+    def set_desired_state(self, desired_state, current_cluster_state,
+                          hostname):
+        self.states.append((desired_state, current_cluster_state, hostname))
+        if self._result is None:
+            return succeed(self.deployer.profile)
+        return self._result
+
+
+class RecordingScript(object):
+    """
+    A stand-in for an ``ICommandLineScript`` which records its calls.
+
+    :ivar list calls: The arguments of each call to ``main``.
+    """
+    def __init__(self, result=None):
+        """
+        :param result: The result with which ``main`` fires.
+        """
+        self.calls = []
+        self._result = result
+
+    def main(self, reactor, options):
+        self.calls.append((reactor, options))
+        return succeed(self._result)
+
+
+class AgentChangeStateScriptTests(TestCase):
+    """
+    Tests for ``AgentChangeStateScript``.
+    """
+    def setUp(self):
+        # UNIX socket paths are limited to about 100 bytes, too few for a
+        # path within the test's temporary directory:
+        directory = FilePath(mkdtemp())
+        self.addCleanup(directory.remove)
+        self.socket = directory.child(b"agent.sock")
+        self.options = ChangeStateOptions()
+        self.options.parseOptions([
+            b"--agent-socket", self.socket.path,
+            safe_dump({u"nodes": {u"node1.example.com": []}, u"version": 1}),
+            b'{applications: {}, version: 1}',
+            b'{}',
+            b'node1.example.com'])
+
+    def listen(self, agent):
+        """
+        Serve the agent API on the test's socket.
+
+        :param agent: The stand-in ``ConvergenceAgent`` to serve.
+        """
+        port = reactor.listenUNIX(self.socket.path, convergence_site(agent))
+        self.addCleanup(port.stopListening)
+
+    def test_no_agent(self):
+        """
+        If the agent's socket doesn't exist the state is changed directly.
+        """
+        local = RecordingScript()
+        script = AgentChangeStateScript(local)
+        self.successResultOf(script.main(reactor, self.options))
+        self.assertEqual([(reactor, self.options)], local.calls)
+
+    def test_agent(self):
+        """
+        If the agent is listening on its socket it is given the new desired
+        state and the state isn't changed directly.
+        """
+        agent = RecordingAgent()
+        self.listen(agent)
+        local = RecordingScript()
+        d = AgentChangeStateScript(local).main(reactor, self.options)
+
+        def changed(result):
+            self.assertEqual(
+                (None, [], [(self.options["deployment"],
+                             self.options["current"], u"node1.example.com")]),
+                (result, local.calls, agent.states))
+        d.addCallback(changed)
+        return d
+
+    def test_stale_socket(self):
+        """
+        If the agent's socket exists but nothing is listening on it, e.g.
+        because ``flocker-serve`` crashed, the state is changed directly.
+        """
+        stale = socket(AF_UNIX)
+        stale.bind(self.socket.path)
+        stale.close()
+        local = RecordingScript()
+        d = AgentChangeStateScript(local).main(reactor, self.options)
+
+        def changed(result):
+            self.assertEqual((None, [(reactor, self.options)]),
+                             (result, local.calls))
+        d.addCallback(changed)
+        return d
+
+    def test_local_only_options(self):
+        """
+        If the agent's socket exists, ``--concurrency``, ``--limit``,
+        ``--docker-threads`` and ``--applied-state``, which the agent doesn't
+        use, are rejected with
+        ``SystemExit`` and the state isn't changed.
+        """
+        self.socket.touch()
+        options = ChangeStateOptions()
+        options.parseOptions([
+            b"--agent-socket", self.socket.path, b"--concurrency", b"2",
+            b"--limit", b"docker=1", b"--docker-threads", b"2",
+            b"--applied-state", b"/tmp/applied",
+            safe_dump({u"nodes": {u"node1.example.com": []}, u"version": 1}),
+            b'{applications: {}, version: 1}',
+            b'{}',
+            b'node1.example.com'])
+        local = RecordingScript()
+        failure = self.failureResultOf(
+            AgentChangeStateScript(local).main(reactor, options), SystemExit)
+        self.assertEqual(
+            (b"--concurrency, --limit, --docker-threads, --applied-state "
+             b"can't be used while "
+             b"flocker-serve is running on this node; it uses its own "
+             b"options.", []),
+            (failure.value.args[0], local.calls))
+
+    def test_agent_fails(self):
+        """
+        If the agent fails to converge on the new state the script fails with
+        ``SystemExit``.
+        """
+        self.listen(RecordingAgent(result=fail(ZeroDivisionError())))
+        d = AgentChangeStateScript(RecordingScript()).main(
+            reactor, self.options)
+        d = self.assertFailure(d, SystemExit)
+        d.addCallback(lambda _: self.flushLoggedErrors(ZeroDivisionError))
+        return d
+
+    def test_profile(self):
+        """
+        With ``--profile``, the marshalled ``ChangeProfile`` with which the
+        local script fires is written to standard output as JSON.
+        """
+        self.options[b"profile"] = True
+        local = RecordingScript(result=[{u"change": u"StopApplication()"}])
+        script = AgentChangeStateScript(local)
+        output = StringIO()
+        self.patch(script, "_stdout", output)
+        self.assertIs(None, self.successResultOf(
+            script.main(reactor, self.options)))
+        self.assertEqual([{u"change": u"StopApplication()"}],
+                         loads(output.getvalue()))
+
+    def test_agent_profile(self):
+        """
+        With ``--profile``, the marshalled ``ChangeProfile`` of the agent's
+        convergence is written to standard output as JSON.
+        """
+        self.options[b"profile"] = True
+        agent = RecordingAgent()
+        agent.deployer.profile.run(Sequentially(changes=[]), agent.deployer)
+        self.listen(agent)
+        script = AgentChangeStateScript(RecordingScript())
+        output = StringIO()
+        self.patch(script, "_stdout", output)
+        d = script.main(reactor, self.options)
+
+        def changed(_):
+            self.assertEqual(agent.deployer.profile.marshal(),
+                             loads(output.getvalue()))
+        d.addCallback(changed)
+        return d
+
 
 class StandardReportStateOptionsTests(
         make_volume_options_tests(ReportStateOptions)):
@@ -377,6 +945,7 @@ class ReportStateScriptMainTests(SynchronousTestCase):
 
         expected = {
             'used_ports': sorted(used_ports),
+            'running': ['site-example.com'],
             'applications': {
                 'site-example.net': {'image': unit2.container_image},
                 'site-example.com': {'image': unit1.container_image}
@@ -399,12 +968,13 @@ from twisted.internet.base import _ThreePhaseEvent
 
 
 @implementer(IReactorCore)
-class MemoryCoreReactor(object):
+class MemoryCoreReactor(MemoryReactorClock):
     """
     Just enough of an implementation of IReactorCore to pass to
     ``_main_for_service`` in the unit tests.
     """
     def __init__(self):
+        MemoryReactorClock.__init__(self)
         self._triggers = {}
 
     def addSystemEventTrigger(self, phase, eventType, callable, *args, **kw):
@@ -444,10 +1014,18 @@ class ServeScriptMainTests(SynchronousTestCase):
     def setUp(self):
         self.reactor = MemoryCoreReactor()
         self.service = Service()
-        self.script = ServeScript()
+        self.script = ServeScript(docker_client=FakeDockerClient(),
+                                  network=make_memory_network())
+        self.socket = FilePath(self.mktemp()).child(b"agent.sock")
+        self.options = ServeOptions()
+        self.applied_state = FilePath(self.mktemp())
+        self.options.parseOptions([b"--agent-socket", self.socket.path,
+                                   b"--converge-interval", b"15",
+                                   b"--applied-state",
+                                   self.applied_state.path])
 
     def main(self, reactor, service):
-        return self.script.main(reactor, {}, service)
+        return self.script.main(reactor, self.options, service)
 
     def _shutdown_reactor(self, reactor):
         """
@@ -512,9 +1090,176 @@ class ServeScriptMainTests(SynchronousTestCase):
         async.callback(None)
         self.assertIs(None, self.successResultOf(result))
 
+    def test_agent_api_listening(self):
+        """
+        ``ServeScript.main`` serves the convergence agent's HTTP API on the
+        UNIX socket given by the options, which only root may use.
+        """
+        self.main(self.reactor, self.service)
+        [(address, factory, backlog, mode, want_pid)] = (
+            self.reactor.unixServers)
+        self.assertEqual(
+            (self.socket.path, 0600, True, Site),
+            (address, mode, want_pid, factory.__class__))
+
+    def test_agent_converges_periodically(self):
+        """
+        ``ServeScript.main`` starts a convergence agent which converges at the
+        interval given by the options.
+        """
+        self.main(self.reactor, self.service)
+        self.assertEqual([15], [call.getTime()
+                                for call in self.reactor.getDelayedCalls()])
+
+    def test_agent_applied_state(self):
+        """
+        ``ServeScript.main`` gives the convergence agent's ``Deployer`` an
+        ``AppliedStateStore`` using the file given by the options.
+        """
+        deployers = []
+        original_init = Deployer.__init__
+
+        def spy_init(deployer, *args, **kwargs):
+            original_init(deployer, *args, **kwargs)
+            deployers.append(deployer)
+        self.patch(Deployer, "__init__", spy_init)
+        self.main(self.reactor, self.service)
+        self.assertEqual([self.applied_state],
+                         [deployer.applied_state.path
+                          for deployer in deployers])
+
+    def test_default_docker_client(self):
+        """
+        By default ``ServeScript.main`` gives the convergence agent's
+        ``Deployer`` a ``CachingDockerClient`` which runs for as long as the
+        process does.
+        """
+        self.patch(CachingDockerClient, "_start_thread", lambda self, f: None)
+        deployers = []
+        original_init = Deployer.__init__
+
+        def spy_init(deployer, *args, **kwargs):
+            original_init(deployer, *args, **kwargs)
+            deployers.append(deployer)
+        self.patch(Deployer, "__init__", spy_init)
+        script = ServeScript(network=make_memory_network())
+        script.main(self.reactor, self.options, self.service)
+        [docker_client] = [deployer.docker_client for deployer in deployers]
+        self.assertEqual((CachingDockerClient, True),
+                         (docker_client.__class__, docker_client.running))
+
+    def test_async_docker_client(self):
+        """
+        With ``--async-docker``, ``ServeScript.main`` gives the convergence
+        agent's ``Deployer`` an ``AsyncDockerClient`` using the given reactor,
+        which loads as many images from other nodes at once as
+        ``--docker-threads`` allows.
+        """
+        deployers = []
+        original_init = Deployer.__init__
+
+        def spy_init(deployer, *args, **kwargs):
+            original_init(deployer, *args, **kwargs)
+            deployers.append(deployer)
+        self.patch(Deployer, "__init__", spy_init)
+        options = ServeOptions()
+        options.parseOptions([b"--agent-socket", self.socket.path,
+                              b"--async-docker", b"--docker-threads", b"5"])
+        script = ServeScript(network=make_memory_network())
+        script.main(self.reactor, options, self.service)
+        [docker_client] = [deployer.docker_client for deployer in deployers]
+        self.assertEqual(
+            (AsyncDockerClient, 5, self.reactor),
+            (docker_client.__class__, docker_client._threads,
+             docker_client._reactor))
+
+    def deployer_network(self, arguments):
+        """
+        Run ``ServeScript.main`` with no network given.
+
+        :param list arguments: Extra command line arguments.
+
+        :return: The network of the convergence agent's ``Deployer``.
+        """
+        deployers = []
+        original_init = Deployer.__init__
+
+        def spy_init(deployer, *args, **kwargs):
+            original_init(deployer, *args, **kwargs)
+            deployers.append(deployer)
+        self.patch(Deployer, "__init__", spy_init)
+        options = ServeOptions()
+        options.parseOptions([b"--agent-socket", self.socket.path,
+                              b"--applied-state",
+                              self.applied_state.path] + arguments)
+        script = ServeScript(docker_client=FakeDockerClient())
+        script.main(self.reactor, options, self.service)
+        [network] = [deployer.network for deployer in deployers]
+        return network
+
+    def test_default_docker_client_threads(self):
+        """
+        The default ``CachingDockerClient`` makes as many blocking calls at
+        once as ``--docker-threads`` allows, delivering their results in the
+        given reactor.
+        """
+        self.patch(CachingDockerClient, "_start_thread", lambda self, f: None)
+        deployers = []
+        original_init = Deployer.__init__
+
+        def spy_init(deployer, *args, **kwargs):
+            original_init(deployer, *args, **kwargs)
+            deployers.append(deployer)
+        self.patch(Deployer, "__init__", spy_init)
+        options = ServeOptions()
+        options.parseOptions([b"--agent-socket", self.socket.path,
+                              b"--docker-threads", b"5"])
+        script = ServeScript(network=make_memory_network())
+        script.main(self.reactor, options, self.service)
+        [workers] = [deployer.docker_client.workers for deployer in deployers]
+        self.assertEqual((5, self.reactor), (workers.size, workers._reactor))
+
+    def test_default_network(self):
+        """
+        By default ``ServeScript.main`` gives the convergence agent's
+        ``Deployer`` a ``RestoreNetwork``.
+        """
+        self.assertIs(RestoreNetwork, self.deployer_network([]).__class__)
+
+    def test_proxy_dispatch(self):
+        """
+        With ``--proxy-dispatch``, ``ServeScript.main`` gives the convergence
+        agent's ``Deployer`` a ``DispatchNetwork``.
+        """
+        self.assertIsInstance(self.deployer_network([b"--proxy-dispatch"]),
+                              DispatchNetwork)
+
 
 class StandardServeOptionsTests(
         make_volume_options_tests(ServeOptions)):
     """
     Tests for the volume configuration arguments of ``ServeOptions``.
     """
+
+
+class ServeOptionsTests(SynchronousTestCase):
+    """
+    Tests for ``ServeOptions``.
+    """
+    def test_defaults(self):
+        """
+        By default the agent listens on ``AGENT_SOCKET``, converges every
+        ``CONVERGE_INTERVAL`` seconds, uses the default resource limits and
+        number of Docker threads and records the configuration it last
+        applied in ``APPLIED_STATE``, without proxy dispatch or the
+        ``AsyncDockerClient``.
+        """
+        options = ServeOptions()
+        options.parseOptions([])
+        self.assertEqual(
+            (AGENT_SOCKET, CONVERGE_INTERVAL, DEFAULT_RESOURCE_LIMITS,
+             DOCKER_THREADS, APPLIED_STATE, False, False),
+            (options["agent-socket"], options["converge-interval"],
+             options["limits"], options["docker-threads"],
+             options["applied-state"], options["proxy-dispatch"],
+             options["async-docker"]))
@@ -16,10 +16,11 @@ this allows easy, transparent migration of containers between any of the
 cooperating nodes.
 """
 
-__all__ = ["INetwork", "make_host_network", "make_memory_network", "Proxy"]
+__all__ = ["INetwork", "ITransactionalNetwork", "make_host_network",
+           "make_memory_network", "Proxy"]
 
 
-from ._interfaces import INetwork
+from ._interfaces import INetwork, ITransactionalNetwork
 from ._iptables import make_host_network
 from ._memory import make_memory_network
 from ._model import Proxy
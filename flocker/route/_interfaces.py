@@ -56,3 +56,19 @@ class INetwork(Interface):
             ports with server listening on them as well as TCP ports owned by
             proxies created by this ``INetwork`` provider.
         """
+
+
+class ITransactionalNetwork(INetwork):
+    """
+    An ``INetwork`` which can change all of its proxies at once.
+    """
+    def set_proxies(proxies):
+        """
+        Create and delete proxies so that exactly the given ones exist,
+        applying all of the changes together.
+
+        :param proxies: A collection of ``Proxy`` instances.
+
+        :return: A ``Deferred`` which fires with ``None`` once the proxies
+            have been changed.
+        """
@@ -7,22 +7,57 @@ Manipulate network routing behavior on a node using ``iptables``.
 
 from __future__ import unicode_literals
 
+import os
 import shlex
-from subprocess import check_call, check_output
+from subprocess import (
+    PIPE, CalledProcessError, Popen, check_call, check_output)
 
 from zope.interface import implementer
 from ipaddr import IPAddress
 from characteristic import attributes
 from eliot import Logger
-from psutil import net_connections
+from eliot.twisted import DeferredContext
+from twisted.internet.defer import Deferred, succeed
+from twisted.internet.error import ProcessDone
+from twisted.internet.protocol import ProcessProtocol
 from twisted.python.filepath import FilePath
 
-from ._logging import CREATE_PROXY_TO, DELETE_PROXY, IPTABLES
-from ._interfaces import INetwork
+from ._logging import (
+    CREATE_PROXY_TO, DELETE_PROXY, IPTABLES, IPTABLES_RESTORE, IPSET_RESTORE,
+    SET_PROXIES)
+from ._interfaces import INetwork, ITransactionalNetwork
 from ._model import Proxy
 
 FLOCKER_COMMENT_MARKER = b"flocker create_proxy_to"
 
+# The comment of a rule at the start of Flocker's PREROUTING chain which
+# records that the chains have been set up: the jumps to them added and the
+# rules of proxies created before Flocker had its own chains moved into
+# them.  It has no target, so it doesn't affect packets.  Finding it means
+# only Flocker's chain needs to be read:
+FLOCKER_SETUP_MARKER = b"flocker chains ready"
+SETUP_RULE = [b"--match", b"comment", b"--comment", FLOCKER_SETUP_MARKER]
+
+# The NAT table chains which hold Flocker's rules, each reached by a single
+# jump from the built-in chain it is named after.  Keeping the rules apart
+# means finding them doesn't involve reading anyone else's, and all of them
+# can be replaced by flushing these chains:
+FLOCKER_CHAINS = [
+    (b"PREROUTING", b"FLOCKER-PREROUTING"),
+    (b"OUTPUT", b"FLOCKER-OUTPUT"),
+    (b"POSTROUTING", b"FLOCKER-POSTROUTING"),
+]
+
+# In dispatch mode, the ipset holding every proxied port, and the prefix of
+# the names of the ipsets holding the ports proxied to each destination.
+# The rest of such a name is the destination's IPv4 address in hex, which
+# keeps it within ipset's 31 character limit:
+PORTS_SET = b"flocker-ports"
+DESTINATION_SET_PREFIX = b"flocker-to-"
+
+# Any TCP port can be looked up in a set of this type in constant time:
+_SET_TYPE = b"bitmap:port range 0-65535"
+
 
 @attributes(["comment", "destination_port", "to_destination"])
 class RuleOptions(object):
@@ -56,6 +91,7 @@ def create_proxy_to(logger, ip, port):
         logger=logger, target_ip=ip, target_port=port)
 
     with action:
+        ensure_flocker_chains(logger)
         encoded_ip = unicode(ip).encode("ascii")
         encoded_port = unicode(port).encode("ascii")
 
@@ -71,8 +107,9 @@ def create_proxy_to(logger, ip, port):
             # Destination NAT has to happen "pre"-routing so that the normal
             # routing rules on the machine will use the re-written destination
             # address and get the packet to that new destination.  Accomplish
-            # this by appending the rule to the PREROUTING chain.
-            b"--append", b"PREROUTING",
+            # this by appending the rule to Flocker's chain reached from the
+            # PREROUTING chain.
+            b"--append", b"FLOCKER-PREROUTING",
 
             # Only re-route traffic with a destination port matching the one we
             # were told to manipulate.  It is also necessary to specify TCP (or
@@ -118,8 +155,9 @@ def create_proxy_to(logger, ip, port):
 
             # As described above, this transformation happens after routing
             # decisions have been made and the packet is on its way out of the
-            # system.  Therefore, append the rule to the POSTROUTING chain.
-            b"--append", b"POSTROUTING",
+            # system.  Therefore, append the rule to Flocker's chain reached
+            # from the POSTROUTING chain.
+            b"--append", b"FLOCKER-POSTROUTING",
 
             # We'll stick to matching the same kinds of packets we matched in
             # the earlier stage.  We might want to change the factoring of this
@@ -143,8 +181,9 @@ def create_proxy_to(logger, ip, port):
             # All NAT stuff happens in the netfilter NAT table.
             b"--table", b"nat",
 
-            # As mentioned, this rule is for the OUTPUT chain.
-            b"--append", b"OUTPUT",
+            # As mentioned, this rule is for the OUTPUT chain (by way of
+            # Flocker's chain).
+            b"--append", b"FLOCKER-OUTPUT",
 
             # Matching the exact same kinds of packets as the PREROUTING rule
             # matches.
@@ -156,54 +195,241 @@ def create_proxy_to(logger, ip, port):
             b"--jump", b"DNAT", b"--to-destination", encoded_ip,
         ])
 
-        # The network stack only considers forwarding traffic when certain
-        # system configuration is in place.
-        #
-        # https://www.kernel.org/doc/Documentation/networking/ip-sysctl.txt
-        # will explain the meaning of these in (very slightly) more detail.
-        conf = FilePath(b"/proc/sys/net/ipv4/conf")
-        descendant = conf.descendant([b"default", b"forwarding"])
-        with descendant.open("wb") as forwarding:
-            forwarding.write(b"1")
-
-        # In order to have the OUTPUT chain DNAT rule affect routing decisions,
-        # we also need to tell the system to make routing decisions about
-        # traffic from or to localhost.
-        for path in conf.children():
-            with path.child(b"route_localnet").open("wb") as route_localnet:
-                route_localnet.write(b"1")
+        enable_forwarding(IPV4_CONF)
 
         return Proxy(ip=ip, port=port)
 
 
-def delete_proxy(logger, proxy):
+# The per-interface IPv4 network configuration of the system:
+IPV4_CONF = FilePath(b"/proc/sys/net/ipv4/conf")
+
+# The kernel's tables of sockets, by protocol:
+PROC_NET = FilePath(b"/proc/net")
+
+# How many seconds ``RestoreNetwork`` reuses the proxies and used ports it
+# found, unless it changes the proxies itself in the meantime:
+CACHE_TTL = 2
+
+
+def used_tcp_ports(proc_net):
     """
-    :see: ``HostNetwork.delete_proxy``
+    Find the local ports of all IPv4 and IPv6 TCP sockets, listening or
+    connected, by reading the kernel's socket tables directly.
+
+    Sockets in every state are included, not just listening ones: a proxy
+    on the local port of an outgoing connection would capture that
+    connection's traffic.
+
+    Unlike ``psutil.net_connections``, this doesn't look through every
+    process's file descriptors to find which process owns each socket.
+
+    :param FilePath proc_net: The directory holding the ``tcp`` and
+        ``tcp6`` tables, normally ``PROC_NET``.
+
+    :return: A ``set`` of ``int`` port numbers.
+    """
+    ports = set()
+    for name in [b"tcp", b"tcp6"]:
+        table = proc_net.child(name)
+        try:
+            content = table.getContent()
+        except IOError:
+            # IPv6 may be disabled:
+            continue
+        # Lines after the header look like:
+        #
+        #   0: 0100007F:1F90 00000000:0000 0A 00000000:00000000 00:00000000 ...
+        #
+        # where the local address is the IP and port, in hex.
+        for line in content.splitlines()[1:]:
+            fields = line.split()
+            if len(fields) > 1:
+                ports.add(int(fields[1].rsplit(b":", 1)[1], 16))
+    return ports
+
+
+def enable_forwarding(conf):
+    """
+    Configure the network stack to forward proxied traffic.
+
+    :param FilePath conf: The directory of per-interface IPv4
+        configuration, normally ``IPV4_CONF``.
+    """
+    # The network stack only considers forwarding traffic when certain
+    # system configuration is in place.
+    #
+    # https://www.kernel.org/doc/Documentation/networking/ip-sysctl.txt
+    # will explain the meaning of these in (very slightly) more detail.
+    descendant = conf.descendant([b"default", b"forwarding"])
+    with descendant.open("wb") as forwarding:
+        forwarding.write(b"1")
+
+    # In order to have the OUTPUT chain DNAT rule affect routing decisions,
+    # we also need to tell the system to make routing decisions about
+    # traffic from or to localhost.
+    for path in conf.children():
+        with path.child(b"route_localnet").open("wb") as route_localnet:
+            route_localnet.write(b"1")
+
+
+def missing_chains(output):
+    """
+    Find which of Flocker's chains, and the jumps to them, don't exist.
+
+    :param bytes output: The output of ``iptables-save --table nat``.
+
+    :return: A ``tuple`` of a ``list`` of the names of the missing chains and
+        a ``list`` of ``(built-in chain, Flocker chain)`` tuples for the
+        missing jumps.
+    """
+    lines = set(output.splitlines())
+    chains = []
+    jumps = []
+    for builtin, chain in FLOCKER_CHAINS:
+        if not any(line.startswith(b":" + chain + b" ") for line in lines):
+            chains.append(chain)
+        if b"-A %s -j %s" % (builtin, chain) not in lines:
+            jumps.append((builtin, chain))
+    return chains, jumps
+
+
+def legacy_proxies(output):
+    """
+    Find the proxies created before Flocker had its own chains, whose rules
+    are in the built-in chains.
+
+    :param bytes output: The output of ``iptables-save --table nat``.
+
+    :return: A ``list`` of ``Proxy`` instances.
+    """
+    return [Proxy(ip=options.to_destination, port=options.destination_port)
+            for options in parse_flocker_rules(output, b"PREROUTING")]
+
+
+def list_flocker_rules():
+    """
+    List the rules in Flocker's chain reached from ``PREROUTING``.
+
+    :return: The ``bytes`` output of ``iptables --list-rules`` for the
+        chain, or ``None`` if the chain doesn't exist.
+    """
+    with open(os.devnull, "wb") as discard:
+        try:
+            return check_output(
+                [b"iptables", b"--table", b"nat", b"--list-rules",
+                 flocker_chain(b"PREROUTING")], stderr=discard)
+        except CalledProcessError:
+            return None
+
+
+def setup_done(output):
+    """
+    :param bytes output: The output of ``iptables --list-rules`` for
+        Flocker's chain reached from ``PREROUTING``, or of ``iptables-save
+        --table nat``.
+
+    :return: ``True`` if Flocker's chains have been set up, as recorded by
+        the rule with ``FLOCKER_SETUP_MARKER``, otherwise ``False``.
+    """
+    prefix = b"-A " + flocker_chain(b"PREROUTING") + b" "
+    return any(line.startswith(prefix) and FLOCKER_SETUP_MARKER in line
+               for line in output.splitlines())
+
+
+def dispatching(output):
+    """
+    :param bytes output: The output of ``iptables --list-rules`` for
+        Flocker's chain reached from ``PREROUTING``.
+
+    :return: ``True`` if the chain holds the rules of ``DispatchNetwork``,
+        which look proxied ports up in Flocker's ipsets, otherwise
+        ``False``.
+    """
+    prefix = b"-A " + flocker_chain(b"PREROUTING") + b" "
+    return any(line.startswith(prefix) and
+               b"--match-set " + PORTS_SET + b" " in line
+               for line in output.splitlines())
+
+
+def ensure_flocker_chains(logger):
+    """
+    Create Flocker's chains and the jumps to them, if they don't exist, and
+    move the rules of proxies created before Flocker had its own chains
+    into them.
+
+    Once that has been done and recorded, only Flocker's chain reached from
+    ``PREROUTING`` is read to find that out, rather than the whole table.
+    """
+    listed = list_flocker_rules()
+    if listed is not None and setup_done(listed):
+        return
+    output = check_output([b"iptables-save", b"--table", b"nat"])
+    chains, jumps = missing_chains(output)
+    for chain in chains:
+        iptables(logger, [b"--table", b"nat", b"--new-chain", chain])
+    for builtin, chain in jumps:
+        iptables(logger,
+                 [b"--table", b"nat", b"--append", builtin, b"--jump", chain])
+    for proxy in legacy_proxies(output):
+        for builtin, rule in proxy_rules(proxy):
+            # Add the new rule before deleting the old one so the proxy
+            # keeps working throughout:
+            iptables(logger, [b"--table", b"nat", b"--append",
+                              flocker_chain(builtin)] + rule)
+            iptables(logger, [b"--table", b"nat", b"--delete", builtin] + rule)
+    iptables(logger, [b"--table", b"nat", b"--insert",
+                      flocker_chain(b"PREROUTING"), b"1"] + SETUP_RULE)
+
+
+def flocker_chain(builtin):
+    """
+    :param bytes builtin: The name of a built-in NAT chain.
+
+    :return: The name of Flocker's chain reached from it.
+    """
+    return dict(FLOCKER_CHAINS)[builtin]
+
+
+def proxy_rules(proxy):
+    """
+    Describe the NAT table rules which make a proxy work, as created by
+    ``create_proxy_to``.
+
+    :param Proxy proxy: The proxy.
+
+    :return: A ``list`` of ``(chain, rule)`` tuples, where ``chain`` is the
+        ``bytes`` name of the built-in chain whose Flocker chain holds the
+        rule and ``rule`` is a ``list`` of ``bytes`` iptables arguments
+        specifying it.
     """
     ip = unicode(proxy.ip).encode("ascii")
     port = unicode(proxy.port).encode("ascii")
-
-    commands = [
-        [b"--table", b"nat",
-         b"--delete", b"PREROUTING",
-         b"--protocol", b"tcp", b"--destination-port", port,
-         b"--match", b"addrtype", b"--dst-type", b"LOCAL",
-         b"--match", b"comment", b"--comment", FLOCKER_COMMENT_MARKER,
-         b"--jump", b"DNAT", b"--to-destination", ip],
-        [b"--table", b"nat",
-         b"--delete", b"POSTROUTING",
-         b"--protocol", b"tcp", b"--destination-port", port,
-         b"--jump", b"MASQUERADE"],
-        [b"--table", b"nat",
-         b"--delete", b"OUTPUT",
-         b"--protocol", b"tcp", b"--destination-port", port,
-         b"--match", b"addrtype", b"--dst-type", b"LOCAL",
-         b"--jump", b"DNAT", b"--to-destination", ip],
+    return [
+        (b"PREROUTING",
+         [b"--protocol", b"tcp", b"--destination-port", port,
+          b"--match", b"addrtype", b"--dst-type", b"LOCAL",
+          b"--match", b"comment", b"--comment", FLOCKER_COMMENT_MARKER,
+          b"--jump", b"DNAT", b"--to-destination", ip]),
+        (b"POSTROUTING",
+         [b"--protocol", b"tcp", b"--destination-port", port,
+          b"--jump", b"MASQUERADE"]),
+        (b"OUTPUT",
+         [b"--protocol", b"tcp", b"--destination-port", port,
+          b"--match", b"addrtype", b"--dst-type", b"LOCAL",
+          b"--jump", b"DNAT", b"--to-destination", ip]),
     ]
 
+
+def delete_proxy(logger, proxy):
+    """
+    :see: ``HostNetwork.delete_proxy``
+    """
     with DELETE_PROXY(logger, target_ip=proxy.ip, target_port=proxy.port):
-        for argv in commands:
-            iptables(logger, argv)
+        # The proxy may have been created before Flocker had its own chains:
+        ensure_flocker_chains(logger)
+        for chain, rule in proxy_rules(proxy):
+            iptables(logger, [b"--table", b"nat", b"--delete",
+                              flocker_chain(chain)] + rule)
 
 
 def enumerate_proxies():
@@ -211,42 +437,68 @@ def enumerate_proxies():
     Inspect the system's iptables configuration to determine what proxies
     currently exist.
 
+    Proxies set up by ``DispatchNetwork`` are found in Flocker's ipsets
+    whenever its rules are in Flocker's chains, whichever network does the
+    looking, so that any of them can replace those proxies.
+
     :see: :py:meth:`INetwork.enumerate_proxies` for parameter documentation.
     """
+    output = list_flocker_rules()
     proxies = []
-    for rule in get_flocker_rules():
+    for rule in get_flocker_rules(output):
         proxies.append(
             Proxy(ip=rule.to_destination, port=rule.destination_port))
 
+    if output is not None and dispatching(output):
+        proxies.extend(
+            proxy for proxy in parse_dispatch_sets(
+                check_output([b"ipset", b"save"]))
+            if proxy not in proxies)
     return proxies
 
 
-def get_flocker_rules():
+def get_flocker_rules(output):
     """
     Look up all of the iptables rules created/managed by flocker.
 
+    :param output: The output of ``list_flocker_rules``.
+
     :return: An iterator of :py:class:`Options` instances, one for each rule
         found.
     """
-    # Life is horrible.
-    # https://stackoverflow.com/questions/109553/how-can-i-programmatically-manage-iptables-rules-on-the-fly
-    # At least we know all the rules we need to inspect are in the NAT table.
-    output = check_output([b"iptables-save", b"--table", b"nat"])
-
-    # Find the beginning of the NAT table
-    header = b"*nat\n"
-    begin = output.find(header) + len(header)
-
-    # Find the end of the NAT table
-    footer = b"COMMIT\n"
-    end = output.find(footer, begin)
+    # Every proxy has a rule in Flocker's own chain, so only that needs to
+    # be read once the chains have been set up.  Until then the rules of
+    # proxies created before Flocker had its own chains are in the built-in
+    # one.
+    chain = flocker_chain(b"PREROUTING")
+    rules = []
+    if output is not None:
+        rules.extend(parse_flocker_rules(output, chain))
+        if setup_done(output):
+            return iter(rules)
+    rules.extend(parse_flocker_rules(
+        check_output([b"iptables", b"--table", b"nat", b"--list-rules",
+                      b"PREROUTING"]), b"PREROUTING"))
+    return iter(rules)
+
+
+def parse_flocker_rules(output, chain):
+    """
+    Find the iptables rules created/managed by flocker in one chain of the
+    output of ``iptables-save`` or ``iptables --list-rules``.
 
-    # Slice it out.
-    nat = output[begin:end]
+    :param bytes output: The output of ``iptables-save --table nat`` or
+        ``iptables --table nat --list-rules``.
+    :param bytes chain: The name of the chain.
 
-    for line in nat.splitlines():
-        if line.startswith(b":"):
-            # Skip these lines describing a chain or the table overall.
+    :return: An iterator of :py:class:`Options` instances, one for each rule
+        found.
+    """
+    prefix = b"-A " + chain + b" "
+    for line in output.splitlines():
+        if not line.startswith(prefix) or FLOCKER_COMMENT_MARKER not in line:
+            # Skip lines describing other chains or the table overall, and
+            # rules which can't be Flocker's, without parsing them.
             continue
 
         options = parse_iptables_options(shlex.split(line))
@@ -327,6 +579,8 @@ class HostNetwork(object):
 
     enumerate_proxies = staticmethod(enumerate_proxies)
 
+    proc_net = PROC_NET
+
     def enumerate_used_ports(self):
         """
         Find all ports that are in use on this node by normal TCP servers or by
@@ -335,23 +589,737 @@ class HostNetwork(object):
         :see: :meth:`INetwork.enumerate_used_ports` for parameter
             documentation.
         """
-        listening = set(
-            conn.laddr[1]
-            for conn
-            in net_connections(kind='tcp')
-        )
+        listening = used_tcp_ports(self.proc_net)
         proxied = set(
             proxy.port
             for proxy in self.enumerate_proxies()
         )
-        # net_connections won't tell us about ports bound by sockets that
+        # The kernel's tables won't tell us about ports bound by sockets that
         # haven't entered the TCP state graph yet.
         return frozenset(listening | proxied)
 
 
-def make_host_network():
+class IPTablesFailed(Exception):
+    """
+    An iptables command failed.
+
+    :ivar list argv: The command's argument list.
+    :ivar int status: Its exit status, or ``None`` if it was killed.
+    :ivar bytes errors: What it wrote to standard error.
+    """
+    def __init__(self, argv, status, errors):
+        Exception.__init__(self, argv, status, errors)
+        self.argv = argv
+        self.status = status
+        self.errors = errors
+
+
+class _CommandProtocol(ProcessProtocol):
+    """
+    Feed a process its input and collect its output.
+
+    :ivar Deferred result: Fires with the ``bytes`` the process wrote to
+        standard output once it exits successfully, or fails with
+        ``IPTablesFailed``.
+    """
+    def __init__(self, argv, stdin):
+        self.result = Deferred()
+        self._argv = argv
+        self._stdin = stdin
+        self._output = []
+        self._errors = []
+
+    def connectionMade(self):
+        self.transport.write(self._stdin)
+        self.transport.closeStdin()
+
+    def outReceived(self, data):
+        self._output.append(data)
+
+    def errReceived(self, data):
+        self._errors.append(data)
+
+    def processEnded(self, reason):
+        if reason.check(ProcessDone):
+            self.result.callback(b"".join(self._output))
+        else:
+            self.result.errback(IPTablesFailed(
+                self._argv, reason.value.exitCode, b"".join(self._errors)))
+
+
+def run_command(reactor, argv, stdin=b""):
+    """
+    Run a command without blocking.
+
+    :param reactor: An ``IReactorProcess`` provider.
+    :param list argv: The ``bytes`` argument list, starting with the name of
+        the executable.
+    :param bytes stdin: What to write to the command's standard input.
+
+    :return: A ``Deferred`` firing with the ``bytes`` the command wrote to
+        standard output, or failing with ``IPTablesFailed``.
+    """
+    protocol = _CommandProtocol(argv, stdin)
+    reactor.spawnProcess(protocol, argv[0], argv, env=os.environ)
+    return protocol.result
+
+
+def _restore_argument(argument):
+    """
+    Quote an argument for a line of ``iptables-restore`` input.
+    """
+    if b" " in argument:
+        return b'"' + argument + b'"'
+    return argument
+
+
+def _restore_rule(action, chain, rule):
+    """
+    Create a line of ``iptables-restore`` input changing a rule.
+
+    :param bytes action: ``b"-A"`` or ``b"-D"``.
+    :param bytes chain: The name of the chain.
+    :param list rule: The ``bytes`` arguments specifying the rule.
+    """
+    return b" ".join(
+        [action, chain] + [_restore_argument(argument) for argument in rule])
+
+
+def chain_setup(output):
+    """
+    Create ``iptables-restore`` input which adds any missing jumps to
+    Flocker's chains and deletes the rules of proxies created before Flocker
+    had its own chains.
+
+    :param bytes output: The output of ``iptables-save --table nat``.
+
+    :return: A ``list`` of ``bytes`` lines to include in the NAT table
+        section given to ``iptables-restore --noflush``, after Flocker's
+        chains are declared.
+    """
+    _, jumps = missing_chains(output)
+    lines = [_restore_rule(b"-A", builtin, [b"--jump", chain])
+             for builtin, chain in jumps]
+    for proxy in legacy_proxies(output):
+        lines.extend(_restore_rule(b"-D", chain, rule)
+                     for chain, rule in proxy_rules(proxy))
+    return lines
+
+
+def proxy_ruleset(proxies, setup=()):
+    """
+    Create ``iptables-restore`` input which replaces all of Flocker's NAT
+    rules with those for the given proxies.
+
+    :param proxies: A collection of the ``Proxy`` instances which should
+        exist.
+    :param setup: Lines from ``chain_setup`` to include, if Flocker's
+        chains may not be set up yet.
+
+    :return: ``bytes`` for ``iptables-restore --noflush``.  Declaring
+        Flocker's chains creates or flushes them, and the rules for every
+        proxy are then appended, all in a single transaction.
+    """
+    rules = []
+    for proxy in sorted(proxies):
+        rules.extend(proxy_rules(proxy))
+    return _ruleset(rules, setup)
+
+
+def _ruleset(rules, setup):
+    """
+    Create ``iptables-restore`` input which replaces all of Flocker's NAT
+    rules.
+
+    :param list rules: ``(chain, rule)`` tuples like those returned by
+        ``proxy_rules``, in the order to append them.
+    :param setup: Lines from ``chain_setup`` to include.
+
+    :return: ``bytes`` for ``iptables-restore --noflush``.
+    """
+    lines = [b"*nat"]
+    lines.extend(b":%s - [0:0]" % (chain,) for _, chain in FLOCKER_CHAINS)
+    lines.extend(setup)
+    lines.append(
+        _restore_rule(b"-A", flocker_chain(b"PREROUTING"), SETUP_RULE))
+    for chain, rule in rules:
+        lines.append(_restore_rule(b"-A", flocker_chain(chain), rule))
+    lines.append(b"COMMIT")
+    return b"\n".join(lines) + b"\n"
+
+
+def destination_set(ip):
+    """
+    :param ip: The IPv4 address proxied to, as ``unicode`` or an
+        ``IPv4Address``.
+
+    :return: The ``bytes`` name of the ipset holding the ports proxied to
+        ``ip`` in dispatch mode.
+    """
+    return DESTINATION_SET_PREFIX + b"%08x" % (int(IPAddress(ip)),)
+
+
+def _set_destination(name):
+    """
+    :param bytes name: The name of an ipset.
+
+    :return: The ``IPv4Address`` whose ports ipset ``name`` holds, or
+        ``None`` if it isn't one of Flocker's destination sets.
+    """
+    if not name.startswith(DESTINATION_SET_PREFIX):
+        return None
+    address = name[len(DESTINATION_SET_PREFIX):]
+    if len(address) != 8:
+        return None
+    try:
+        return IPAddress(int(address, 16))
+    except ValueError:
+        return None
+
+
+def destination_sets(output):
+    """
+    :param bytes output: The output of ``ipset list -name``.
+
+    :return: A ``frozenset`` of the names of Flocker's destination sets.
+    """
+    return frozenset(name for name in output.split()
+                     if _set_destination(name) is not None)
+
+
+def parse_dispatch_sets(output):
+    """
+    Find the proxies configured in dispatch mode.
+
+    :param bytes output: The output of ``ipset save``.
+
+    :return: A ``list`` of ``Proxy`` instances, one for each port in each of
+        Flocker's destination sets.
+    """
+    proxies = []
+    for line in output.splitlines():
+        words = line.split()
+        if len(words) != 3 or words[0] != b"add":
+            continue
+        ip = _set_destination(words[1])
+        if ip is not None:
+            proxies.append(Proxy(ip=ip, port=int(words[2])))
+    return proxies
+
+
+def dispatch_sets(proxies):
+    """
+    Create ``ipset restore`` input which makes Flocker's sets hold exactly
+    the ports of the given proxies.
+
+    Each set is filled in a staging set which is then swapped with it, so
+    rules matching the set never see it partly filled.
+
+    :param proxies: A collection of the ``Proxy`` instances which should
+        exist.
+
+    :return: ``bytes`` for ``ipset -exist restore``.
+    """
+    members = {PORTS_SET: set()}
+    for proxy in proxies:
+        members[PORTS_SET].add(proxy.port)
+        members.setdefault(destination_set(proxy.ip), set()).add(proxy.port)
+    lines = []
+    for name, ports in sorted(members.items()):
+        staging = name + b"-new"
+        lines.extend([b"create %s %s" % (name, _SET_TYPE),
+                      b"create %s %s" % (staging, _SET_TYPE),
+                      b"flush %s" % (staging,)])
+        lines.extend(b"add %s %d" % (staging, port) for port in sorted(ports))
+        lines.extend([b"swap %s %s" % (staging, name),
+                      b"destroy %s" % (staging,)])
+    return b"\n".join(lines) + b"\n"
+
+
+def _destroy_sets(names):
+    """
+    :param names: The names of the ipsets to destroy.
+
+    :return: ``bytes`` for ``ipset restore``.
+    """
+    return b"".join(b"destroy %s\n" % (name,) for name in sorted(names))
+
+
+def dispatch_rules(ip):
+    """
+    Describe the NAT table rules which, in dispatch mode, send connections
+    to any of the ports in a destination's set to that destination.
+
+    :param ip: The IPv4 address proxied to.
+
+    :return: A ``list`` of ``(chain, rule)`` tuples like those returned by
+        ``proxy_rules``.
+    """
+    match = [b"--protocol", b"tcp",
+             b"--match", b"set", b"--match-set", destination_set(ip), b"dst",
+             b"--match", b"addrtype", b"--dst-type", b"LOCAL"]
+    dnat = [b"--jump", b"DNAT",
+            b"--to-destination", unicode(ip).encode("ascii")]
+    return [
+        (b"PREROUTING",
+         match + [b"--match", b"comment", b"--comment",
+                  FLOCKER_COMMENT_MARKER] + dnat),
+        (b"OUTPUT", match + dnat),
+    ]
+
+
+def dispatch_ruleset(proxies, setup=()):
+    """
+    Create ``iptables-restore`` input which replaces all of Flocker's NAT
+    rules with those dispatching connections to the given proxies by
+    looking their ports up in Flocker's ipsets.
+
+    Connections to ports which aren't proxied leave Flocker's chains after
+    one lookup in ``PORTS_SET``, and the rest are matched by one rule per
+    destination, so the number of rules doesn't grow with the number of
+    proxies.
+
+    :param proxies: A collection of the ``Proxy`` instances which should
+        exist.
+    :param setup: Lines from ``chain_setup`` to include, if Flocker's
+        chains may not be set up yet.
+
+    :return: ``bytes`` for ``iptables-restore --noflush``.
+    """
+    skip = [b"--protocol", b"tcp",
+            b"--match", b"set", b"!", b"--match-set", PORTS_SET, b"dst",
+            b"--jump", b"RETURN"]
+    rules = [(b"PREROUTING", skip), (b"OUTPUT", skip)]
+    for ip in sorted({IPAddress(proxy.ip) for proxy in proxies}):
+        rules.extend(dispatch_rules(ip))
+    rules.append(
+        (b"POSTROUTING",
+         [b"--protocol", b"tcp",
+          b"--match", b"set", b"--match-set", PORTS_SET, b"dst",
+          b"--jump", b"MASQUERADE"]))
+    return _ruleset(rules, setup)
+
+
+@implementer(ITransactionalNetwork)
+class RestoreNetwork(HostNetwork):
+    """
+    An ``INetwork`` implementation which replaces all of its proxies at once
+    using a single ``iptables-restore`` transaction, without blocking.
+
+    The proxies and used ports found are reused for ``cache_ttl`` seconds,
+    so the several lookups made while planning changes to a node only read
+    the system's configuration once.  Changing the proxies through this
+    object discards them.
+
+    :ivar FilePath ipv4_conf: The per-interface IPv4 configuration to
+        enable forwarding in, normally ``IPV4_CONF``.
+    :ivar cache_ttl: How many seconds to reuse the proxies and used ports
+        for.
+    """
+    def __init__(self, reactor, ipv4_conf=IPV4_CONF, cache_ttl=CACHE_TTL):
+        """
+        :param reactor: The ``IReactorProcess`` and ``IReactorTime``
+            provider to run commands with.
+        :param FilePath ipv4_conf: See ``ipv4_conf``.
+        :param cache_ttl: See ``cache_ttl``.
+        """
+        self._reactor = reactor
+        self.ipv4_conf = ipv4_conf
+        self.cache_ttl = cache_ttl
+        self._chains_ready = False
+        # Whether Flocker's chains were found holding the rules of
+        # ``DispatchNetwork``, so that its ipsets need destroying once the
+        # rules have been replaced:
+        self._dispatched = False
+        # Maps the name of each cached lookup to when it expires and its
+        # result:
+        self._cache = {}
+
+    def _cached(self, name, lookup):
+        """
+        :param unicode name: The name of a lookup.
+        :param lookup: A no-argument callable doing the lookup.
+
+        :return: The result of ``lookup``, reused if it was called less than
+            ``cache_ttl`` seconds ago and the cache hasn't been discarded
+            since.
+        """
+        now = self._reactor.seconds()
+        expires, result = self._cache.get(name, (None, None))
+        if expires is None or now >= expires:
+            result = lookup()
+            self._cache[name] = (now + self.cache_ttl, result)
+        return result
+
+    def _read_proxies(self):
+        """
+        Read the proxies from the system's configuration, including those
+        created before Flocker had its own chains until they have been
+        moved, and those in Flocker's ipsets while its chains hold the rules
+        of ``DispatchNetwork``.
+
+        :return: A ``list`` of ``Proxy`` instances.
+        """
+        return enumerate_proxies()
+
+    def enumerate_proxies(self):
+        """
+        :see: :meth:`INetwork.enumerate_proxies` for parameter documentation.
+        """
+        return list(self._cached(u"proxies", self._read_proxies))
+
+    def enumerate_used_ports(self):
+        """
+        :see: ``HostNetwork.enumerate_used_ports``
+        """
+        return self._cached(
+            u"used_ports", lambda: HostNetwork.enumerate_used_ports(self))
+
+    def create_proxy_to(self, ip, port):
+        """
+        :see: ``HostNetwork.create_proxy_to``
+        """
+        self._cache.clear()
+        return HostNetwork.create_proxy_to(self, ip, port)
+
+    def delete_proxy(self, proxy):
+        """
+        :see: ``HostNetwork.delete_proxy``
+        """
+        self._cache.clear()
+        return HostNetwork.delete_proxy(self, proxy)
+
+    def set_proxies(self, proxies):
+        """
+        Replace the rules in Flocker's chains with those for the given
+        proxies using a single ``iptables-restore --noflush``.
+
+        The first time, Flocker's chain reached from ``PREROUTING`` is
+        listed to find whether the chains have been set up.  If not, the NAT
+        table is read with ``iptables-save`` to find whether the jumps to
+        Flocker's chains need adding, and the rules of proxies created
+        before Flocker had its own chains are deleted in the same
+        transaction.  If the chains hold the rules of ``DispatchNetwork``,
+        its ipsets are destroyed once the rules have been replaced.
+
+        :see: :meth:`ITransactionalNetwork.set_proxies` for parameter
+            documentation.
+        """
+        proxies = frozenset(proxies)
+        self._cache.clear()
+        action = SET_PROXIES(self.logger, proxies=proxies)
+        with action.context():
+            d = DeferredContext(self._chain_setup())
+
+            def got_setup(setup):
+                if proxies:
+                    enable_forwarding(self.ipv4_conf)
+                return self._apply(proxies, setup)
+            d.addCallback(got_setup)
+
+            def restored(_):
+                self._chains_ready = True
+            d.addCallback(restored)
+
+            def finished(result):
+                # Anything looked up while the changes were being made may
+                # be out of date:
+                self._cache.clear()
+                return result
+            d.addBoth(finished)
+            d.addActionFinish()
+        return d.result
+
+    def _chain_setup(self):
+        """
+        Find what needs doing to set up Flocker's chains.
+
+        :return: A ``Deferred`` firing with the lines from ``chain_setup``
+            to include when replacing the rules, empty if the chains have
+            been set up.
+        """
+        if self._chains_ready:
+            return succeed([])
+        d = run_command(
+            self._reactor, [b"iptables", b"--table", b"nat", b"--list-rules",
+                            flocker_chain(b"PREROUTING")])
+
+        def missing(failure):
+            # The chain hasn't been created yet:
+            failure.trap(IPTablesFailed)
+            return None
+
+        def listed(output):
+            if output is not None and dispatching(output):
+                self._dispatched = True
+            if output is not None and setup_done(output):
+                return []
+            reading = run_command(
+                self._reactor, [b"iptables-save", b"--table", b"nat"])
+            reading.addCallback(chain_setup)
+            return reading
+        d.addErrback(missing)
+        d.addCallback(listed)
+        return d
+
+    def _apply(self, proxies, setup):
+        """
+        Replace the rules in Flocker's chains with those for the given
+        proxies.
+
+        :param frozenset proxies: The ``Proxy`` instances which should
+            exist.
+        :param list setup: Lines from ``chain_setup`` to include.
+
+        :return: A ``Deferred`` which fires once the rules are replaced.
+        """
+        d = self._restore(proxy_ruleset(proxies, setup))
+        if self._dispatched:
+            # The rules which looked ports up in the sets are gone, so
+            # nothing refers to them any more:
+            d.addCallback(lambda _: self._destroy_dispatch_sets())
+        return d
+
+    def _destroy_dispatch_sets(self):
+        """
+        Destroy all of Flocker's ipsets.
+
+        :return: A ``Deferred`` which fires once they have been destroyed.
+        """
+        d = run_command(self._reactor, [b"ipset", b"list", b"-name"])
+
+        def listed(output):
+            names = destination_sets(output)
+            if PORTS_SET in output.split():
+                names |= {PORTS_SET}
+            if names:
+                return self._ipset([b"restore"], _destroy_sets(names))
+        d.addCallback(listed)
+
+        def destroyed(_):
+            self._dispatched = False
+        d.addCallback(destroyed)
+        return d
+
+    def _restore(self, ruleset):
+        """
+        Apply changes to the iptables rules in one transaction.
+
+        :param bytes ruleset: Input for ``iptables-restore --noflush``.
+
+        :return: A ``Deferred`` which fires with ``None`` once the changes
+            have been committed, or fails with ``IPTablesFailed``.
+        """
+        action = IPTABLES_RESTORE(self.logger, ruleset=ruleset)
+        with action.context():
+            restoring = DeferredContext(run_command(
+                self._reactor, [b"iptables-restore", b"--noflush"], ruleset))
+            restoring.addCallback(lambda _: None)
+            restoring.addActionFinish()
+        return restoring.result
+
+    def _ipset(self, arguments, sets):
+        """
+        Change ipsets in one run of ``ipset``.
+
+        :param list arguments: The ``bytes`` arguments to ``ipset``.
+        :param bytes sets: Its input.
+
+        :return: A ``Deferred`` which fires with ``None`` once it has
+            succeeded, or fails with ``IPTablesFailed``.
+        """
+        action = IPSET_RESTORE(self.logger, sets=sets)
+        with action.context():
+            restoring = DeferredContext(run_command(
+                self._reactor, [b"ipset"] + arguments, sets))
+            restoring.addCallback(lambda _: None)
+            restoring.addActionFinish()
+        return restoring.result
+
+
+def _run_blocking(argv, stdin=b""):
+    """
+    Run a command, blocking until it exits.
+
+    :param list argv: The ``bytes`` argument list, starting with the name of
+        the executable.
+    :param bytes stdin: What to write to the command's standard input.
+
+    :raise IPTablesFailed: If the command fails.
+    """
+    process = Popen(argv, stdin=PIPE, stdout=PIPE, stderr=PIPE)
+    _, errors = process.communicate(stdin)
+    if process.returncode != 0:
+        raise IPTablesFailed(argv, process.returncode, errors)
+
+
+class DispatchNetwork(RestoreNetwork):
+    """
+    An ``INetwork`` implementation which looks the destination port of each
+    new connection up in ipsets, rather than matching it against one rule
+    per proxy.
+
+    Each destination has a ``bitmap:port`` ipset of the ports proxied to it
+    and a single DNAT rule matching that set, so connection setup costs the
+    same however many ports are proxied.  ``ipset`` must be installed.
+    """
+    def __init__(self, reactor, ipv4_conf=IPV4_CONF, cache_ttl=CACHE_TTL):
+        RestoreNetwork.__init__(self, reactor, ipv4_conf, cache_ttl)
+        # The names of Flocker's destination sets, or ``None`` if they need
+        # to be listed:
+        self._sets = None
+
+    def create_proxy_to(self, ip, port):
+        """
+        Add a port to the ipset of the destination.  If the destination has
+        no set, or the state of Flocker's chains and sets isn't known, they
+        are all replaced instead so that its rules are created too.
+
+        :see: :meth:`INetwork.create_proxy_to` for parameter documentation.
+        """
+        proxy = Proxy(ip=ip, port=port)
+        with CREATE_PROXY_TO(self.logger, target_ip=ip, target_port=port):
+            if self._ready() and destination_set(ip) in self._sets:
+                self._cache.clear()
+                enable_forwarding(self.ipv4_conf)
+                # Add the port to the destination's set first, so it is
+                # dispatched as soon as it is looked up in PORTS_SET:
+                self._change_members(b"add", [destination_set(ip), PORTS_SET],
+                                     port)
+            else:
+                self._replace_blocking(set(self._read_proxies()) | {proxy})
+        return proxy
+
+    def delete_proxy(self, proxy):
+        """
+        Remove a port from the ipset of its destination.  If the state of
+        Flocker's chains and sets isn't known, they are all replaced
+        instead.
+
+        :see: :meth:`INetwork.delete_proxy` for parameter documentation.
+        """
+        with DELETE_PROXY(self.logger, target_ip=proxy.ip,
+                          target_port=proxy.port):
+            if self._ready():
+                self._cache.clear()
+                # The destination's set and rules are left, empty, until
+                # the proxies are next replaced.
+                self._change_members(
+                    b"del", [PORTS_SET, destination_set(proxy.ip)],
+                    proxy.port)
+            else:
+                self._replace_blocking(set(self._read_proxies()) - {proxy})
+
+    def _ready(self):
+        """
+        :return: ``True`` if Flocker's chains hold only the dispatch rules
+            and its destination sets are known, otherwise ``False``.
+        """
+        return self._chains_ready and self._sets is not None
+
+    def _change_members(self, command, names, port):
+        """
+        Add a port to, or delete it from, ipsets in one run of ``ipset``,
+        blocking until done.
+
+        :param bytes command: ``b"add"`` or ``b"del"``.
+        :param list names: The names of the sets, in the order to change
+            them.
+        :param int port: The port.
+        """
+        try:
+            _run_blocking([b"ipset", b"-exist", b"restore"],
+                          b"".join(b"%s %s %d\n" % (command, name, port)
+                                   for name in names))
+        except IPTablesFailed:
+            # Replace everything next time rather than trust the sets:
+            self._sets = None
+            raise
+
+    def _replace_blocking(self, proxies):
+        """
+        Make the given proxies exactly the ones which exist, blocking until
+        done.  The steps are the same as those of ``set_proxies``.
+
+        :param set proxies: The ``Proxy`` instances which should exist.
+        """
+        self._cache.clear()
+        # Until this succeeds the sets aren't known:
+        self._sets = None
+        listed = list_flocker_rules()
+        if listed is not None and setup_done(listed):
+            setup = []
+        else:
+            setup = chain_setup(
+                check_output([b"iptables-save", b"--table", b"nat"]))
+        if proxies:
+            enable_forwarding(self.ipv4_conf)
+        existing = destination_sets(
+            check_output([b"ipset", b"list", b"-name"]))
+        wanted = frozenset(destination_set(proxy.ip) for proxy in proxies)
+        _run_blocking([b"ipset", b"-exist", b"restore"],
+                      dispatch_sets(proxies))
+        _run_blocking([b"iptables-restore", b"--noflush"],
+                      dispatch_ruleset(proxies, setup))
+        if existing - wanted:
+            _run_blocking([b"ipset", b"restore"],
+                          _destroy_sets(existing - wanted))
+        self._chains_ready = True
+        self._sets = wanted
+
+    def _apply(self, proxies, setup):
+        """
+        Fill Flocker's ipsets, replace the rules in Flocker's chains with
+        those matching the sets and then destroy the sets of destinations
+        which are no longer proxied to.
+
+        The sets are listed with ``ipset list -name`` the first time, and
+        again after a failure.
+
+        :see: ``RestoreNetwork._apply``
+        """
+        if self._sets is None:
+            d = run_command(self._reactor, [b"ipset", b"list", b"-name"])
+            d.addCallback(destination_sets)
+        else:
+            d = succeed(self._sets)
+
+        wanted = frozenset(destination_set(proxy.ip) for proxy in proxies)
+
+        def got_sets(existing):
+            applying = self._ipset([b"-exist", b"restore"],
+                                   dispatch_sets(proxies))
+            applying.addCallback(lambda _: self._restore(
+                dispatch_ruleset(proxies, setup)))
+            if existing - wanted:
+                applying.addCallback(lambda _: self._ipset(
+                    [b"restore"], _destroy_sets(existing - wanted)))
+            return applying
+        d.addCallback(got_sets)
+
+        def applied(result):
+            self._sets = wanted
+            return result
+
+        def failed(reason):
+            self._sets = None
+            return reason
+        d.addCallbacks(applied, failed)
+        return d
+
+
+def make_host_network(reactor=None, dispatch=False):
     """
     Create a new ``INetwork`` provider which will interact with the underlying
     system's network configuration.
+
+    :param reactor: The ``IReactorProcess`` provider to run commands with,
+        or ``None`` for the global reactor.
+    :param bool dispatch: If ``True``, look proxied ports up in ipsets
+        rather than matching one rule per proxy; see ``DispatchNetwork``.
     """
-    return HostNetwork()
+    if reactor is None:
+        from twisted.internet import reactor
+    if dispatch:
+        return DispatchNetwork(reactor)
+    return RestoreNetwork(reactor)
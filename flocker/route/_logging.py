@@ -58,3 +58,43 @@ DELETE_PROXY = ActionType(
     [TARGET_IP, TARGET_PORT],
     [],
     u"Flocker is deleting an existing proxy.")
+
+
+def serialize_proxies(proxies):
+    return sorted([u"%s:%d" % (proxy.ip, proxy.port) for proxy in proxies])
+
+
+PROXIES = Field(
+    u"proxies", serialize_proxies,
+    u"The proxies which should exist.")
+
+
+RULESET = Field.forTypes(
+    u"ruleset", [bytes],
+    u"The input given to iptables-restore.")
+
+
+SET_PROXIES = ActionType(
+    _system(u"set_proxies"),
+    [PROXIES],
+    [],
+    u"Flocker is changing the proxies to be exactly the given ones.")
+
+
+IPTABLES_RESTORE = ActionType(
+    _system(u"iptables_restore"),
+    [RULESET],
+    [],
+    u"Flocker is applying changes to iptables rules in one transaction.")
+
+
+SETS = Field.forTypes(
+    u"sets", [bytes],
+    u"The input given to ipset.")
+
+
+IPSET_RESTORE = ActionType(
+    _system(u"ipset_restore"),
+    [SETS],
+    [],
+    u"Flocker is changing the ipsets proxied ports are looked up in.")
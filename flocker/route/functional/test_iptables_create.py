@@ -20,7 +20,8 @@ from twisted.trial.unittest import TestCase
 from twisted.python.procutils import which
 
 from ...testtools import if_root
-from .. import make_host_network
+from .. import make_host_network, Proxy
+from .._iptables import ensure_flocker_chains, proxy_rules
 from .._logging import CREATE_PROXY_TO, DELETE_PROXY, IPTABLES
 from .networktests import make_proxying_tests
 
@@ -105,6 +106,10 @@ _iptables_skip = skipUnless(
     which(b"iptables-save"),
     "Cannot set up isolated environment without iptables-save.")
 
+_ipset_skip = skipUnless(
+    which(b"ipset"),
+    "Cannot test proxy dispatch without ipset.")
+
 
 class GetIPTablesTests(TestCase):
     """
@@ -142,6 +147,24 @@ class IPTablesProxyTests(make_proxying_tests(make_host_network)):
         super(IPTablesProxyTests, self).setUp()
 
 
+class DispatchProxyTests(
+        make_proxying_tests(lambda: make_host_network(dispatch=True))):
+    """
+    Apply the generic ``INetwork`` test suite to the implementation which
+    looks proxied ports up in ipsets.
+    """
+    @_dependency_skip
+    @_environment_skip
+    @_ipset_skip
+    def setUp(self):
+        """
+        Arrange for the tests to not corrupt the system network configuration.
+        """
+        self.namespace = create_network_namespace()
+        self.addCleanup(self.namespace.restore)
+        super(DispatchProxyTests, self).setUp()
+
+
 class CreateTests(TestCase):
     """
     Tests for the creation of new external routing rules.
@@ -363,8 +386,9 @@ class DeleteTests(TestCase):
         """
         After a route created using :py:func:`flocker.route.create_proxy_to` is
         deleted using :py:meth:`delete_proxy` the iptables rules which were
-        added by the former are removed.
+        added by the former are removed.  Flocker's chains remain.
         """
+        ensure_flocker_chains(self.network.logger)
         original_rules = get_iptables_rules()
 
         proxy = self.network.create_proxy_to(IPAddress("10.1.2.3"), 12345)
@@ -404,6 +428,117 @@ class DeleteTests(TestCase):
             actual)
 
 
+class SetProxiesTests(TestCase):
+    """
+    Tests for changing all of the Flocker-managed external routing rules in
+    one ``iptables-restore`` transaction.
+    """
+    @_dependency_skip
+    @_environment_skip
+    def setUp(self):
+        self.addCleanup(create_network_namespace().restore)
+        self.network = make_host_network()
+
+    def test_set_proxies(self):
+        """
+        After ``set_proxies``, exactly the given proxies exist with the same
+        rules as if they had been created one at a time, and unrelated rules
+        are untouched.
+        """
+        create_user_rule()
+        kept = self.network.create_proxy_to(IPAddress("10.1.2.4"), 23456)
+        expected = sorted(get_iptables_rules())
+        self.network.create_proxy_to(IPAddress("10.1.2.3"), 12345)
+        added = Proxy(ip=IPAddress("10.1.2.5"), port=34567)
+
+        d = self.network.set_proxies([kept, added])
+        d.addCallback(lambda _: self.assertEqual(
+            sorted([kept, added]), sorted(self.network.enumerate_proxies())))
+        d.addCallback(lambda _: self.network.set_proxies([kept]))
+        d.addCallback(lambda _: self.assertEqual(
+            expected, sorted(get_iptables_rules())))
+        return d
+
+
+class ChainsTests(TestCase):
+    """
+    Tests for keeping Flocker's rules in chains of its own.
+    """
+    @_dependency_skip
+    @_environment_skip
+    def setUp(self):
+        self.addCleanup(create_network_namespace().restore)
+        self.network = make_host_network()
+
+    def test_rules_in_flocker_chains(self):
+        """
+        The rules for a proxy are in Flocker's chains, each reached by a
+        single jump from a built-in chain, however many proxies there are.
+        Besides them there is only the rule recording that the chains have
+        been set up.
+        """
+        self.network.create_proxy_to(IPAddress("10.1.2.3"), 12345)
+        self.network.create_proxy_to(IPAddress("10.1.2.4"), 23456)
+        rules = [rule for rule in get_iptables_rules()
+                 if rule.startswith(b"-A ")]
+        self.assertEqual(
+            ([b"-A PREROUTING -j FLOCKER-PREROUTING",
+              b"-A OUTPUT -j FLOCKER-OUTPUT",
+              b"-A POSTROUTING -j FLOCKER-POSTROUTING"],
+             7),
+            ([rule for rule in rules
+              if rule.split()[1] in (b"PREROUTING", b"OUTPUT",
+                                     b"POSTROUTING")],
+             len([rule for rule in rules
+                  if rule.split()[1].startswith(b"FLOCKER-")])))
+
+    def create_legacy_proxy(self, proxy):
+        """
+        Create the rules for a proxy in the built-in chains, as Flocker did
+        before it had chains of its own.
+
+        :param Proxy proxy: The proxy.
+        """
+        for chain, rule in proxy_rules(proxy):
+            check_call([b"iptables", b"--table", b"nat", b"--append", chain]
+                       + rule)
+
+    def test_legacy_enumerated(self):
+        """
+        Proxies whose rules are in the built-in chains are enumerated.
+        """
+        proxy = Proxy(ip=IPAddress("10.1.2.3"), port=12345)
+        self.create_legacy_proxy(proxy)
+        self.assertEqual([proxy], self.network.enumerate_proxies())
+
+    def test_legacy_moved(self):
+        """
+        Creating a proxy moves the rules of proxies in the built-in chains
+        into Flocker's chains.
+        """
+        legacy = Proxy(ip=IPAddress("10.1.2.3"), port=12345)
+        self.create_legacy_proxy(legacy)
+        created = self.network.create_proxy_to(IPAddress("10.1.2.4"), 23456)
+        self.assertEqual(
+            ([b"-A PREROUTING -j FLOCKER-PREROUTING",
+              b"-A OUTPUT -j FLOCKER-OUTPUT",
+              b"-A POSTROUTING -j FLOCKER-POSTROUTING"],
+             sorted([legacy, created])),
+            ([rule for rule in get_iptables_rules()
+              if rule.split()[1] in (b"PREROUTING", b"OUTPUT",
+                                     b"POSTROUTING")],
+             sorted(self.network.enumerate_proxies())))
+
+    def test_legacy_deleted(self):
+        """
+        A proxy whose rules are in the built-in chains can be deleted.
+        """
+        legacy = Proxy(ip=IPAddress("10.1.2.3"), port=12345)
+        self.create_legacy_proxy(legacy)
+        self.network.delete_proxy(legacy)
+        self.assertEqual([], self.network.enumerate_proxies())
+
+
 class UsedPortsTests(TestCase):
     """
     Tests for enumeration of used ports.
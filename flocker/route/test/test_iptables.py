@@ -0,0 +1,1099 @@
+# Copyright Hybrid Logic Ltd.  See LICENSE file for details.
+
+"""
+Unit tests for :py:mod:`flocker.route._iptables`.
+"""
+
+from subprocess import CalledProcessError
+
+from ipaddr import IPAddress
+
+from zope.interface.verify import verifyObject
+
+from twisted.internet.error import ProcessDone, ProcessTerminated
+from twisted.python.failure import Failure
+from twisted.python.filepath import FilePath
+from twisted.trial.unittest import SynchronousTestCase
+
+from eliot.testing import validateLogging, assertHasAction
+
+from ...testtools import FakeProcessReactor
+from .. import ITransactionalNetwork, Proxy
+from .. import _iptables
+from .._iptables import (
+    HostNetwork, RestoreNetwork, DispatchNetwork, IPTablesFailed,
+    proxy_ruleset, make_host_network, missing_chains, chain_setup,
+    destination_set, destination_sets, dispatch_sets, dispatch_ruleset,
+    parse_dispatch_sets, used_tcp_ports, CACHE_TTL, enumerate_proxies,
+    ensure_flocker_chains, legacy_proxies, setup_done, dispatching)
+from .._logging import IPTABLES_RESTORE, IPSET_RESTORE
+
+
+# iptables-save output with one proxy created before Flocker had its own
+# chains, and one rule which wasn't created by Flocker:
+LEGACY = b"""\
+# Generated by iptables-save v1.4.21
+*nat
+:PREROUTING ACCEPT [0:0]
+:OUTPUT ACCEPT [0:0]
+:POSTROUTING ACCEPT [0:0]
+-A PREROUTING -p tcp -m tcp --dport 12345 -m addrtype --dst-type LOCAL \
+-j DNAT --to-destination 10.7.8.9
+-A PREROUTING -p tcp -m tcp --dport 3306 -m addrtype --dst-type LOCAL \
+-m comment --comment "flocker create_proxy_to" -j DNAT \
+--to-destination 10.0.0.1
+-A OUTPUT -p tcp -m tcp --dport 3306 -m addrtype --dst-type LOCAL \
+-j DNAT --to-destination 10.0.0.1
+-A POSTROUTING -p tcp -m tcp --dport 3306 -j MASQUERADE
+COMMIT
+# Completed
+"""
+
+# iptables-save output once Flocker's chains are set up, and that has been
+# recorded:
+READY = b"""\
+*nat
+:PREROUTING ACCEPT [0:0]
+:OUTPUT ACCEPT [0:0]
+:POSTROUTING ACCEPT [0:0]
+:FLOCKER-OUTPUT - [0:0]
+:FLOCKER-POSTROUTING - [0:0]
+:FLOCKER-PREROUTING - [0:0]
+-A PREROUTING -j FLOCKER-PREROUTING
+-A OUTPUT -j FLOCKER-OUTPUT
+-A POSTROUTING -j FLOCKER-POSTROUTING
+-A FLOCKER-PREROUTING -m comment --comment "flocker chains ready"
+-A FLOCKER-PREROUTING -p tcp -m tcp --dport 3306 -m addrtype \
+--dst-type LOCAL -m comment --comment "flocker create_proxy_to" -j DNAT \
+--to-destination 10.0.0.1
+COMMIT
+"""
+
+# iptables-save output once DispatchNetwork has set up proxies to 10.0.0.1,
+# and the ipset save output listing their ports:
+DISPATCH = b"""\
+*nat
+:PREROUTING ACCEPT [0:0]
+:OUTPUT ACCEPT [0:0]
+:POSTROUTING ACCEPT [0:0]
+:FLOCKER-OUTPUT - [0:0]
+:FLOCKER-POSTROUTING - [0:0]
+:FLOCKER-PREROUTING - [0:0]
+-A PREROUTING -j FLOCKER-PREROUTING
+-A OUTPUT -j FLOCKER-OUTPUT
+-A POSTROUTING -j FLOCKER-POSTROUTING
+-A FLOCKER-PREROUTING -m comment --comment "flocker chains ready"
+-A FLOCKER-PREROUTING -p tcp -m set ! --match-set flocker-ports dst -j RETURN
+-A FLOCKER-PREROUTING -p tcp -m set --match-set flocker-to-0a000001 dst \
+-m addrtype --dst-type LOCAL -m comment --comment "flocker create_proxy_to" \
+-j DNAT --to-destination 10.0.0.1
+-A FLOCKER-OUTPUT -p tcp -m set ! --match-set flocker-ports dst -j RETURN
+-A FLOCKER-OUTPUT -p tcp -m set --match-set flocker-to-0a000001 dst \
+-m addrtype --dst-type LOCAL -j DNAT --to-destination 10.0.0.1
+-A FLOCKER-POSTROUTING -p tcp -m set --match-set flocker-ports dst \
+-j MASQUERADE
+COMMIT
+"""
+DISPATCH_SETS = b"""\
+create flocker-ports bitmap:port range 0-65535
+add flocker-ports 3306
+add flocker-ports 5432
+create flocker-to-0a000001 bitmap:port range 0-65535
+add flocker-to-0a000001 3306
+add flocker-to-0a000001 5432
+"""
+
+# /proc/net/tcp with a socket listening on 127.0.0.1:8000 and one
+# connected from port 53012 to 10.0.0.1:22:
+PROC_NET_TCP = b"""\
+  sl  local_address rem_address   st tx_queue rx_queue tr tm->when \
+retrnsmt   uid  timeout inode
+   0: 0100007F:1F40 00000000:0000 0A 00000000:00000000 00:00000000 \
+00000000     0        0 13432 1 ffff8800 100 0 0 10 0
+   1: 0F02000A:CF14 0100000A:0016 01 00000000:00000000 02:000A7B3E \
+00000000  1000        0 23712 4 ffff8800 20 4 29 10 -1
+"""
+
+# /proc/net/tcp6 with a socket listening on port 80 of every address:
+PROC_NET_TCP6 = b"""\
+  sl  local_address                         remote_address                \
+        st tx_queue rx_queue tr tm->when retrnsmt   uid  timeout inode
+   0: 00000000000000000000000000000000:0050 \
+00000000000000000000000000000000:0000 0A 00000000:00000000 00:00000000 \
+00000000     0        0 14923 1 ffff8800 100 0 0 10 0
+"""
+
+EXISTING = Proxy(ip=IPAddress("10.0.0.1"), port=3306)
+NEW = Proxy(ip=IPAddress("10.0.0.2"), port=8080)
+
+
+def list_rules(table, chain):
+    """
+    Find what ``iptables --list-rules`` would write for a chain.
+
+    :param bytes table: The ``iptables-save --table nat`` output.
+    :param bytes chain: The name of the chain.
+
+    :return: The ``bytes`` output, or ``None`` if there is no such chain.
+    """
+    lines = table.splitlines()
+    if not any(line.startswith(b":" + chain + b" ") for line in lines):
+        return None
+    return b"-N " + chain + b"\n" + b"".join(
+        line + b"\n" for line in lines
+        if line.startswith(b"-A " + chain + b" "))
+
+
+# The arguments and output of the command listing Flocker's chain reached
+# from PREROUTING, once the chains are set up with one rule per proxy or by
+# DispatchNetwork:
+LIST_RULES = [b"iptables", b"--table", b"nat", b"--list-rules",
+              b"FLOCKER-PREROUTING"]
+READY_RULES = list_rules(READY, b"FLOCKER-PREROUTING")
+DISPATCH_RULES = list_rules(DISPATCH, b"FLOCKER-PREROUTING")
+
+
+def finish(process, status=0, output=b"", errors=b""):
+    """
+    Make a process spawned by a ``FakeProcessReactor`` write some output and
+    exit.
+
+    :param SpawnProcessArguments process: The process.
+    :param int status: Its exit status.
+    :param bytes output: What it writes to standard output.
+    :param bytes errors: What it writes to standard error.
+    """
+    protocol = process.processProtocol
+    if output:
+        protocol.childDataReceived(1, output)
+    if errors:
+        protocol.childDataReceived(2, errors)
+    if status == 0:
+        reason = ProcessDone(status)
+    else:
+        reason = ProcessTerminated(status)
+    protocol.processEnded(Failure(reason))
+
+
+def finish_missing(process):
+    """
+    Make a process spawned by a ``FakeProcessReactor`` to list a chain fail
+    as ``iptables`` does when the chain doesn't exist.
+
+    :param SpawnProcessArguments process: The process.
+    """
+    finish(process, status=1,
+           errors=b"iptables: No chain/target/match by that name.\n")
+
+
+class FakeIPTables(object):
+    """
+    A stand-in for the ``iptables`` commands run by blocking code, whose NAT
+    table is described by ``iptables-save`` output.
+
+    :ivar bytes table: The ``iptables-save --table nat`` output.
+    :ivar bytes sets: The ``ipset save`` output.
+    :ivar list changes: The arguments of each ``iptables`` command run.
+    """
+    def __init__(self, test, table, sets=b""):
+        self.table = table
+        self.sets = sets
+        self.changes = []
+        test.patch(_iptables, "check_output", self.check_output)
+        test.patch(_iptables, "check_call", self.check_call)
+
+    def check_output(self, argv, stderr=None):
+        if argv == [b"iptables-save", b"--table", b"nat"]:
+            return self.table
+        if argv == [b"ipset", b"save"]:
+            return self.sets
+        if argv == [b"ipset", b"list", b"-name"]:
+            return b"".join(sorted({line.split()[1] + b"\n"
+                                    for line in self.sets.splitlines()}))
+        if argv[:3] == [b"iptables", b"--table", b"nat"] and argv[3] == (
+                b"--list-rules"):
+            output = list_rules(self.table, argv[4])
+            if output is None:
+                raise CalledProcessError(1, argv)
+            return output
+        raise AssertionError("Unexpected command: %r" % (argv,))
+
+    def check_call(self, argv):
+        self.changes.append(argv)
+
+
+class ChainSetupTests(SynchronousTestCase):
+    """
+    Tests for ``missing_chains`` and ``chain_setup``.
+    """
+    def test_missing(self):
+        """
+        ``missing_chains`` finds Flocker's chains and the jumps to them which
+        don't exist.
+        """
+        self.assertEqual(
+            ([b"FLOCKER-PREROUTING", b"FLOCKER-OUTPUT",
+              b"FLOCKER-POSTROUTING"],
+             [(b"PREROUTING", b"FLOCKER-PREROUTING"),
+              (b"OUTPUT", b"FLOCKER-OUTPUT"),
+              (b"POSTROUTING", b"FLOCKER-POSTROUTING")]),
+            missing_chains(LEGACY))
+
+    def test_ready(self):
+        """
+        Once Flocker's chains are set up nothing is missing and no setup is
+        needed.
+        """
+        self.assertEqual((([], []), []),
+                         (missing_chains(READY), chain_setup(READY)))
+
+    def test_setup(self):
+        """
+        ``chain_setup`` adds the missing jumps and deletes the rules of
+        proxies created before Flocker had its own chains.
+        """
+        self.assertEqual(
+            [b"-A PREROUTING --jump FLOCKER-PREROUTING",
+             b"-A OUTPUT --jump FLOCKER-OUTPUT",
+             b"-A POSTROUTING --jump FLOCKER-POSTROUTING",
+             b"-D PREROUTING --protocol tcp --destination-port 3306 "
+             b"--match addrtype --dst-type LOCAL "
+             b"--match comment --comment \"flocker create_proxy_to\" "
+             b"--jump DNAT --to-destination 10.0.0.1",
+             b"-D POSTROUTING --protocol tcp --destination-port 3306 "
+             b"--jump MASQUERADE",
+             b"-D OUTPUT --protocol tcp --destination-port 3306 "
+             b"--match addrtype --dst-type LOCAL "
+             b"--jump DNAT --to-destination 10.0.0.1"],
+            chain_setup(LEGACY))
+
+
+class LegacyProxiesTests(SynchronousTestCase):
+    """
+    Tests for finding and moving the proxies created before Flocker had its
+    own chains.
+    """
+    def test_legacy_proxies(self):
+        """
+        ``legacy_proxies`` finds the proxies whose rules are in the built-in
+        chains.
+        """
+        self.assertEqual(([EXISTING], []),
+                         (legacy_proxies(LEGACY), legacy_proxies(READY)))
+
+    def test_setup_done(self):
+        """
+        ``setup_done`` finds the rule recording that Flocker's chains have
+        been set up, in the output of either ``iptables-save`` or
+        ``iptables --list-rules``.
+        """
+        self.assertEqual((False, True, True),
+                         (setup_done(LEGACY), setup_done(READY),
+                          setup_done(READY_RULES)))
+
+    def test_enumerated(self):
+        """
+        Until Flocker's chains have been set up, ``enumerate_proxies``
+        includes the proxies whose rules are in the built-in chains.
+        """
+        FakeIPTables(self, LEGACY)
+        self.assertEqual([EXISTING], enumerate_proxies())
+
+    def test_enumerated_ready(self):
+        """
+        Once Flocker's chains have been set up, ``enumerate_proxies`` only
+        reads them.
+        """
+        table = READY.replace(
+            b"COMMIT\n",
+            b"-A PREROUTING -p tcp -m tcp --dport 8080 -m addrtype "
+            b"--dst-type LOCAL -m comment --comment "
+            b"\"flocker create_proxy_to\" -j DNAT --to-destination 10.0.0.2\n"
+            b"COMMIT\n")
+        FakeIPTables(self, table)
+        self.assertEqual([EXISTING], enumerate_proxies())
+
+    def test_moved(self):
+        """
+        ``ensure_flocker_chains`` creates Flocker's chains and the jumps to
+        them, and moves the rules of proxies in the built-in chains into
+        them, adding each new rule before deleting the old one.  Finally it
+        records that this has been done.
+        """
+        iptables = FakeIPTables(self, LEGACY)
+        ensure_flocker_chains(HostNetwork.logger)
+        nat = [b"--table", b"nat"]
+        moves = []
+        for chain, rule in _iptables.proxy_rules(EXISTING):
+            moves.extend([
+                [b"iptables"] + nat + [
+                    b"--append", _iptables.flocker_chain(chain)] + rule,
+                [b"iptables"] + nat + [b"--delete", chain] + rule])
+        self.assertEqual(
+            [[b"iptables"] + nat + [b"--new-chain", b"FLOCKER-PREROUTING"],
+             [b"iptables"] + nat + [b"--new-chain", b"FLOCKER-OUTPUT"],
+             [b"iptables"] + nat + [b"--new-chain", b"FLOCKER-POSTROUTING"],
+             [b"iptables"] + nat + [b"--append", b"PREROUTING",
+                                    b"--jump", b"FLOCKER-PREROUTING"],
+             [b"iptables"] + nat + [b"--append", b"OUTPUT",
+                                    b"--jump", b"FLOCKER-OUTPUT"],
+             [b"iptables"] + nat + [b"--append", b"POSTROUTING",
+                                    b"--jump", b"FLOCKER-POSTROUTING"]] +
+            moves +
+            [[b"iptables"] + nat + [b"--insert", b"FLOCKER-PREROUTING", b"1",
+                                    b"--match", b"comment", b"--comment",
+                                    b"flocker chains ready"]],
+            iptables.changes)
+
+    def test_recorded(self):
+        """
+        Once setting up Flocker's chains has been recorded,
+        ``ensure_flocker_chains`` changes nothing.
+        """
+        iptables = FakeIPTables(self, READY)
+        ensure_flocker_chains(HostNetwork.logger)
+        self.assertEqual([], iptables.changes)
+
+    def test_moved_before_delete(self):
+        """
+        ``HostNetwork.delete_proxy`` moves the rules of proxies in the
+        built-in chains into Flocker's chains before deleting the proxy's
+        rules from them.
+        """
+        iptables = FakeIPTables(self, LEGACY)
+        HostNetwork().delete_proxy(EXISTING)
+        self.assertEqual(
+            [[b"iptables", b"--table", b"nat", b"--delete",
+              _iptables.flocker_chain(chain)] + rule
+             for chain, rule in _iptables.proxy_rules(EXISTING)],
+            iptables.changes[-3:])
+
+
+class ProxyRulesetTests(SynchronousTestCase):
+    """
+    Tests for ``proxy_ruleset``.
+    """
+    def test_empty(self):
+        """
+        With no proxies, ``proxy_ruleset`` just flushes Flocker's chains.
+        """
+        self.assertEqual(
+            b"*nat\n"
+            b":FLOCKER-PREROUTING - [0:0]\n"
+            b":FLOCKER-OUTPUT - [0:0]\n"
+            b":FLOCKER-POSTROUTING - [0:0]\n"
+            b"-A FLOCKER-PREROUTING --match comment "
+            b"--comment \"flocker chains ready\"\n"
+            b"COMMIT\n",
+            proxy_ruleset([]))
+
+    def test_ruleset(self):
+        """
+        ``proxy_ruleset`` returns a single NAT table transaction which flushes
+        Flocker's chains, runs the setup, records that it has been done and
+        appends every proxy's rules.
+        """
+        self.assertEqual(
+            b"*nat\n"
+            b":FLOCKER-PREROUTING - [0:0]\n"
+            b":FLOCKER-OUTPUT - [0:0]\n"
+            b":FLOCKER-POSTROUTING - [0:0]\n"
+            b"-A PREROUTING --jump FLOCKER-PREROUTING\n"
+            b"-A FLOCKER-PREROUTING --match comment "
+            b"--comment \"flocker chains ready\"\n"
+            b"-A FLOCKER-PREROUTING --protocol tcp --destination-port 8080 "
+            b"--match addrtype --dst-type LOCAL "
+            b"--match comment --comment \"flocker create_proxy_to\" "
+            b"--jump DNAT --to-destination 10.0.0.2\n"
+            b"-A FLOCKER-POSTROUTING --protocol tcp --destination-port 8080 "
+            b"--jump MASQUERADE\n"
+            b"-A FLOCKER-OUTPUT --protocol tcp --destination-port 8080 "
+            b"--match addrtype --dst-type LOCAL "
+            b"--jump DNAT --to-destination 10.0.0.2\n"
+            b"COMMIT\n",
+            proxy_ruleset(
+                [NEW], [b"-A PREROUTING --jump FLOCKER-PREROUTING"]))
+
+
+class RestoreNetworkTests(SynchronousTestCase):
+    """
+    Tests for ``RestoreNetwork``.
+    """
+    def setUp(self):
+        self.reactor = FakeProcessReactor()
+        # A stand-in for /proc/sys/net/ipv4/conf:
+        self.conf = FilePath(self.mktemp())
+        self.conf.child(b"default").makedirs()
+        self.network = RestoreNetwork(self.reactor, ipv4_conf=self.conf)
+
+    def test_interface(self):
+        """
+        ``RestoreNetwork`` provides ``ITransactionalNetwork``.
+        """
+        self.assertTrue(verifyObject(ITransactionalNetwork, self.network))
+
+    def test_host_network(self):
+        """
+        ``make_host_network`` creates a ``RestoreNetwork``.
+        """
+        self.assertIsInstance(make_host_network(self.reactor), RestoreNetwork)
+
+    def test_one_transaction(self):
+        """
+        The first time, if Flocker's chain reached from ``PREROUTING`` can't
+        be listed, ``RestoreNetwork.set_proxies`` reads the NAT table with
+        ``iptables-save``, then sets up Flocker's chains and replaces their
+        rules with one ``iptables-restore --noflush``, enabling forwarding
+        first.
+        """
+        d = self.network.set_proxies([NEW])
+        finish_missing(self.reactor.processes[0])
+        finish(self.reactor.processes[1], output=LEGACY)
+        self.assertNoResult(d)
+        restore = self.reactor.processes[2]
+        finish(restore)
+        self.assertEqual(
+            ([LIST_RULES,
+              [b"iptables-save", b"--table", b"nat"],
+              [b"iptables-restore", b"--noflush"]],
+             proxy_ruleset([NEW], chain_setup(LEGACY)), True, b"1",
+             None),
+            ([process.args for process in self.reactor.processes],
+             restore.transport.stdin, restore.transport.stdin_closed,
+             self.conf.descendant([b"default", b"forwarding"]).getContent(),
+             self.successResultOf(d)))
+
+    def test_legacy_enumerated(self):
+        """
+        Until Flocker's chains have been set up,
+        ``RestoreNetwork.enumerate_proxies`` includes the proxies whose rules
+        are in the built-in chains, and ``RestoreNetwork.set_proxies``
+        deletes their rules even if no proxies are wanted.
+        """
+        FakeIPTables(self, LEGACY)
+        proxies = self.network.enumerate_proxies()
+        self.network.set_proxies([])
+        finish_missing(self.reactor.processes[0])
+        finish(self.reactor.processes[1], output=LEGACY)
+        restore = self.reactor.processes[2]
+        finish(restore)
+        self.assertEqual(
+            ([EXISTING], proxy_ruleset([], chain_setup(LEGACY))),
+            (proxies, restore.transport.stdin))
+
+    def test_setup_recorded(self):
+        """
+        If listing Flocker's chain reached from ``PREROUTING`` shows that
+        the chains have been set up, ``RestoreNetwork.set_proxies`` doesn't
+        read the whole NAT table.
+        """
+        d = self.network.set_proxies([NEW])
+        finish(self.reactor.processes[0], output=READY_RULES)
+        restore = self.reactor.processes[1]
+        finish(restore)
+        self.assertEqual(
+            ([LIST_RULES, [b"iptables-restore", b"--noflush"]],
+             proxy_ruleset([NEW]), None),
+            ([process.args for process in self.reactor.processes],
+             restore.transport.stdin, self.successResultOf(d)))
+
+    def test_dispatch_enumerated(self):
+        """
+        While Flocker's chains hold the rules of ``DispatchNetwork``,
+        ``RestoreNetwork.enumerate_proxies`` finds the proxies in Flocker's
+        ipsets.
+        """
+        FakeIPTables(self, DISPATCH, sets=DISPATCH_SETS)
+        self.assertEqual(
+            [EXISTING, Proxy(ip=EXISTING.ip, port=5432)],
+            self.network.enumerate_proxies())
+
+    def test_dispatch_replaced(self):
+        """
+        If Flocker's chains hold the rules of ``DispatchNetwork``,
+        ``RestoreNetwork.set_proxies`` replaces them with one rule per proxy
+        and then destroys Flocker's ipsets, which nothing refers to any
+        more.
+        """
+        d = self.network.set_proxies([NEW])
+        finish(self.reactor.processes[0], output=DISPATCH_RULES)
+        finish(self.reactor.processes[1])
+        finish(self.reactor.processes[2],
+               output=b"docker\nflocker-ports\nflocker-to-0a000001\n")
+        finish(self.reactor.processes[3])
+        self.assertEqual(
+            ([LIST_RULES,
+              [b"iptables-restore", b"--noflush"],
+              [b"ipset", b"list", b"-name"],
+              [b"ipset", b"restore"]],
+             [proxy_ruleset([NEW]),
+              b"destroy flocker-ports\ndestroy flocker-to-0a000001\n"],
+             None),
+            ([process.args for process in self.reactor.processes],
+             [process.transport.stdin
+              for process in self.reactor.processes[1::2]],
+             self.successResultOf(d)))
+
+    def test_dispatch_destroyed_once(self):
+        """
+        Once Flocker's ipsets have been destroyed, ``RestoreNetwork``
+        doesn't look for them again.
+        """
+        self.network.set_proxies([NEW])
+        finish(self.reactor.processes[0], output=DISPATCH_RULES)
+        finish(self.reactor.processes[1])
+        finish(self.reactor.processes[2], output=b"flocker-ports\n")
+        finish(self.reactor.processes[3])
+        self.network.set_proxies([EXISTING])
+        finish(self.reactor.processes[4])
+        self.assertEqual(
+            [[b"iptables-restore", b"--noflush"]],
+            [process.args for process in self.reactor.processes[4:]])
+
+    def test_table_read_once(self):
+        """
+        Once Flocker's chains have been set up, ``RestoreNetwork.set_proxies``
+        only runs ``iptables-restore``.
+        """
+        self.network.set_proxies([NEW])
+        finish_missing(self.reactor.processes[0])
+        finish(self.reactor.processes[1], output=LEGACY)
+        finish(self.reactor.processes[2])
+        d = self.network.set_proxies([EXISTING])
+        restore = self.reactor.processes[3]
+        finish(restore)
+        self.assertEqual(
+            (4, [b"iptables-restore", b"--noflush"],
+             proxy_ruleset([EXISTING]), None),
+            (len(self.reactor.processes), restore.args,
+             restore.transport.stdin, self.successResultOf(d)))
+
+    def test_failure(self):
+        """
+        If ``iptables-restore`` fails, the ``Deferred`` returned by
+        ``RestoreNetwork.set_proxies`` fails with ``IPTablesFailed``, giving
+        what it wrote to standard error, and Flocker's chains are checked
+        again next time.
+        """
+        d = self.network.set_proxies([])
+        finish(self.reactor.processes[0], output=READY_RULES)
+        finish(self.reactor.processes[1], status=2,
+               errors=b"iptables-restore: line 2 failed\n")
+        failure = self.failureResultOf(d, IPTablesFailed)
+        self.network.set_proxies([])
+        self.assertEqual(
+            (2, b"iptables-restore: line 2 failed\n", LIST_RULES),
+            (failure.value.status, failure.value.errors,
+             self.reactor.processes[2].args))
+
+    @validateLogging(None)
+    def test_logged(self, logger):
+        """
+        The transaction is logged as a ``flocker:route:iptables_restore``
+        action.
+        """
+        self.network.logger = logger
+        self.network.set_proxies([])
+        finish(self.reactor.processes[0], output=READY_RULES)
+        finish(self.reactor.processes[1])
+        assertHasAction(self, logger, IPTABLES_RESTORE, True,
+                        {u"ruleset": proxy_ruleset([])})
+
+
+class DestinationSetTests(SynchronousTestCase):
+    """
+    Tests for ``destination_set``, ``destination_sets`` and
+    ``parse_dispatch_sets``.
+    """
+    def test_name(self):
+        """
+        ``destination_set`` names the set of a destination after its address
+        in hex.
+        """
+        self.assertEqual(
+            [b"flocker-to-0a000001", b"flocker-to-0a000001"],
+            [destination_set(u"10.0.0.1"),
+             destination_set(IPAddress("10.0.0.1"))])
+
+    def test_sets(self):
+        """
+        ``destination_sets`` finds only Flocker's destination sets in the
+        output of ``ipset list -name``.
+        """
+        self.assertEqual(
+            frozenset([b"flocker-to-0a000001"]),
+            destination_sets(b"flocker-ports\nflocker-to-0a000001\n"
+                             b"flocker-to-0a000002-new\nflocker-to-xyz\n"
+                             b"blacklist\n"))
+
+    def test_parse(self):
+        """
+        ``parse_dispatch_sets`` finds a proxy for each port in each of
+        Flocker's destination sets in the output of ``ipset save``.
+        """
+        self.assertEqual(
+            [EXISTING, NEW],
+            parse_dispatch_sets(
+                b"create flocker-ports bitmap:port range 0-65535\n"
+                b"add flocker-ports 3306\n"
+                b"add flocker-ports 8080\n"
+                b"create flocker-to-0a000001 bitmap:port range 0-65535\n"
+                b"add flocker-to-0a000001 3306\n"
+                b"create flocker-to-0a000002 bitmap:port range 0-65535\n"
+                b"add flocker-to-0a000002 8080\n"
+                b"create blacklist hash:ip family inet\n"
+                b"add blacklist 10.1.1.1\n"))
+
+
+class DispatchSetsTests(SynchronousTestCase):
+    """
+    Tests for ``dispatch_sets``.
+    """
+    def test_empty(self):
+        """
+        With no proxies, ``dispatch_sets`` just empties ``PORTS_SET``.
+        """
+        self.assertEqual(
+            b"create flocker-ports bitmap:port range 0-65535\n"
+            b"create flocker-ports-new bitmap:port range 0-65535\n"
+            b"flush flocker-ports-new\n"
+            b"swap flocker-ports-new flocker-ports\n"
+            b"destroy flocker-ports-new\n",
+            dispatch_sets([]))
+
+    def test_sets(self):
+        """
+        ``dispatch_sets`` fills ``PORTS_SET`` with every proxied port and the
+        set of each destination with the ports proxied to it, swapping each
+        in once filled.
+        """
+        self.assertEqual(
+            b"create flocker-ports bitmap:port range 0-65535\n"
+            b"create flocker-ports-new bitmap:port range 0-65535\n"
+            b"flush flocker-ports-new\n"
+            b"add flocker-ports-new 3306\n"
+            b"add flocker-ports-new 8080\n"
+            b"swap flocker-ports-new flocker-ports\n"
+            b"destroy flocker-ports-new\n"
+            b"create flocker-to-0a000001 bitmap:port range 0-65535\n"
+            b"create flocker-to-0a000001-new bitmap:port range 0-65535\n"
+            b"flush flocker-to-0a000001-new\n"
+            b"add flocker-to-0a000001-new 3306\n"
+            b"add flocker-to-0a000001-new 8080\n"
+            b"swap flocker-to-0a000001-new flocker-to-0a000001\n"
+            b"destroy flocker-to-0a000001-new\n",
+            dispatch_sets([EXISTING, Proxy(ip=EXISTING.ip, port=8080)]))
+
+
+class DispatchRulesetTests(SynchronousTestCase):
+    """
+    Tests for ``dispatch_ruleset``.
+    """
+    def test_ruleset(self):
+        """
+        ``dispatch_ruleset`` returns a single NAT table transaction which
+        flushes Flocker's chains, runs the setup, returns early for ports not
+        in ``PORTS_SET`` and has one DNAT rule per destination in each of
+        ``FLOCKER-PREROUTING`` and ``FLOCKER-OUTPUT``.
+        """
+        self.assertEqual(
+            b"*nat\n"
+            b":FLOCKER-PREROUTING - [0:0]\n"
+            b":FLOCKER-OUTPUT - [0:0]\n"
+            b":FLOCKER-POSTROUTING - [0:0]\n"
+            b"-A PREROUTING --jump FLOCKER-PREROUTING\n"
+            b"-A FLOCKER-PREROUTING --match comment "
+            b"--comment \"flocker chains ready\"\n"
+            b"-A FLOCKER-PREROUTING --protocol tcp --match set ! "
+            b"--match-set flocker-ports dst --jump RETURN\n"
+            b"-A FLOCKER-OUTPUT --protocol tcp --match set ! "
+            b"--match-set flocker-ports dst --jump RETURN\n"
+            b"-A FLOCKER-PREROUTING --protocol tcp --match set "
+            b"--match-set flocker-to-0a000001 dst "
+            b"--match addrtype --dst-type LOCAL "
+            b"--match comment --comment \"flocker create_proxy_to\" "
+            b"--jump DNAT --to-destination 10.0.0.1\n"
+            b"-A FLOCKER-OUTPUT --protocol tcp --match set "
+            b"--match-set flocker-to-0a000001 dst "
+            b"--match addrtype --dst-type LOCAL "
+            b"--jump DNAT --to-destination 10.0.0.1\n"
+            b"-A FLOCKER-POSTROUTING --protocol tcp --match set "
+            b"--match-set flocker-ports dst --jump MASQUERADE\n"
+            b"COMMIT\n",
+            dispatch_ruleset(
+                [EXISTING, Proxy(ip=EXISTING.ip, port=8080)],
+                [b"-A PREROUTING --jump FLOCKER-PREROUTING"]))
+
+    def test_dispatching(self):
+        """
+        ``dispatching`` finds the rules of ``DispatchNetwork`` in the listing
+        of Flocker's chain reached from ``PREROUTING``.
+        """
+        self.assertEqual((True, False),
+                         (dispatching(DISPATCH_RULES),
+                          dispatching(READY_RULES)))
+
+    def test_rules_per_destination(self):
+        """
+        The number of rules depends on the number of destinations, not on
+        the number of proxies.
+        """
+        few = [EXISTING, NEW]
+        many = few + [Proxy(ip=proxy.ip, port=port)
+                      for proxy in few for port in range(10000, 10100)]
+        self.assertEqual(len(dispatch_ruleset(few).splitlines()),
+                         len(dispatch_ruleset(many).splitlines()))
+
+
+class DispatchNetworkTests(SynchronousTestCase):
+    """
+    Tests for ``DispatchNetwork``.
+    """
+    def setUp(self):
+        self.reactor = FakeProcessReactor()
+        # A stand-in for /proc/sys/net/ipv4/conf:
+        self.conf = FilePath(self.mktemp())
+        self.conf.child(b"default").makedirs()
+        self.network = DispatchNetwork(self.reactor, ipv4_conf=self.conf)
+
+    def test_interface(self):
+        """
+        ``DispatchNetwork`` provides ``ITransactionalNetwork``.
+        """
+        self.assertTrue(verifyObject(ITransactionalNetwork, self.network))
+
+    def test_host_network(self):
+        """
+        ``make_host_network`` creates a ``DispatchNetwork`` in dispatch
+        mode.
+        """
+        self.assertIsInstance(make_host_network(self.reactor, dispatch=True),
+                              DispatchNetwork)
+
+    def test_set_proxies(self):
+        """
+        The first time, ``DispatchNetwork.set_proxies`` checks Flocker's
+        chains and lists the ipsets, fills the sets with ``ipset restore``,
+        replaces the rules with ``iptables-restore`` and then destroys the
+        sets of destinations no longer proxied to.
+        """
+        d = self.network.set_proxies([NEW])
+        finish(self.reactor.processes[0], output=READY_RULES)
+        finish(self.reactor.processes[1],
+               output=b"flocker-ports\nflocker-to-0a000001\n")
+        finish(self.reactor.processes[2])
+        finish(self.reactor.processes[3])
+        finish(self.reactor.processes[4])
+        self.assertEqual(
+            ([LIST_RULES,
+              [b"ipset", b"list", b"-name"],
+              [b"ipset", b"-exist", b"restore"],
+              [b"iptables-restore", b"--noflush"],
+              [b"ipset", b"restore"]],
+             [dispatch_sets([NEW]), dispatch_ruleset([NEW]),
+              b"destroy flocker-to-0a000001\n"],
+             None),
+            ([process.args for process in self.reactor.processes],
+             [process.transport.stdin
+              for process in self.reactor.processes[2:]],
+             self.successResultOf(d)))
+
+    def test_enumerated(self):
+        """
+        ``DispatchNetwork.enumerate_proxies`` finds the proxies in Flocker's
+        ipsets.
+        """
+        FakeIPTables(self, DISPATCH, sets=DISPATCH_SETS)
+        self.assertEqual(
+            [EXISTING, Proxy(ip=EXISTING.ip, port=5432)],
+            self.network.enumerate_proxies())
+
+    def test_legacy_enumerated(self):
+        """
+        Until ``DispatchNetwork.set_proxies`` has replaced the rules in
+        Flocker's chains, ``DispatchNetwork.enumerate_proxies`` finds the
+        proxies with rules of their own.
+        """
+        FakeIPTables(self, LEGACY, sets=b"add flocker-to-0a000002 8080\n")
+        self.assertEqual([EXISTING], self.network.enumerate_proxies())
+
+    def test_sets_listed_once(self):
+        """
+        Once the sets have been listed, ``DispatchNetwork.set_proxies``
+        remembers which exist, and only destroys sets when a destination is
+        no longer proxied to.
+        """
+        self.network.set_proxies([NEW])
+        finish(self.reactor.processes[0], output=READY_RULES)
+        finish(self.reactor.processes[1], output=b"")
+        finish(self.reactor.processes[2])
+        finish(self.reactor.processes[3])
+        d = self.network.set_proxies([EXISTING])
+        finish(self.reactor.processes[4])
+        finish(self.reactor.processes[5])
+        finish(self.reactor.processes[6])
+        self.assertEqual(
+            ([[b"ipset", b"-exist", b"restore"],
+              [b"iptables-restore", b"--noflush"],
+              [b"ipset", b"restore"]],
+             b"destroy flocker-to-0a000002\n", None),
+            ([process.args for process in self.reactor.processes[4:]],
+             self.reactor.processes[-1].transport.stdin,
+             self.successResultOf(d)))
+
+    def test_failure(self):
+        """
+        If ``ipset`` fails, the ``Deferred`` returned by
+        ``DispatchNetwork.set_proxies`` fails with ``IPTablesFailed``, and
+        the sets are listed again next time.
+        """
+        d = self.network.set_proxies([NEW])
+        finish(self.reactor.processes[0], output=READY_RULES)
+        finish(self.reactor.processes[1], output=b"")
+        finish(self.reactor.processes[2], status=1,
+               errors=b"ipset v6.19: Kernel error\n")
+        self.failureResultOf(d, IPTablesFailed)
+        self.network.set_proxies([NEW])
+        finish(self.reactor.processes[3], output=READY_RULES)
+        self.assertEqual([b"ipset", b"list", b"-name"],
+                         self.reactor.processes[4].args)
+
+    def ready(self, proxies):
+        """
+        Set the proxies with ``DispatchNetwork.set_proxies``, so that the
+        state of Flocker's chains and sets is known, and record the blocking
+        commands run afterwards in ``self.runs``.
+
+        :param list proxies: The ``Proxy`` instances to set.
+        """
+        self.network.set_proxies(proxies)
+        finish(self.reactor.processes[0], output=READY_RULES)
+        finish(self.reactor.processes[1], output=b"")
+        finish(self.reactor.processes[2])
+        finish(self.reactor.processes[3])
+        self.runs = []
+        self.patch(_iptables, "_run_blocking",
+                   lambda argv, stdin=b"": self.runs.append((argv, stdin)))
+
+    def test_create_proxy_to_member(self):
+        """
+        Once the sets are known, ``DispatchNetwork.create_proxy_to`` for a
+        destination which already has a set just adds the port to that set
+        and then to ``PORTS_SET``, in one run of ``ipset``.
+        """
+        self.ready([EXISTING])
+        proxy = self.network.create_proxy_to(EXISTING.ip, 8080)
+        self.assertEqual(
+            ([([b"ipset", b"-exist", b"restore"],
+               b"add flocker-to-0a000001 8080\nadd flocker-ports 8080\n")],
+             Proxy(ip=EXISTING.ip, port=8080)),
+            (self.runs, proxy))
+
+    def test_create_proxy_to_new_destination(self):
+        """
+        ``DispatchNetwork.create_proxy_to`` for a destination with no set
+        replaces all of the sets and rules, so the destination gets a rule.
+        """
+        self.ready([EXISTING])
+        FakeIPTables(self, READY, sets=b"add flocker-to-0a000001 3306\n")
+        self.network.create_proxy_to(NEW.ip, NEW.port)
+        self.assertEqual(
+            [([b"ipset", b"-exist", b"restore"],
+              dispatch_sets([EXISTING, NEW])),
+             ([b"iptables-restore", b"--noflush"],
+              dispatch_ruleset([EXISTING, NEW]))],
+            self.runs)
+
+    def test_delete_proxy_member(self):
+        """
+        Once the sets are known, ``DispatchNetwork.delete_proxy`` just
+        deletes the port from ``PORTS_SET`` and then from the set of its
+        destination, in one run of ``ipset``.
+        """
+        self.ready([EXISTING, NEW])
+        self.network.delete_proxy(NEW)
+        self.assertEqual(
+            [([b"ipset", b"-exist", b"restore"],
+              b"del flocker-ports 8080\ndel flocker-to-0a000002 8080\n")],
+            self.runs)
+
+    def test_delete_proxy_unknown(self):
+        """
+        Until the sets are known, ``DispatchNetwork.delete_proxy`` replaces
+        all of the sets and rules.
+        """
+        self.runs = []
+        self.patch(_iptables, "_run_blocking",
+                   lambda argv, stdin=b"": self.runs.append((argv, stdin)))
+        FakeIPTables(self, READY, sets=b"add flocker-to-0a000001 3306\n")
+        self.network.delete_proxy(EXISTING)
+        self.assertEqual(
+            [([b"ipset", b"-exist", b"restore"], dispatch_sets([])),
+             ([b"iptables-restore", b"--noflush"], dispatch_ruleset([])),
+             ([b"ipset", b"restore"], b"destroy flocker-to-0a000001\n")],
+            self.runs)
+
+    def test_member_failure(self):
+        """
+        If changing a set's members fails, ``IPTablesFailed`` is raised and
+        the next change replaces all of the sets and rules.
+        """
+        self.ready([EXISTING])
+
+        def fail(argv, stdin=b""):
+            raise IPTablesFailed(argv, 1, b"ipset v6.19: Kernel error\n")
+        self.patch(_iptables, "_run_blocking", fail)
+        self.assertRaises(IPTablesFailed, self.network.delete_proxy, EXISTING)
+        self.patch(_iptables, "_run_blocking",
+                   lambda argv, stdin=b"": self.runs.append((argv, stdin)))
+        FakeIPTables(self, READY, sets=b"add flocker-to-0a000001 3306\n")
+        self.network.create_proxy_to(EXISTING.ip, 8080)
+        self.assertEqual(
+            [[b"ipset", b"-exist", b"restore"],
+             [b"iptables-restore", b"--noflush"]],
+            [argv for argv, stdin in self.runs])
+
+    @validateLogging(None)
+    def test_logged(self, logger):
+        """
+        Changes to the sets are logged as ``flocker:route:ipset_restore``
+        actions.
+        """
+        self.network.logger = logger
+        self.network.set_proxies([])
+        finish(self.reactor.processes[0], output=READY_RULES)
+        finish(self.reactor.processes[1], output=b"")
+        finish(self.reactor.processes[2])
+        finish(self.reactor.processes[3])
+        assertHasAction(self, logger, IPSET_RESTORE, True,
+                        {u"sets": dispatch_sets([])})
+
+
+class UsedTCPPortsTests(SynchronousTestCase):
+    """
+    Tests for ``used_tcp_ports``.
+    """
+    def setUp(self):
+        self.proc_net = FilePath(self.mktemp())
+        self.proc_net.makedirs()
+        self.proc_net.child(b"tcp").setContent(PROC_NET_TCP)
+
+    def test_ports(self):
+        """
+        ``used_tcp_ports`` finds the local ports of the listening and
+        connected sockets in both ``tcp`` and ``tcp6``.
+        """
+        self.proc_net.child(b"tcp6").setContent(PROC_NET_TCP6)
+        self.assertEqual({8000, 53012, 80}, used_tcp_ports(self.proc_net))
+
+    def test_no_ipv6(self):
+        """
+        If there is no ``tcp6`` table, ``used_tcp_ports`` finds the ports in
+        ``tcp``.
+        """
+        self.assertEqual({8000, 53012}, used_tcp_ports(self.proc_net))
+
+    def test_all_states(self):
+        """
+        ``used_tcp_ports`` finds the local ports of sockets in every state,
+        not only listening ones.
+        """
+        header = PROC_NET_TCP.splitlines(True)[0]
+        line = (b"   %d: 0100007F:%04X 0100007F:0016 %s 00000000:00000000 "
+                b"00:00000000 00000000     0        0 %d 1 ffff8800 "
+                b"100 0 0 10 0\n")
+        states = [b"01", b"02", b"06", b"08", b"0A", b"0B"]
+        self.proc_net.child(b"tcp").setContent(header + b"".join(
+            line % (i, 9000 + i, state, 10000 + i)
+            for i, state in enumerate(states)))
+        self.assertEqual(set(range(9000, 9000 + len(states))),
+                         used_tcp_ports(self.proc_net))
+
+
+class CacheTests(SynchronousTestCase):
+    """
+    Tests for the caching of the proxies and used ports found by
+    ``RestoreNetwork``.
+    """
+    def setUp(self):
+        self.reactor = FakeProcessReactor()
+        self.conf = FilePath(self.mktemp())
+        self.conf.child(b"default").makedirs()
+        self.network = RestoreNetwork(self.reactor, ipv4_conf=self.conf)
+        self.reads = []
+
+        def read_proxies():
+            self.reads.append(self.reactor.seconds())
+            return [EXISTING]
+        self.network._read_proxies = read_proxies
+        self.network.proc_net = FilePath(self.mktemp())
+        self.network.proc_net.makedirs()
+        self.network.proc_net.child(b"tcp").setContent(PROC_NET_TCP)
+
+    def test_default_ttl(self):
+        """
+        By default lookups are reused for ``CACHE_TTL`` seconds.
+        """
+        self.assertEqual(CACHE_TTL, self.network.cache_ttl)
+
+    def test_reused(self):
+        """
+        Proxies found less than ``cache_ttl`` seconds ago are reused, by both
+        ``enumerate_proxies`` and ``enumerate_used_ports``.
+        """
+        proxies = self.network.enumerate_proxies()
+        self.reactor.advance(CACHE_TTL - 0.5)
+        ports = self.network.enumerate_used_ports()
+        self.assertEqual(
+            ([EXISTING], [EXISTING], frozenset([8000, 53012, 3306]), [0]),
+            (proxies, self.network.enumerate_proxies(), ports, self.reads))
+
+    def test_used_ports_reused(self):
+        """
+        Used ports found less than ``cache_ttl`` seconds ago are reused.
+        """
+        self.network.enumerate_used_ports()
+        self.network.proc_net.child(b"tcp").setContent(b"header\n")
+        self.assertEqual(frozenset([8000, 53012, 3306]),
+                         self.network.enumerate_used_ports())
+
+    def test_expires(self):
+        """
+        Once ``cache_ttl`` seconds have passed, the proxies are read again.
+        """
+        self.network.enumerate_proxies()
+        self.reactor.advance(CACHE_TTL)
+        self.network.enumerate_proxies()
+        self.assertEqual([0, CACHE_TTL], self.reads)
+
+    def test_set_proxies(self):
+        """
+        ``RestoreNetwork.set_proxies`` discards what was found, so the
+        proxies are read again once it has finished.
+        """
+        self.network.enumerate_proxies()
+        self.network.set_proxies([])
+        finish(self.reactor.processes[0], output=READY_RULES)
+        finish(self.reactor.processes[1])
+        self.network.enumerate_proxies()
+        self.assertEqual([0, 0], self.reads)
+
+    def test_create_proxy_to(self):
+        """
+        ``RestoreNetwork.create_proxy_to`` discards what was found.
+        """
+        self.patch(HostNetwork, "create_proxy_to", lambda self, ip, port: None)
+        self.network.enumerate_proxies()
+        self.network.create_proxy_to(NEW.ip, NEW.port)
+        self.network.enumerate_proxies()
+        self.assertEqual([0, 0], self.reads)
+
+    def test_delete_proxy(self):
+        """
+        ``RestoreNetwork.delete_proxy`` discards what was found.
+        """
+        self.patch(HostNetwork, "delete_proxy", lambda self, proxy: None)
+        self.network.enumerate_proxies()
+        self.network.delete_proxy(EXISTING)
+        self.network.enumerate_proxies()
+        self.assertEqual([0, 0], self.reads)
@@ -52,14 +52,24 @@ class FakeProcessTransport(object):
     Mock process transport to observe signals sent to a process.
 
     @ivar signals: L{list} of signals sent to process.
+    @ivar stdin: L{bytes} written to the process's standard input.
+    @ivar stdin_closed: Whether the process's standard input was closed.
     """
 
     def __init__(self):
         self.signals = []
+        self.stdin = b""
+        self.stdin_closed = False
 
     def signalProcess(self, signal):
         self.signals.append(signal)
 
+    def write(self, data):
+        self.stdin += data
+
+    def closeStdin(self):
+        self.stdin_closed = True
+
 
 class SpawnProcessArguments(namedtuple(
                             'ProcessData',
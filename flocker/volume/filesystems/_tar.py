@@ -0,0 +1,393 @@
+# Copyright Hybrid Logic Ltd.  See LICENSE file for details.
+
+"""
+Streaming tar archives of directories, for the directory-backed filesystem.
+
+Unlike ``tarfile.TarFile`` writing into and reading from an in-memory buffer,
+both directions here work a chunk at a time so memory use does not depend on
+the size of the directory being copied.
+"""
+
+from __future__ import absolute_import
+
+import os
+from io import BytesIO
+from time import time
+from stat import S_IFBLK, S_IFCHR
+from tarfile import (
+    BLOCKSIZE, NUL, GNUTYPE_LONGNAME, GNUTYPE_LONGLINK, TarFile, TarInfo,
+    HeaderError, ReadError, ExtractError,
+)
+
+from twisted.python.filepath import InsecurePath
+
+
+# How much of a file to read at a time when archiving it:
+CHUNK_SIZE = 64 * 1024
+
+# The two zero blocks which mark the end of an archive:
+END_OF_ARCHIVE = NUL * (2 * BLOCKSIZE)
+
+
+def _padding(size):
+    """
+    :param int size: The size of some member data.
+
+    :return: The ``bytes`` padding needed to fill out the last block of that
+        data.
+    """
+    remainder = size % BLOCKSIZE
+    if remainder:
+        return NUL * (BLOCKSIZE - remainder)
+    return b""
+
+
+def _file_chunks(path, size, chunk_size):
+    """
+    Generate the contents of a file, a chunk at a time.
+
+    :param FilePath path: The file to read.
+    :param int size: The number of bytes to read, as recorded in the file's
+        tar header.
+    :param int chunk_size: The maximum size of each chunk.
+
+    :raise IOError: If the file is shorter than ``size``, e.g. because it
+        was truncated after its header was generated.
+    """
+    remaining = size
+    with path.open() as f:
+        while remaining:
+            chunk = f.read(min(chunk_size, remaining))
+            if not chunk:
+                raise IOError("%s shrank while being archived" % (path.path,))
+            remaining -= len(chunk)
+            yield chunk
+
+
+def file_member(name, content):
+    """
+    Create an archive member for a regular file from some in-memory content.
+
+    :param bytes name: The name of the member.
+    :param bytes content: The contents of the file.
+
+    :return: A ``list`` of ``bytes`` making up the member.
+    """
+    tarinfo = TarInfo(name)
+    tarinfo.size = len(content)
+    tarinfo.mtime = time()
+    return [tarinfo.tobuf(), content, _padding(len(content))]
+
+
+def tree_members(root, arcname=None, include=None, chunk_size=CHUNK_SIZE):
+    """
+    Generate archive members for the contents of a directory.
+
+    Symbolic links are archived as links, not followed, and files with
+    several links inside ``root`` are archived once with hard links to them.
+
+    :param FilePath root: The directory to archive.
+    :param bytes arcname: If not ``None``, ``root`` itself is archived with
+        this name and its contents beneath it.  Otherwise only its contents
+        are archived, at the top level.
+    :param include: If not ``None``, a callable which is passed the
+        ``tuple`` of path segments of each entry relative to ``root`` and
+        returns whether to archive it.  The contents of excluded directories
+        are still considered.
+    :param int chunk_size: The maximum amount of a file's data to hold in
+        memory at once.
+
+    :return: An iterator of ``bytes`` which together make up the members.
+    """
+    # Only used for ``gettarinfo``, which keeps track of hard links:
+    archive = TarFile(fileobj=BytesIO(), mode="w")
+    prefix = [] if arcname is None else [arcname]
+    for path in root.walk(descend=lambda child: not child.islink()):
+        if path == root:
+            if arcname is None:
+                continue
+            segments = []
+        else:
+            segments = path.segmentsFrom(root)
+            if include is not None and not include(tuple(segments)):
+                continue
+        tarinfo = archive.gettarinfo(path.path, b"/".join(prefix + segments))
+        if tarinfo is None:
+            # Sockets can't be archived; tarfile skips them too.
+            continue
+        yield tarinfo.tobuf()
+        if tarinfo.isreg():
+            for chunk in _file_chunks(path, tarinfo.size, chunk_size):
+                yield chunk
+            yield _padding(tarinfo.size)
+
+
+def tar_chunks(root, chunk_size=CHUNK_SIZE):
+    """
+    Generate a tar archive of the contents of a directory.
+
+    :param FilePath root: The directory to archive.  It is not itself
+        included in the archive, only its contents.
+    :param int chunk_size: The maximum amount of a file's data to hold in
+        memory at once.
+
+    :return: An iterator of ``bytes`` which together make up the archive.
+    """
+    for chunk in tree_members(root, chunk_size=chunk_size):
+        yield chunk
+    yield END_OF_ARCHIVE
+
+
+class ChunkReader(object):
+    """
+    A readable file-like object which reads from an iterator of ``bytes``.
+
+    Only as much of the iterator as is needed to satisfy each ``read`` is
+    consumed.
+    """
+    def __init__(self, chunks):
+        """
+        :param chunks: An iterator of ``bytes``.
+        """
+        self._chunks = iter(chunks)
+        self._buffer = b""
+
+    def read(self, size=-1):
+        """
+        Read up to ``size`` bytes, or everything that remains if ``size`` is
+        negative.
+
+        :return: ``bytes``, empty once the iterator is exhausted.
+        """
+        if size < 0:
+            result = self._buffer + b"".join(self._chunks)
+            self._buffer = b""
+            return result
+        pieces = [self._buffer]
+        length = len(self._buffer)
+        while length < size:
+            try:
+                chunk = next(self._chunks)
+            except StopIteration:
+                break
+            pieces.append(chunk)
+            length += len(chunk)
+        data = b"".join(pieces)
+        result, self._buffer = data[:size], data[size:]
+        return result
+
+
+class TarExtractor(object):
+    """
+    Extract a tar archive into a directory as its bytes are written.
+
+    Member data is written to disk as it arrives, so memory use is bounded by
+    the size of the chunks written rather than the size of the archive.
+    Anything written after the end-of-archive marker is ignored.
+
+    Errors don't interrupt whoever is writing: the rest of the archive is
+    discarded and the error is raised by ``close``, much like the exit status
+    of a ``tar`` process being fed through a pipe.
+
+    Only the member types and GNU long name extensions produced by
+    ``tree_members`` are supported.
+    """
+    def __init__(self, root):
+        """
+        :param FilePath root: The existing directory to extract into.
+        """
+        self._root = root
+        self._pending = b""
+        self._state = self._header
+        self._size = self._remaining = 0
+        self._sink = None
+        self._done = None
+        self._file = None
+        self._long_names = {}
+        self._directories = []
+        self._finished = False
+        self._error = None
+
+    def write(self, data):
+        """
+        Extract the next part of the archive.
+
+        :param bytes data: The next bytes of the archive.
+        """
+        if self._finished or self._error is not None:
+            return
+        if self._pending:
+            data = self._pending + data
+            self._pending = b""
+        offset = 0
+        try:
+            while offset < len(data) and not self._finished:
+                offset = self._state(data, offset)
+        except (EnvironmentError, ExtractError, ReadError) as e:
+            self._close_file()
+            self._error = e
+
+    def close(self):
+        """
+        Finish extracting the archive.
+
+        :raise: The first error encountered extracting the archive, or
+            ``tarfile.ReadError`` if the archive was incomplete.
+        """
+        self._close_file()
+        if self._error is None and not self._finished:
+            self._error = ReadError("unexpected end of archive")
+        if self._error is not None:
+            raise self._error
+        # Like ``TarFile.extractall``, set directory attributes last, deepest
+        # first, so extracting their contents doesn't change their times and
+        # read-only directories can still be populated.
+        for tarinfo, path in reversed(self._directories):
+            self._set_attributes(tarinfo, path)
+
+    def _close_file(self):
+        """
+        Close the regular file currently being extracted, if any.
+        """
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def _header(self, data, offset):
+        """
+        Parse the next member's header block.
+        """
+        block = data[offset:offset + BLOCKSIZE]
+        if len(block) < BLOCKSIZE:
+            self._pending = block
+            return len(data)
+        if block == NUL * BLOCKSIZE:
+            self._finished = True
+        else:
+            try:
+                tarinfo = TarInfo.frombuf(block)
+            except HeaderError as e:
+                raise ReadError(str(e))
+            if tarinfo.type in (GNUTYPE_LONGNAME, GNUTYPE_LONGLINK):
+                pieces = []
+
+                def got_long_name():
+                    self._long_names[tarinfo.type] = (
+                        b"".join(pieces).split(NUL, 1)[0])
+                self._start_data(tarinfo.size, pieces.append, got_long_name)
+            else:
+                self._extract(tarinfo)
+        return offset + BLOCKSIZE
+
+    def _start_data(self, size, sink, done):
+        """
+        Start reading a member's data.
+
+        :param int size: The length of the data.
+        :param sink: Callable which is called with each piece of the data.
+        :param done: Callable which is called with no arguments once all of
+            the data has been passed to ``sink``.
+        """
+        self._size = self._remaining = size
+        self._sink = sink
+        self._done = done
+        self._state = self._data
+        if not size:
+            self._end_data()
+
+    def _data(self, data, offset):
+        """
+        Pass member data to the current sink.
+        """
+        piece = data[offset:offset + self._remaining]
+        self._sink(piece)
+        self._remaining -= len(piece)
+        if not self._remaining:
+            self._end_data()
+        return offset + len(piece)
+
+    def _end_data(self):
+        """
+        Finish reading a member's data and skip its padding.
+        """
+        self._done()
+        self._sink = self._done = None
+        self._remaining = len(_padding(self._size))
+        self._state = self._skip if self._remaining else self._header
+
+    def _skip(self, data, offset):
+        """
+        Skip padding after member data.
+        """
+        skipped = min(self._remaining, len(data) - offset)
+        self._remaining -= skipped
+        if not self._remaining:
+            self._state = self._header
+        return offset + skipped
+
+    def _child(self, name):
+        """
+        :param bytes name: The name of an archive member.
+
+        :raise ExtractError: If ``name`` would be outside the root.
+
+        :return: The ``FilePath`` to extract the member to.
+        """
+        segments = [segment for segment in name.split(b"/")
+                    if segment not in (b"", b".")]
+        try:
+            return self._root.descendant(segments)
+        except InsecurePath:
+            raise ExtractError("Refusing to extract %r" % (name,))
+
+    def _extract(self, tarinfo):
+        """
+        Create a member of the archive.
+
+        :param TarInfo tarinfo: The member's header.
+        """
+        path = self._child(
+            self._long_names.pop(GNUTYPE_LONGNAME, tarinfo.name))
+        linkname = self._long_names.pop(GNUTYPE_LONGLINK, tarinfo.linkname)
+        if tarinfo.isdir():
+            if not path.isdir():
+                os.mkdir(path.path, 0700)
+            self._directories.append((tarinfo, path))
+            return
+        if tarinfo.isreg():
+            self._file = path.open("w")
+
+            def extracted():
+                self._close_file()
+                self._set_attributes(tarinfo, path)
+            self._start_data(tarinfo.size, self._file.write, extracted)
+            return
+        if tarinfo.issym():
+            os.symlink(linkname, path.path)
+        elif tarinfo.islnk():
+            os.link(self._child(linkname).path, path.path)
+        elif tarinfo.isfifo():
+            os.mkfifo(path.path)
+        elif tarinfo.ischr() or tarinfo.isblk():
+            kind = S_IFCHR if tarinfo.ischr() else S_IFBLK
+            os.mknod(path.path, tarinfo.mode | kind,
+                     os.makedev(tarinfo.devmajor, tarinfo.devminor))
+        else:
+            raise ExtractError(
+                "Unsupported member type %r for %r" % (
+                    tarinfo.type, tarinfo.name))
+        self._set_attributes(tarinfo, path)
+
+    def _set_attributes(self, tarinfo, path):
+        """
+        Give an extracted member the ownership, permissions and modification
+        time recorded in the archive.
+
+        :param TarInfo tarinfo: The member's header.
+        :param FilePath path: The extracted member.
+        """
+        if os.geteuid() == 0:
+            os.lchown(path.path, tarinfo.uid, tarinfo.gid)
+        if not tarinfo.issym():
+            os.chmod(path.path, tarinfo.mode)
+            os.utime(path.path, (tarinfo.mtime, tarinfo.mtime))
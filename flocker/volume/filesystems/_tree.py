@@ -0,0 +1,295 @@
+# Copyright Hybrid Logic Ltd.  See LICENSE file for details.
+
+"""
+Snapshotting, comparing and copying directory trees, for the
+directory-backed filesystem.
+
+Snapshots are trees of hard links in the style of ``rsnapshot``: a file which
+hasn't changed since the previous snapshot is a hard link to that snapshot's
+copy, so each snapshot only costs as much space as the files which changed.
+Files in a snapshot are never hard links to the live files, since those may
+be modified in place.
+"""
+
+from __future__ import absolute_import
+
+import errno
+import os
+import shutil
+from fcntl import ioctl
+from stat import S_IFMT, S_ISDIR, S_ISLNK, S_ISREG
+
+
+# The Linux ioctl which makes one file a reflink of another, _IOW(0x94, 9,
+# int):
+FICLONE = 0x40049409
+
+# The errors with which FICLONE indicates the files can't share blocks, as
+# opposed to some other problem copying:
+_REFLINK_UNSUPPORTED = frozenset({
+    errno.EOPNOTSUPP, errno.ENOTTY, errno.EXDEV, errno.EINVAL, errno.ENOSYS,
+})
+
+# How much of a file to hold in memory at once when copying it:
+_CHUNK_SIZE = 1024 * 1024
+
+# ``os.utime`` only has microsecond precision, so a copy's modification time
+# can differ from the original's by a tiny amount:
+_MTIME_RESOLUTION = 1e-5
+
+
+def _walk(root):
+    """
+    Walk a directory tree without following symbolic links.
+
+    :param FilePath root: The directory to walk.
+
+    :return: An iterator of ``(segments, path)`` tuples for everything
+        beneath ``root``, parents before their children.  ``segments`` is the
+        ``tuple`` of path segments of ``path`` relative to ``root``.
+    """
+    for path in root.walk(descend=lambda child: not child.islink()):
+        if path != root:
+            yield tuple(path.segmentsFrom(root)), path
+
+
+def _lstat(path):
+    """
+    :param FilePath path: A path which may not exist.
+
+    :return: The result of ``os.lstat`` on ``path``, or ``None`` if it does
+        not exist.
+    """
+    try:
+        return os.lstat(path.path)
+    except OSError:
+        return None
+
+
+def _same_file(path, other):
+    """
+    Determine whether two regular files look the same, like ``rsync``'s
+    quick check.
+
+    :param FilePath path: A regular file.
+    :param FilePath other: A path which may or may not be a regular file
+        with the same permissions, size and modification time as ``path``.
+
+    :return: ``True`` if ``other`` looks the same as ``path``, otherwise
+        ``False``.
+    """
+    first, second = _lstat(path), _lstat(other)
+    return (second is not None and S_ISREG(second.st_mode)
+            and first.st_mode == second.st_mode
+            and first.st_size == second.st_size
+            and abs(first.st_mtime - second.st_mtime) < _MTIME_RESOLUTION)
+
+
+def _remove(path):
+    """
+    Remove a path, whatever it is, if it exists.
+
+    :param FilePath path: The path to remove.
+    """
+    if os.path.lexists(path.path):
+        path.remove()
+
+
+def copy_file(source, destination):
+    """
+    Copy a regular file's contents, permissions and modification time.
+
+    Where the filesystem supports it (e.g. btrfs or XFS) the copy is a
+    reflink, sharing the original's blocks until either is changed, so it
+    takes constant time and space whatever the size of the file.  Otherwise
+    the contents are copied a chunk at a time.
+
+    :param FilePath source: The file to copy.
+    :param FilePath destination: The path of the new copy, which must not
+        exist.
+    """
+    with source.open() as source_file:
+        with destination.open("w") as destination_file:
+            try:
+                ioctl(destination_file.fileno(), FICLONE, source_file.fileno())
+            except IOError as e:
+                if e.errno not in _REFLINK_UNSUPPORTED:
+                    raise
+                shutil.copyfileobj(source_file, destination_file, _CHUNK_SIZE)
+    shutil.copystat(source.path, destination.path)
+
+
+def snapshot_tree(source, destination, previous=None):
+    """
+    Take a snapshot of a directory tree.
+
+    Sockets, devices and named pipes aren't included in the snapshot.
+
+    :param FilePath source: The directory to snapshot.
+    :param FilePath destination: Where to create the snapshot, which must
+        not exist.
+    :param FilePath previous: If not ``None``, an earlier snapshot of
+        ``source``.  Files which are unchanged since then are hard linked to
+        it rather than copied.
+    """
+    destination.createDirectory()
+    directories = [(source, destination)]
+    for segments, path in _walk(source):
+        target = destination.descendant(segments)
+        if path.islink():
+            os.symlink(os.readlink(path.path), target.path)
+        elif path.isdir():
+            target.createDirectory()
+            directories.append((path, target))
+        elif path.isfile():
+            if previous is not None:
+                earlier = previous.descendant(segments)
+                if _same_file(path, earlier):
+                    os.link(earlier.path, target.path)
+                    continue
+            copy_file(path, target)
+    for path, target in reversed(directories):
+        shutil.copystat(path.path, target.path)
+
+
+def _differs(path, earlier):
+    """
+    Determine whether an entry in a snapshot differs from the entry at the
+    same place in an earlier snapshot.
+
+    :param FilePath path: An entry in a snapshot.
+    :param FilePath earlier: The same entry in an earlier snapshot, which
+        may not exist.
+
+    :return: ``True`` if the entry was added or changed between the
+        snapshots, otherwise ``False``.
+    """
+    first, second = _lstat(path), _lstat(earlier)
+    if second is None or S_IFMT(first.st_mode) != S_IFMT(second.st_mode):
+        return True
+    if S_ISREG(first.st_mode):
+        # Unchanged files are hard links between snapshots.
+        return (first.st_dev, first.st_ino) != (second.st_dev, second.st_ino)
+    if S_ISLNK(first.st_mode):
+        return os.readlink(path.path) != os.readlink(earlier.path)
+    return first.st_mode != second.st_mode
+
+
+def tree_delta(tree, base):
+    """
+    Compare two snapshots of the same directory tree.
+
+    :param FilePath tree: A snapshot.
+    :param FilePath base: An earlier snapshot.
+
+    :return: A ``tuple`` of a ``set`` and a ``list``, both of path segment
+        ``tuple`` instances.  The ``set`` has the entries of ``tree`` which
+        were added or changed since ``base``, along with all of their parent
+        directories.  The ``list`` has the entries of ``base`` which were
+        removed by ``tree``, but not their contents.
+    """
+    changed = set()
+    for segments, path in _walk(tree):
+        if _differs(path, base.descendant(segments)):
+            changed.update(segments[:i] for i in range(1, len(segments) + 1))
+
+    def descend(child):
+        counterpart = tree.descendant(child.segmentsFrom(base))
+        return counterpart.isdir() and not counterpart.islink()
+
+    removed = []
+    for path in base.walk(descend=descend):
+        if path == base:
+            continue
+        segments = tuple(path.segmentsFrom(base))
+        if not os.path.lexists(tree.descendant(segments).path):
+            removed.append(segments)
+    return changed, removed
+
+
+def merge_tree(base, destination, excluded, segments=()):
+    """
+    Complete a partial snapshot by hard linking in everything it lacks from
+    an earlier snapshot.
+
+    :param FilePath base: The earlier snapshot.
+    :param FilePath destination: The partial snapshot.  Entries it already
+        has take precedence over those in ``base``.
+    :param excluded: A container of path segment ``tuple`` instances of
+        entries of ``base`` which should not be merged, along with their
+        contents.
+    :param tuple segments: The path segments of ``base`` relative to the
+        top of the snapshot, for recursive calls.
+    """
+    for child in base.children():
+        child_segments = segments + (child.basename(),)
+        if child_segments in excluded:
+            continue
+        target = destination.child(child.basename())
+        is_directory = child.isdir() and not child.islink()
+        existing = _lstat(target)
+        if existing is not None:
+            if is_directory and S_ISDIR(existing.st_mode):
+                merge_tree(child, target, excluded, child_segments)
+            continue
+        if child.islink():
+            os.symlink(os.readlink(child.path), target.path)
+        elif is_directory:
+            target.createDirectory()
+            merge_tree(child, target, excluded, child_segments)
+            shutil.copystat(child.path, target.path)
+        else:
+            os.link(child.path, target.path)
+
+
+def sync_tree(source, destination):
+    """
+    Make a directory tree a copy of another, only copying files which look
+    different.
+
+    Each file is replaced atomically, but the tree as a whole is not.
+
+    :param FilePath source: The directory to copy.
+    :param FilePath destination: The directory to make a copy of
+        ``source``.  It is created if necessary.
+    """
+    if not destination.isdir() or destination.islink():
+        _remove(destination)
+        destination.makedirs()
+
+    def descend(child):
+        counterpart = source.descendant(child.segmentsFrom(destination))
+        return (not child.islink() and counterpart.isdir()
+                and not counterpart.islink())
+
+    for path in list(destination.walk(descend=descend)):
+        if path == destination:
+            continue
+        counterpart = source.descendant(path.segmentsFrom(destination))
+        if not os.path.lexists(counterpart.path):
+            path.remove()
+
+    directories = [(source, destination)]
+    for segments, path in _walk(source):
+        target = destination.descendant(segments)
+        if path.islink():
+            link = os.readlink(path.path)
+            if target.islink() and os.readlink(target.path) == link:
+                continue
+            _remove(target)
+            os.symlink(link, target.path)
+        elif path.isdir():
+            if not target.isdir() or target.islink():
+                _remove(target)
+                target.createDirectory()
+            directories.append((path, target))
+        elif path.isfile():
+            if _same_file(path, target):
+                continue
+            if target.isdir() and not target.islink():
+                target.remove()
+            temporary = target.temporarySibling()
+            copy_file(path, temporary)
+            temporary.moveTo(target)
+    for path, target in reversed(directories):
+        shutil.copystat(path.path, target.path)
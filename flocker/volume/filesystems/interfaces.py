@@ -111,27 +111,39 @@ class IFilesystem(Interface):
 class IStoragePool(Interface):
     """Pool of on-disk storage where filesystems are stored."""
 
-    def create(volume):
+    def create(volume, properties=frozenset()):
         """
         Create a new filesystem for the given volume.
 
         :param volume: The volume whose filesystem should be created.
         :type volume: :class:`flocker.volume.service.Volume`
 
+        :param frozenset properties: Storage properties to set on the new
+            filesystem, as (name, value) ``tuple``\ s, e.g.
+            ``(b"recordsize", b"8k")``.  Pools without a notion of such
+            properties may ignore them.
+
         :return: Deferred that fires on filesystem creation with a
             :class:`IFilesystem` provider, or errbacks if creation failed.
         """
 
-    def clone_to(parent, volume):
+    def clone_to(parent, volume, properties=frozenset()):
         """
         Clone an existing volume to create a new one.
 
+        The new filesystem has the same storage properties as the parent
+        filesystem.
+
         :param parent: A :class:`flocker.volume.service.Volume` whose
            filesystem will be cloned to create the new filesystem.
 
         :param volume: The volume whose filesystem should be created.
         :type volume: :class:`flocker.volume.service.Volume`
 
+        :param frozenset properties: Additional storage properties to set
+            on the new filesystem, overriding those of the parent.  See
+            ``create``.
+
         :return: Deferred that fires on filesystem cloning with a
             :class:`IFilesystem` provider, or errbacks if cloning failed.
         """
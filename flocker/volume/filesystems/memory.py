@@ -6,8 +6,8 @@ from __future__ import absolute_import
 
 from errno import ENOENT
 from contextlib import contextmanager
-from tarfile import TarFile
-from io import BytesIO
+from itertools import chain
+from uuid import uuid4
 
 from zope.interface import implementer
 
@@ -19,7 +19,11 @@ from twisted.application.service import Service
 from .interfaces import (
     IFilesystemSnapshots, IStoragePool, IFilesystem,
     FilesystemAlreadyExists)
-from .zfs import Snapshot
+from .zfs import Snapshot, _latest_common_snapshot
+from ._tar import (
+    END_OF_ARCHIVE, ChunkReader, TarExtractor, file_member, tree_members,
+)
+from ._tree import merge_tree, snapshot_tree, sync_tree, tree_delta
 
 
 @implementer(IFilesystemSnapshots)
@@ -48,23 +52,54 @@ class DirectoryFilesystem(object):
     """
     A directory pretending to be an independent filesystem.
 
-    Snapshots are also supported in a pretend way.  A file is kept in the
-    directory recording the names of snapshots which supposedly have been
-    taken.  No other state related to snapshots is tracked (eg, the state of
-    the directory at the time of those snapshots is not recorded).
+    Snapshots are trees of hard links kept in a hidden sibling directory,
+    along with a file listing their names from oldest to newest.  Only files
+    which changed since the previous snapshot take up more space.  Streams
+    based on a snapshot the receiver already has only contain the changes
+    since that snapshot.
+
+    Once a snapshot has been sent or received only it is kept, as the base
+    for the next incremental stream; older snapshots are deleted.
     """
     def get_path(self):
         return self.path
 
+    def _snapshot_directory(self):
+        """
+        :return: The ``FilePath`` of the directory where this filesystem's
+            snapshots are kept.
+        """
+        return self.path.sibling(b".%s.snapshots" % (self.path.basename(),))
+
+    def _tree(self, snapshot):
+        """
+        :param Snapshot snapshot: One of this filesystem's snapshots.
+
+        :return: The ``FilePath`` of the snapshot's tree of files.
+        """
+        return self._snapshot_directory().child(b"trees").child(snapshot.name)
+
+    def _staging_directory(self):
+        """
+        Create a new, uniquely named directory in which to assemble a
+        snapshot.
+
+        :return: The ``FilePath`` of the new directory.
+        """
+        staging = self._snapshot_directory().child(
+            b"incoming-%s" % (uuid4().hex,))
+        staging.makedirs()
+        return staging
+
     def _snapshots(self):
         """
-        Load the pretend snapshot data.
+        Load the snapshot index.
 
-        :return: A ``list`` of ``Snapshot`` instances.  These will correspond
-            to the pretend snapshots taken by the ``snapshot`` method.
+        :return: A ``list`` of ``Snapshot`` instances, ordered from oldest to
+            newest.
         """
         try:
-            data = self.get_path().child(b".snapshots").getContent()
+            data = self._snapshot_directory().child(b"index").getContent()
         except IOError as e:
             if e.errno != ENOENT:
                 raise
@@ -77,62 +112,158 @@ class DirectoryFilesystem(object):
             ]
         return snapshots
 
+    def _add_snapshot(self, name, tree):
+        """
+        Record a complete snapshot tree as the newest snapshot.
+
+        :param bytes name: The name of the snapshot.
+        :param FilePath tree: The snapshot's tree of files, which is moved
+            into place.
+        """
+        snapshot = Snapshot(name=name)
+        if snapshot in self._snapshots():
+            raise ValueError("Snapshot %r already exists" % (name,))
+        destination = self._tree(snapshot)
+        if not destination.parent().exists():
+            destination.parent().makedirs()
+        tree.moveTo(destination)
+        self._write_index(self._snapshots() + [snapshot])
+
+    def _write_index(self, snapshots):
+        """
+        Replace the snapshot index.
+
+        :param list snapshots: The ``Snapshot`` instances to record, ordered
+            from oldest to newest.
+        """
+        self._snapshot_directory().child(b"index").setContent(
+            b"".join(snapshot.name + b"\n" for snapshot in snapshots))
+
+    def _prune(self):
+        """
+        Delete every snapshot except the newest.
+
+        The index is updated before any tree is removed, so it never names a
+        snapshot whose tree is missing.
+        """
+        snapshots = self._snapshots()
+        self._write_index(snapshots[-1:])
+        for snapshot in snapshots[:-1]:
+            self._tree(snapshot).remove()
+
     def snapshots(self):
         """
-        Retrieve the snapshots which were previously taken, for pretend.
+        Retrieve the snapshots which were previously taken.
         """
         return succeed(self._snapshots())
 
     def snapshot(self, name):
         """
-        Pretend to take a snapshot.  Assign it the given name.
+        Take a snapshot of the filesystem's current contents.
+
+        :param bytes name: The name to give the snapshot.
         """
-        self.get_path().child(b".snapshots").setContent(
-            b"\n".join([
-                snapshot.name for snapshot in self._snapshots()] + [name])
-        )
+        snapshots = self._snapshots()
+        previous = self._tree(snapshots[-1]) if snapshots else None
+        staging = self._staging_directory()
+        try:
+            tree = staging.child(b"data")
+            snapshot_tree(self.path, tree, previous)
+            self._add_snapshot(name, tree)
+        finally:
+            staging.remove()
 
     @contextmanager
     def reader(self, remote_snapshots=None):
         """
         Package up filesystem contents as a tarball.
+
+        A new snapshot is taken and the tarball is generated from it as it is
+        read, so the contents are never held in memory all at once.  If
+        ``remote_snapshots`` includes one of this filesystem's snapshots, the
+        tarball only contains what changed since the latest of them.
+
+        The tarball has a ``snapshot`` member with the new snapshot's name and
+        the snapshot's files beneath ``data``.  Incremental tarballs also have
+        a ``base`` member with the name of the snapshot they are based on and
+        a ``deleted`` member with the NUL-separated paths of entries removed
+        since then.
+
+        Once the tarball has been read without error every snapshot except
+        the new one is deleted.
         """
-        result = BytesIO()
-        tarball = TarFile(fileobj=result, mode="w")
-        for child in self.path.children():
-            tarball.add(child.path, arcname=child.basename(), recursive=True)
-        tarball.close()
-
-        # You can append anything to the end of a tar stream without corrupting
-        # it.  Smuggle some data about the snapshots through here.  This lets
-        # tests verify that an incremental stream is really being produced
-        # without forcing us to implement actual incremental streams on top of
-        # dumb directories.
-        if remote_snapshots:
-            result.write(
-                u"\nincremental stream based on\n{}".format(
-                    u"\n".join(snapshot.name for snapshot in remote_snapshots)
-                ).encode("ascii")
-            )
-        result.seek(0, 0)
-        yield result
+        name = bytes(uuid4())
+        self.snapshot(name)
+        snapshots = self._snapshots()
+        tree = self._tree(snapshots[-1])
+        base = _latest_common_snapshot(remote_snapshots or [], snapshots)
+
+        members = [file_member(b"snapshot", name)]
+        if base is None:
+            data = tree_members(tree, b"data")
+        else:
+            changed, deleted = tree_delta(tree, self._tree(base))
+            members.append(file_member(b"base", base.name))
+            members.append(file_member(
+                b"deleted", b"\0".join(b"/".join(path) for path in deleted)))
+            data = tree_members(tree, b"data", include=changed.__contains__)
+        try:
+            yield ChunkReader(
+                chain(chain.from_iterable(members), data, [END_OF_ARCHIVE]))
+        finally:
+            data.close()
+        self._prune()
 
     @contextmanager
     def writer(self):
-        """Expect written bytes to be a tarball."""
-        result = BytesIO()
-        yield result
-        result.seek(0, 0)
+        """
+        Expect written bytes to be a tarball generated by ``reader``.
+
+        The tarball is extracted as it is written into a staging directory.
+        Only once it is complete is it recorded as a snapshot, and the
+        filesystem's contents updated to match it.  Older snapshots are then
+        deleted.
+        """
+        staging = self._staging_directory()
+        extractor = TarExtractor(staging)
         try:
-            tarball = TarFile(fileobj=result, mode="r")
-            if self.path.exists():
-                self.path.remove()
-            self.path.createDirectory()
-            tarball.extractall(self.path.path)
-        except:
-            # This should really be dealt with, e.g. logged:
-            # https://github.com/ClusterHQ/flocker/issues/122
-            pass
+            yield extractor
+            try:
+                extractor.close()
+                tree = self._receive(staging)
+            except:
+                # This should really be dealt with, e.g. logged:
+                # https://github.com/ClusterHQ/flocker/issues/122
+                pass
+            else:
+                sync_tree(tree, self.path)
+                self._prune()
+        finally:
+            staging.remove()
+
+    def _receive(self, staging):
+        """
+        Record a snapshot from an extracted tarball.
+
+        :param FilePath staging: The directory the tarball was extracted to.
+
+        :raise ValueError: If the tarball is incremental but its base
+            snapshot doesn't exist here, or if its snapshot already does.
+
+        :return: The ``FilePath`` of the new snapshot's tree of files.
+        """
+        name = staging.child(b"snapshot").getContent()
+        tree = staging.child(b"data")
+        if staging.child(b"base").exists():
+            base = Snapshot(name=staging.child(b"base").getContent())
+            if base not in self._snapshots():
+                raise ValueError("Missing base snapshot %r" % (base.name,))
+            deleted = staging.child(b"deleted").getContent()
+            merge_tree(self._tree(base), tree, {
+                tuple(path.split(b"/")) for path in deleted.split(b"\0")
+                if path})
+        self._add_snapshot(name, tree)
+        return self._tree(Snapshot(name=name))
 
 
 @implementer(IStoragePool)
@@ -151,21 +282,24 @@ class FilesystemStoragePool(Service):
         if not self._root.exists():
             self._root.createDirectory()
 
-    def create(self, volume):
+    def create(self, volume, properties=frozenset()):
+        # Directories have no storage properties, so those are ignored.
         filesystem = self.get(volume)
         filesystem.get_path().makedirs()
         return succeed(filesystem)
 
-    def clone_to(self, parent, volume):
+    def clone_to(self, parent, volume, properties=frozenset()):
         parent = self.get(parent)
         child = self.get(volume)
         if child.get_path().exists():
             return fail(FilesystemAlreadyExists())
 
         d = self.create(volume)
-        with parent.reader() as reader:
-            with child.writer() as writer:
-                writer.write(reader.read())
+        # Files are reflinked where the filesystem supports it, so cloning
+        # is cheap on e.g. btrfs or XFS.  Hard links would be cheap
+        # everywhere but aren't copy-on-write: writing to a file in place
+        # would change it in both filesystems.
+        sync_tree(parent.get_path(), child.get_path())
         return d
 
     def change_owner(self, volume, new_volume):
@@ -180,6 +314,9 @@ class FilesystemStoragePool(Service):
             return fail(FilesystemAlreadyExists())
 
         old_filesystem.get_path().moveTo(new_filesystem.get_path())
+        snapshots = old_filesystem._snapshot_directory()
+        if snapshots.exists():
+            snapshots.moveTo(new_filesystem._snapshot_directory())
         return succeed(new_filesystem)
 
     def get(self, volume):
@@ -189,7 +326,9 @@ class FilesystemStoragePool(Service):
 
     def enumerate(self):
         if self._root.isdir():
+            # Hidden directories hold snapshots, not filesystems.
             return succeed({
                 DirectoryFilesystem(path=path)
-                for path in self._root.children()})
+                for path in self._root.children()
+                if not path.basename().startswith(b".")})
         return succeed(set())
@@ -7,6 +7,7 @@ ZFS APIs.
 from __future__ import absolute_import
 
 import os
+from sys import exc_info
 from contextlib import contextmanager
 from uuid import uuid4
 from subprocess import (
@@ -131,6 +132,38 @@ def _sync_command_error_squashed(arguments, logger):
         message.write(logger)
 
 
+def _dataset_exists(dataset):
+    """
+    Synchronously determine whether a ZFS dataset exists locally.
+
+    :param bytes dataset: The full name of the dataset, e.g.
+        ``b"hpool/myfs"``.
+
+    :return: ``True`` if there is a dataset with this name, ``False``
+        otherwise.
+    """
+    try:
+        check_output([b"zfs", b"list", dataset], stderr=STDOUT)
+    except CalledProcessError:
+        return False
+    return True
+
+
+def _destroy_if_exists(dataset, logger):
+    """
+    Synchronously destroy a ZFS dataset, if it exists, logging any errors.
+
+    :param bytes dataset: The full name of the dataset, e.g.
+        ``b"hpool/myfs"``.
+
+    :param eliot.Logger logger: The log writer to use to log errors running the
+        zfs command.
+    """
+    if _dataset_exists(dataset):
+        _sync_command_error_squashed(
+            [b"zfs", b"destroy", b"-r", dataset], logger)
+
+
 @attributes(["name"])
 class Snapshot(object):
     """
@@ -174,6 +207,8 @@ class Filesystem(object):
     filesystem.  This will likely grow into a more sophisticiated
     implementation over time.
     """
+    logger = Logger()
+
     def __init__(self, pool, dataset, mountpoint=None, reactor=None):
         """
         :param pool: The filesystem's pool name, e.g. ``b"hpool"``.
@@ -198,11 +233,17 @@ class Filesystem(object):
         :return: ``True`` if there is a filesystem with this name, ``False``
             otherwise.
         """
-        try:
-            check_output([b"zfs", b"list", self.name], stderr=STDOUT)
-        except CalledProcessError:
-            return False
-        return True
+        return _dataset_exists(self.name)
+
+    def _mounted(self):
+        """
+        Determine whether this filesystem is currently mounted.
+
+        :return: ``True`` if it is mounted, ``False`` otherwise.
+        """
+        return check_output(
+            [b"zfs", b"get", b"-H", b"-o", b"value", b"mounted", self.name]
+        ).strip() == b"yes"
 
     def snapshots(self):
         if self._exists():
@@ -268,7 +309,9 @@ class Filesystem(object):
                 snapshot,
             ]
 
-        process = Popen([b"zfs", b"send"] + identifier, stdout=PIPE)
+        # -p includes the filesystem's properties in the stream so that
+        # storage tuning survives the volume moving to another node.
+        process = Popen([b"zfs", b"send", b"-p"] + identifier, stdout=PIPE)
         try:
             yield process.stdout
         finally:
@@ -279,7 +322,28 @@ class Filesystem(object):
     def writer(self):
         """
         Read in zfs stream.
+
+        A complete stream is received into a uniquely named staging dataset
+        which is only renamed to this filesystem's name once the whole stream
+        has been received, so an aborted receive never leaves a half-written
+        filesystem behind and concurrent receives of the same volume cannot
+        both succeed.
+
+        The staging dataset is received unmounted and is only mounted once it
+        has been renamed, so concurrent receives never contend for this
+        filesystem's mountpoint.
+
+        :raise FilesystemAlreadyExists: If a concurrent receive created this
+            filesystem while the complete stream was being received.
         """
+        # The stream carries the sender's properties, including its
+        # mountpoint which may well be in use on this node, so override that
+        # during the receive.  The sender owns the volume, so its filesystem
+        # is writeable and the stream says readonly=off; received filesystems
+        # are remotely owned and so must inherit readonly from the pool,
+        # hence -x.
+        options = [b"-o", b"mountpoint=" + self._mountpoint.path,
+                   b"-x", b"readonly"]
         if self._exists():
             # If the filesystem already exists then this should be an
             # incremental data stream to up date it to a more recent snapshot.
@@ -289,33 +353,49 @@ class Filesystem(object):
             # a hack.  When we replace this mechanism with a proper API we
             # should make it include that information.
             #
-            # -e means "if the stream says it is for foo/bar/baz then receive
-            # into baz".  I don't know why self.name is also required,
-            # then. XXX try -d self.pool instead. XXX it works without -e w/
-            # self.name too. XXX Delete this paragraph if we go ahead with just
-            # `-F` in the implementation.
-            #
             # -F means force.  If the stream is based on not-quite-the-latest
             # snapshot then we have to throw away all the snapshots newer than
             # it in order to receive the stream.  To do that you have to
             # force.
             #
-            cmd = [b"zfs", b"receive", b"-F", self.name]
+            # An incremental stream can only be applied to a filesystem which
+            # has its base snapshot, so it can't be staged elsewhere.  ZFS
+            # already receives it into a hidden clone and only switches the
+            # filesystem over once the stream is complete, though, so this is
+            # just as atomic.
+            staging = None
+            cmd = [b"zfs", b"receive", b"-F"] + options + [self.name]
         else:
             # If the filesystem doesn't already exist then this is a complete
-            # data stream.
-            cmd = [b"zfs", b"receive", self.name]
+            # data stream.  The staging name has no "." in it so it is never
+            # mistaken for a volume by ``VolumeService.enumerate``.  -u keeps
+            # it unmounted until it has been renamed into place.
+            staging = b"%s/receive-%s" % (self.pool, uuid4())
+            cmd = [b"zfs", b"receive", b"-u"] + options + [staging]
         process = Popen(cmd, stdin=PIPE)
-        succeeded = False
+        aborted = True
         try:
             yield process.stdin
+            aborted = False
         finally:
             process.stdin.close()
-            succeeded = not process.wait()
-        if succeeded:
-            check_call([b"zfs", b"set",
-                        b"mountpoint=" + self._mountpoint.path,
-                        self.name])
+            succeeded = not process.wait() and not aborted
+            if staging is not None and not succeeded:
+                _destroy_if_exists(staging, self.logger)
+        if staging is not None and succeeded:
+            try:
+                check_output([b"zfs", b"rename", staging, self.name],
+                             stderr=STDOUT)
+            except CalledProcessError:
+                # Keep hold of the error: the checks below run commands of
+                # their own, which would clobber it for a bare ``raise``.
+                error = exc_info()
+                _destroy_if_exists(staging, self.logger)
+                if self._exists():
+                    raise FilesystemAlreadyExists()
+                raise error[0], error[1], error[2]
+            if not self._mounted():
+                check_output([b"zfs", b"mount", self.name], stderr=STDOUT)
 
 
 @implementer(IFilesystemSnapshots)
@@ -412,6 +492,56 @@ def _list_snapshots(reactor, filesystem):
     return d
 
 
+# Properties which ``StoragePool`` sets itself based on the owner and name of
+# a volume, rather than copying them from other filesystems:
+_MANAGED_PROPERTIES = frozenset({b"mountpoint", b"readonly"})
+
+
+def _property_arguments(properties):
+    """
+    Construct ``zfs create`` or ``zfs clone`` arguments which set the given
+    properties on the new filesystem.
+
+    :param properties: An iterable of (name, value) ``tuple``\ s.
+
+    :return list: ``bytes`` arguments to pass to ``zfs``.
+    """
+    arguments = []
+    for name, value in sorted(properties):
+        arguments.extend([
+            b"-o", u"{}={}".format(name, value).encode("ascii")])
+    return arguments
+
+
+def _list_local_properties(reactor, filesystem):
+    """
+    Retrieve the properties which have been set directly on a filesystem,
+    rather than inherited or defaulted, excluding those ``StoragePool``
+    manages itself.
+
+    :param IReactorProcess reactor: The reactor to use to launch the ``zfs``
+        child process.
+
+    :param Filesystem filesystem: The filesystem whose properties to
+        retrieve.
+
+    :return: A ``Deferred`` which fires with a ``list`` of (name, value)
+        ``tuple``\ s of ``bytes``.
+    """
+    d = zfs_command(reactor, [b"get", b"-H", b"-o", b"property,value",
+                              b"-s", b"local", b"all", filesystem.name])
+
+    def parse(output):
+        result = []
+        for line in output.splitlines():
+            name, value = line.split(b"\t", 1)
+            if name not in _MANAGED_PROPERTIES:
+                result.append((name, value))
+        return result
+    d.addCallback(parse)
+    return d
+
+
 def volume_to_dataset(volume):
     """Convert a volume to a dataset name.
 
@@ -480,30 +610,44 @@ class StoragePool(Service):
         _sync_command_error_squashed(
             [b"zfs", b"set", b"canmount=off", self._name], self.logger)
 
-    def create(self, volume):
+    def create(self, volume, properties=frozenset()):
         filesystem = self.get(volume)
         mount_path = filesystem.get_path().path
-        properties = [b"-o", b"mountpoint=" + mount_path]
+        arguments = _property_arguments(properties)
+        arguments.extend([b"-o", b"mountpoint=" + mount_path])
         if volume.locally_owned():
-            properties.extend([b"-o", b"readonly=off"])
+            arguments.extend([b"-o", b"readonly=off"])
         d = zfs_command(self._reactor,
-                        [b"create"] + properties + [filesystem.name])
+                        [b"create"] + arguments + [filesystem.name])
         d.addCallback(lambda _: filesystem)
         return d
 
-    def clone_to(self, parent, volume):
+    def clone_to(self, parent, volume, properties=frozenset()):
         parent_filesystem = self.get(parent)
         new_filesystem = self.get(volume)
         zfs_snapshots = ZFSSnapshots(self._reactor, parent_filesystem)
         snapshot_name = bytes(uuid4())
         d = zfs_snapshots.create(snapshot_name)
-        clone_command = [b"clone",
-                         # Snapshot we're cloning from:
-                         b"%s@%s" % (parent_filesystem.name, snapshot_name),
-                         # New filesystem we're cloning to:
-                         new_filesystem.name,
-                         ]
-        d.addCallback(lambda _: zfs_command(self._reactor, clone_command))
+        # A clone inherits its properties from its parent dataset (the
+        # pool), not from its origin, so copy the origin's properties over
+        # explicitly.
+        d.addCallback(lambda _: _list_local_properties(
+            self._reactor, parent_filesystem))
+
+        def got_properties(parent_properties):
+            clone_properties = dict(parent_properties)
+            clone_properties.update(properties)
+            clone_command = (
+                [b"clone"] +
+                _property_arguments(clone_properties.items()) +
+                [
+                    # Snapshot we're cloning from:
+                    b"%s@%s" % (parent_filesystem.name, snapshot_name),
+                    # New filesystem we're cloning to:
+                    new_filesystem.name,
+                ])
+            return zfs_command(self._reactor, clone_command)
+        d.addCallback(got_properties)
         self._created(d, volume)
         d.addCallback(lambda _: new_filesystem)
         return d
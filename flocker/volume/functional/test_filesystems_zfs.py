@@ -25,6 +25,7 @@ from ..filesystems.zfs import (
     Snapshot, ZFSSnapshots, Filesystem, StoragePool, volume_to_dataset,
     zfs_command,
 )
+from ..filesystems.interfaces import FilesystemAlreadyExists
 from ..service import Volume, VolumeName
 from ..testtools import create_zfs_pool, service_for_pool
 
@@ -332,6 +333,151 @@ class StoragePoolTests(TestCase):
         d.addCallback(got_volumes)
         return d
 
+    def assertRecordSize(self, filesystem, expected):
+        """
+        Assert the ``recordsize`` property of a filesystem has the given
+        value.
+
+        :param Filesystem filesystem: The filesystem to inspect.
+        :param bytes expected: The expected value.
+        """
+        self.assertEqual(
+            expected,
+            subprocess.check_output(
+                [b"zfs", b"get", b"-H", b"-o", b"value",
+                 b"recordsize", filesystem.name]).strip())
+
+    def test_created_properties(self):
+        """
+        A filesystem created with storage properties has those properties.
+        """
+        pool = build_pool(self)
+        service = service_for_pool(self, pool)
+        volume = service.get(MY_VOLUME)
+
+        d = pool.create(volume, frozenset([(b"recordsize", b"8K")]))
+        d.addCallback(self.assertRecordSize, b"8K")
+        return d
+
+    def test_cloned_properties(self):
+        """
+        A filesystem cloned from one with storage properties has the same
+        properties.
+        """
+        pool = build_pool(self)
+        service = service_for_pool(self, pool)
+        parent = service.get(MY_VOLUME2)
+        volume = service.get(MY_VOLUME)
+
+        d = pool.create(parent, frozenset([(b"recordsize", b"8K")]))
+        d.addCallback(lambda _: pool.clone_to(parent, volume))
+        d.addCallback(self.assertRecordSize, b"8K")
+        return d
+
+    def test_written_properties(self):
+        """
+        A filesystem which is received from a remote filesystem has the
+        storage properties of the remote filesystem.
+        """
+        d = create_and_copy(self, build_pool)
+
+        def got_volumes(copied):
+            from_filesystem = copied.from_volume.get_filesystem()
+            subprocess.check_call([b"zfs", b"set", b"recordsize=8K",
+                                   from_filesystem.name])
+            copying = copy(copied.from_volume, copied.to_volume)
+            copying.addCallback(
+                lambda _: self.assertRecordSize(
+                    copied.to_volume.get_filesystem(), b"8K"))
+            return copying
+        d.addCallback(got_volumes)
+        return d
+
+
+class StagedReceiveTests(TestCase):
+    """
+    Tests for receiving complete streams into a staging dataset.
+    """
+    def setUp(self):
+        self.from_pool = build_pool(self)
+        from_service = service_for_pool(self, self.from_pool)
+        self.from_volume = from_service.get(MY_VOLUME)
+        self.to_pool = build_pool(self)
+        to_service = service_for_pool(self, self.to_pool)
+        self.to_volume = Volume(uuid=from_service.uuid, name=MY_VOLUME,
+                                service=to_service)
+        return self.from_pool.create(self.from_volume)
+
+    def list_datasets(self):
+        """
+        :return: ``list`` of the names of all datasets in the receiving
+            pool, including any staging datasets.
+        """
+        return subprocess.check_output(
+            [b"zfs", b"list", b"-H", b"-o", b"name", b"-r",
+             self.to_pool._name]).split()
+
+    def test_aborted_receive_leaves_nothing(self):
+        """
+        If an exception is raised in the context of the writer for a
+        complete stream, neither the target filesystem nor the staging
+        dataset exists afterwards.
+        """
+        from_filesystem = self.from_volume.get_filesystem()
+        to_filesystem = self.to_volume.get_filesystem()
+        try:
+            with from_filesystem.reader() as reader:
+                with to_filesystem.writer() as writer:
+                    writer.write(reader.read())
+                    raise ZeroDivisionError()
+        except ZeroDivisionError:
+            pass
+        self.assertEqual([self.to_pool._name], self.list_datasets())
+
+    def test_staging_unmounted(self):
+        """
+        The staging dataset is not mounted while the stream is received, and
+        the received filesystem is mounted at its mountpoint once it has been
+        renamed into place.
+        """
+        from_filesystem = self.from_volume.get_filesystem()
+        from_filesystem.get_path().child(b"file").setContent(b"sent")
+        to_filesystem = self.to_volume.get_filesystem()
+        with from_filesystem.reader() as reader:
+            with to_filesystem.writer() as writer:
+                writer.write(reader.read())
+                mounted_during = subprocess.check_output(
+                    [b"zfs", b"list", b"-H", b"-o", b"name,mounted", b"-r",
+                     self.to_pool._name]).splitlines()
+        staging_mounted = [
+            line for line in mounted_during
+            if not line.startswith(self.to_pool._name + b"\t")
+            and line.endswith(b"\tyes")]
+        self.assertEqual(
+            ([], b"sent"),
+            (staging_mounted,
+             to_filesystem.get_path().child(b"file").getContent()))
+
+    def test_concurrently_created(self):
+        """
+        If the target filesystem is created while a complete stream is being
+        received, the writer raises ``FilesystemAlreadyExists``, leaves the
+        existing filesystem alone and cleans up the staging dataset.
+        """
+        from_filesystem = self.from_volume.get_filesystem()
+        from_filesystem.get_path().child(b"file").setContent(b"sent")
+        to_filesystem = self.to_volume.get_filesystem()
+
+        def receive():
+            with from_filesystem.reader() as reader:
+                with to_filesystem.writer() as writer:
+                    writer.write(reader.read())
+                    subprocess.check_call(
+                        [b"zfs", b"create", to_filesystem.name])
+        self.assertRaises(FilesystemAlreadyExists, receive)
+        self.assertEqual([self.to_pool._name, to_filesystem.name],
+                         self.list_datasets())
+
 
 class IncrementalPushTests(TestCase):
     """
@@ -124,15 +124,18 @@ class VolumeService(Service):
         self.uuid = config[u"uuid"]
         self.pool.startService()
 
-    def create(self, name):
+    def create(self, name, properties=frozenset()):
         """Create a new volume.
 
         :param VolumeName name: The name of the volume.
 
+        :param frozenset properties: Storage properties to apply to the
+            volume's filesystem, as (name, value) ``tuple``\ s.
+
         :return: A ``Deferred`` that fires with a :class:`Volume`.
         """
         volume = Volume(uuid=self.uuid, name=name, service=self)
-        d = self.pool.create(volume)
+        d = self.pool.create(volume, properties)
 
         def created(filesystem):
             self._make_public(filesystem)
@@ -140,7 +143,7 @@ class VolumeService(Service):
         d.addCallback(created)
         return d
 
-    def clone_to(self, parent, name):
+    def clone_to(self, parent, name, properties=frozenset()):
         """
         Clone a parent ``Volume`` to create a new one.
 
@@ -148,10 +151,14 @@ class VolumeService(Service):
 
         :param VolumeName name: The name of the volume to clone to.
 
+        :param frozenset properties: Storage properties to apply to the new
+            volume's filesystem in addition to those of the parent, as
+            (name, value) ``tuple``\ s.
+
         :return: A ``Deferred`` that fires with a :class:`Volume`.
         """
         volume = self.get(name)
-        d = self.pool.clone_to(parent, volume)
+        d = self.pool.clone_to(parent, volume, properties)
 
         def created(filesystem):
             self._make_public(filesystem)
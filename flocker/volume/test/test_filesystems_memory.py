@@ -6,6 +6,10 @@ Tests for :module:`flocker.filesystems.memory`.
 
 from __future__ import absolute_import
 
+import os
+from io import BytesIO
+from tarfile import TarFile
+
 from twisted.internet.defer import succeed, fail
 from twisted.trial.unittest import SynchronousTestCase
 from twisted.python.filepath import FilePath
@@ -14,8 +18,14 @@ from .filesystemtests import (
     make_ifilesystemsnapshots_tests, make_istoragepool_tests,
     )
 from ..filesystems.memory import (
-    CannedFilesystemSnapshots, FilesystemStoragePool,
+    CannedFilesystemSnapshots, DirectoryFilesystem, FilesystemStoragePool,
     )
+from ..filesystems.zfs import Snapshot
+from ..service import Volume, VolumeName
+from ..testtools import service_for_pool
+
+
+MY_VOLUME = VolumeName(namespace=u"myns", id=u"myvolume")
 
 
 class IFilesystemSnapshotsTests(make_ifilesystemsnapshots_tests(
@@ -50,3 +60,199 @@ class IStoragePoolTests(make_istoragepool_tests(
     lambda test_case:
         FilesystemStoragePool(FilePath(test_case.mktemp())))):
     """``IStoragePoolTests`` for fake storage pool."""
+
+
+class DirectoryFilesystemTests(SynchronousTestCase):
+    """
+    Additional tests for ``DirectoryFilesystem``.
+    """
+    def setUp(self):
+        self.root = FilePath(self.mktemp())
+        self.root.makedirs()
+        self.source = DirectoryFilesystem(path=self.root.child(b"source"))
+        self.source.get_path().makedirs()
+        self.source.get_path().child(b"file").setContent(b"original")
+        self.source.get_path().child(b"other").setContent(b"unchanged")
+        self.target = DirectoryFilesystem(path=self.root.child(b"target"))
+
+    def copy(self):
+        """
+        Copy the source filesystem to the target filesystem, incrementally
+        if possible.
+
+        :return: The ``list`` of names of the members of the tarball.
+        """
+        snapshots = self.successResultOf(self.target.snapshots())
+        data = BytesIO()
+        with self.source.reader(snapshots) as reader:
+            with self.target.writer() as writer:
+                for chunk in iter(lambda: reader.read(100), b""):
+                    data.write(chunk)
+                    writer.write(chunk)
+        data.seek(0, 0)
+        return TarFile(fileobj=data, mode="r").getnames()
+
+    def test_failed_write_cleans_up(self):
+        """
+        If the written data can't be extracted, the staging directory it was
+        being extracted into is removed and the filesystem is unchanged.
+        """
+        with self.source.writer() as writer:
+            writer.write(b"NOT A REAL THING")
+        self.assertEqual(
+            ([], b"original"),
+            (self.source._snapshot_directory().children(),
+             self.source.get_path().child(b"file").getContent()))
+
+    def test_write_replaces_contents(self):
+        """
+        A complete tarball written to the filesystem replaces its contents.
+        """
+        self.target.get_path().makedirs()
+        self.target.get_path().child(b"old").setContent(b"old")
+        self.copy()
+        self.assertEqual([b"file", b"other"],
+                         sorted(self.target.get_path().listdir()))
+
+    def test_snapshot_links_unchanged(self):
+        """
+        Files which haven't changed since the previous snapshot are hard
+        links to that snapshot's copy.
+        """
+        self.source.snapshot(b"first")
+        self.source.snapshot(b"second")
+        first, second = self.successResultOf(self.source.snapshots())
+        self.assertEqual(
+            os.stat(self.source._tree(first).child(b"file").path).st_ino,
+            os.stat(self.source._tree(second).child(b"file").path).st_ino)
+
+    def test_snapshot_unaffected_by_changes(self):
+        """
+        Changing a file in place after a snapshot is taken doesn't change the
+        snapshot's copy.
+        """
+        self.source.snapshot(b"first")
+        with self.source.get_path().child(b"file").open("w") as f:
+            f.write(b"changed")
+        [first] = self.successResultOf(self.source.snapshots())
+        self.assertEqual(
+            b"original", self.source._tree(first).child(b"file").getContent())
+
+    def test_incremental_only_changes(self):
+        """
+        A tarball based on a snapshot the receiver has only includes files
+        which changed since then, and updates the receiver to match.
+        """
+        self.copy()
+        self.source.get_path().child(b"file").setContent(b"changed")
+        names = self.copy()
+        self.assertEqual(
+            ([b"snapshot", b"base", b"deleted", b"data", b"data/file"],
+             b"changed"),
+            (names, self.target.get_path().child(b"file").getContent()))
+
+    def test_incremental_deletes(self):
+        """
+        Files which were removed since the snapshot an incremental tarball is
+        based on are removed by the receiver.
+        """
+        self.copy()
+        self.source.get_path().child(b"file").remove()
+        self.copy()
+        self.assertEqual([b"other"], self.target.get_path().listdir())
+
+    def test_incremental_reverts_receiver_changes(self):
+        """
+        Changes made by the receiver since the snapshot an incremental
+        tarball is based on are discarded.
+        """
+        self.copy()
+        self.target.get_path().child(b"other").setContent(b"local change")
+        self.target.get_path().child(b"extra").setContent(b"local file")
+        self.source.get_path().child(b"file").setContent(b"changed")
+        self.copy()
+        self.assertEqual(
+            ([b"file", b"other"], b"unchanged"),
+            (sorted(self.target.get_path().listdir()),
+             self.target.get_path().child(b"other").getContent()))
+
+    def test_old_snapshots_removed(self):
+        """
+        Once a tarball has been sent and received, only the snapshot it
+        contained is kept by either filesystem, and the trees of older
+        snapshots are deleted.
+        """
+        self.copy()
+        [first] = self.successResultOf(self.source.snapshots())
+        self.source.get_path().child(b"file").setContent(b"changed")
+        self.copy()
+        source_snapshots = self.successResultOf(self.source.snapshots())
+        self.assertEqual(
+            (1, source_snapshots, False, False),
+            (len(source_snapshots),
+             self.successResultOf(self.target.snapshots()),
+             self.source._tree(first).exists(),
+             self.target._tree(first).exists()))
+
+    def test_failed_read_keeps_snapshots(self):
+        """
+        If the tarball isn't read successfully, no snapshots are deleted.
+        """
+        self.source.snapshot(b"base")
+        try:
+            with self.source.reader():
+                raise ZeroDivisionError()
+        except ZeroDivisionError:
+            pass
+        self.assertEqual(
+            (2, True),
+            (len(self.successResultOf(self.source.snapshots())),
+             self.source._tree(Snapshot(name=b"base")).exists()))
+
+    def test_incremental_missing_base(self):
+        """
+        An incremental tarball based on a snapshot the receiver doesn't have
+        makes no changes to it.
+        """
+        self.source.snapshot(b"base")
+        self.target.get_path().makedirs()
+        with self.source.reader([Snapshot(name=b"base")]) as reader:
+            with self.target.writer() as writer:
+                writer.write(reader.read())
+        self.assertEqual(
+            ([], []),
+            (self.target.get_path().listdir(),
+             self.successResultOf(self.target.snapshots())))
+
+
+class FilesystemStoragePoolTests(SynchronousTestCase):
+    """
+    Additional tests for ``FilesystemStoragePool``.
+    """
+    def setUp(self):
+        self.pool = FilesystemStoragePool(FilePath(self.mktemp()))
+        self.service = service_for_pool(self, self.pool)
+        self.volume = Volume(uuid=self.service.uuid, name=MY_VOLUME,
+                             service=self.service)
+
+    def test_enumerate_ignores_snapshots(self):
+        """
+        The directories holding snapshots are not enumerated as filesystems.
+        """
+        filesystem = self.successResultOf(self.pool.create(self.volume))
+        filesystem.snapshot(b"snap")
+        self.assertEqual({filesystem},
+                         self.successResultOf(self.pool.enumerate()))
+
+    def test_change_owner_keeps_snapshots(self):
+        """
+        A filesystem whose owner changes keeps its snapshots.
+        """
+        filesystem = self.successResultOf(self.pool.create(self.volume))
+        filesystem.snapshot(b"snap")
+        new_volume = Volume(uuid=u"other-uuid", name=MY_VOLUME,
+                            service=self.service)
+        new_filesystem = self.successResultOf(
+            self.pool.change_owner(self.volume, new_volume))
+        self.assertEqual([Snapshot(name=b"snap")],
+                         self.successResultOf(new_filesystem.snapshots()))
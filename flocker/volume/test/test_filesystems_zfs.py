@@ -15,13 +15,17 @@ from twisted.python.failure import Failure
 from eliot import Logger
 from eliot.testing import LoggedMessage, validateLogging, assertContainsFields
 
+from twisted.python.filepath import FilePath
+
 from ...testtools import FakeProcessReactor
 
 from ..filesystems.zfs import (
     zfs_command, CommandFailed, BadArguments, Filesystem, ZFSSnapshots,
     _sync_command_error_squashed, _latest_common_snapshot, ZFS_ERROR,
-    Snapshot,
+    Snapshot, StoragePool,
 )
+from ..service import Volume, VolumeName
+from ..testtools import create_volume_service
 
 
 class FilesystemTests(SynchronousTestCase):
@@ -325,3 +329,67 @@ class LatestCommonSnapshotTests(SynchronousTestCase):
         b = Snapshot(name=b"b")
         self.assertEqual(
             b, _latest_common_snapshot([a, b], [a, b]))
+
+
+class StoragePoolPropertiesTests(SynchronousTestCase):
+    """
+    Tests for the handling of storage properties by ``StoragePool``.
+    """
+    def setUp(self):
+        self.reactor = FakeProcessReactor()
+        self.pool = StoragePool(self.reactor, b"mypool", FilePath(b"/flocker"))
+        self.service = create_volume_service(self)
+
+    def finish(self, index, output=b""):
+        """
+        Make one of the ``zfs`` processes spawned so far exit successfully.
+
+        :param int index: The index of the process to finish.
+        :param bytes output: The output for the process to produce.
+        """
+        process_protocol = self.reactor.processes[index].processProtocol
+        process_protocol.childDataReceived(1, output)
+        process_protocol.processEnded(Failure(ProcessDone(0)))
+
+    def test_create(self):
+        """
+        ``StoragePool.create`` passes the given properties to ``zfs create``.
+        """
+        volume = self.service.get(VolumeName(namespace=u"ns", id=u"vol"))
+        self.pool.create(
+            volume, frozenset([(u"recordsize", u"8k"),
+                               (u"compression", u"lz4")]))
+        filesystem = self.pool.get(volume)
+        self.assertEqual(
+            self.reactor.processes[0].args,
+            [b"zfs", b"create",
+             b"-o", b"compression=lz4", b"-o", b"recordsize=8k",
+             b"-o", b"mountpoint=" + filesystem.get_path().path,
+             b"-o", b"readonly=off",
+             filesystem.name])
+
+    def test_clone_to(self):
+        """
+        ``StoragePool.clone_to`` passes the locally set properties of the
+        parent filesystem, other than those managed by the pool itself,
+        along with the given properties to ``zfs clone``.
+        """
+        parent = self.service.get(VolumeName(namespace=u"ns", id=u"parent"))
+        volume = Volume(uuid=u"other", name=VolumeName(
+            namespace=u"ns", id=u"clone"), service=self.service)
+        self.pool.clone_to(parent, volume, frozenset([(u"atime", u"off")]))
+        self.finish(0)
+        parent_filesystem = self.pool.get(parent)
+        self.assertEqual(
+            self.reactor.processes[1].args,
+            [b"zfs", b"get", b"-H", b"-o", b"property,value",
+             b"-s", b"local", b"all", parent_filesystem.name])
+        self.finish(
+            1, b"recordsize\t8K\nmountpoint\t/flocker/x\n"
+               b"readonly\toff\natime\ton\n")
+        arguments = self.reactor.processes[2].args
+        snapshot = arguments[-2]
+        self.assertEqual(
+            (arguments, snapshot.startswith(parent_filesystem.name + b"@")),
+            ([b"zfs", b"clone", b"-o", b"atime=off", b"-o", b"recordsize=8K",
+              snapshot, self.pool.get(volume).name], True))
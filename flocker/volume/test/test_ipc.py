@@ -275,7 +275,7 @@ class LocalVolumeManagerInterfaceTests(
     def test_snapshots(self):
         """
         ``LocalVolumeManager.snapshots`` returns a ``Deferred`` that fires with
-        ``[]`` because ``DirectoryFilesystem`` does not support snapshots.
+        ``[]`` because no snapshots of the new volume have been taken.
         """
         pair = create_local_servicepair(self)
         volume = self.successResultOf(pair.from_service.create(MY_VOLUME))
@@ -0,0 +1,264 @@
+# Copyright Hybrid Logic Ltd.  See LICENSE file for details.
+
+"""
+Tests for :module:`flocker.volume.filesystems._tar`.
+"""
+
+from __future__ import absolute_import
+
+import os
+from io import BytesIO
+from tarfile import TarFile, TarInfo, ReadError, ExtractError
+
+from twisted.trial.unittest import SynchronousTestCase
+from twisted.python.filepath import FilePath
+
+from ..filesystems._tar import (
+    END_OF_ARCHIVE, ChunkReader, TarExtractor, tar_chunks, tree_members,
+)
+
+
+def populate(test_case):
+    """
+    Create a directory with a variety of contents to archive.
+
+    :param test_case: The test the directory is for.
+
+    :return: The ``FilePath`` of the directory.
+    """
+    root = FilePath(test_case.mktemp())
+    root.makedirs()
+    root.child(b"file").setContent(b"some bytes")
+    root.child(b"empty").setContent(b"")
+    subdirectory = root.child(b"directory").child(b"nested")
+    subdirectory.makedirs()
+    subdirectory.child(b"x" * 150).setContent(b"long name")
+    subdirectory.child(b"big").setContent(b"0123456789" * 10000)
+    os.chmod(root.child(b"file").path, 0600)
+    os.utime(root.child(b"file").path, (1234567, 1234567))
+    os.symlink(b"../file", root.child(b"directory").child(b"link").path)
+    os.link(root.child(b"file").path, root.child(b"hardlink").path)
+    return root
+
+
+def extract(test_case, chunks, chunk_size=None):
+    """
+    Extract a tar archive into a new directory.
+
+    :param test_case: The test the directory is for.
+    :param chunks: An iterable of ``bytes`` making up the archive.
+    :param chunk_size: If not ``None``, re-split the archive into writes of
+        this size.
+
+    :return: The ``FilePath`` of the directory.
+    """
+    root = FilePath(test_case.mktemp())
+    root.makedirs()
+    extractor = TarExtractor(root)
+    if chunk_size is None:
+        for chunk in chunks:
+            extractor.write(chunk)
+    else:
+        reader = ChunkReader(chunks)
+        for chunk in iter(lambda: reader.read(chunk_size), b""):
+            extractor.write(chunk)
+    extractor.close()
+    return root
+
+
+def archive_bytes(*members):
+    """
+    Create a tar archive using ``tarfile``.
+
+    :param members: ``(TarInfo, bytes)`` tuples to add to the archive.
+
+    :return: The archive as ``bytes``.
+    """
+    result = BytesIO()
+    archive = TarFile(fileobj=result, mode="w")
+    for tarinfo, content in members:
+        tarinfo.size = len(content)
+        archive.addfile(tarinfo, BytesIO(content))
+    archive.close()
+    return result.getvalue()
+
+
+class TarRoundTripTests(SynchronousTestCase):
+    """
+    Tests for extracting archives generated by ``tar_chunks`` with
+    ``TarExtractor``.
+    """
+    def assertCopied(self, source, destination):
+        """
+        Assert the contents of two directories are the same.
+        """
+        def contents(root):
+            result = {}
+            for path in root.walk(descend=lambda child: not child.islink()):
+                key = tuple(path.segmentsFrom(root)) if path != root else ()
+                if path.islink():
+                    value = (b"link", os.readlink(path.path))
+                elif path.isdir():
+                    value = (b"directory",)
+                else:
+                    value = (b"file", path.getContent())
+                result[key] = value
+            return result
+        self.assertEqual(contents(source), contents(destination))
+
+    def test_contents(self):
+        """
+        Files, directories and symbolic links archived by ``tar_chunks`` are
+        recreated by ``TarExtractor``.
+        """
+        source = populate(self)
+        destination = extract(self, tar_chunks(source))
+        self.assertCopied(source, destination)
+
+    def test_small_writes(self):
+        """
+        The archive can be written to ``TarExtractor`` in arbitrarily small
+        pieces.
+        """
+        source = populate(self)
+        destination = extract(self, tar_chunks(source), chunk_size=7)
+        self.assertCopied(source, destination)
+
+    def test_hard_links(self):
+        """
+        Files linked to from several places are still linked together after
+        extraction.
+        """
+        destination = extract(self, tar_chunks(populate(self)))
+        self.assertEqual(
+            os.stat(destination.child(b"file").path).st_ino,
+            os.stat(destination.child(b"hardlink").path).st_ino)
+
+    def test_attributes(self):
+        """
+        Permissions and modification times are preserved.
+        """
+        destination = extract(self, tar_chunks(populate(self)))
+        result = os.stat(destination.child(b"file").path)
+        self.assertEqual((0600, 1234567),
+                         (result.st_mode & 0777, result.st_mtime))
+
+    def test_bounded_chunks(self):
+        """
+        ``tar_chunks`` never generates a chunk larger than its chunk size,
+        however large the files being archived are.
+        """
+        source = populate(self)
+        self.assertEqual(
+            [], [len(chunk) for chunk in tar_chunks(source, chunk_size=4096)
+                 if len(chunk) > 4096])
+
+    def test_tarfile_compatible(self):
+        """
+        ``tar_chunks`` generates an archive which ``tarfile`` can read.
+        """
+        source = populate(self)
+        archive = TarFile(
+            fileobj=BytesIO(b"".join(tar_chunks(source))), mode="r")
+        self.assertEqual(
+            b"some bytes", archive.extractfile(b"file").read())
+
+
+class TreeMembersTests(SynchronousTestCase):
+    """
+    Tests for ``tree_members``.
+    """
+    def test_arcname_and_include(self):
+        """
+        With an ``arcname`` the directory itself is archived under that name
+        with its contents beneath it, and only entries accepted by
+        ``include`` are archived.
+        """
+        source = populate(self)
+        chunks = tree_members(
+            source, b"data",
+            include=lambda segments: segments[0] == b"directory")
+        archive = TarFile(
+            fileobj=BytesIO(b"".join(chunks) + END_OF_ARCHIVE), mode="r")
+        self.assertEqual(
+            [b"data", b"data/directory", b"data/directory/link",
+             b"data/directory/nested", b"data/directory/nested/big",
+             b"data/directory/nested/" + b"x" * 150],
+            sorted(archive.getnames()))
+
+
+class TarExtractorTests(SynchronousTestCase):
+    """
+    Tests for ``TarExtractor``.
+    """
+    def test_trailing_data(self):
+        """
+        Data written after the end of the archive is ignored.
+        """
+        source = populate(self)
+        destination = extract(self, [b"".join(tar_chunks(source)) + b"junk"])
+        self.assertEqual(b"some bytes",
+                         destination.child(b"file").getContent())
+
+    def test_garbage(self):
+        """
+        Writing garbage doesn't raise an exception, but ``close`` raises
+        ``ReadError``.
+        """
+        extractor = TarExtractor(FilePath(self.mktemp()))
+        extractor.write(b"NOT A REAL THING" * 100)
+        self.assertRaises(ReadError, extractor.close)
+
+    def test_truncated(self):
+        """
+        If the archive ends early ``close`` raises ``ReadError``.
+        """
+        root = FilePath(self.mktemp())
+        root.makedirs()
+        extractor = TarExtractor(root)
+        extractor.write(b"".join(tar_chunks(populate(self)))[:-2048])
+        self.assertRaises(ReadError, extractor.close)
+
+    def test_unsafe_name(self):
+        """
+        A member which would be extracted outside the directory causes
+        ``close`` to raise ``ExtractError``, and isn't extracted.
+        """
+        base = FilePath(self.mktemp())
+        root = base.child(b"root")
+        root.makedirs()
+        extractor = TarExtractor(root)
+        extractor.write(archive_bytes((TarInfo(b"../escaped"), b"data")))
+        self.assertRaises(ExtractError, extractor.close)
+        self.assertFalse(base.child(b"escaped").exists())
+
+
+class ChunkReaderTests(SynchronousTestCase):
+    """
+    Tests for ``ChunkReader``.
+    """
+    def test_read_size(self):
+        """
+        ``ChunkReader.read`` returns at most the requested number of bytes,
+        regardless of how the underlying chunks are split.
+        """
+        reader = ChunkReader([b"ab", b"cde", b"", b"f"])
+        self.assertEqual(
+            [b"abc", b"def", b""],
+            [reader.read(3), reader.read(3), reader.read(3)])
+
+    def test_read_all(self):
+        """
+        ``ChunkReader.read`` with no size returns everything remaining.
+        """
+        reader = ChunkReader([b"ab", b"cde", b"f"])
+        self.assertEqual([b"a", b"bcdef"], [reader.read(1), reader.read()])
+
+    def test_lazy(self):
+        """
+        ``ChunkReader.read`` only consumes as many chunks as it needs.
+        """
+        chunks = iter([b"ab", b"cd", b"ef"])
+        reader = ChunkReader(chunks)
+        reader.read(3)
+        self.assertEqual([b"ef"], list(chunks))
@@ -0,0 +1,80 @@
+# Copyright Hybrid Logic Ltd.  See LICENSE file for details.
+
+"""
+Tests for :module:`flocker.volume.filesystems._tree`.
+"""
+
+from __future__ import absolute_import
+
+import os
+from errno import EOPNOTSUPP, EIO
+
+from twisted.trial.unittest import SynchronousTestCase
+from twisted.python.filepath import FilePath
+
+from ..filesystems import _tree
+from ..filesystems._tree import FICLONE, copy_file
+
+
+class CopyFileTests(SynchronousTestCase):
+    """
+    Tests for ``copy_file``.
+    """
+    def setUp(self):
+        root = FilePath(self.mktemp())
+        root.makedirs()
+        self.source = root.child(b"source")
+        self.source.setContent(b"some bytes")
+        os.chmod(self.source.path, 0640)
+        os.utime(self.source.path, (1234567, 1234567))
+        self.destination = root.child(b"destination")
+
+    def test_reflink(self):
+        """
+        ``copy_file`` asks the filesystem to make the copy a reflink of the
+        original.
+        """
+        calls = []
+
+        def ioctl(fd, request, arg):
+            calls.append((os.fstat(fd).st_ino, request, os.fstat(arg).st_ino))
+        self.patch(_tree, "ioctl", ioctl)
+        copy_file(self.source, self.destination)
+        self.assertEqual(
+            [(os.stat(self.destination.path).st_ino, FICLONE,
+              os.stat(self.source.path).st_ino)], calls)
+
+    def test_reflink_unsupported(self):
+        """
+        If the filesystem doesn't support reflinks, ``copy_file`` copies the
+        contents, permissions and modification time.
+        """
+        def ioctl(fd, request, arg):
+            raise IOError(EOPNOTSUPP, os.strerror(EOPNOTSUPP))
+        self.patch(_tree, "ioctl", ioctl)
+        copy_file(self.source, self.destination)
+        result = os.stat(self.destination.path)
+        self.assertEqual(
+            (b"some bytes", 0640, 1234567),
+            (self.destination.getContent(), result.st_mode & 0777,
+             result.st_mtime))
+
+    def test_reflink_error(self):
+        """
+        Errors making a reflink other than the filesystem not supporting them
+        are raised.
+        """
+        def ioctl(fd, request, arg):
+            raise IOError(EIO, os.strerror(EIO))
+        self.patch(_tree, "ioctl", ioctl)
+        exception = self.assertRaises(
+            IOError, copy_file, self.source, self.destination)
+        self.assertEqual(EIO, exception.errno)
+
+    def test_copy(self):
+        """
+        ``copy_file`` copies the file whether or not the filesystem the tests
+        are running on supports reflinks.
+        """
+        copy_file(self.source, self.destination)
+        self.assertEqual(b"some bytes", self.destination.getContent())